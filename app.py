@@ -1,9 +1,12 @@
 import asyncio
 import copy
-from datetime import date
+import hmac
+from datetime import date, timedelta
 import logging
 import os
 import re
+import time
+import unicodedata
 from threading import Thread
 from multiprocessing import Manager
 import json
@@ -22,16 +25,39 @@ from data_extractor import (
     extract_structured_data,
     transcribe_audio,
 )
-from supabase_client import (
+from storage import (
+    StockVersionConflict,
+    get_daily_rollups,
     get_daily_sales_summary,
+    get_period_summary,
+    get_item_sales,
+    search_item_history,
     get_low_stock_items,
+    get_low_stock_items_by_user,
+    get_owner_low_stock_items,
+    get_owner_rollup,
+    get_owner_shops,
+    link_owner_shop,
+    unlink_owner_shop,
+    get_stock_cache_stats,
     get_stock_levels,
+    invalidate_stock_cache,
     get_user_transactions_summary,
-    save_transaction,
-    supabase,
-    update_stock_item,
-    get_all_unique_user_ids_with_stock,
+    ensure_transaction_partitions,
+    archive_horizon,
+    archive_old_transactions,
+    recompute_daily_rollups,
+    reconcile_shop_balances,
+    record_writes,
+    start_write_behind_ledger,
+    take_stock_snapshots,
+    iter_active_shops,
+    update_shop,
 )
+from bill_hash_index import bill_hash_index, compute_bill_hashes
+from ledger_export import EXPORT_DIR, EXPORT_TTL_HOURS, export_shop_ledger
+from khata_import import import_khata_file, stage_import_file
+from sender_prefetch import get_prefetched_price_memory, get_prefetched_shop, get_prefetched_stock_levels, start_sender_prefetch
 from weather_events_api import get_weather_forecast, get_festivals_from_llm
 
 # FFmpeg path configuration
@@ -69,6 +95,19 @@ TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER") # Twilio Voice enabled nu
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OMNIDIM_AGENT_ID = os.getenv("OMNIDIM_AGENT_ID") 
 OMNIDIM_AGENT_ID = os.getenv("OMNIDIM_FROM_NUMBER")# OmniDimension Agent ID
+MAX_CONCURRENT_MEDIA_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_MEDIA_DOWNLOADS", "3")) # Bounds parallel downloads/extractions per message
+
+# Bill photos that look like an already processed bill wait here until the shopkeeper confirms them.
+# In a production environment, this would be stored in a database.
+PENDING_DUPLICATE_BILLS = {}
+PENDING_DUPLICATE_BILL_TTL_SECONDS = 600
+DUPLICATE_BILL_CONFIRM_KEYWORDS = ["yes", "haan", "han", "ha", "हाँ", "हां", "confirm", "process"]
+DUPLICATE_BILL_REJECT_KEYWORDS = ["no", "nahi", "nahin", "नहीं", "cancel"]
+
+# Stock-takes in progress: the counts received so far and the adjustments last shown for confirmation.
+# In a production environment, this would be stored in a database.
+PENDING_STOCK_TAKES = {}
+STOCK_TAKE_TTL_SECONDS = 3600
 
 twilio_client = twilio.rest.Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
 
@@ -120,7 +159,54 @@ MESSAGES = {
         "call_initiated": "Initiating call to {supplier_name} at {supplier_phone_number} for {quantity} {unit} of {item_name}. I will notify you once the order is confirmed.",
         "order_confirmation_prompt": "Which item and supplier would you like to confirm an order for? Example: 'Order 10 kg rice from Supplier A'.",
         "order_confirmed_shopkeeper": "✅ Order for {quantity} {unit} of {item_name} from {supplier_name} confirmed. Expect delivery in 2 days.",
-        "order_failed_shopkeeper": "❌ Failed to confirm order for {item_name} from {supplier_name}. Reason: {reason}"
+        "order_failed_shopkeeper": "❌ Failed to confirm order for {item_name} from {supplier_name}. Reason: {reason}",
+        "duplicate_bill_prompt": "⚠️ {count} of these bill photos look like a bill you already sent. Reply 'yes' to add the stock again, or 'no' to skip.",
+        "duplicate_bill_discarded": "👍 Skipped the repeated bill. Your stock was not changed.",
+        "partial_transcription": "⚠️ Part of your long voice note ({failed_chunks} pieces) could not be understood. Please check the entries below and resend anything that is missing.",
+        "partial_bill": "⚠️ Part of your bill ({failed_bands} sections) could not be read, so some items may be missing. Please send the missing items by voice or text, or send a clearer photo of the bill.",
+        "period_summary": "📈 Your {period_label} ({start_date} to {end_date}):\n• Sales: ₹{sales:.2f}\n• Expenses: ₹{expenses:.2f}\n• Purchases: ₹{purchases:.2f}\n• Profit: ₹{profit:.2f}\n• Transactions: {txn_count}\n{best_day}",
+        "period_label_week": "last 7 days",
+        "period_label_month": "this month",
+        "period_best_day": "Best day: {best_date} (₹{best_sales:.2f} sales)",
+        "period_top_items": "Top items: {items}",
+        "export_started": "⏳ Preparing your khata export ({start_date} to {end_date}). The files will arrive here shortly.",
+        "export_ready": "📄 {kind_label} ({start_date} to {end_date}): {rows} rows\n{url}\nThe link works for {ttl_hours} hours.",
+        "export_failed": "❌ Could not prepare your export: {error_msg}",
+        "export_label_transactions": "Transactions",
+        "export_label_stock_movements": "Stock movements",
+        "import_started": "📥 Importing your khata file. This can take a few minutes for large files; I will message you when it is done.",
+        "import_progress": "⏳ Import in progress: {rows_done} rows done so far.",
+        "import_done": "✅ Khata import finished: {imported} entries added from {rows_done} rows in {seconds:.0f}s.",
+        "import_rejected": "⚠️ {rejected} rows were skipped because the date, amount or type could not be read.",
+        "import_failed": "❌ The import stopped: {error_msg}\nSend the same file again to continue from where it stopped.",
+        "search_header": "🔎 '{query}' from {start_date} to {end_date}:",
+        "search_sale": "• {item}: sold {quantity} for ₹{amount:.2f} ({entry_count} sales), last on {last_date} ({last_quantity})",
+        "search_purchase": "• {item}: bought {quantity} for ₹{amount:.2f} ({entry_count} purchases), last on {last_date} ({last_quantity}, ₹{last_amount:.2f})",
+        "search_expense": "• {item}: spent ₹{amount:.2f} ({entry_count} times), last on {last_date} (₹{last_amount:.2f})",
+        "search_no_results": "🔎 Nothing matching '{query}' from {start_date} to {end_date}.",
+        "owner_linked": "🔗 This shop is now an outlet of {owner}; their balance, sales and low-stock replies include it. Send 'owner remove' to stop sharing.",
+        "owner_unlinked": "🔗 This shop is no longer linked to {owner}.",
+        "owner_not_linked": "This shop is not linked to an owner.",
+        "owner_link_failed": "❌ Could not link this shop to {owner}. Please try again.",
+        "owner_link_self": "That is this shop's own number. Send 'owner' with the owner's WhatsApp number, e.g. 'owner 98765 43210'.",
+        "owner_balance": "🏪 All {shop_count} outlets: balance ₹{balance:.2f}\n{shop_lines}",
+        "owner_sales": "🏪 All {shop_count} outlets today: sales ₹{sales:.2f}\n{shop_lines}",
+        "owner_shop_line": "• {shop}: ₹{amount:.2f}",
+        "owner_low_stock": "⚠️ Low stock across your {shop_count} outlets:\n{shop_lines}",
+        "low_stock_none": "✅ No items are running low.",
+        "stock_take_started": "📋 Stock-take started. Send what you counted by voice, text or a photo of your count sheet (e.g. 'rice 20 kg, sugar 12 kg'), in as many messages as you like. Nothing changes until you confirm.",
+        "stock_take_diff": "📋 Stock-take: {counted_count} items counted, {change_count} differ from your records:\n{lines}",
+        "stock_take_line": "• {item}: records {current}, counted {counted} ({delta})",
+        "stock_take_new_line": "• {item}: not in your records, counted {counted}",
+        "stock_take_shrinkage": "📉 Missing stock worth ₹{value:.2f} at cost.",
+        "stock_take_unconvertible": "⚠️ Skipped because the unit differs from your records: {items}",
+        "stock_take_confirm": "Reply YES to update your stock, NO to cancel, or send more counted items.",
+        "stock_take_all_match": "✅ All {counted_count} counted items match your records. Send more counted items, or NO to finish.",
+        "stock_take_applied": "✅ Stock-take done: {change_count} items adjusted.",
+        "stock_take_cancelled": "Stock-take cancelled; your stock was not changed.",
+        "stock_take_conflict": "⚠️ A sale or purchase was recorded while you were counting, so the differences changed.",
+        "stock_take_failed": "❌ Could not update your stock: {error_msg}\nReply YES to try again.",
+        "stock_take_nothing_counted": "Could not read any counted items. Send them like 'rice 20 kg, sugar 12 kg'."
     },
     "hi": {
         "sale_success": "✅ ₹{amount:.2f} की बिक्री दर्ज की गई:\n{item_details}",
@@ -156,7 +242,54 @@ MESSAGES = {
         "call_initiated": "नमस्ते, मैं गुप्ता किराना स्टोर से रमा बात कर रही हूँ। क्या मैं {supplier_name} से बात कर सकती हूँ?",
         "order_confirmation_prompt": "आप किस आइटम और आपूर्तिकर्ता के लिए ऑर्डर की पुष्टि करना चाहेंगे? उदाहरण: 'सप्लायर ए से 10 किलो चावल ऑर्डर करें'।",
         "order_confirmed_shopkeeper": "✅ {item_name} के {quantity} {unit} का {supplier_name} से ऑर्डर पुष्ट हो गया है। स्टॉक अपडेट कर दिया गया है। डिलीवरी 2 दिनों में अपेक्षित है।",
-        "order_failed_shopkeeper": "❌ Failed to confirm order for {item_name} from {supplier_name}. Reason: {reason}"
+        "order_failed_shopkeeper": "❌ Failed to confirm order for {item_name} from {supplier_name}. Reason: {reason}",
+        "duplicate_bill_prompt": "⚠️ इनमें से {count} बिल की फोटो पहले भेजे गए बिल जैसी लग रही है। स्टॉक फिर से जोड़ने के लिए 'हाँ' लिखें, या छोड़ने के लिए 'नहीं' लिखें।",
+        "duplicate_bill_discarded": "👍 दोहराया गया बिल छोड़ दिया गया। आपका स्टॉक नहीं बदला गया।",
+        "partial_transcription": "⚠️ आपके लंबे वॉइस नोट का कुछ हिस्सा ({failed_chunks} भाग) समझ नहीं आया। कृपया नीचे की एंट्री जाँचें और जो छूट गया हो उसे फिर से भेजें।",
+        "partial_bill": "⚠️ आपके बिल का कुछ हिस्सा ({failed_bands} भाग) पढ़ा नहीं जा सका, इसलिए कुछ सामान छूट सकता है। छूटा हुआ सामान वॉइस या टेक्स्ट से भेजें, या बिल की साफ़ फोटो भेजें।",
+        "period_summary": "📈 आपका {period_label} का हिसाब ({start_date} से {end_date}):\n• बिक्री: ₹{sales:.2f}\n• खर्च: ₹{expenses:.2f}\n• खरीद: ₹{purchases:.2f}\n• मुनाफा: ₹{profit:.2f}\n• लेनदेन: {txn_count}\n{best_day}",
+        "period_label_week": "पिछले 7 दिन",
+        "period_label_month": "इस महीने",
+        "period_best_day": "सबसे अच्छा दिन: {best_date} (₹{best_sales:.2f} बिक्री)",
+        "period_top_items": "सबसे ज़्यादा बिके: {items}",
+        "export_started": "⏳ आपके खाते का एक्सपोर्ट ({start_date} से {end_date}) तैयार हो रहा है। फ़ाइलें जल्द ही यहाँ आ जाएँगी।",
+        "export_ready": "📄 {kind_label} ({start_date} से {end_date}): {rows} पंक्तियाँ\n{url}\nयह लिंक {ttl_hours} घंटे तक चलेगा।",
+        "export_failed": "❌ एक्सपोर्ट तैयार नहीं हो सका: {error_msg}",
+        "export_label_transactions": "लेनदेन",
+        "export_label_stock_movements": "स्टॉक की आवाजाही",
+        "import_started": "📥 आपकी खाता फ़ाइल इम्पोर्ट हो रही है। बड़ी फ़ाइल में कुछ मिनट लग सकते हैं; पूरा होने पर मैं संदेश भेजूँगा।",
+        "import_progress": "⏳ इम्पोर्ट जारी है: अब तक {rows_done} पंक्तियाँ हो चुकी हैं।",
+        "import_done": "✅ खाता इम्पोर्ट पूरा हुआ: {rows_done} पंक्तियों में से {imported} एंट्री {seconds:.0f} सेकंड में जोड़ी गईं।",
+        "import_rejected": "⚠️ {rejected} पंक्तियाँ छोड़ दी गईं क्योंकि तारीख, राशि या प्रकार पढ़ा नहीं जा सका।",
+        "import_failed": "❌ इम्पोर्ट रुक गया: {error_msg}\nजहाँ रुका था वहीं से जारी रखने के लिए वही फ़ाइल फिर से भेजें।",
+        "search_header": "🔎 '{query}' ({start_date} से {end_date}):",
+        "search_sale": "• {item}: {quantity} बेचा, ₹{amount:.2f} ({entry_count} बिक्री), आखिरी बार {last_date} ({last_quantity})",
+        "search_purchase": "• {item}: {quantity} खरीदा, ₹{amount:.2f} ({entry_count} खरीद), आखिरी बार {last_date} ({last_quantity}, ₹{last_amount:.2f})",
+        "search_expense": "• {item}: ₹{amount:.2f} खर्च ({entry_count} बार), आखिरी बार {last_date} (₹{last_amount:.2f})",
+        "search_no_results": "🔎 {start_date} से {end_date} तक '{query}' से मिलता कुछ नहीं मिला।",
+        "owner_linked": "🔗 यह दुकान अब {owner} की शाखा है; उनके बैलेंस, बिक्री और कम स्टॉक के जवाबों में यह शामिल होगी। साझा करना बंद करने के लिए 'owner remove' भेजें।",
+        "owner_unlinked": "🔗 यह दुकान अब {owner} से जुड़ी नहीं है।",
+        "owner_not_linked": "यह दुकान किसी मालिक से जुड़ी नहीं है।",
+        "owner_link_failed": "❌ यह दुकान {owner} से नहीं जोड़ी जा सकी। कृपया फिर से कोशिश करें।",
+        "owner_link_self": "यह इसी दुकान का नंबर है। मालिक के व्हाट्सएप नंबर के साथ 'owner' भेजें, जैसे 'owner 98765 43210'।",
+        "owner_balance": "🏪 सभी {shop_count} दुकानें: बैलेंस ₹{balance:.2f}\n{shop_lines}",
+        "owner_sales": "🏪 सभी {shop_count} दुकानें, आज की बिक्री: ₹{sales:.2f}\n{shop_lines}",
+        "owner_shop_line": "• {shop}: ₹{amount:.2f}",
+        "owner_low_stock": "⚠️ आपकी {shop_count} दुकानों में कम स्टॉक:\n{shop_lines}",
+        "low_stock_none": "✅ कोई भी आइटम कम नहीं है।",
+        "stock_take_started": "📋 स्टॉक गिनती शुरू हुई। जो गिना है वह वॉइस, टेक्स्ट या गिनती की पर्ची की फ़ोटो से भेजें (जैसे 'चावल 20 किलो, चीनी 12 किलो'), जितने भी संदेशों में चाहें। आपकी पुष्टि के बिना कुछ नहीं बदलेगा।",
+        "stock_take_diff": "📋 स्टॉक गिनती: {counted_count} आइटम गिने गए, {change_count} आपके रिकॉर्ड से अलग हैं:\n{lines}",
+        "stock_take_line": "• {item}: रिकॉर्ड में {current}, गिनती में {counted} ({delta})",
+        "stock_take_new_line": "• {item}: रिकॉर्ड में नहीं है, गिनती में {counted}",
+        "stock_take_shrinkage": "📉 लागत के हिसाब से ₹{value:.2f} का स्टॉक कम है।",
+        "stock_take_unconvertible": "⚠️ इकाई आपके रिकॉर्ड से अलग होने के कारण छोड़े गए: {items}",
+        "stock_take_confirm": "स्टॉक अपडेट करने के लिए YES, रद्द करने के लिए NO भेजें, या और गिने हुए आइटम भेजें।",
+        "stock_take_all_match": "✅ गिने गए सभी {counted_count} आइटम आपके रिकॉर्ड से मेल खाते हैं। और आइटम भेजें, या खत्म करने के लिए NO भेजें।",
+        "stock_take_applied": "✅ स्टॉक गिनती पूरी: {change_count} आइटम ठीक किए गए।",
+        "stock_take_cancelled": "स्टॉक गिनती रद्द कर दी गई; आपका स्टॉक नहीं बदला।",
+        "stock_take_conflict": "⚠️ गिनती के दौरान कोई बिक्री या खरीद दर्ज हुई, इसलिए अंतर बदल गए हैं।",
+        "stock_take_failed": "❌ आपका स्टॉक अपडेट नहीं हो सका: {error_msg}\nफिर से कोशिश करने के लिए YES भेजें।",
+        "stock_take_nothing_counted": "कोई गिना हुआ आइटम पढ़ा नहीं जा सका। इस तरह भेजें: 'चावल 20 किलो, चीनी 12 किलो'।"
     },
     "pa": { # Punjabi messages
         "sale_success": "✅ ਤੁਹਾਡੇ ਡਿਜੀਟਲ ਖਾਤੇ ਵਿੱਚ ₹{amount:.2f} ({item}) ਦੀ ਵਿਕਰੀ ਦਰਜ ਕੀਤੀ ਗਈ।",
@@ -430,7 +563,15 @@ def download_media_with_retry(media_url: str, file_path: str):
         f.write(response.content)
     print(f"Media downloaded successfully to {file_path}")
 
-async def send_whatsapp_message(to_number: str, message_body: str):
+def _remember_stock_row(stock_levels: list[dict], stock_row: dict):
+    """Writes a freshly updated stock row back into a request's prefetched snapshot."""
+    for existing_row in stock_levels:
+        if existing_row.get('id') == stock_row.get('id'):
+            existing_row.update(stock_row)
+            return
+    stock_levels.append(stock_row)
+
+async def send_whatsapp_message(to_number: str, message_body: str, media_url: str | None = None):
     if to_number == TWILIO_WHATSAPP_NUMBER:
         print(f"DEBUG: Skipping sending message to self ({to_number}). Message: {message_body}")
         return
@@ -440,21 +581,699 @@ async def send_whatsapp_message(to_number: str, message_body: str):
             twilio_client.messages.create,
             to=to_number,
             from_=TWILIO_WHATSAPP_NUMBER,
-            body=message_body
+            body=message_body,
+            **({"media_url": [media_url]} if media_url else {})
         )
         print(f"DEBUG: WhatsApp message sent successfully. SID: {message.sid}")
     except Exception as e:
         print(f"ERROR: Failed to send WhatsApp message to {to_number}: {e}")
 
+def _collect_media_attachments(form) -> list[tuple[int, str, str | None]]:
+    """Returns (index, url, content_type) for every attachment Twilio reports via NumMedia."""
+    try:
+        num_media = int(form.get('NumMedia', 0) or 0)
+    except ValueError:
+        num_media = 0
+    if num_media == 0 and form.get('MediaUrl0'):
+        num_media = 1  # Older payloads without NumMedia still carry a single attachment
+    attachments = []
+    for index in range(num_media):
+        media_url = form.get(f'MediaUrl{index}')
+        if media_url:
+            attachments.append((index, media_url, form.get(f'MediaContentType{index}')))
+    return attachments
+
+def _temp_media_path(sender_id: str, kind: str, index: int, extension: str) -> str:
+    # The random suffix keeps concurrent attachments (and concurrent messages) from clobbering each other
+    return f"./temp_{kind}_{sender_id.replace(':', '_')}_{index}_{os.urandom(4).hex()}.{extension}"
+
+async def _transcribe_voice_note_attachment(sender_id: str, index: int, media_url: str, semaphore: asyncio.Semaphore) -> dict:
+    """Downloads, transcodes and transcribes one voice note attachment."""
+    async with semaphore:
+        audio_file_path = _temp_media_path(sender_id, "audio", index, "ogg")
+        await asyncio.to_thread(download_media_with_retry, media_url, audio_file_path)
+
+        from pydub import AudioSegment  # Ensure AudioSegment is imported
+
+        mp3_file_path = audio_file_path.replace(".ogg", ".mp3")
+        try:
+            await asyncio.to_thread(lambda: AudioSegment.from_file(audio_file_path).export(mp3_file_path, format="mp3"))
+        except Exception as e:
+            print(f"Error converting audio file: {e}")
+            raise
+        finally:
+            if os.path.exists(audio_file_path):
+                os.remove(audio_file_path)
+
+        try:
+            return await asyncio.to_thread(transcribe_audio, mp3_file_path)
+        finally:
+            if os.path.exists(mp3_file_path):
+                os.remove(mp3_file_path)
+
+async def _extract_downloaded_bill(image_file_path: str, image_hash: int | None, detail_hash: int | None = None) -> dict:
+    """Extracts the line items of a downloaded bill image and deletes the file."""
+    try:
+        extracted_bill_data = await asyncio.to_thread(extract_items_from_bill_image, image_file_path)
+    finally:
+        if os.path.exists(image_file_path):
+            os.remove(image_file_path)
+    extracted_bill_data["image_hash"] = image_hash
+    extracted_bill_data["detail_hash"] = detail_hash
+    return extracted_bill_data
+
+async def _compute_bill_hashes(image_file_path: str) -> tuple[int | None, int | None]:
+    try:
+        return await asyncio.to_thread(compute_bill_hashes, image_file_path)
+    except Exception as e:
+        print(f"DEBUG_BILL_HASH: Could not hash bill image, skipping duplicate check: {e}")
+        return None, None
+
+async def _extract_bill_from_attachment(sender_id: str, index: int, media_url: str, semaphore: asyncio.Semaphore) -> dict:
+    """Downloads one bill image attachment and extracts its line items.
+
+    Photos that are near-duplicates of an already processed bill are not sent to the
+    Vision API; they come back as {"duplicate_of": ..., "image_path": ...} so the caller
+    can ask the shopkeeper to confirm them first.
+    """
+    async with semaphore:
+        image_file_path = _temp_media_path(sender_id, "image", index, "jpg")
+        try:
+            await asyncio.to_thread(download_media_with_retry, media_url, image_file_path)
+            image_hash, detail_hash = await _compute_bill_hashes(image_file_path)
+            if image_hash is not None:
+                duplicate = await bill_hash_index.find_near_duplicate(sender_id, image_hash, detail_hash)
+                if duplicate:
+                    print(f"DEBUG_BILL_HASH: Attachment {index} is {duplicate[0]} bits away from a bill processed at {duplicate[2]['created_at']}.")
+                    return {"duplicate_of": duplicate, "image_path": image_file_path, "image_hash": image_hash, "detail_hash": detail_hash}
+        except Exception:
+            if os.path.exists(image_file_path):
+                os.remove(image_file_path)
+            raise
+        extracted_bill_data = await _extract_downloaded_bill(image_file_path, image_hash, detail_hash)
+        print(f"DEBUG: Attachment {index} extracted bill type: {extracted_bill_data.get('bill_type')}, items: {extracted_bill_data.get('items')}")
+        return extracted_bill_data
+
+def _discard_pending_duplicate_bills(sender_id: str) -> list[dict]:
+    pending_bills = PENDING_DUPLICATE_BILLS.pop(sender_id, [])
+    for pending_bill in pending_bills:
+        if os.path.exists(pending_bill["image_path"]):
+            os.remove(pending_bill["image_path"])
+    return pending_bills
+
+def expire_pending_duplicate_bills():
+    """Deletes the parked photos of duplicate-bill prompts nobody answered in time (the periodic job)."""
+    expired_senders = [
+        sender_id for sender_id, pending_bills in list(PENDING_DUPLICATE_BILLS.items())
+        if any(time.time() - pending_bill["created_at"] > PENDING_DUPLICATE_BILL_TTL_SECONDS for pending_bill in pending_bills)
+    ]
+    for sender_id in expired_senders:
+        _discard_pending_duplicate_bills(sender_id)
+    if expired_senders:
+        print(f"DEBUG_BILL_HASH: Expired the pending duplicate bills of {len(expired_senders)} sender(s).")
+
+async def _ask_to_confirm_duplicate_bills(sender_id: str, duplicate_results: list[dict], detected_language: str):
+    """Parks near-duplicate bill photos and asks the shopkeeper whether to process them anyway."""
+    _discard_pending_duplicate_bills(sender_id)
+    PENDING_DUPLICATE_BILLS[sender_id] = [
+        {"image_path": result["image_path"], "image_hash": result["image_hash"], "detail_hash": result["detail_hash"], "created_at": time.time()}
+        for result in duplicate_results
+    ]
+    reply_message = MESSAGES[detected_language].get("duplicate_bill_prompt", MESSAGES["en"]["duplicate_bill_prompt"]).format(count=len(duplicate_results))
+    await send_whatsapp_message(sender_id, reply_message)
+
+async def _resolve_pending_duplicate_bills(sender_id: str, message_body: str, current_date: date, detected_language: str) -> bool:
+    """Handles a yes/no reply to a duplicate-bill prompt. Returns True if the message was such a reply."""
+    pending_bills = PENDING_DUPLICATE_BILLS.get(sender_id)
+    if not pending_bills:
+        return False
+    if any(time.time() - pending_bill["created_at"] > PENDING_DUPLICATE_BILL_TTL_SECONDS for pending_bill in pending_bills):
+        _discard_pending_duplicate_bills(sender_id)
+        return False
+
+    # Split on whitespace and punctuation only; stripping non-word characters would mangle Devanagari vowel signs
+    reply_words = re.findall(r'[^\s!?.,।]+', message_body.lower())
+    if any(word in DUPLICATE_BILL_REJECT_KEYWORDS for word in reply_words):
+        _discard_pending_duplicate_bills(sender_id)
+        await send_whatsapp_message(sender_id, MESSAGES[detected_language].get("duplicate_bill_discarded", MESSAGES["en"]["duplicate_bill_discarded"]))
+        return True
+    if not any(word in DUPLICATE_BILL_CONFIRM_KEYWORDS for word in reply_words):
+        return False
+
+    PENDING_DUPLICATE_BILLS.pop(sender_id, None)
+    await send_whatsapp_message(sender_id, MESSAGES[detected_language]["image_received_stock_update"])
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_MEDIA_DOWNLOADS)
+
+    async def extract_pending_bill(pending_bill: dict) -> dict:
+        async with semaphore:
+            return await _extract_downloaded_bill(pending_bill["image_path"], pending_bill["image_hash"], pending_bill["detail_hash"])
+
+    bill_results = await asyncio.gather(*(extract_pending_bill(pending_bill) for pending_bill in pending_bills), return_exceptions=True)
+    await _process_bill_images(sender_id, bill_results, current_date, detected_language)
+    return True
+
+def _merge_bill_items(items: list[dict]) -> list[dict]:
+    """Merges identical purchase lines from several bill pages so each item gets one stock update."""
+    merged = {}
+    for item in items:
+        item_name = item.get("item_name")
+        quantity = item.get("quantity")
+        unit = item.get("unit", "pcs")
+        cost_price_per_unit = item.get("cost_price_per_unit")
+        if not item_name or not isinstance(quantity, (int, float)) or cost_price_per_unit is None:
+            continue
+        key = (item_name.strip().lower(), unit.strip().lower(), float(cost_price_per_unit))
+        if key in merged:
+            merged[key]["quantity"] += float(quantity)
+        else:
+            merged[key] = {**item, "item_name": item_name.strip(), "quantity": float(quantity), "unit": unit}
+    return list(merged.values())
+
+async def _process_bill_images(sender_id: str, bill_results: list, current_date: date, detected_language: str) -> str:
+    """Applies the purchase items from every bill page as one stock update and one expense, then replies once.
+
+    Returns the language detected from the bills so the caller can keep replying in it.
+    """
+    purchase_items = []
+    purchase_hashes = []
+    failure_notes = []
+    failed_bands = 0
+    for page_number, result in enumerate(bill_results, start=1):
+        page_label = f"Page {page_number}: " if len(bill_results) > 1 else ""
+        if isinstance(result, Exception):
+            print(f"Error during image processing (page {page_number}): {result}")
+            failure_notes.append(f"{page_label}{result}")
+            continue
+
+        bill_type = result.get("bill_type", "unknown")
+        extracted_items = result.get("items", [])
+        detected_language = language_map.get(result.get("detected_language", 'en'), 'en')
+
+        if not extracted_items:
+            failure_notes.append(f"{page_label}Could not extract any items from the image.")
+            continue
+
+        if bill_type == "unknown":
+            if any(item.get("cost_price_per_unit") is not None for item in extracted_items):
+                bill_type = "purchase"
+            elif any(item.get("selling_price_per_unit") is not None for item in extracted_items):
+                failure_notes.append(f"{page_label}Sales via image are not supported. Please send sales details (item name, quantity, selling price) via voice note or text.")
+                continue
+
+        if bill_type == "purchase":
+            purchase_items.extend(extracted_items)
+            failed_bands += result.get("failed_bands", 0)
+            # A partly read bill is not remembered, so sending the same photo again is not flagged as a duplicate
+            if result.get("image_hash") is not None and not result.get("failed_bands"):
+                purchase_hashes.append((result["image_hash"], result.get("detail_hash")))
+        elif bill_type == "sale":
+            failure_notes.append(f"{page_label}Sales bills cannot be processed via image. Please send sales information via voice note or text (item name, quantity, selling price).")
+        else:
+            failure_notes.append(f"{page_label}Could not extract any valid items or clear pricing information from the image to determine bill type.")
+
+    update_messages = []
+    total_bill_expense = 0.0
+    merged_items = _merge_bill_items(purchase_items)
+    try:
+        if merged_items:
+            stock_deltas = []
+            purchase_lines = []
+            for item in merged_items:
+                item_name = item["item_name"]
+                quantity = item["quantity"]
+                unit = item["unit"]
+                cost_price_per_unit = item["cost_price_per_unit"]
+                print(f"DEBUG: Processing purchase item: {item_name}, quantity={quantity} {unit}, cost_price_per_unit={cost_price_per_unit}")
+                stock_deltas.append({"item_name": item_name, "quantity_delta": quantity, "unit": unit, "cost_price_per_unit": cost_price_per_unit})
+                update_messages.append(f"{item_name}: {quantity} {unit}")
+                line_amount = quantity * float(cost_price_per_unit)
+                purchase_lines.append({"item_name": item_name, "quantity": quantity, "unit": unit, "unit_price": float(cost_price_per_unit), "amount": line_amount, "cost": line_amount})
+                total_bill_expense += line_amount
+
+            expense_transactions = []
+            if total_bill_expense > 0:
+                pages_note = f", {len(bill_results)} pages" if len(bill_results) > 1 else ""
+                expense_transactions.append({
+                    "date": current_date.strftime('%Y-%m-%d'),
+                    "type": "expense",
+                    "amount": total_bill_expense,
+                    "item": f"Stock purchase via bill ({len(update_messages)} items{pages_note})",
+                    "lines": purchase_lines,
+                })
+
+            # The stock movements are applied and the expense recorded together
+            stock_levels = await get_prefetched_stock_levels(sender_id)
+            recorded = await record_writes(sender_id, stock_deltas=stock_deltas, transactions=expense_transactions)
+            for updated_stock_item in recorded["stock"]:
+                _remember_stock_row(stock_levels, updated_stock_item)
+            if expense_transactions:
+                update_messages.append(f"Total expense of ₹{total_bill_expense:.2f} recorded.")
+
+            # Only bills that actually changed stock are remembered for duplicate detection
+            for image_hash, detail_hash in purchase_hashes:
+                await bill_hash_index.remember(sender_id, image_hash, detail_hash)
+    except Exception as e:
+        print(f"Error during image processing: {e}")
+        failure_notes.append(str(e))
+
+    reply_parts = []
+    if update_messages:
+        reply_parts.append(MESSAGES[detected_language]["stock_update_success"].format(updates="\n".join(update_messages)))
+    if failed_bands:
+        reply_parts.append(MESSAGES[detected_language].get("partial_bill", MESSAGES["en"]["partial_bill"]).format(failed_bands=failed_bands))
+    if failure_notes or not update_messages:
+        error_msg = "\n".join(failure_notes) if failure_notes else "Could not extract any valid items with cost prices from the purchase bill."
+        reply_parts.append(MESSAGES[detected_language]["stock_update_fail"].format(error_msg=error_msg))
+    await send_whatsapp_message(sender_id, "\n\n".join(reply_parts))
+    return detected_language
+
+def _financial_year_start(current_date: date) -> date:
+    """First day of the Indian financial year (April to March) that current_date falls in."""
+    return date(current_date.year if current_date.month >= 4 else current_date.year - 1, 4, 1)
+
+# "Export my full khata", "poora hisab": the whole history, archived months included
+FULL_HISTORY_KEYWORDS = ["full", "all", "entire", "archive", "poora", "pura", "saara", "sara", "purana", "पूरा", "सारा", "पुराना"]
+FULL_HISTORY_START = date(2000, 1, 1)
+
+# Item search ("how much Parle-G did I sell last month", "kab ghee kharida"): a question word, a kind and an item
+search_question_keywords = ["how much", "how many", "when", "search", "find", "kitna", "kitne", "kitni", "kab", "कितना", "कितने", "कितनी", "कब"]
+search_kind_keywords = {
+    "sale": ["sell", "sold", "sale", "becha", "bechi", "beche", "bika", "biki", "बेचा", "बेची", "बेचे", "बिका", "बिकी", "बिके"],
+    "purchase": ["buy", "bought", "purchase", "purchased", "kharida", "kharidi", "kharide", "खरीदा", "खरीदी", "खरीदे", "ख़रीदा"],
+    "expense": ["spend", "spent", "expense", "kharch", "खर्च", "ख़र्च"],
+}
+# Words of a search question that are not part of the item name
+search_stopwords = {
+    "how", "much", "many", "when", "search", "find", "did", "do", "does", "i", "we", "my", "the", "a", "an", "of", "in", "on", "for",
+    "last", "this", "time", "was", "is", "have", "has", "sales", "today", "yesterday", "week", "month", "year", "total",
+    "kitna", "kitne", "kitni", "kab", "maine", "mene", "humne", "ne", "ka", "ki", "ke", "ko", "kya", "hai", "tha", "thi",
+    "aakhri", "akhri", "pichle", "pichhle", "pichla", "aaj", "kal", "hafte", "mahine", "saal", "mein", "me",
+    "कितना", "कितने", "कितनी", "कब", "मैंने", "हमने", "ने", "का", "की", "के", "को", "क्या", "है", "था", "थी", "थे", "आखिरी", "आख़िरी",
+    "पिछले", "पिछली", "पिछला", "इस", "आज", "कल", "हफ्ते", "हफ़्ते", "महीने", "महीना", "साल", "में", "बार",
+    "hua", "hui", "hue", "item", "items", "cheez", "cheezein", "saman", "samaan", "it", "what", "all", "any",
+    "हुआ", "हुई", "हुए", "चीज़", "चीज", "सामान",
+} | {keyword for keywords in search_kind_keywords.values() for keyword in keywords} | set(FULL_HISTORY_KEYWORDS)
+SEARCH_MAX_TERMS = 6
+# A number other than a year ("2 kg rice becha, kitna hua?") makes a message a transaction, not a search
+SEARCH_YEAR_PATTERN = re.compile(r'^(19|20)\d\d$')
+# So does a quantity in words: a number word right before a unit word ("do kilo chawal becha, kitna hua?")
+search_number_words = {
+    "ek", "do", "teen", "char", "chaar", "paanch", "panch", "chhe", "chhah", "saat", "aath", "nau", "das", "bees", "pachas", "sau",
+    "aadha", "adha", "dedh", "dhai", "dhaai", "sawa", "paune", "dozen", "darjan",
+    "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "twenty", "fifty", "hundred", "half",
+    "एक", "दो", "तीन", "चार", "पांच", "पाँच", "छह", "छः", "सात", "आठ", "नौ", "दस", "बीस", "पचास", "सौ", "आधा", "डेढ़", "ढाई", "सवा", "दर्जन",
+}
+search_unit_words = {
+    "kg", "kgs", "kilo", "kilos", "g", "gm", "gram", "grams", "gms", "l", "litre", "litres", "liter", "liters", "ml",
+    "packet", "packets", "pack", "packs", "pcs", "pc", "piece", "pieces", "dozen", "dozens", "darjan", "bag", "bags", "bori", "box", "boxes",
+    "rupees", "rupaye", "rupay", "rs", "rupee",
+    "किलो", "ग्राम", "लीटर", "पैकेट", "पीस", "दर्जन", "बोरी", "रुपये", "रुपए",
+}
+
+def _search_text(text: str) -> str:
+    """Lowercases text and replaces everything but letters, vowel signs and digits with spaces (keeps Devanagari words whole)."""
+    return " ".join("".join(char if unicodedata.category(char)[0] in "LMN" else " " for char in (text or "").lower()).split())
+
+def _mentions_phrase(text: str, phrase: str) -> bool:
+    """Whether a normalized text contains the phrase as whole words ("kab" is not in "kabab")."""
+    return f" {phrase} " in f" {text} "
+
+def _mentions_quantity_in_words(text: str) -> bool:
+    words = text.split()
+    return any(word in search_number_words and next_word in search_unit_words for word, next_word in zip(words, words[1:]))
+
+def _parse_item_search(texts: list[str]) -> tuple[str, list[str]] | None:
+    """
+    Reads an item search out of the message texts (from _search_text): returns (kind, terms) or None
+    if it is not one. The terms are what is left of each text once question, kind and period words
+    are removed, as a phrase and word by word, so a Hindi message also searches with its translation.
+    A message with a quantity or amount in it, in digits or in words, is a transaction that happens to
+    ask a question, not a search.
+    """
+    if not any(_mentions_phrase(text, keyword) for text in texts for keyword in search_question_keywords):
+        return None
+    if any(any(char.isdigit() for char in word) and not SEARCH_YEAR_PATTERN.match(word) for text in texts for word in text.split()):
+        return None
+    if any(_mentions_quantity_in_words(text) for text in texts):
+        return None
+    kind = next((kind for kind, keywords in search_kind_keywords.items() if any(keyword in text.split() for text in texts for keyword in keywords)), None)
+    if kind is None:
+        return None
+    terms = []
+    for text in texts:
+        words = [word for word in text.split() if word not in search_stopwords and word not in search_unit_words and not word.isdigit()]
+        for term in [" ".join(words)] + [word for word in words if len(word) >= 3]:
+            if term and term not in terms:
+                terms.append(term)
+    return (kind, terms[:SEARCH_MAX_TERMS]) if terms else None
+
+def _item_search_period(texts: list[str], current_date: date, week_keywords: list[str], month_keywords: list[str]) -> tuple[date, date]:
+    """The dates an item search covers: everything, last month, this month, the last week, today, yesterday, or the last year."""
+    def _mentions(keywords):
+        return any(keyword in text for text in texts for keyword in keywords)
+
+    if any(keyword in text.split() for text in texts for keyword in FULL_HISTORY_KEYWORDS):
+        return FULL_HISTORY_START, current_date
+    if _mentions(["last month", "pichle mahine", "pichhle mahine", "पिछले महीने", "पिछला महीना"]):
+        end_date = current_date.replace(day=1) - timedelta(days=1)
+        return end_date.replace(day=1), end_date
+    if _mentions(month_keywords):
+        return current_date.replace(day=1), current_date
+    if _mentions(week_keywords):
+        return current_date - timedelta(days=6), current_date
+    if _mentions(["today", "aaj", "आज"]):
+        return current_date, current_date
+    if _mentions(["yesterday", "kal", "कल"]):
+        return current_date - timedelta(days=1), current_date - timedelta(days=1)
+    return current_date - timedelta(days=365), current_date
+
+def _format_item_search(results: list[dict], messages: dict) -> list[str]:
+    """One message line per search result, worded for its kind (sale, purchase or expense)."""
+    lines = []
+    for row in results:
+        key = f"search_{row['kind']}"
+        unit = row["unit"] or ""
+        lines.append(messages.get(key, MESSAGES["en"][key]).format(
+            item=row["item_name"], quantity=f"{row['quantity'] or 0:g} {unit}".strip(), amount=row["amount"], entry_count=row["entry_count"],
+            last_date=row["last_date"], last_quantity=f"{row['last_quantity'] or 0:g} {unit}".strip(), last_amount=row["last_amount"] or 0,
+        ))
+    return lines
+
+# An outlet shares its figures with its owner by sending "owner <owner's WhatsApp number>" (or "malik ..."),
+# and stops with "owner remove". The outlet, not the owner, has to ask, so nobody can read another shop's khata.
+OWNER_LINK_PATTERN = re.compile(r'^\s*(?:owner|malik|मालिक)\s+(?:(remove|unlink|hatao|हटाओ)|(\+?[\d][\d\s-]{8,16}\d))\s*$', re.IGNORECASE)
+low_stock_keywords = ["low stock", "stock low", "kam stock", "stock kam", "कम स्टॉक", "स्टॉक कम"]
+
+def _owner_id_from_number(number: str) -> str:
+    """The WhatsApp sender id of a typed phone number; ten-digit numbers are taken as Indian (+91)."""
+    digits = re.sub(r'\D', '', number)
+    return f"whatsapp:+{'91' + digits if len(digits) == 10 else digits}"
+
+def _shop_label(user_id: str) -> str:
+    """How an outlet is named in owner replies: the last four digits of its number."""
+    return f"…{user_id[-4:]}"
+
+def _owner_shop_lines(shops: list[dict], field: str, messages: dict) -> str:
+    return "\n".join(messages.get("owner_shop_line", MESSAGES["en"]["owner_shop_line"]).format(shop=_shop_label(shop["user_id"]), amount=shop[field]) for shop in shops)
+
+async def _handle_owner_link(sender_id: str, message_body: str) -> bool:
+    """Links or unlinks the sender's shop to an owner if the message asks to; returns whether it did."""
+    match = OWNER_LINK_PATTERN.match(message_body)
+    if not match:
+        return False
+    shop = await get_prefetched_shop(sender_id)
+    messages = MESSAGES.get(shop.get("language") if shop else None, MESSAGES["en"])
+    if match.group(1):
+        owner_id = await unlink_owner_shop(sender_id)
+        reply_key = "owner_unlinked" if owner_id else "owner_not_linked"
+    else:
+        owner_id = _owner_id_from_number(match.group(2))
+        if owner_id == sender_id:
+            reply_key = "owner_link_self"
+        else:
+            reply_key = "owner_linked" if await link_owner_shop(owner_id, sender_id) else "owner_link_failed"
+    print(f"DEBUG_OWNER: {sender_id} sent an owner link request ({reply_key}, owner {owner_id}).")
+    await send_whatsapp_message(sender_id, messages.get(reply_key, MESSAGES["en"][reply_key]).format(owner=(owner_id or "").replace("whatsapp:", "")))
+    return True
+
+# Stock-take ("stock ginti"): the shopkeeper sends what is on the shelves by voice, text or a photo of the count
+# sheet, over as many messages as they like. Each list is diffed against the stock rows already in memory and the
+# differences are shown; "yes" applies all of them as one record_writes batch, recorded as 'adjustment' movements.
+stock_take_keywords = ["stock take", "stocktake", "stock count", "stock ginti", "stock ki ginti", "स्टॉक गिनती", "स्टॉक की गिनती"]
+
+def _active_stock_take(sender_id: str) -> dict | None:
+    stock_take = PENDING_STOCK_TAKES.get(sender_id)
+    if stock_take and time.time() - stock_take["updated_at"] > STOCK_TAKE_TTL_SECONDS:
+        PENDING_STOCK_TAKES.pop(sender_id, None)
+        return None
+    return stock_take
+
+def _counted_items(items: list[dict]) -> dict:
+    """Counted items keyed by (name, unit); an item counted twice in one list (two shelves) is added up."""
+    counts = {}
+    for item in items:
+        item_name, quantity, unit = item.get("item_name"), item.get("quantity"), (item.get("unit") or "pcs").strip().lower()
+        if not item_name or not isinstance(quantity, (int, float)) or quantity < 0:
+            continue
+        key = (item_name.strip().lower(), unit)
+        counts.setdefault(key, {"item_name": item_name.strip(), "quantity": 0.0, "unit": unit})["quantity"] += float(quantity)
+    return counts
+
+def _count_in_unit(quantity: float, unit: str, target_unit: str) -> float | None:
+    """A counted quantity in a stock row's unit, or None if the units do not convert (only kg and g do)."""
+    unit, target_unit = (unit or "pcs").lower(), (target_unit or "pcs").lower()
+    if unit == target_unit:
+        return quantity
+    grams = {"kg": 1000.0, "g": 1.0}
+    if unit in grams and target_unit in grams:
+        return quantity * grams[unit] / grams[target_unit]
+    return None
+
+def _match_stock_row(item_name: str, stock_levels: list[dict]) -> dict | None:
+    """The stock row a counted item refers to: the same name, else the closest name scoring at least 80."""
+    name = item_name.lower()
+    best_row, best_score = None, 0
+    for row in stock_levels:
+        if row["item_name"].lower() == name:
+            return row
+        score = fuzz.token_sort_ratio(name, row["item_name"].lower())
+        if score > best_score:
+            best_row, best_score = row, score
+    return best_row if best_score >= 80 else None
+
+def _diff_stock_take(counts: list[dict], stock_levels: list[dict]) -> tuple[list[dict], list[str]]:
+    """
+    Compares counted items with the stock rows in memory. Returns one adjustment per row whose count
+    differs (counts matching the same row are added up; unknown items become new rows) and the
+    counted items whose unit does not convert to their row's.
+    """
+    counted_by_row, new_items, unconvertible = {}, {}, []
+    for count in counts:
+        row = _match_stock_row(count["item_name"], stock_levels)
+        if row is None:
+            key = (count["item_name"].lower(), count["unit"])
+            new_items.setdefault(key, {"item_name": count["item_name"], "unit": count["unit"], "counted": 0.0})["counted"] += count["quantity"]
+            continue
+        quantity = _count_in_unit(count["quantity"], count["unit"], row["unit"])
+        if quantity is None:
+            unconvertible.append(f"{count['item_name']} ({count['unit']}/{row['unit']})")
+            continue
+        counted_by_row.setdefault(row["id"], [row, 0.0])[1] += quantity
+
+    adjustments = []
+    for row, counted in counted_by_row.values():
+        current = float(row["quantity"])
+        if abs(counted - current) >= 0.001:
+            # Valued at the cost basis the adjustment movement records (average cost), like sale profit
+            unit_cost = row.get("average_cost") if row.get("average_cost") is not None else row.get("cost_price_per_unit")
+            adjustments.append({"item_name": row["item_name"], "unit": row["unit"], "current": current, "counted": round(counted, 3),
+                                "quantity_delta": round(counted - current, 3), "expected_version": row.get("version"), "unit_cost": unit_cost})
+    for item in new_items.values():
+        if item["counted"] > 0:
+            adjustments.append({**item, "current": None, "quantity_delta": item["counted"], "expected_version": None, "unit_cost": None})
+    return adjustments, unconvertible
+
+def _stock_take_shrinkage(adjustments: list[dict]) -> float:
+    """Value at cost (average cost, else the last purchase price) of the stock found missing."""
+    return sum(-adjustment["quantity_delta"] * float(adjustment["unit_cost"]) for adjustment in adjustments if adjustment["quantity_delta"] < 0 and adjustment["unit_cost"] is not None)
+
+def _format_stock_take(stock_take: dict, unconvertible: list[str], messages: dict) -> str:
+    adjustments = stock_take["adjustments"]
+    parts = []
+    if adjustments:
+        lines = []
+        for adjustment in adjustments:
+            unit = adjustment["unit"]
+            if adjustment["current"] is None:
+                lines.append(messages.get("stock_take_new_line", MESSAGES["en"]["stock_take_new_line"]).format(item=adjustment["item_name"], counted=f"{adjustment['counted']:g} {unit}"))
+            else:
+                lines.append(messages.get("stock_take_line", MESSAGES["en"]["stock_take_line"]).format(
+                    item=adjustment["item_name"], current=f"{adjustment['current']:g} {unit}", counted=f"{adjustment['counted']:g} {unit}", delta=f"{adjustment['quantity_delta']:+g} {unit}"))
+        parts.append(messages.get("stock_take_diff", MESSAGES["en"]["stock_take_diff"]).format(counted_count=len(stock_take["counts"]), change_count=len(adjustments), lines="\n".join(lines)))
+        shrinkage = _stock_take_shrinkage(adjustments)
+        if shrinkage > 0:
+            parts.append(messages.get("stock_take_shrinkage", MESSAGES["en"]["stock_take_shrinkage"]).format(value=shrinkage))
+    if unconvertible:
+        parts.append(messages.get("stock_take_unconvertible", MESSAGES["en"]["stock_take_unconvertible"]).format(items=", ".join(unconvertible)))
+    if adjustments:
+        parts.append(messages.get("stock_take_confirm", MESSAGES["en"]["stock_take_confirm"]))
+    else:
+        parts.append(messages.get("stock_take_all_match", MESSAGES["en"]["stock_take_all_match"]).format(counted_count=len(stock_take["counts"])))
+    return "\n\n".join(parts)
+
+async def _show_stock_take(sender_id: str, stock_take: dict, stock_levels: list[dict], messages: dict, note: str = ""):
+    """Diffs the stock-take's counts against stock_levels, keeps the adjustments for confirmation and sends them."""
+    adjustments, unconvertible = _diff_stock_take(list(stock_take["counts"].values()), stock_levels)
+    stock_take.update(adjustments=adjustments, updated_at=time.time())
+    PENDING_STOCK_TAKES[sender_id] = stock_take
+    print(f"DEBUG_STOCK_TAKE: {sender_id} counted {len(stock_take['counts'])} items, {len(adjustments)} differ from stock_items.")
+    await send_whatsapp_message(sender_id, "\n\n".join(part for part in (note, _format_stock_take(stock_take, unconvertible, messages)) if part))
+
+async def _start_stock_take(sender_id: str, messages: dict):
+    PENDING_STOCK_TAKES[sender_id] = {"counts": {}, "adjustments": [], "updated_at": time.time()}
+    await send_whatsapp_message(sender_id, messages.get("stock_take_started", MESSAGES["en"]["stock_take_started"]))
+
+async def _update_stock_take(sender_id: str, counted_items: list[dict], messages: dict):
+    """Adds a counted list to the sender's stock-take (starting one if needed) and shows the differences so far.
+    A later count of the same item replaces the earlier one."""
+    counts = _counted_items(counted_items)
+    if not counts:
+        await send_whatsapp_message(sender_id, messages.get("stock_take_nothing_counted", MESSAGES["en"]["stock_take_nothing_counted"]))
+        return
+    stock_take = _active_stock_take(sender_id) or {"counts": {}, "adjustments": []}
+    stock_take["counts"].update(counts)
+    await _show_stock_take(sender_id, stock_take, await get_prefetched_stock_levels(sender_id), messages)
+
+async def _resolve_pending_stock_take(sender_id: str, message_body: str) -> bool:
+    """Handles a yes/no reply during a stock-take. Returns True if the message was such a reply."""
+    stock_take = _active_stock_take(sender_id)
+    if not stock_take:
+        return False
+    reply_words = re.findall(r'[^\s!?.,।]+', message_body.lower())
+    is_rejection = any(word in DUPLICATE_BILL_REJECT_KEYWORDS for word in reply_words)
+    if not is_rejection and not any(word in DUPLICATE_BILL_CONFIRM_KEYWORDS for word in reply_words):
+        return False
+    shop = await get_prefetched_shop(sender_id)
+    messages = MESSAGES.get(shop.get("language") if shop else None, MESSAGES["en"])
+    if is_rejection or not stock_take["adjustments"]:
+        PENDING_STOCK_TAKES.pop(sender_id, None)
+        reply_key = "stock_take_cancelled" if is_rejection else "stock_take_applied"
+        await send_whatsapp_message(sender_id, messages.get(reply_key, MESSAGES["en"][reply_key]).format(change_count=0))
+        return True
+
+    # Every adjustment is one delta of a single transactional batch, recorded like sales and purchases so it is
+    # ordered after them; a row changed since the diff fails the whole batch
+    deltas = [
+        {"item_name": adjustment["item_name"], "quantity_delta": adjustment["quantity_delta"], "unit": adjustment["unit"],
+         "expected_version": adjustment["expected_version"], "movement_type": "adjustment"}
+        for adjustment in stock_take["adjustments"]
+    ]
+    try:
+        updated_rows = (await record_writes(sender_id, stock_deltas=deltas))["stock"]
+    except StockVersionConflict as e:
+        print(f"DEBUG_STOCK_TAKE: Stock of {sender_id} changed since the diff, diffing again: {e}")
+        invalidate_stock_cache(sender_id)
+        await _show_stock_take(sender_id, stock_take, await get_stock_levels(sender_id), messages,
+                               note=messages.get("stock_take_conflict", MESSAGES["en"]["stock_take_conflict"]))
+        return True
+    except Exception as e:
+        print(f"ERROR_STOCK_TAKE: Could not apply the stock-take of {sender_id}: {e}")
+        await send_whatsapp_message(sender_id, messages.get("stock_take_failed", MESSAGES["en"]["stock_take_failed"]).format(error_msg=str(e)))
+        return True
+
+    PENDING_STOCK_TAKES.pop(sender_id, None)
+    stock_levels = await get_prefetched_stock_levels(sender_id)
+    for updated_stock_item in updated_rows:
+        _remember_stock_row(stock_levels, updated_stock_item)
+    reply_message = messages.get("stock_take_applied", MESSAGES["en"]["stock_take_applied"]).format(change_count=len(deltas))
+    shrinkage = _stock_take_shrinkage(stock_take["adjustments"])
+    if shrinkage > 0:
+        reply_message += "\n" + messages.get("stock_take_shrinkage", MESSAGES["en"]["stock_take_shrinkage"]).format(value=shrinkage)
+    await send_whatsapp_message(sender_id, reply_message)
+    return True
+
+async def _extract_count_sheet_from_attachment(sender_id: str, index: int, media_url: str, semaphore: asyncio.Semaphore) -> dict:
+    """Downloads a photo of a stock-take count sheet and reads its items with the bill extractor (prices are ignored)."""
+    async with semaphore:
+        image_file_path = _temp_media_path(sender_id, "image", index, "jpg")
+        try:
+            await asyncio.to_thread(download_media_with_retry, media_url, image_file_path)
+        except Exception:
+            if os.path.exists(image_file_path):
+                os.remove(image_file_path)
+            raise
+        return await _extract_downloaded_bill(image_file_path, None)
+
+async def _send_ledger_export(sender_id: str, start_date: date, end_date: date, export_format: str, detected_language: str):
+    """Builds the shop's export files and sends each one as a WhatsApp media link."""
+    messages = MESSAGES.get(detected_language, MESSAGES["en"])
+    try:
+        # The archived months are only read when the range reaches back to them
+        exports = await export_shop_ledger(sender_id, start_date, end_date, export_format, include_archive=start_date < archive_horizon(end_date))
+    except Exception as e:
+        print(f"ERROR_EXPORT: Export for {sender_id} failed: {e}")
+        await send_whatsapp_message(sender_id, messages.get("export_failed", MESSAGES["en"]["export_failed"]).format(error_msg=str(e)))
+        return
+    for export in exports:
+        url = f"{BASE_URL}/exports/{export['filename']}"
+        label_key = f"export_label_{export['kind']}"
+        reply_message = messages.get("export_ready", MESSAGES["en"]["export_ready"]).format(
+            kind_label=messages.get(label_key, MESSAGES["en"][label_key]),
+            start_date=start_date.strftime('%Y-%m-%d'),
+            end_date=end_date.strftime('%Y-%m-%d'),
+            rows=export["rows"],
+            url=url,
+            ttl_hours=f"{EXPORT_TTL_HOURS:g}",
+        )
+        await send_whatsapp_message(sender_id, reply_message, media_url=url)
+
+# Spreadsheet documents accepted for a bulk khata import, by content type
+KHATA_IMPORT_CONTENT_TYPES = {
+    "text/csv": "csv",
+    "text/comma-separated-values": "csv",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+}
+# Progress messages are sent at most once per this many rows
+IMPORT_PROGRESS_MESSAGE_ROWS = 100_000
+
+async def _run_khata_import(sender_id: str, index: int, media_url: str, extension: str, detected_language: str):
+    """Downloads an uploaded khata spreadsheet and imports it, messaging progress and the result."""
+    messages = MESSAGES.get(detected_language, MESSAGES["en"])
+    next_progress_message = IMPORT_PROGRESS_MESSAGE_ROWS
+
+    async def _report_progress(progress: dict):
+        nonlocal next_progress_message
+        if progress["rows_done"] >= next_progress_message:
+            next_progress_message = progress["rows_done"] + IMPORT_PROGRESS_MESSAGE_ROWS
+            await send_whatsapp_message(sender_id, messages.get("import_progress", MESSAGES["en"]["import_progress"]).format(rows_done=progress["rows_done"]))
+
+    downloaded_path = _temp_media_path(sender_id, "import", index, extension)
+    try:
+        await asyncio.to_thread(download_media_with_retry, media_url, downloaded_path)
+        import_path = await asyncio.to_thread(stage_import_file, sender_id, downloaded_path)
+        result = await import_khata_file(sender_id, import_path, on_progress=_report_progress)
+    except Exception as e:
+        print(f"ERROR_IMPORT: Khata import for {sender_id} failed: {e}")
+        if os.path.exists(downloaded_path):
+            os.remove(downloaded_path)
+        await send_whatsapp_message(sender_id, messages.get("import_failed", MESSAGES["en"]["import_failed"]).format(error_msg=str(e)))
+        return
+    # Cached stock is unaffected, but balances and summaries now include the imported history
+    reply_message = messages.get("import_done", MESSAGES["en"]["import_done"]).format(imported=result["imported"], rows_done=result["rows_done"], seconds=result["seconds"])
+    if result["rejected"]:
+        reply_message += "\n" + messages.get("import_rejected", MESSAGES["en"]["import_rejected"]).format(rejected=result["rejected"])
+    await send_whatsapp_message(sender_id, reply_message)
+
+def _start_khata_import(sender_id: str, index: int, media_url: str, extension: str, detected_language: str):
+    """Runs an import on its own thread; a large file takes minutes, far longer than Twilio waits for the webhook."""
+    import_thread = Thread(target=asyncio.run, args=(_run_khata_import(sender_id, index, media_url, extension, detected_language),), name="khata-import")
+    import_thread.daemon = True
+    import_thread.start()
+
+def _start_ledger_export(sender_id: str, start_date: date, end_date: date, export_format: str, detected_language: str):
+    """Runs the export on its own thread, so the webhook can answer Twilio while a large khata is written."""
+    export_thread = Thread(target=asyncio.run, args=(_send_ledger_export(sender_id, start_date, end_date, export_format, detected_language),), name="ledger-export")
+    export_thread.daemon = True
+    export_thread.start()
+
 @app.route("/whatsapp", methods=["POST"])
 async def whatsapp_webhook():
+    sender_id = request.form.get('From', '')
+    # Start loading the shop's stock and price memory while the media is downloaded and transcribed
+    prefetch = start_sender_prefetch(sender_id) if sender_id else None
+    try:
+        return await _handle_whatsapp_message()
+    finally:
+        if prefetch is not None:
+            await prefetch.close()
+
+async def _handle_whatsapp_message():
     sender_id = request.form.get('From', '')
     message_body = request.form.get('Body', '')
-    media_url = request.form.get('MediaUrl0', None)
-    media_content_type = request.form.get('MediaContentType0', None)
+    media_attachments = _collect_media_attachments(request.form)
     current_date = date.today()
 
-    print(f"DEBUG_WEBHOOK: Received message. MediaUrl0: {media_url}, MediaContentType0: {media_content_type}")
+    print(f"DEBUG_WEBHOOK: Received message with {len(media_attachments)} attachments: {media_attachments}")
 
     detected_language = 'en'
     original_transcription = ""
@@ -463,155 +1282,121 @@ async def whatsapp_webhook():
     should_return_early = False
 
     balance_keywords = ["balance", "account", "kitna", "total", "shilak", "rupai", "money", "खाता", "कितने पैसे हैं", "how much money", "kitni rakam hai", "शिल्लक", "रक्कम"]
+    week_keywords = ["week", "weekly", "hafte", "hafta", "हफ्ते", "हफ़्ते", "सप्ताह"]
+    month_keywords = ["month", "monthly", "mahine", "mahina", "महीने", "महीना"]
+    period_sales_keywords = ["sales", "sale", "bikri", "बिक्री", "hisab", "हिसाब"]
+    export_keywords = ["export", "download", "csv", "parquet", "excel", "gst", "एक्सपोर्ट", "डाउनलोड"]
     earnings_keywords = ["kamai", "earnings", "profit", "aaj kii", "today's", "कितनी कमाई हुई", "आज की कमाई", "फायदा", "कमई", "how much did you earn today", "how much you earn today", "total sales today", "total earned today", "आज कमई", "कमई", "aaj ki kamai", "how much today earnings"]
 
     cleaned_original_transcription = ""
     cleaned_english_translation = ""
 
-    if media_url:
-        if media_content_type and 'audio' in media_content_type:
-            try:
-                audio_file_path = f"./temp_audio_{sender_id.replace(':', '_')}.ogg"
-                download_media_with_retry(media_url, audio_file_path)
-
-                from pydub import AudioSegment  # Ensure AudioSegment is imported
-
-                mp3_file_path = audio_file_path.replace(".ogg", ".mp3")
-                try:
-                    AudioSegment.from_file(audio_file_path).export(mp3_file_path, format="mp3")
-                except Exception as e:
-                    print(f"Error converting audio file: {e}")
-                    raise
-                finally:
-                    if os.path.exists(audio_file_path):
-                        os.remove(audio_file_path)
-
-                transcription_result = transcribe_audio(mp3_file_path)
-                if os.path.exists(mp3_file_path):
-                    os.remove(mp3_file_path)
-               
-
-                original_transcription = transcription_result["original_transcription"]
-                english_translation = transcription_result["english_translation"]
-                detected_language = language_map.get(transcription_result["detected_language"], 'en')
-                print(f"Detected language: {detected_language}")
-                print(f"Original Transcription: {original_transcription}")
-                print(f"English Translation: {english_translation}")
-
-                cleaned_original_transcription = re.sub(r'[^\w\s]', '', original_transcription, flags=re.IGNORECASE | re.UNICODE).lower().strip() if original_transcription else ''
-                cleaned_english_translation = re.sub(r'[^\w\s]', '', english_translation, flags=re.IGNORECASE | re.UNICODE).lower().strip() if english_translation else ''
+    if media_attachments:
+        audio_attachments = [(index, url, content_type) for index, url, content_type in media_attachments if content_type and 'audio' in content_type]
+        image_attachments = [(index, url, content_type) for index, url, content_type in media_attachments if content_type and 'image' in content_type]
+        document_attachments = [(index, url, content_type) for index, url, content_type in media_attachments if (content_type or "").split(";")[0] in KHATA_IMPORT_CONTENT_TYPES]
+        unsupported_types = [content_type for _, _, content_type in media_attachments if not content_type or ('audio' not in content_type and 'image' not in content_type and content_type.split(";")[0] not in KHATA_IMPORT_CONTENT_TYPES)]
 
-            except Exception as e:
-                print(f"Error during voice note processing: {e}")
-                reply_message = MESSAGES[detected_language]["file_error"].format(error_msg=str(e))
-                await send_whatsapp_message(sender_id, reply_message)
+        if unsupported_types:
+            print(f"Unsupported media type received: {unsupported_types}")
+            reply_message = MESSAGES[detected_language]["unsupported_media"].format(media_type=", ".join(str(media_type) for media_type in unsupported_types))
+            await send_whatsapp_message(sender_id, reply_message)
+            if not audio_attachments and not image_attachments:
                 should_return_early = True
-                original_transcription = ""
-                english_translation = ""
 
-        elif media_content_type and 'image' in media_content_type:
-            try:
-                image_file_path = f"./temp_image_{sender_id.replace(':', '_')}.jpg"
-                download_media_with_retry(media_url, image_file_path)
+        media_semaphore = asyncio.Semaphore(MAX_CONCURRENT_MEDIA_DOWNLOADS)
 
-                await send_whatsapp_message(sender_id, MESSAGES[detected_language]["image_received_stock_update"])
-
-                extracted_bill_data = extract_items_from_bill_image(image_file_path)
-                os.remove(image_file_path)
+        if document_attachments:
+            shop = await get_prefetched_shop(sender_id)
+            import_language = shop.get("language") if shop and shop.get("language") in MESSAGES else detected_language
+            await send_whatsapp_message(sender_id, MESSAGES[import_language].get("import_started", MESSAGES["en"]["import_started"]))
+            for index, url, content_type in document_attachments:
+                _start_khata_import(sender_id, index, url, KHATA_IMPORT_CONTENT_TYPES[content_type.split(";")[0]], import_language)
+            if not audio_attachments and not image_attachments:
+                should_return_early = True
 
-                bill_type = extracted_bill_data.get("bill_type", "unknown")
-                extracted_items = extracted_bill_data.get("items", [])
-                detected_language_from_bill = extracted_bill_data.get("detected_language", 'en')
-
-                detected_language = language_map.get(detected_language_from_bill, 'en')
-                print(f"DEBUG: Detected language from bill: {detected_language_from_bill} -> Normalized: {detected_language}")
-
-                print(f"DEBUG: Extracted bill type: {bill_type}")
-                print(f"DEBUG: Extracted items: {extracted_items}")
-
-                if extracted_items:
-                    update_messages = []
-
-                    if bill_type == "unknown":
-                        if any(item.get("cost_price_per_unit") is not None for item in extracted_items):
-                            bill_type = "purchase"
-                        elif any(item.get("selling_price_per_unit") is not None for item in extracted_items):
-                            reply_message = MESSAGES[detected_language]["stock_update_fail"].format(error_msg="Sales via image are not supported. Please send sales details (item name, quantity, selling price) via voice note or text.")
-                            await send_whatsapp_message(sender_id, reply_message)
-                            should_return_early = True
-
-                    if bill_type == "purchase":
-                        total_bill_expense = 0.0
-                        for item in extracted_items:
-                            item_name = item.get("item_name")
-                            quantity = item.get("quantity")
-                            unit = item.get("unit", "pcs")
-                            cost_price_per_unit = item.get("cost_price_per_unit")
-
-                            if item_name and isinstance(quantity, (int, float)) and cost_price_per_unit is not None:
-                                print(f"DEBUG: Processing purchase item: {item_name}, quantity={float(quantity)} {unit}, cost_price_per_unit={cost_price_per_unit}")
-                                await update_stock_item(sender_id, item_name, float(quantity), unit, cost_price_per_unit)
-                                update_messages.append(f"{item_name}: {quantity} {unit}")
-
-                                quantity_for_expense_calc = float(quantity)
-
-                                total_bill_expense += quantity_for_expense_calc * float(cost_price_per_unit)
-
-                        if update_messages:
-                            if total_bill_expense > 0:
-                                expense_data = {
-                                    "date": current_date.strftime('%Y-%m-%d'),
-                                    "type": "expense",
-                                    "amount": total_bill_expense,
-                                    "item": f"Stock purchase via bill ({len(update_messages)} items)"
-                                }
-                                await save_transaction(expense_data, sender_id)
-                                update_messages.append(f"Total expense of ₹{total_bill_expense:.2f} recorded.")
-
-                            reply_message = MESSAGES[detected_language]["stock_update_success"].format(updates="\n".join(update_messages))
-                            await send_whatsapp_message(sender_id, reply_message)
-                            should_return_early = True
-                        else:
-                            reply_message = MESSAGES[detected_language]["stock_update_fail"].format(error_msg="Could not extract any valid items with cost prices from the purchase bill.")
-                            await send_whatsapp_message(sender_id, reply_message)
-                            should_return_early = True
-
-                    elif bill_type == "sale":
-                        reply_message = MESSAGES[detected_language]["stock_update_fail"].format(error_msg="Sales bills cannot be processed via image. Please send sales information via voice note or text (item name, quantity, selling price).")
-                        await send_whatsapp_message(sender_id, reply_message)
-                        should_return_early = True
+        if image_attachments and (_active_stock_take(sender_id) or any(keyword in (message_body or "").lower() for keyword in stock_take_keywords)):
+            # During a stock-take (or with a "stock take" caption) photos are count sheets, not bills
+            count_results = await asyncio.gather(
+                *(_extract_count_sheet_from_attachment(sender_id, index, url, media_semaphore) for index, url, _ in image_attachments),
+                return_exceptions=True,
+            )
+            for failure in (result for result in count_results if isinstance(result, Exception)):
+                print(f"Error during count sheet processing (skipping this photo): {failure}")
+            shop = await get_prefetched_shop(sender_id)
+            await _update_stock_take(sender_id, [item for result in count_results if isinstance(result, dict) for item in result.get("items", [])],
+                                     MESSAGES.get(shop.get("language") if shop else None, MESSAGES["en"]))
+            if not audio_attachments:
+                should_return_early = True
 
-                    else:
-                        reply_message = MESSAGES[detected_language]["stock_update_fail"].format(error_msg="Could not extract any valid items or clear pricing information from the image to determine bill type.")
-                        await send_whatsapp_message(sender_id, reply_message)
-                        should_return_early = True
+        elif image_attachments:
+            await send_whatsapp_message(sender_id, MESSAGES[detected_language]["image_received_stock_update"])
+            bill_results = await asyncio.gather(
+                *(_extract_bill_from_attachment(sender_id, index, url, media_semaphore) for index, url, _ in image_attachments),
+                return_exceptions=True,
+            )
+            duplicate_results = [result for result in bill_results if isinstance(result, dict) and result.get("duplicate_of")]
+            new_bill_results = [result for result in bill_results if not (isinstance(result, dict) and result.get("duplicate_of"))]
+            if new_bill_results:
+                detected_language = await _process_bill_images(sender_id, new_bill_results, current_date, detected_language)
+            if duplicate_results:
+                await _ask_to_confirm_duplicate_bills(sender_id, duplicate_results, detected_language)
+            if not audio_attachments:
+                should_return_early = True
 
-                else:
-                    reply_message = MESSAGES[detected_language]["stock_update_fail"].format(error_msg="Could not extract any items from the image.")
-                    await send_whatsapp_message(sender_id, reply_message)
-                    should_return_early = True
+        if audio_attachments:
+            transcription_results = await asyncio.gather(
+                *(_transcribe_voice_note_attachment(sender_id, index, url, media_semaphore) for index, url, _ in audio_attachments),
+                return_exceptions=True,
+            )
+            failed_transcriptions = [result for result in transcription_results if isinstance(result, Exception)]
+            successful_transcriptions = [result for result in transcription_results if not isinstance(result, Exception)]
 
-            except Exception as e:
-                print(f"Error during image processing: {e}")
-                print(f"DEBUG: Type of exception e: {type(e)}")
-                print(f"DEBUG: Content of exception e: {e}")
-                reply_message = MESSAGES[detected_language]["stock_update_fail"].format(error_msg=str(e))
+            if failed_transcriptions and not successful_transcriptions:
+                print(f"Error during voice note processing: {failed_transcriptions[0]}")
+                reply_message = MESSAGES[detected_language]["file_error"].format(error_msg=str(failed_transcriptions[0]))
                 await send_whatsapp_message(sender_id, reply_message)
                 should_return_early = True
-        else:
-            print(f"Unsupported media type received: {media_content_type}")
-            reply_message = MESSAGES[detected_language]["unsupported_media"].format(media_type=media_content_type)
-            await send_whatsapp_message(sender_id, reply_message)
-            should_return_early = True
+            else:
+                for failure in failed_transcriptions:
+                    print(f"Error during voice note processing (skipping this voice note): {failure}")
+                failed_chunks = sum(result.get("failed_chunks", 0) for result in successful_transcriptions)
+                if failed_chunks:
+                    language_for_warning = language_map.get(successful_transcriptions[0]["detected_language"], 'en')
+                    await send_whatsapp_message(sender_id, MESSAGES[language_for_warning].get("partial_transcription", MESSAGES["en"]["partial_transcription"]).format(failed_chunks=failed_chunks))
+                # Voice notes sent together are treated as one dictation, stitched in the order they were sent
+                original_transcription = " ".join(result["original_transcription"] for result in successful_transcriptions if result["original_transcription"]).strip()
+                english_translation = " ".join(result["english_translation"] for result in successful_transcriptions if result["english_translation"]).strip()
+                detected_language = language_map.get(successful_transcriptions[0]["detected_language"], 'en')
+                print(f"Detected language: {detected_language}")
+                # Remember the language the shopkeeper speaks so text replies can use it too
+                shop = await get_prefetched_shop(sender_id)
+                if shop is None or shop.get("language") != detected_language:
+                    await update_shop(sender_id, language=detected_language)
+                print(f"Original Transcription: {original_transcription}")
+                print(f"English Translation: {english_translation}")
+
+                cleaned_original_transcription = re.sub(r'[^\w\s]', '', original_transcription, flags=re.IGNORECASE | re.UNICODE).lower().strip() if original_transcription else ''
+                cleaned_english_translation = re.sub(r'[^\w\s]', '', english_translation, flags=re.IGNORECASE | re.UNICODE).lower().strip() if english_translation else ''
 
     if should_return_early:
         return str(MessagingResponse())
 
+    if message_body and not media_attachments:
+        if await _resolve_pending_duplicate_bills(sender_id, message_body, current_date, detected_language):
+            return str(MessagingResponse())
+        if await _handle_owner_link(sender_id, message_body):
+            return str(MessagingResponse())
+        if await _resolve_pending_stock_take(sender_id, message_body):
+            return str(MessagingResponse())
+
     if message_body and not should_return_early:
         original_transcription = message_body
         english_translation = message_body
         print(f"Received text message: {message_body}")
-        detected_language = 'en'
+        shop = await get_prefetched_shop(sender_id)
+        shop_language = shop.get("language") if shop else None
+        detected_language = shop_language if shop_language in MESSAGES else 'en'
         cleaned_original_transcription = re.sub(r'[^\w\s]', '', original_transcription, flags=re.IGNORECASE | re.UNICODE).lower().strip() if original_transcription else ''
         cleaned_english_translation = re.sub(r'[^\w\s]', '', english_translation, flags=re.IGNORECASE | re.UNICODE).lower().strip() if english_translation else ''
 
@@ -636,9 +1421,103 @@ async def whatsapp_webhook():
 
         is_balance_inquiry = any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in balance_keywords)
         is_earnings_inquiry = any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in earnings_keywords)
+        is_period_sales_inquiry = is_earnings_inquiry or any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in period_sales_keywords)
+        is_week_inquiry = is_period_sales_inquiry and any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in week_keywords)
+        is_month_inquiry = is_period_sales_inquiry and any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in month_keywords)
+        is_export_request = any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in export_keywords)
+        search_texts = list(dict.fromkeys(text for text in (_search_text(original_transcription), _search_text(english_translation)) if text))
+        is_low_stock_inquiry = any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in low_stock_keywords)
+        item_search = None if is_export_request or is_low_stock_inquiry else _parse_item_search(search_texts)
+
+        if is_export_request:
+            # "full" widens the export to the whole history, "this month" / "this week" narrow it; otherwise it covers the financial year so far
+            if any(keyword in search_text.split() for search_text in search_texts for keyword in FULL_HISTORY_KEYWORDS):
+                start_date = FULL_HISTORY_START
+            elif any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in month_keywords):
+                start_date = current_date.replace(day=1)
+            elif any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in week_keywords):
+                start_date = current_date - timedelta(days=6)
+            else:
+                start_date = _financial_year_start(current_date)
+            export_format = "parquet" if "parquet" in cleaned_original_transcription or "parquet" in cleaned_english_translation else "csv"
+            messages = MESSAGES.get(detected_language, MESSAGES["en"])
+            await send_whatsapp_message(sender_id, messages.get("export_started", MESSAGES["en"]["export_started"]).format(
+                start_date=start_date.strftime('%Y-%m-%d'), end_date=current_date.strftime('%Y-%m-%d')))
+            _start_ledger_export(sender_id, start_date, current_date, export_format, detected_language)
+            should_return_early = True
 
-        if is_earnings_inquiry:
-            today_sales, today_sales_transactions = await get_daily_sales_summary(sender_id, current_date)
+        elif item_search:
+            search_kind, search_terms = item_search
+            start_date, end_date = _item_search_period(search_texts, current_date, week_keywords, month_keywords)
+            print(f"DEBUG_SEARCH: Searching {search_kind} history of {sender_id} for {search_terms} from {start_date} to {end_date}.")
+            results = await search_item_history(sender_id, search_terms, start_date, end_date, kind=search_kind, include_archive=start_date < archive_horizon(current_date))
+            messages = MESSAGES.get(detected_language, MESSAGES["en"])
+            period = {"query": search_terms[0], "start_date": start_date.strftime('%Y-%m-%d'), "end_date": end_date.strftime('%Y-%m-%d')}
+            if results:
+                reply_message = "\n".join([messages.get("search_header", MESSAGES["en"]["search_header"]).format(**period)] + _format_item_search(results, messages))
+            else:
+                reply_message = messages.get("search_no_results", MESSAGES["en"]["search_no_results"]).format(**period)
+            await send_whatsapp_message(sender_id, reply_message)
+            should_return_early = True
+
+        elif is_low_stock_inquiry:
+            # An owner sees every outlet's low stock, grouped by outlet; a single shop sees its own
+            own_items, owner_items, owner_shops = await asyncio.gather(
+                get_low_stock_items(sender_id), get_owner_low_stock_items(sender_id), get_owner_shops(sender_id))
+            messages = MESSAGES.get(detected_language, MESSAGES["en"])
+            if len(owner_shops) > 1 and owner_items:
+                shop_lines = "\n".join(
+                    f"{_shop_label(user_id)}: " + ", ".join(f"{item['item_name']} ({float(item['quantity']):g} {item['unit']})" for item in items)
+                    for user_id, items in owner_items.items()
+                )
+                reply_message = messages.get("owner_low_stock", MESSAGES["en"]["owner_low_stock"]).format(shop_count=len(owner_shops), shop_lines=shop_lines)
+            elif own_items:
+                reply_message = messages.get("low_stock_alert", MESSAGES["en"]["low_stock_alert"]).format(
+                    low_stock_items_list="\n".join(f"• {item['item_name']}: {float(item['quantity']):g} {item['unit']}" for item in own_items))
+            else:
+                reply_message = messages.get("low_stock_none", MESSAGES["en"]["low_stock_none"])
+            await send_whatsapp_message(sender_id, reply_message)
+            should_return_early = True
+
+        elif is_week_inquiry or is_month_inquiry:
+            if is_month_inquiry:
+                start_date, period_key = current_date.replace(day=1), "period_label_month"
+            else:
+                start_date, period_key = current_date - timedelta(days=6), "period_label_week"
+            period, item_sales = await asyncio.gather(
+                get_period_summary(sender_id, start_date, current_date),
+                get_item_sales(sender_id, start_date, current_date),
+            )
+
+            messages = MESSAGES.get(detected_language, MESSAGES["en"])
+            best_day = ""
+            if period["days"]:
+                best = max(period["days"], key=lambda day: day["sales"])
+                if best["sales"] > 0:
+                    best_day = messages.get("period_best_day", MESSAGES["en"]["period_best_day"]).format(best_date=best["rollup_date"], best_sales=best["sales"])
+            if item_sales:
+                top_items = ", ".join(f"{row['item_name']} ₹{row['sales']:.2f}" for row in item_sales[:3])
+                best_day = f"{best_day}\n{messages.get('period_top_items', MESSAGES['en']['period_top_items']).format(items=top_items)}".strip()
+            reply_message = messages.get("period_summary", MESSAGES["en"]["period_summary"]).format(
+                period_label=messages.get(period_key, MESSAGES["en"][period_key]),
+                start_date=start_date.strftime('%Y-%m-%d'),
+                end_date=current_date.strftime('%Y-%m-%d'),
+                sales=period["sales"],
+                expenses=period["expenses"],
+                purchases=period["purchases"],
+                profit=period["profit"],
+                txn_count=period["txn_count"],
+                best_day=best_day
+            ).strip()
+            await send_whatsapp_message(sender_id, reply_message)
+            should_return_early = True
+
+        elif is_earnings_inquiry:
+            # The owner roll-up is read alongside, so an owner's reply takes no longer than a single shop's
+            (today_sales, today_sales_transactions), owner_rollup = await asyncio.gather(
+                get_daily_sales_summary(sender_id, current_date),
+                get_owner_rollup(sender_id, current_date, current_date),
+            )
 
             sales_details_list = []
             if today_sales_transactions:
@@ -654,11 +1533,18 @@ async def whatsapp_webhook():
                 total_sales=today_sales,
                 sales_details=sales_details_str
             )
+            if len(owner_rollup["shops"]) > 1:
+                messages = MESSAGES.get(detected_language, MESSAGES["en"])
+                reply_message += "\n\n" + messages.get("owner_sales", MESSAGES["en"]["owner_sales"]).format(
+                    shop_count=len(owner_rollup["shops"]), sales=owner_rollup["sales"], shop_lines=_owner_shop_lines(owner_rollup["shops"], "sales", messages))
             await send_whatsapp_message(sender_id, reply_message)
             should_return_early = True
 
         elif is_balance_inquiry:
-            total_balance, recent_transactions = await get_user_transactions_summary(sender_id)
+            (total_balance, recent_transactions), owner_rollup = await asyncio.gather(
+                get_user_transactions_summary(sender_id),
+                get_owner_rollup(sender_id, current_date, current_date),
+            )
 
             transactions_summary_list = []
             for txn in recent_transactions:
@@ -681,6 +1567,10 @@ async def whatsapp_webhook():
                 balance=total_balance,
                 transactions_summary=transactions_summary_str
             )
+            if len(owner_rollup["shops"]) > 1:
+                messages = MESSAGES.get(detected_language, MESSAGES["en"])
+                reply_message += "\n\n" + messages.get("owner_balance", MESSAGES["en"]["owner_balance"]).format(
+                    shop_count=len(owner_rollup["shops"]), balance=owner_rollup["balance"], shop_lines=_owner_shop_lines(owner_rollup["shops"], "balance", messages))
 
             await send_whatsapp_message(sender_id, reply_message)
             should_return_early = True
@@ -707,7 +1597,8 @@ async def whatsapp_webhook():
 
             print(f"DEBUG: Text for structured data extraction: {text_for_extraction}")
             try:
-                raw_extracted_content = extract_structured_data(text_for_extraction, current_date)
+                is_stock_take = _active_stock_take(sender_id) is not None or any(keyword in cleaned_original_transcription or keyword in cleaned_english_translation for keyword in stock_take_keywords)
+                raw_extracted_content = await asyncio.to_thread(extract_structured_data, text_for_extraction, current_date, stock_take=is_stock_take)
                 print(f"DEBUG_APP: Raw extracted content (from data_extractor): {raw_extracted_content}")
                 extracted_data = copy.deepcopy(raw_extracted_content)
                 print(f"DEBUG_APP: Extracted structured data (after direct deep copy): {extracted_data}")
@@ -772,12 +1663,14 @@ async def _process_transaction_sync(extracted_data: dict, sender_id: str, detect
 
         items_sold = extracted_data.get("items_sold", [])
         if items_sold:
-            stock_levels = await get_stock_levels(sender_id)
+            stock_levels = await get_prefetched_stock_levels(sender_id)
             stock_map = {f"{item['item_name']}-{item['unit']}": item for item in stock_levels}
             print(f"DEBUG_STOCK: Current stock_levels: {stock_levels}")
             print(f"DEBUG_STOCK: Current stock_map keys: {list(stock_map.keys())}")
 
             target_stock_language = "hi"
+            stock_deltas = []
+            sale_transactions = []
 
             for item in items_sold:
                 item_name = item.get("item_name")
@@ -863,25 +1756,34 @@ async def _process_transaction_sync(extracted_data: dict, sender_id: str, detect
 
                     delta_for_update = -float(quantity)
 
-                    await update_stock_item(sender_id, stock_item_name_for_lookup, delta_for_update, unit, None)
+                    stock_deltas.append({"item_name": stock_item_name_for_lookup, "quantity_delta": delta_for_update, "unit": unit})
 
-                    sale_data = {
+                    # Profit is measured against the weighted-average cost of the stock on hand, not the latest purchase price
+                    cost_price_per_unit = None
+                    if final_stock_item.get("average_cost") is not None:
+                        cost_price_per_unit = float(final_stock_item["average_cost"])
+                    elif final_stock_item.get("cost_price_per_unit") is not None:
+                        cost_price_per_unit = float(final_stock_item["cost_price_per_unit"])
+                    cost_of_goods = float(quantity) * cost_price_per_unit if cost_price_per_unit is not None else None
+
+                    sale_transactions.append({
                         "date": extracted_data.get("date", current_date.strftime('%Y-%m-%d')),
                         "type": "sale",
                         "amount": selling_amount,
-                        "item": f"{stock_item_name_for_lookup} ({quantity} {item.get('unit', 'pcs')})"
-                    }
-                    await save_transaction(sale_data, sender_id)
+                        "item": f"{stock_item_name_for_lookup} ({quantity} {item.get('unit', 'pcs')})",
+                        # The structured line behind the display text, for item-level sales and margin
+                        "lines": [{
+                            "item_name": final_stock_item["item_name"], "quantity": float(quantity), "unit": unit,
+                            "unit_price": selling_amount / float(quantity) if float(quantity) else None,
+                            "amount": selling_amount, "cost": cost_of_goods,
+                        }],
+                    })
 
                     total_sales_amount += selling_amount
 
-                    cost_price_per_unit = None
-                    if final_stock_item.get("cost_price_per_unit") is not None:
-                        cost_price_per_unit = float(final_stock_item["cost_price_per_unit"])
-
                     profit_for_item = 0.0
-                    if cost_price_per_unit is not None:
-                        profit_for_item = selling_amount - (float(quantity) * cost_price_per_unit)
+                    if cost_of_goods is not None:
+                        profit_for_item = selling_amount - cost_of_goods
                         total_profit += profit_for_item
 
                     if should_show_profit and cost_price_per_unit is not None:
@@ -889,6 +1791,11 @@ async def _process_transaction_sync(extracted_data: dict, sender_id: str, detect
                     else:
                         sales_summary_messages.append(f"{final_stock_item['item_name']}: ₹{selling_amount:.2f}")
 
+            # All matched items leave stock in one batch and the sales are recorded with it
+            recorded = await record_writes(sender_id, stock_deltas=stock_deltas, transactions=sale_transactions)
+            for updated_stock_item in recorded["stock"]:
+                _remember_stock_row(stock_levels, updated_stock_item)
+
             print(f"DEBUG_REPLY: sales_summary_messages: {sales_summary_messages}")
             print(f"DEBUG_REPLY: unprocessed_items_messages: {unprocessed_items_messages}")
 
@@ -918,27 +1825,44 @@ async def _process_transaction_sync(extracted_data: dict, sender_id: str, detect
 
         items_purchased = extracted_data.get("items_purchased", [])
         if items_purchased:
+            stock_deltas = []
+            purchase_lines = []
+            # "Bought 10 Parle-G" without a price is costed at the last price paid for the item
+            price_memory = await get_prefetched_price_memory(sender_id)
             for item in items_purchased:
                 item_name = item.get("item_name")
                 quantity = item.get("quantity")
                 unit = item.get("unit", "pcs")
                 cost_price_per_unit = item.get("cost_price_per_unit")
+                price_note = ""
+                if cost_price_per_unit is None and item_name:
+                    cost_price_per_unit = price_memory.get((item_name.lower(), (unit or "").lower()))
+                    price_note = " (last price)" if cost_price_per_unit is not None else ""
 
                 if item_name and isinstance(quantity, (int, float)) and cost_price_per_unit is not None:
-                    await update_stock_item(sender_id, item_name, float(quantity), unit, cost_price_per_unit)
-                    purchase_summary_messages.append(f"{item_name}: {quantity} {unit} @ ₹{cost_price_per_unit:.2f}/{unit}")
+                    stock_deltas.append({"item_name": item_name, "quantity_delta": float(quantity), "unit": unit, "cost_price_per_unit": cost_price_per_unit})
+                    purchase_summary_messages.append(f"{item_name}: {quantity} {unit} @ ₹{cost_price_per_unit:.2f}/{unit}{price_note}")
 
-                    total_purchase_expense += float(quantity) * float(cost_price_per_unit)
+                    line_amount = float(quantity) * float(cost_price_per_unit)
+                    purchase_lines.append({"item_name": item_name, "quantity": float(quantity), "unit": unit, "unit_price": float(cost_price_per_unit), "amount": line_amount, "cost": line_amount})
+                    total_purchase_expense += line_amount
 
             if purchase_summary_messages:
+                expense_transactions = []
                 if total_purchase_expense > 0:
-                    expense_data = {
+                    expense_transactions.append({
                         "date": extracted_data.get("date", current_date.strftime('%Y-%m-%d')),
                         "type": "expense",
                         "amount": total_purchase_expense,
-                        "item": f"Stock purchase ({len(purchase_summary_messages)} items)"
-                    }
-                    await save_transaction(expense_data, sender_id)
+                        "item": f"Stock purchase ({len(purchase_summary_messages)} items)",
+                        "lines": purchase_lines,
+                    })
+
+                stock_levels = await get_prefetched_stock_levels(sender_id)
+                recorded = await record_writes(sender_id, stock_deltas=stock_deltas, transactions=expense_transactions)
+                for updated_stock_item in recorded["stock"]:
+                    _remember_stock_row(stock_levels, updated_stock_item)
+                if expense_transactions:
                     purchase_summary_messages.append(f"Total expense of ₹{total_purchase_expense:.2f} recorded.")
 
                 reply_message = MESSAGES[detected_language]["stock_update_success"].format(updates="\n".join(purchase_summary_messages))
@@ -956,7 +1880,7 @@ async def _process_transaction_sync(extracted_data: dict, sender_id: str, detect
                 "date": extracted_data.get("date", current_date.strftime('%Y-%m-%d')), "type": "expense",
                 "amount": amount, "item": description
             }
-            await save_transaction(expense_data, sender_id)
+            await record_writes(sender_id, transactions=[expense_data])
 
             if description:
                 reply_message = MESSAGES[detected_language]["expense_success"].format(amount=amount, item=description)
@@ -1007,6 +1931,13 @@ async def _process_transaction_sync(extracted_data: dict, sender_id: str, detect
                 await send_whatsapp_message(sender_id, f"Supplier '{supplier_name}' not found.")
         else:
             await send_whatsapp_message(sender_id, MESSAGES[detected_language]["extract_fail"])
+    elif transaction_type == "stock_count":
+        messages = MESSAGES.get(detected_language, MESSAGES["en"])
+        items_counted = extracted_data.get("items_counted", [])
+        if items_counted:
+            await _update_stock_take(sender_id, items_counted, messages)
+        else:
+            await _start_stock_take(sender_id, messages)
     else:
         await send_whatsapp_message(sender_id, MESSAGES[detected_language]["extract_fail"])
 
@@ -1066,6 +1997,27 @@ def serve_audio(filename):
         print(f"ERROR: Failed to serve audio file {filename}: {str(e)}")
         return ("Audio file not found", 404)
 
+@app.route("/exports/<filename>")
+def serve_export(filename):
+    print(f"DEBUG_EXPORT: Serving export file: {filename}")
+    try:
+        return send_from_directory(EXPORT_DIR, filename, as_attachment=True)
+    except Exception as e:
+        print(f"ERROR_EXPORT: Failed to serve export file {filename}: {str(e)}")
+        return ("Export not found or expired", 404)
+
+@app.route("/stock_cache/invalidate", methods=["POST"])
+def stock_cache_invalidate():
+    """Invalidation hook for stock written outside this process (e.g. SQL edits or another worker).
+    POST user_id to drop one shop, or nothing to drop every shop. Requires the X-Invalidation-Token header."""
+    expected_token = os.getenv("STOCK_CACHE_INVALIDATION_TOKEN")
+    if not expected_token or not hmac.compare_digest(request.headers.get("X-Invalidation-Token", ""), expected_token):
+        return ("Forbidden", 403)
+    user_id = request.form.get("user_id") or None
+    invalidate_stock_cache(user_id)
+    print(f"DEBUG_STOCK_CACHE: Invalidated {user_id or 'all shops'}. Stats: {get_stock_cache_stats()}")
+    return ("OK", 200)
+
 @app.route("/omnidim_post_call_webhook", methods=['POST'])
 async def omnidim_post_call_webhook():
     try:
@@ -1126,21 +2078,36 @@ async def generate_local_insights():
         return
     
     print("DEBUG_INSIGHTS: Generating local insights...")
-    unique_user_ids = await get_all_unique_user_ids_with_stock()
 
     # --- Step 1: Fetch Global Data Once ---
-    latitude = SHOPKEEPER_LOCATION["latitude"]
-    longitude = SHOPKEEPER_LOCATION["longitude"]
-    weather_data = await get_weather_forecast(latitude, longitude)
     festivals_data = get_festivals_from_llm(days_in_advance=90)
+    low_stock_by_user = await get_low_stock_items_by_user()  # One query for every shop
+    weather_by_location = {}  # Forecasts are shared by shops within ~10 km of each other
 
-    # --- Step 2: Process All Insights For Each User ---
-    for user_id in unique_user_ids:
+    # --- Step 2: Process All Insights For Each Active Shop, streamed page by page from the registry ---
+    async for shop in iter_active_shops():
+        user_id = shop["user_id"]
         print(f"DEBUG_INSIGHTS: Generating insights for user: {user_id}")
-        
-        stock_levels = await get_stock_levels(user_id)
+
+        latitude = shop.get("latitude") if shop.get("latitude") is not None else SHOPKEEPER_LOCATION["latitude"]
+        longitude = shop.get("longitude") if shop.get("longitude") is not None else SHOPKEEPER_LOCATION["longitude"]
+        location_key = (round(latitude, 1), round(longitude, 1))
+        if location_key not in weather_by_location:
+            weather_by_location[location_key] = await get_weather_forecast(latitude, longitude)
+        weather_data = weather_by_location[location_key]
+
+        stock_levels = await get_stock_levels(user_id, populate_cache=False)  # Don't evict shops that are chatting
         stock_list_str = ", ".join([item['item_name'].lower() for item in stock_levels]) if stock_levels else "कोई आइटम स्टॉक में नहीं है।"
 
+        # Forecasting input: weekly sales over the last 4 weeks, read from the daily rollups
+        today = date.today()
+        recent_rollups = await get_daily_rollups(user_id, today - timedelta(days=27), today)
+        weekly_sales = [0.0, 0.0, 0.0, 0.0]
+        for rollup in recent_rollups:
+            weeks_ago = (today - date.fromisoformat(rollup["rollup_date"])).days // 7
+            weekly_sales[3 - weeks_ago] += rollup["sales"]
+        sales_trend_summary = "पिछले 4 हफ्तों की बिक्री (पुराने से नए): " + ", ".join(f"₹{week_sales:.0f}" for week_sales in weekly_sales) if recent_rollups else "पिछली बिक्री का डेटा उपलब्ध नहीं है।"
+
         # --- Step 3: Create a Hindi-focused, Concise, and Structured Prompt ---
         weather_summary = "मौसम का पूर्वानुमान अभी उपलब्ध नहीं है।"
         if weather_data and "daily" in weather_data:
@@ -1163,9 +2130,10 @@ async def generate_local_insights():
         1.  **14-Day Weather Forecast:** {weather_summary}
         2.  **Upcoming Festivals:** {festival_summary}
         3.  **Current Inventory:** {stock_list_str}
+        4.  **Sales Trend:** {sales_trend_summary}
 
         **Your Tasks (in Hindi):**
-        1.  **Opportunities:** Identify 2 key sales opportunities, one for weather and one for festivals.
+        1.  **Opportunities:** Identify 2 key sales opportunities, one for weather and one for festivals. Use the sales trend to judge how much demand to expect.
         2.  **Recommendations:** Provide two separate lists of recommendations:
             - A list named `weather_recommendations` with 2 products based ONLY on the weather.
             - A list named `festival_recommendations` with 2-3 products based ONLY on the festivals.
@@ -1245,7 +2213,7 @@ async def generate_local_insights():
                     final_message_parts.append(f"• **{action_text}: {item}** (संभावना: {potential})\n  - *कारण: {reason}*")
             
             # --- Step 6: Add Low-Stock Alert to the Same Message ---
-            low_stock_items = await get_low_stock_items(user_id)
+            low_stock_items = low_stock_by_user.get(user_id, [])
             if low_stock_items:
                 final_message_parts.append("\n⚠️ **कम स्टॉक की चेतावनी!**")
                 for item in low_stock_items:
@@ -1274,10 +2242,24 @@ if __name__ == "__main__":
         # Initialize a Manager for shared state between processes
         manager = Manager()
         call_states = manager.dict() # Use Manager dictionary for process-safe state
+        # Replay writes the previous run acknowledged but had not yet applied to the database
+        start_write_behind_ledger()
         
     # Initialize and start the scheduler when the app starts
         if not scheduler.running:
             scheduler.add_job(generate_local_insights, 'interval', seconds=30, id='generate_insights_job', replace_existing=True)
+            # Parked duplicate-bill photos are deleted once their prompt expires, even if the sender never writes again
+            scheduler.add_job(expire_pending_duplicate_bills, 'interval', seconds=PENDING_DUPLICATE_BILL_TTL_SECONDS, id='expire_pending_duplicate_bills_job', replace_existing=True)
+            # Nightly set-based recompute of yesterday's rollups for all shops
+            scheduler.add_job(recompute_daily_rollups, 'cron', hour=0, minute=15, id='recompute_daily_rollups_job', replace_existing=True)
+            # Keep next months' transaction partitions created ahead of time
+            scheduler.add_job(ensure_transaction_partitions, 'cron', hour=1, minute=0, id='ensure_transaction_partitions_job', replace_existing=True)
+            # Nightly check that the trigger-maintained shop balances still match the ledger
+            scheduler.add_job(reconcile_shop_balances, 'cron', hour=2, minute=30, id='reconcile_shop_balances_job', replace_existing=True)
+            # Nightly stock snapshots keep "stock as of" lookups to at most a day of movements per item
+            scheduler.add_job(take_stock_snapshots, 'cron', hour=3, minute=0, id='take_stock_snapshots_job', replace_existing=True)
+            # Monthly move of transactions older than TRANSACTION_ARCHIVE_MONTHS to the archive tables
+            scheduler.add_job(archive_old_transactions, 'cron', day=1, hour=3, minute=30, id='archive_old_transactions_job', replace_existing=True)
         # Removed the low stock alert scheduler job
         # scheduler.add_job(check_low_stock_and_alert, 'interval', seconds=30, id='check_low_stock_and_alert', replace_existing=True)
         scheduler_thread = Thread(target=_run_scheduler)
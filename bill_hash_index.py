@@ -0,0 +1,221 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from storage import get_bill_image_hashes, save_bill_image_hash
+
+HASH_BITS = 64
+BILL_DUPLICATE_MAX_DISTANCE = 10  # Hamming distance up to which two bill photos are candidates for the same bill
+# The 64-bit hash of a 9x8 thumbnail mostly sees the layout, so bills printed on one supplier's template
+# come out close. A candidate is confirmed on a 256-bit hash of a 17x16 thumbnail, which sees the rows.
+DETAIL_HASH_SIZE = 16
+BILL_DUPLICATE_MAX_DETAIL_DISTANCE = 32
+BILL_DUPLICATE_LEGACY_MAX_DISTANCE = 4  # For bills stored before detail hashes, which only have the 64-bit hash
+BILL_HASH_MAX_USERS = int(os.getenv("BILL_HASH_MAX_USERS", "1000"))  # LRU bound on the users whose hashes are kept in memory
+MIH_CHUNKS = 4  # Multi-index hashing: the 64-bit hash is split into 4 x 16-bit substrings
+_CHUNK_BITS = HASH_BITS // MIH_CHUNKS
+_CHUNK_MASK = (1 << _CHUNK_BITS) - 1
+
+
+def _difference_hash(image, size: int) -> int:
+    """dHash of a grayscale image: one bit per horizontally neighbouring pixel pair of a (size + 1) x size thumbnail."""
+    from PIL import Image
+
+    pixels = list(image.resize((size + 1, size), Image.LANCZOS).getdata())
+    image_hash = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            right = pixels[row * (size + 1) + column + 1]
+            image_hash = (image_hash << 1) | (1 if left > right else 0)
+    return image_hash
+
+
+def compute_bill_hashes(image_file_path: str) -> tuple[int, int]:
+    """Computes the 64-bit and the 256-bit difference hash (dHash) of a bill photo.
+
+    The hashes compare the brightness of neighbouring pixels on a 9x8 and a 17x16 thumbnail,
+    so they are stable under lighting changes, recompression and small shifts in framing.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(image_file_path) as opened_image:
+        image = ImageOps.exif_transpose(opened_image).convert("L")
+    return _difference_hash(image, 8), _difference_hash(image, DETAIL_HASH_SIZE)
+
+
+def hamming_distance(first_hash: int, second_hash: int) -> int:
+    return (first_hash ^ second_hash).bit_count()
+
+
+def _neighbours_within(value: int, bits: int, radius: int):
+    """Yields every `bits`-wide integer within Hamming distance `radius` of `value`."""
+    yield value
+    if radius == 0:
+        return
+    frontier = [(value, -1)]
+    for _ in range(radius):
+        next_frontier = []
+        for current, last_flipped in frontier:
+            for bit in range(last_flipped + 1, bits):
+                flipped = current ^ (1 << bit)
+                yield flipped
+                next_frontier.append((flipped, bit))
+        frontier = next_frontier
+
+
+class MultiIndexHashTable:
+    """Hamming-distance index over 64-bit hashes using multi-index hashing.
+
+    If two hashes differ in at most r bits, then by the pigeonhole principle at least one
+    of the MIH_CHUNKS substrings differs in at most r // MIH_CHUNKS bits. A lookup therefore
+    probes each substring table with every value within that small radius and only verifies
+    the full distance for the few candidates found, instead of scanning every stored hash.
+    """
+
+    def __init__(self):
+        self._tables = [dict() for _ in range(MIH_CHUNKS)]
+        self._hashes = {}  # hash -> payloads of every entry added under it, oldest first
+
+    def __len__(self):
+        return len(self._hashes)
+
+    @staticmethod
+    def _chunks(image_hash: int) -> list[int]:
+        return [(image_hash >> (chunk * _CHUNK_BITS)) & _CHUNK_MASK for chunk in range(MIH_CHUNKS)]
+
+    def add(self, image_hash: int, payload=None):
+        if image_hash in self._hashes:
+            # Different bills can share a hash (e.g. one supplier's template); each keeps its payload
+            self._hashes[image_hash].append(payload)
+            return
+        self._hashes[image_hash] = [payload]
+        for table, chunk_value in zip(self._tables, self._chunks(image_hash)):
+            table.setdefault(chunk_value, []).append(image_hash)
+
+    def payloads(self, image_hash: int) -> list:
+        return list(self._hashes.get(image_hash, ()))
+
+    def search(self, image_hash: int, max_distance: int = BILL_DUPLICATE_MAX_DISTANCE) -> list[tuple[int, int, object]]:
+        """Returns (distance, stored_hash, payloads) for every stored hash within `max_distance`, nearest first."""
+        chunk_radius = max_distance // MIH_CHUNKS
+        seen = set()
+        matches = []
+        for table, chunk_value in zip(self._tables, self._chunks(image_hash)):
+            for probe in _neighbours_within(chunk_value, _CHUNK_BITS, chunk_radius):
+                for candidate in table.get(probe, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = hamming_distance(image_hash, candidate)
+                    if distance <= max_distance:
+                        matches.append((distance, candidate, self._hashes[candidate]))
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+class BillHashIndex:
+    """Per-user index of the bill photos already processed, backed by the `bill_image_hashes` table.
+
+    Users' tables are loaded on first use and kept in an LRU bounded by `max_users`.
+    """
+
+    def __init__(self, max_users: int = BILL_HASH_MAX_USERS):
+        self.max_users = max_users
+        self._user_tables = OrderedDict()
+        self._lock = threading.Lock()  # Webhook requests run on different event loops/threads
+
+    async def _table_for(self, user_id: str) -> MultiIndexHashTable:
+        with self._lock:
+            table = self._user_tables.get(user_id)
+            if table is not None:
+                self._user_tables.move_to_end(user_id)
+                return table
+        stored_hashes = await get_bill_image_hashes(user_id)
+        loaded_table = MultiIndexHashTable()
+        for row in stored_hashes:
+            loaded_table.add(row["image_hash"], {"created_at": row.get("created_at"), "detail_hash": row.get("detail_hash")})
+        with self._lock:
+            # Another request may have loaded the same user meanwhile; keep the first table
+            table = self._user_tables.setdefault(user_id, loaded_table)
+            self._user_tables.move_to_end(user_id)
+            while len(self._user_tables) > self.max_users:
+                self._user_tables.popitem(last=False)
+            return table
+
+    @staticmethod
+    def _is_same_bill(distance: int, detail_hash: int | None, stored: dict) -> bool:
+        if detail_hash is None or stored["detail_hash"] is None:
+            return distance <= BILL_DUPLICATE_LEGACY_MAX_DISTANCE
+        return hamming_distance(detail_hash, stored["detail_hash"]) <= BILL_DUPLICATE_MAX_DETAIL_DISTANCE
+
+    async def find_near_duplicate(self, user_id: str, image_hash: int, detail_hash: int | None = None) -> tuple[int, int, dict] | None:
+        """Returns (distance, stored_hash, {"created_at", "detail_hash"}) of the closest previously processed
+        bill that both hashes match, if any."""
+        table = await self._table_for(user_id)
+        started_at = time.perf_counter()
+        with self._lock:
+            candidates = table.search(image_hash)
+        # Each stored bill under a matching image hash is checked on its own detail hash
+        matches = [
+            (distance, stored_hash, stored)
+            for distance, stored_hash, stored_bills in candidates
+            for stored in stored_bills
+            if self._is_same_bill(distance, detail_hash, stored)
+        ]
+        print(f"DEBUG_BILL_HASH: Lookup over {len(table)} hashes for {user_id} took {(time.perf_counter() - started_at) * 1000:.2f} ms, "
+              f"{len(candidates)} candidates, {len(matches)} confirmed.")
+        return matches[0] if matches else None
+
+    async def remember(self, user_id: str, image_hash: int, detail_hash: int | None = None):
+        """Records a processed bill so later re-photographs of it are caught."""
+        table = await self._table_for(user_id)
+        with self._lock:
+            if not any(stored["detail_hash"] == detail_hash for stored in table.payloads(image_hash)):
+                table.add(image_hash, {"created_at": None, "detail_hash": detail_hash})
+        await save_bill_image_hash(user_id, image_hash, detail_hash)
+
+
+bill_hash_index = BillHashIndex()
+
+
+if __name__ == "__main__":
+    print("--- Benchmarking near-duplicate lookup at 100k stored hashes ---")
+    random.seed(7)
+    table = MultiIndexHashTable()
+    stored = [random.getrandbits(HASH_BITS) for _ in range(100_000)]
+    started_at = time.perf_counter()
+    for stored_hash in stored:
+        table.add(stored_hash)
+    print(f"Built index of {len(table)} hashes in {time.perf_counter() - started_at:.2f} s")
+
+    # Half the queries are re-photographs (a few bits flipped), half are new bills
+    queries = []
+    for query_number in range(1000):
+        if query_number % 2 == 0:
+            near_copy = random.choice(stored)
+            for bit in random.sample(range(HASH_BITS), random.randint(1, BILL_DUPLICATE_MAX_DISTANCE)):
+                near_copy ^= 1 << bit
+            queries.append((near_copy, True))
+        else:
+            queries.append((random.getrandbits(HASH_BITS), False))
+
+    timings = []
+    found_duplicates = 0
+    for query_hash, is_duplicate in queries:
+        started_at = time.perf_counter()
+        matches = table.search(query_hash)
+        timings.append(time.perf_counter() - started_at)
+        if is_duplicate and matches:
+            found_duplicates += 1
+    timings.sort()
+    print(f"Lookup latency: p50 {timings[len(timings) // 2] * 1000:.3f} ms, p99 {timings[int(len(timings) * 0.99)] * 1000:.3f} ms")
+    print(f"Near-duplicates found: {found_duplicates}/500")
+
+    # Sanity check against a linear scan for a handful of queries
+    for query_hash, _ in queries[:20]:
+        expected = sorted(stored_hash for stored_hash in stored if hamming_distance(query_hash, stored_hash) <= BILL_DUPLICATE_MAX_DISTANCE)
+        assert sorted(match[1] for match in table.search(query_hash)) == expected
+    print("Multi-index results match a linear scan.")
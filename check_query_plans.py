@@ -0,0 +1,138 @@
+import json
+
+from migrate import connect
+
+SAMPLE_USER_ID = "whatsapp:+1234567890"
+
+# The read paths behind supabase_client.py's exported functions, written as the SQL that
+# PostgREST / the RPC functions run. `single_partition` queries are bounded to one day, so they
+# must be pruned to one monthly partition of `transactions`.
+# reconcile_shop_balances is left out on purpose: it scans the whole ledger by design.
+HOT_QUERIES = [
+    {
+        "name": "get_user_transactions_summary (recent)",
+        "sql": f"SELECT transaction_date, transaction_type, amount, item FROM transactions WHERE user_id = '{SAMPLE_USER_ID}' ORDER BY created_at DESC LIMIT 5",
+    },
+    {
+        "name": "get_total_balance",
+        "sql": f"SELECT balance FROM shop_balances WHERE user_id = '{SAMPLE_USER_ID}' LIMIT 1",
+    },
+    {
+        "name": "get_daily_sales_summary (details)",
+        "sql": f"SELECT item, amount FROM transactions WHERE user_id = '{SAMPLE_USER_ID}' AND transaction_type = 'sale' AND transaction_date = CURRENT_DATE ORDER BY created_at DESC LIMIT 10",
+        "single_partition": True,
+    },
+    {
+        "name": "get_daily_rollups",
+        "sql": f"SELECT rollup_date, sales, expenses, purchases, profit, txn_count FROM daily_rollups WHERE user_id = '{SAMPLE_USER_ID}' AND rollup_date >= CURRENT_DATE - 30 AND rollup_date <= CURRENT_DATE ORDER BY rollup_date",
+    },
+    {
+        "name": "recompute_daily_rollups",
+        "sql": "SELECT user_id, SUM(amount), COUNT(*) FROM transactions WHERE transaction_date = CURRENT_DATE - 1 GROUP BY user_id",
+        "single_partition": True,
+    },
+    {
+        "name": "get_item_sales",
+        "sql": f"SELECT item_name, SUM(quantity), SUM(amount), SUM(cost) FROM transaction_lines WHERE user_id = '{SAMPLE_USER_ID}' AND item_name = 'rice' AND transaction_date BETWEEN CURRENT_DATE - 30 AND CURRENT_DATE AND transaction_type = 'sale' GROUP BY item_name",
+    },
+    {
+        "name": "search_item_history (trigram)",
+        "sql": f"SELECT item_name, SUM(quantity), SUM(amount), MAX(transaction_date) FROM transaction_lines WHERE user_id = '{SAMPLE_USER_ID}' AND 'parle' <% lower(item_name) AND transaction_date BETWEEN CURRENT_DATE - 365 AND CURRENT_DATE GROUP BY item_name",
+    },
+    {
+        "name": "iter_transaction_pages (keyset)",
+        "sql": f"SELECT id, transaction_date, transaction_type, amount, item, created_at FROM transactions WHERE user_id = '{SAMPLE_USER_ID}' AND transaction_date >= CURRENT_DATE - 365 AND transaction_date <= CURRENT_DATE AND (transaction_date > CURRENT_DATE - 30 OR (transaction_date = CURRENT_DATE - 30 AND id > '00000000-0000-0000-0000-000000000000')) ORDER BY transaction_date, id LIMIT 5000",
+    },
+    {
+        "name": "iter_stock_movement_pages (keyset)",
+        "sql": f"SELECT id, stock_item_id, item_name, movement_type, quantity_delta, unit_cost, average_cost_after, created_at FROM stock_movements WHERE user_id = '{SAMPLE_USER_ID}' AND created_at >= CURRENT_DATE - 365 AND created_at < CURRENT_DATE + 1 AND (created_at > NOW() - INTERVAL '30 days' OR (created_at = NOW() - INTERVAL '30 days' AND id > 0)) ORDER BY created_at, id LIMIT 5000",
+    },
+    {
+        "name": "get_stock_levels",
+        "sql": f"SELECT * FROM stock_items WHERE user_id = '{SAMPLE_USER_ID}' ORDER BY item_name",
+    },
+    {
+        "name": "apply_stock_delta (row lookup)",
+        "sql": f"SELECT * FROM stock_items WHERE user_id = '{SAMPLE_USER_ID}' AND item_name = 'rice' FOR UPDATE",
+    },
+    {
+        "name": "get_stock_as_of (movements since snapshot)",
+        "sql": f"SELECT SUM(quantity_delta) FROM stock_movements WHERE stock_item_id = (SELECT id FROM stock_items WHERE user_id = '{SAMPLE_USER_ID}' LIMIT 1) AND id > 0 AND created_at <= NOW()",
+    },
+    {
+        "name": "get_low_stock_items",
+        "sql": f"SELECT * FROM stock_items WHERE user_id = '{SAMPLE_USER_ID}' AND quantity <= min_quantity_threshold ORDER BY item_name",
+    },
+    {
+        "name": "get_low_stock_items_by_user",
+        "sql": "SELECT * FROM stock_items WHERE quantity <= min_quantity_threshold ORDER BY user_id, item_name",
+    },
+    {
+        "name": "get_owner_rollup",
+        "sql": f"SELECT o.user_id, b.balance, SUM(r.sales), SUM(r.txn_count) FROM owner_shops o LEFT JOIN shop_balances b ON b.user_id = o.user_id LEFT JOIN daily_rollups r ON r.user_id = o.user_id AND r.rollup_date BETWEEN CURRENT_DATE - 6 AND CURRENT_DATE WHERE o.owner_id = '{SAMPLE_USER_ID}' GROUP BY o.user_id, b.balance",
+    },
+    {
+        "name": "get_owner_low_stock_items",
+        "sql": f"SELECT s.* FROM owner_shops o JOIN stock_items s ON s.user_id = o.user_id AND s.quantity <= s.min_quantity_threshold WHERE o.owner_id = '{SAMPLE_USER_ID}' ORDER BY s.user_id, s.item_name",
+    },
+    {
+        "name": "iter_active_shops",
+        "sql": "SELECT user_id, language, latitude, longitude FROM shops WHERE status = 'active' AND user_id > '' ORDER BY user_id LIMIT 500",
+    },
+    {
+        "name": "get_shop",
+        "sql": f"SELECT user_id, language, latitude, longitude, status FROM shops WHERE user_id = '{SAMPLE_USER_ID}' LIMIT 1",
+    },
+    {
+        "name": "get_bill_image_hashes",
+        "sql": f"SELECT image_hash, created_at FROM bill_image_hashes WHERE user_id = '{SAMPLE_USER_ID}'",
+    },
+]
+
+
+def _plan_nodes(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def check_query(conn, query: dict) -> list[str]:
+    """EXPLAINs one query and returns the problems found (empty if it can use indexes)."""
+    # With sequential scans disabled the planner still picks one if no index can serve the query,
+    # so this detects missing indexes even on a small development database.
+    with conn.transaction():
+        conn.execute("SET LOCAL enable_seqscan = off")
+        plan = conn.execute(f"EXPLAIN (FORMAT JSON) {query['sql']}").fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    problems = []
+    scanned_partitions = set()
+    for node in _plan_nodes(plan[0]["Plan"]):
+        relation = node.get("Relation Name")
+        if node["Node Type"] == "Seq Scan":
+            problems.append(f"sequential scan on {relation}")
+        if relation and relation.startswith("transactions_"):
+            scanned_partitions.add(relation)
+    if query.get("single_partition") and len(scanned_partitions) > 1:
+        problems.append(f"not pruned to one partition (scans {sorted(scanned_partitions)})")
+    return problems
+
+
+def main() -> int:
+    """Checks every hot query; returns a non-zero exit status if any cannot use an index."""
+    failures = 0
+    with connect() as conn:
+        for query in HOT_QUERIES:
+            problems = check_query(conn, query)
+            if problems:
+                failures += 1
+                print(f"FAIL  {query['name']}: {'; '.join(problems)}")
+            else:
+                print(f"ok    {query['name']}")
+    print(f"{len(HOT_QUERIES) - failures}/{len(HOT_QUERIES)} queries use indexes.")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
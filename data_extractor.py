@@ -4,16 +4,50 @@ from openai import OpenAI
 import json
 from datetime import date # Import date
 import base64 # Import base64 for image encoding
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fuzzywuzzy import fuzz
+from tenacity import retry, stop_after_attempt, wait_fixed
 
 load_dotenv()
 
 client = OpenAI()
 
+# --- Long voice notes ---
+# Notes longer than this are split at pauses and the pieces are transcribed in parallel.
+LONG_NOTE_THRESHOLD_SECONDS = 60
+LONG_NOTE_TARGET_CHUNK_SECONDS = 30
+LONG_NOTE_MAX_CHUNK_SECONDS = 45  # Hard cut if the speaker never pauses
+LONG_NOTE_MIN_SILENCE_MS = 400
+LONG_NOTE_SILENCE_OFFSET_DB = 16  # A pause is anything this much quieter than the note's average loudness
+LONG_NOTE_MAX_WORKERS = 6
+
+
+class TranscriptionFailed(Exception):
+    """Raised when no chunk of a long voice note could be transcribed."""
+
 def transcribe_audio(audio_file_path: str) -> dict:
     """
     Transcribes an audio file to text using OpenAI Whisper.
     Assumes the audio file is in a supported format (e.g., mp3, wav, m4a).
+    Notes longer than LONG_NOTE_THRESHOLD_SECONDS are handed to `transcribe_long_audio`.
     """
+    audio = None
+    try:
+        from pydub import AudioSegment
+        audio = AudioSegment.from_file(audio_file_path)
+    except Exception as e:
+        print(f"DEBUG_TRANSCRIPT: Could not measure note length, transcribing in one request: {e}")
+    if audio is not None and len(audio) > LONG_NOTE_THRESHOLD_SECONDS * 1000:
+        try:
+            return transcribe_long_audio(audio_file_path, audio)
+        except TranscriptionFailed:
+            # Every chunk already failed after its retries; one request for the whole note would not fare better
+            raise
+        except Exception as e:
+            print(f"Error during chunked transcription, transcribing in one request: {e}")
+
     try:
         with open(audio_file_path, "rb") as audio_file:
             # Transcribe without specifying a target language first to detect the original language
@@ -46,24 +80,115 @@ def transcribe_audio(audio_file_path: str) -> dict:
         print(f"Error during transcription: {e}")
         return {"detected_language": "en", "original_transcription": "", "english_translation": ""}
 
-def extract_structured_data(text: str, reference_date: date) -> dict:
+@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+def _transcribe_chunk(chunk_file_path: str) -> dict:
+    """Transcribes and translates one chunk of a long note. Retried on its own if it fails."""
+    with open(chunk_file_path, "rb") as audio_file:
+        transcript = client.audio.transcriptions.create(
+            model="whisper-1",
+            file=audio_file,
+            response_format="verbose_json",
+        )
+    with open(chunk_file_path, "rb") as audio_file:
+        translation = client.audio.translations.create(
+            model="whisper-1",
+            file=audio_file,
+            response_format="text",
+        )
+    return {"detected_language": transcript.language, "original_transcription": transcript.text, "english_translation": translation}
+
+def _find_chunk_boundaries(audio) -> list[tuple[int, int]]:
+    """Picks (start_ms, end_ms) chunk boundaries at pauses close to the target chunk length."""
+    from pydub.silence import detect_silence
+
+    silences = detect_silence(audio, min_silence_len=LONG_NOTE_MIN_SILENCE_MS, silence_thresh=audio.dBFS - LONG_NOTE_SILENCE_OFFSET_DB)
+    cut_points = [(silence_start + silence_end) // 2 for silence_start, silence_end in silences]
+
+    boundaries = []
+    start = 0
+    total = len(audio)
+    while total - start > LONG_NOTE_MAX_CHUNK_SECONDS * 1000:
+        target = start + LONG_NOTE_TARGET_CHUNK_SECONDS * 1000
+        window_end = start + LONG_NOTE_MAX_CHUNK_SECONDS * 1000
+        candidates = [point for point in cut_points if start + 5000 < point <= window_end]
+        end = min(candidates, key=lambda point: abs(point - target)) if candidates else window_end
+        boundaries.append((start, end))
+        start = end
+    boundaries.append((start, total))
+    return boundaries
+
+def transcribe_long_audio(audio_file_path: str, audio=None) -> dict:
+    """Transcribes a long voice note by splitting it at pauses and transcribing the chunks concurrently.
+
+    The chunk transcripts are stitched back in order, so the result has the same shape as
+    `transcribe_audio`. 'failed_chunks' counts chunks that still failed after their retries;
+    if all of them failed, TranscriptionFailed is raised.
+    """
+    from pydub import AudioSegment
+
+    if audio is None:
+        audio = AudioSegment.from_file(audio_file_path)
+    boundaries = _find_chunk_boundaries(audio)
+    base_path = os.path.splitext(audio_file_path)[0]
+    chunk_paths = []
+    for chunk_index, (start, end) in enumerate(boundaries):
+        chunk_path = f"{base_path}_chunk{chunk_index}.mp3"
+        audio[start:end].export(chunk_path, format="mp3")
+        chunk_paths.append(chunk_path)
+    print(f"DEBUG_TRANSCRIPT: Split {len(audio) / 1000:.1f}s note into {len(boundaries)} chunks: {[(start / 1000, end / 1000) for start, end in boundaries]}")
+
+    def transcribe_chunk(chunk_index: int) -> tuple[dict | None, float]:
+        started_at = time.perf_counter()
+        try:
+            return _transcribe_chunk(chunk_paths[chunk_index]), time.perf_counter() - started_at
+        except Exception as e:
+            print(f"Error during transcription of chunk {chunk_index}: {e}")
+            return None, time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=min(LONG_NOTE_MAX_WORKERS, len(chunk_paths))) as executor:
+            chunk_results = list(executor.map(transcribe_chunk, range(len(chunk_paths))))
+    finally:
+        for chunk_path in chunk_paths:
+            if os.path.exists(chunk_path):
+                os.remove(chunk_path)
+    chunk_timings_ms = [round(seconds * 1000, 1) for _, seconds in chunk_results]
+    print(f"DEBUG_TRANSCRIPT: Chunk timings (ms): {chunk_timings_ms}, total wall time: {round((time.perf_counter() - started_at) * 1000, 1)}")
+
+    transcripts = [result for result, _ in chunk_results if result is not None]
+    if not transcripts:
+        raise TranscriptionFailed(f"None of the {len(chunk_results)} parts of the voice note could be transcribed")
+    languages = [transcript["detected_language"] for transcript in transcripts]
+    return {
+        "detected_language": max(set(languages), key=languages.count),
+        "original_transcription": " ".join(transcript["original_transcription"].strip() for transcript in transcripts),
+        "english_translation": " ".join(transcript["english_translation"].strip() for transcript in transcripts),
+        "failed_chunks": len(chunk_results) - len(transcripts),
+    }
+
+def extract_structured_data(text: str, reference_date: date, stock_take: bool = False) -> dict:
     """
     Extracts structured data from text, now supporting multiple items for order confirmations.
+    With stock_take=True (a stock-take is in progress) a bare list of items and quantities is read as a stock count.
     """
     formatted_reference_date = reference_date.strftime('%Y-%m-%d')
+    stock_take_note = "\n    The shopkeeper is in the middle of a stock-take: a plain list of items and quantities without prices is a 'stock_count'.\n" if stock_take else ""
 
     # CORRECTED: The 'order_confirmation' type now supports a list of items.
     prompt = f"""
     From the following text, extract transaction details into a strict JSON format.
     Use today's date, {formatted_reference_date}, if no other date is mentioned.
-    Determine the 'type' as 'sale', 'purchase', 'expense', or 'order_confirmation'.
+    Determine the 'type' as 'sale', 'purchase', 'expense', 'order_confirmation' or 'stock_count'.
 
     - For 'sale', extract `items_sold`: `[ {{"item_name": str, "quantity": float, "unit": str, "selling_amount": float}} ]`.
     - For 'purchase', extract `items_purchased`: `[ {{"item_name": str, "quantity": float, "unit": str, "cost_price_per_unit": float}} ]`.
     - For 'expense', extract `amount` (float) and `description` (str).
     - For 'order_confirmation', extract a top-level `supplier_name` (str) and a list of `items_to_order`: `[ {{"item_name": str, "quantity": float, "unit": str}} ]`.
       The `unit` must be in English (e.g., 'kg', 'pcs', 'packet', 'litre'). Default to 'pcs' if not specified.
-
+    - For 'stock_count' (a physical count of what is on the shelves, e.g. "stock take: rice 20 kg, sugar 12 kg"), extract `items_counted`: `[ {{"item_name": str, "quantity": float, "unit": str}} ]`.
+      It is an empty list when the shopkeeper only asks to start a stock-take. Units as for 'order_confirmation'.
+{stock_take_note}
     Text: "{text}"
     """
 
@@ -92,9 +217,166 @@ def encode_image(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode("utf-8")
 
+# --- Tiled extraction for long receipts ---
+# "auto" tiles only tall photos, "always" tiles every bill, "off" always sends the whole image in one call.
+BILL_TILING_MODE = os.getenv("BILL_TILING_MODE", "auto").lower()
+BILL_TILE_MIN_ASPECT_RATIO = 2.0  # height / width above which a bill is considered "long"
+BILL_TILE_BAND_ASPECT_RATIO = 1.0  # height / width of each band before overlap is added
+BILL_TILE_OVERLAP_FRACTION = 0.15  # Fraction of a band repeated in the next one so no row is cut in half
+BILL_TILE_MAX_WORKERS = 6
+BILL_TILE_DEDUPE_WINDOW = 4  # How many trailing items of a band can reappear at the top of the next band
+
+EMPTY_BILL_RESULT = {"bill_type": "unknown", "items": [], "detected_language": "en"}
+
+def _bill_extraction_prompt(tile_note: str = "") -> str:
+    # Define the JSON example as a Python dictionary, then convert to JSON string
+    bill_example_dict = {"bill_type": "purchase", "items": [{"item_name": "Milk", "quantity": 2.0, "unit": "kg", "num_packets": 1, "cost_price_per_unit": 50.0, "selling_price_per_unit": None}, {"item_name": "Bread", "quantity": 1.0, "unit": "packet", "num_packets": 2, "cost_price_per_unit": None, "selling_price_per_unit": 30.0}]}
+    bill_example_json = json.dumps(bill_example_dict)
+    return f"{tile_note}From this bill photo, first determine the primary language of the text on the bill, returning its ISO 639-1 code (e.g., 'en' for English, 'hi' for Hindi, 'pa' for Punjabi, 'gu' for Gujarati, 'ta' for Tamil, 'te' for Telugu, 'bn' for Bengali, 'mr' for Marathi). If the language is ambiguous or not one of these, default to 'en'. Then, determine if it is a 'purchase invoice' (from a supplier) or a 'sales receipt' (to a customer). If ambiguous, categorize as 'unknown'. To classify, look for keywords like \"invoice\", \"purchase\", \"supplier\" for purchases, or \"receipt\", \"sale\", \"customer\" for sales. **Crucially, if there is a column of prices on the far right and the items listed are typical inventory for a shopkeeper, interpret these prices as `cost_price_per_unit` and classify the bill as a 'purchase' invoice.** If prices are listed in a way that clearly indicates what the shopkeeper sold items for, assume they are **selling_price_per_unit** and the bill is a 'sale' receipt. Then, extract the item names, their precise quantities (including fractional values like 0.5 for 1/2), their corresponding units (e.g., kg, g, dozen, pcs, packet), the number of packets/items (the standalone number in a separate column), the **cost price per unit** (if written on the bill, often next to the item or quantity, and typically on purchase invoices). **IMPORTANT: If a total price is given for a quantity (e.g., '500 g Rajma, ₹80'), calculate the `cost_price_per_unit` as the total price divided by the quantity. For gram units, ensure `cost_price_per_unit` is truly per gram (e.g., for '500 g Rajma, ₹80', `cost_price_per_unit` should be 0.16).** And the **selling price per unit** (if written on the bill, often next to the item or quantity, and typically on sales receipts). **Prioritize quantity and unit that are found together next to the item name (e.g., '1 Kg' for 'बासमती चावल').** If there is a separate column of numbers (like the column 2, 3, 1, 4, 2, 1 in a provided image), interpret those numbers as the 'num_packets'. If a quantity, unit, num_packets, cost_price_per_unit, or selling_price_per_unit is not explicitly mentioned or found for an item, assume a quantity of 1, a unit of \"pcs\", num_packets of 1, and `cost_price_per_unit`/`selling_price_per_unit` as null. If an item is unclear, **do not include it** in the output. Provide the output strictly as a JSON object with a top-level key 'detected_language' (string), 'bill_type' (string: \"purchase\", \"sale\", or \"unknown\") and another top-level key 'items' which is an array of objects. Each object in the 'items' array should have: 'item_name' (string), 'quantity' (numeric, e.g., 2.0 or 0.5), 'unit' (string), 'num_packets' (integer), 'cost_price_per_unit' (numeric or null), and 'selling_price_per_unit' (numeric or null). List the items in the order they appear from top to bottom. Example: {bill_example_json}"
+
+def _request_bill_items(base64_image: str, tile_note: str = "") -> dict:
+    """Sends one (whole or partial) bill image to the Vision API and parses the JSON it returns."""
+    response = client.chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": _bill_extraction_prompt(tile_note)},
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+                ]
+            },
+        ],
+        max_tokens=1000
+    )
+    content = response.choices[0].message.content
+    # The content might be wrapped in markdown code block, so we need to extract the JSON string
+    if content.startswith("```json") and content.endswith("```"):
+        json_string = content[7:-3].strip()
+    else:
+        json_string = content.strip()
+
+    try:
+        return json.loads(json_string)
+    except json.JSONDecodeError:
+        print(f"Raw API response content: {content}") # Print raw content for debugging
+        raise
+
+def _split_bill_into_bands(image_file_path: str) -> list[str]:
+    """Splits a tall bill photo into overlapping horizontal bands, returned as base64 JPEGs.
+
+    Returns an empty list when the image should be sent whole (short bill, tiling disabled,
+    or Pillow not installed).
+    """
+    if BILL_TILING_MODE == "off":
+        return []
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        print("DEBUG_TILING: Pillow is not installed, sending the bill as a single image.")
+        return []
+
+    with Image.open(image_file_path) as opened_image:
+        image = ImageOps.exif_transpose(opened_image).convert("RGB")
+    width, height = image.size
+    if BILL_TILING_MODE != "always" and height / width < BILL_TILE_MIN_ASPECT_RATIO:
+        return []
+
+    band_height = int(width * BILL_TILE_BAND_ASPECT_RATIO)
+    overlap = int(band_height * BILL_TILE_OVERLAP_FRACTION)
+    bands = []
+    top = 0
+    while top < height:
+        bottom = min(height, top + band_height + overlap)
+        buffer = io.BytesIO()
+        image.crop((0, top, width, bottom)).save(buffer, format="JPEG", quality=90)
+        bands.append(base64.b64encode(buffer.getvalue()).decode("utf-8"))
+        if bottom >= height:
+            break
+        top += band_height
+    print(f"DEBUG_TILING: Split {width}x{height} bill into {len(bands)} bands of {band_height}px (+{overlap}px overlap).")
+    return bands if len(bands) > 1 else []
+
+def _bill_item_key(item: dict) -> tuple:
+    return (
+        str(item.get("item_name", "")).strip().lower(),
+        item.get("quantity"),
+        str(item.get("unit", "")).strip().lower(),
+        item.get("cost_price_per_unit"),
+        item.get("selling_price_per_unit"),
+    )
+
+def _is_same_bill_line(first: dict, second: dict) -> bool:
+    first_key, second_key = _bill_item_key(first), _bill_item_key(second)
+    if first_key[1:] != second_key[1:]:
+        return False
+    # The same printed row can be read slightly differently in two bands
+    return first_key[0] == second_key[0] or fuzz.ratio(first_key[0], second_key[0]) >= 90
+
+def _dedupe_band_overlap(previous_items: list[dict], next_items: list[dict]) -> list[dict]:
+    """Drops the leading items of a band that repeat the rows at the bottom of the previous band."""
+    recent_items = previous_items[-BILL_TILE_DEDUPE_WINDOW:]
+    skip = 0
+    while skip < len(next_items) and any(_is_same_bill_line(next_items[skip], item) for item in recent_items):
+        skip += 1
+    if skip:
+        print(f"DEBUG_TILING: Dropped {skip} duplicate items from the overlap region.")
+    return next_items[skip:]
+
+def _extract_items_from_bands(bands: list[str]) -> dict:
+    """Extracts every band concurrently and stitches the results in top-to-bottom order.
+
+    Bands whose extraction failed are counted in 'failed_bands', so the caller can tell a
+    partial bill from a complete one.
+    """
+    def extract_band(band_index: int) -> tuple[dict | None, float]:
+        tile_note = f"This image is band {band_index + 1} of {len(bands)} cut horizontally from one long bill, so the header or totals may be missing. Skip any row that is cut off at the top or bottom edge. "
+        started_at = time.perf_counter()
+        try:
+            return _request_bill_items(bands[band_index], tile_note), time.perf_counter() - started_at
+        except Exception as e:
+            print(f"Error extracting items from bill band {band_index + 1}: {e}")
+            return None, time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(BILL_TILE_MAX_WORKERS, len(bands))) as executor:
+        band_results = list(executor.map(extract_band, range(len(bands))))
+    total_seconds = time.perf_counter() - started_at
+
+    failed_bands = sum(1 for band_result, _ in band_results if band_result is None)
+    if failed_bands == len(bands):
+        raise Exception(f"All {len(bands)} bands of the bill failed to extract")
+
+    items = []
+    bill_types = []
+    languages = []
+    for band_result, _ in band_results:
+        if band_result is None:
+            continue
+        items.extend(_dedupe_band_overlap(items, band_result.get("items", [])))
+        bill_types.append(band_result.get("bill_type", "unknown"))
+        languages.append(band_result.get("detected_language", "en"))
+
+    tile_timings_ms = [round(seconds * 1000, 1) for _, seconds in band_results]
+    print(f"DEBUG_TILING: Tile timings (ms): {tile_timings_ms}, slowest: {max(tile_timings_ms)}, total wall time: {round(total_seconds * 1000, 1)}")
+
+    # The header (and so the invoice/receipt wording) is usually only visible in the first band
+    known_bill_types = [bill_type for bill_type in bill_types if bill_type != "unknown"]
+    return {
+        "bill_type": known_bill_types[0] if known_bill_types else "unknown",
+        "items": items,
+        "detected_language": max(set(languages), key=languages.count),
+        "tile_timings_ms": tile_timings_ms,
+        "failed_bands": failed_bands,
+    }
+
 def extract_items_from_bill_image(image_file_path: str) -> dict:
     """Extracts item names and quantities from a bill image using OpenAI Vision API.
 
+    Tall receipts are split into overlapping bands that are extracted concurrently
+    (see `BILL_TILING_MODE`); the per-band timings are returned in 'tile_timings_ms' and
+    the number of bands that could not be read in 'failed_bands'.
+
     Args:
         image_file_path: The path to the bill image file.
 
@@ -105,42 +387,16 @@ def extract_items_from_bill_image(image_file_path: str) -> dict:
         Example: {"bill_type": "purchase", "items": [{'item_name': 'Milk', 'quantity': 2.0, 'unit': 'kg', 'num_packets': 1, 'cost_price_per_unit': 50.0, 'selling_price_per_unit': null}]}
     """
     try:
-        base64_image = encode_image(image_file_path)
-        
-        # Define the JSON example as a Python dictionary, then convert to JSON string
-        bill_example_dict = {"bill_type": "purchase", "items": [{"item_name": "Milk", "quantity": 2.0, "unit": "kg", "num_packets": 1, "cost_price_per_unit": 50.0, "selling_price_per_unit": None}, {"item_name": "Bread", "quantity": 1.0, "unit": "packet", "num_packets": 2, "cost_price_per_unit": None, "selling_price_per_unit": 30.0}]}
-        bill_example_json = json.dumps(bill_example_dict)
-        
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": f"From this bill photo, first determine the primary language of the text on the bill, returning its ISO 639-1 code (e.g., 'en' for English, 'hi' for Hindi, 'pa' for Punjabi, 'gu' for Gujarati, 'ta' for Tamil, 'te' for Telugu, 'bn' for Bengali, 'mr' for Marathi). If the language is ambiguous or not one of these, default to 'en'. Then, determine if it is a 'purchase invoice' (from a supplier) or a 'sales receipt' (to a customer). If ambiguous, categorize as 'unknown'. To classify, look for keywords like \"invoice\", \"purchase\", \"supplier\" for purchases, or \"receipt\", \"sale\", \"customer\" for sales. **Crucially, if there is a column of prices on the far right and the items listed are typical inventory for a shopkeeper, interpret these prices as `cost_price_per_unit` and classify the bill as a 'purchase' invoice.** If prices are listed in a way that clearly indicates what the shopkeeper sold items for, assume they are **selling_price_per_unit** and the bill is a 'sale' receipt. Then, extract the item names, their precise quantities (including fractional values like 0.5 for 1/2), their corresponding units (e.g., kg, g, dozen, pcs, packet), the number of packets/items (the standalone number in a separate column), the **cost price per unit** (if written on the bill, often next to the item or quantity, and typically on purchase invoices). **IMPORTANT: If a total price is given for a quantity (e.g., '500 g Rajma, ₹80'), calculate the `cost_price_per_unit` as the total price divided by the quantity. For gram units, ensure `cost_price_per_unit` is truly per gram (e.g., for '500 g Rajma, ₹80', `cost_price_per_unit` should be 0.16).** And the **selling price per unit** (if written on the bill, often next to the item or quantity, and typically on sales receipts). **Prioritize quantity and unit that are found together next to the item name (e.g., '1 Kg' for 'बासमती चावल').** If there is a separate column of numbers (like the column 2, 3, 1, 4, 2, 1 in a provided image), interpret those numbers as the 'num_packets'. If a quantity, unit, num_packets, cost_price_per_unit, or selling_price_per_unit is not explicitly mentioned or found for an item, assume a quantity of 1, a unit of \"pcs\", num_packets of 1, and `cost_price_per_unit`/`selling_price_per_unit` as null. If an item is unclear, **do not include it** in the output. Provide the output strictly as a JSON object with a top-level key 'detected_language' (string), 'bill_type' (string: \"purchase\", \"sale\", or \"unknown\") and another top-level key 'items' which is an array of objects. Each object in the 'items' array should have: 'item_name' (string), 'quantity' (numeric, e.g., 2.0 or 0.5), 'unit' (string), 'num_packets' (integer), 'cost_price_per_unit' (numeric or null), and 'selling_price_per_unit' (numeric or null). Example: {bill_example_json}"},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                    ]
-                },
-            ],
-            max_tokens=1000
-        )
-        content = response.choices[0].message.content
-        # The content might be wrapped in markdown code block, so we need to extract the JSON string
-        if content.startswith("```json") and content.endswith("```"):
-            json_string = content[7:-3].strip()
-        else:
-            json_string = content.strip()
-        
-        extracted_data = json.loads(json_string)
-        return extracted_data
+        bands = _split_bill_into_bands(image_file_path)
+        if bands:
+            return _extract_items_from_bands(bands)
+        return _request_bill_items(encode_image(image_file_path))
     except json.JSONDecodeError as e:
         print(f"JSON Decode Error: {e}")
-        print(f"Raw API response content: {content}") # Print raw content for debugging
-        return {"bill_type": "unknown", "items": [], "detected_language": "en"}
+        return dict(EMPTY_BILL_RESULT)
     except Exception as e:
         print(f"Error extracting items from bill image: {e}")
-        return {"bill_type": "unknown", "items": [], "detected_language": "en"}
-
+        return dict(EMPTY_BILL_RESULT)
 
 if __name__ == "__main__":
     # Example usage (you would replace this with actual audio input)
@@ -0,0 +1,114 @@
+import asyncio
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from supabase import acreate_client
+
+from query_metrics import QueryMetrics
+from storage_errors import QueryTimeout
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))  # Queries allowed in flight at once; the rest wait for a slot
+DB_QUERY_TIMEOUT_SECONDS = float(os.getenv("DB_QUERY_TIMEOUT_SECONDS", "10"))
+
+
+class AsyncSupabasePool:
+    """Runs queries on a native async Supabase client with bounded concurrency and per-query timeouts.
+
+    Flask handles every request on a fresh event loop, and the async client's HTTP connection
+    pool cannot be shared between loops. The client therefore lives on one dedicated event-loop
+    thread; callers on any loop (or plain threads) hand it a query and await the result.
+    At most `pool_size` queries run at once, and each query's latency is recorded per name.
+    """
+
+    def __init__(self, url: str, key: str, pool_size: int = DB_POOL_SIZE, query_timeout: float = DB_QUERY_TIMEOUT_SECONDS):
+        self._url = url
+        self._key = key
+        self.pool_size = pool_size
+        self.query_timeout = query_timeout
+        self._loop = None
+        self._client = None
+        self._slots = None
+        self._start_lock = threading.Lock()
+        self._metrics = QueryMetrics()
+        self._waiting = 0
+        self._in_flight = 0
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            if not self._url or not self._key:
+                raise ValueError("Supabase URL and Key must be set in the .env file")
+            # The client has to be created on the loop it will run on, so the thread starts first
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="supabase-db-loop", daemon=True)
+            thread.start()
+            try:
+                self._client = asyncio.run_coroutine_threadsafe(acreate_client(self._url, self._key), loop).result()
+                self._slots = asyncio.run_coroutine_threadsafe(self._create_slots(), loop).result()
+            except BaseException:
+                # Don't leave a running loop thread behind for every failed attempt
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                loop.close()
+                self._client = None
+                raise
+            self._loop = loop
+
+    async def _create_slots(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.pool_size)  # Must be created on the loop that uses it
+
+    async def _run(self, name: str, build_query, timeout: float):
+        queued_at = time.perf_counter()
+        self._waiting += 1
+        async with self._slots:
+            self._waiting -= 1
+            self._in_flight += 1
+            started_at = time.perf_counter()
+            self._metrics.record("pool_wait", (started_at - queued_at) * 1000)
+            failed = True
+            try:
+                response = await asyncio.wait_for(build_query(self._client).execute(), timeout)
+                failed = False
+                return response
+            except asyncio.TimeoutError:
+                raise QueryTimeout(f"Query '{name}' timed out after {timeout:.1f} s")
+            finally:
+                self._in_flight -= 1
+                self._metrics.record(name, (time.perf_counter() - started_at) * 1000, failed=failed)
+
+    def submit(self, name: str, build_query, timeout: float | None = None) -> Future:
+        """Schedules `build_query(client).execute()` on the pool's loop and returns a concurrent Future."""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self._run(name, build_query, timeout or self.query_timeout), self._loop)
+
+    async def execute(self, name: str, build_query, timeout: float | None = None):
+        """Runs a query built from the async client, e.g. `lambda client: client.table("t").select("*")`."""
+        return await asyncio.wrap_future(self.submit(name, build_query, timeout))
+
+    def execute_sync(self, name: str, build_query, timeout: float | None = None):
+        """Blocking variant for worker threads (never call it from the pool's own loop)."""
+        return self.submit(name, build_query, timeout).result()
+
+    def metrics(self) -> dict:
+        """Per-query latency histograms plus the current pool occupancy."""
+        return {
+            "pool_size": self.pool_size,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "queries": self._metrics.summary(),
+        }
+
+    def close(self):
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def create_pool(url: str, key: str) -> AsyncSupabasePool:
+    """Creates the process-wide query pool; its loop thread is stopped when the process exits."""
+    pool = AsyncSupabasePool(url, key)
+    atexit.register(pool.close)
+    return pool
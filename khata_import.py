@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from datetime import date
+
+from storage import ensure_transaction_partitions, import_transactions
+
+# Uploaded files are kept here (named by content) with their progress and rejected-rows files
+IMPORT_DIR = os.getenv("IMPORT_DIR", "imports")
+# Rows parsed, validated and inserted per batch; each batch is one multi-row upsert
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "5000"))
+IMPORT_FORMATS = (".csv", ".xlsx")
+
+# Accepted spellings of each column, matched after lowercasing and trimming the header
+_COLUMN_ALIASES = {
+    "date": ["date", "transaction_date", "txn_date", "day", "tarikh", "तारीख", "दिनांक"],
+    "type": ["type", "transaction_type", "txn_type", "prakar", "प्रकार"],
+    "amount": ["amount", "total", "value", "rs", "rupees", "rakam", "राशि", "रकम"],
+    "item": ["item", "item_name", "description", "details", "particulars", "narration", "saman", "सामान", "विवरण"],
+    "quantity": ["quantity", "qty", "matra", "मात्रा"],
+    "unit": ["unit", "units", "ikai", "इकाई"],
+}
+_TYPE_ALIASES = {
+    "sale": "sale", "sales": "sale", "sold": "sale", "income": "sale", "credit": "sale", "bikri": "sale", "बिक्री": "sale",
+    "expense": "expense", "expenses": "expense", "debit": "expense", "kharcha": "expense", "kharch": "expense", "खर्च": "expense", "खर्चा": "expense",
+    "purchase": "purchase", "purchases": "purchase", "bought": "purchase", "kharid": "purchase", "kharidi": "purchase", "खरीद": "purchase", "खरीदी": "purchase",
+}
+# Same unit names the stock conversion helpers understand
+_UNIT_ALIASES = {
+    "kg": "kg", "kgs": "kg", "kilo": "kg", "kilogram": "kg", "kilograms": "kg", "किलो": "kg",
+    "g": "g", "gm": "g", "gms": "g", "gram": "g", "grams": "g", "ग्राम": "g",
+    "l": "l", "ltr": "l", "litre": "l", "liter": "l", "litres": "l", "liters": "l", "लीटर": "l",
+    "ml": "ml", "millilitre": "ml", "milliliter": "ml",
+    "pcs": "pcs", "pc": "pcs", "piece": "pcs", "pieces": "pcs", "nos": "pcs", "no": "pcs", "पीस": "pcs",
+    "dozen": "dozen", "dz": "dozen", "दर्जन": "dozen",
+    "packet": "packet", "packets": "packet", "pkt": "packet", "पैकेट": "packet",
+}
+# Tried in order on the values still unparsed; shops mostly write day-first dates
+_DATE_FORMATS = ["%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y", "%d-%m-%y", "%d %b %Y", "%d %B %Y"]
+_IMPORT_NAMESPACE = uuid.UUID("6f1d3c1e-0b7a-4c55-9d1e-8a6e2f0c4b1a")
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _shop_key(user_id: str) -> str:
+    return hashlib.sha256(user_id.encode()).hexdigest()[:12]
+
+
+def stage_import_file(user_id: str, downloaded_path: str) -> str:
+    """
+    Moves an uploaded file into IMPORT_DIR under a name derived from the shop and the file's
+    content. Sending the same file again therefore finds its progress and resumes (or finds it done).
+    """
+    extension = os.path.splitext(downloaded_path)[1].lower()
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    staged_path = os.path.join(IMPORT_DIR, f"{_shop_key(user_id)}_{_file_digest(downloaded_path)[:16]}{extension}")
+    if os.path.exists(staged_path):
+        os.remove(downloaded_path)
+    else:
+        os.replace(downloaded_path, staged_path)
+    return staged_path
+
+
+def _read_chunks(path: str, skip_rows: int, chunk_rows: int):
+    """Yields DataFrames of up to chunk_rows raw (string) rows, starting after skip_rows data rows."""
+    import pandas as pd  # Only needed by the import pipeline
+
+    if path.lower().endswith(".csv"):
+        yield from pd.read_csv(path, dtype=str, keep_default_na=False, skiprows=range(1, skip_rows + 1), chunksize=chunk_rows, encoding="utf-8-sig")
+    else:
+        # openpyxl cannot stream into pandas, so spreadsheets are read whole and then chunked
+        frame = pd.read_excel(path, dtype=str, keep_default_na=False)
+        for start in range(skip_rows, len(frame), chunk_rows):
+            yield frame.iloc[start:start + chunk_rows]
+
+
+def _rename_columns(frame):
+    """Maps the file's headers onto date/type/amount/item/quantity/unit. Raises if date or amount is missing."""
+    lookup = {alias: column for column, aliases in _COLUMN_ALIASES.items() for alias in aliases}
+    renamed = {}
+    for header in frame.columns:
+        column = lookup.get(str(header).strip().lower())
+        if column and column not in renamed.values():
+            renamed[header] = column
+    missing = [column for column in ("date", "amount") if column not in renamed.values()]
+    if missing:
+        raise ValueError(f"The file has no {' or '.join(missing)} column (found: {', '.join(map(str, frame.columns))})")
+    return frame[list(renamed)].rename(columns=renamed)
+
+
+def _parse_dates(values):
+    import pandas as pd
+
+    text = values.str.strip()
+    parsed = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    for date_format in _DATE_FORMATS:
+        unparsed = parsed.isna() & (text != "")
+        if not unparsed.any():
+            break
+        parsed[unparsed] = pd.to_datetime(text[unparsed], format=date_format, errors="coerce")
+    return parsed
+
+
+def normalize_chunk(frame, first_row_number: int, import_id: str, today: date):
+    """
+    Validates and normalizes one chunk of raw rows with vectorized parsing. `import_id` names the
+    shop and the file; each row's id and client_txn_id are derived from it and the row number.
+    Returns (transactions, rejected) where rejected is [{"row", "reason", ...raw values}].
+    """
+    import numpy as np
+    import pandas as pd
+
+    frame = _rename_columns(frame).reset_index(drop=True)
+    row_numbers = pd.RangeIndex(first_row_number, first_row_number + len(frame))
+    empty = pd.Series("", index=frame.index)
+
+    dates = _parse_dates(frame["date"])
+    amounts = pd.to_numeric(frame["amount"].str.replace(r"₹|rs\.?|inr|,|\s", "", regex=True, case=False), errors="coerce")
+    types = frame.get("type", empty).str.strip().str.lower().map(_TYPE_ALIASES)
+    # Without a type, the sign of the amount decides: money in is a sale, money out an expense
+    untyped = frame.get("type", empty).str.strip() == ""
+    types = types.mask(untyped, np.where(amounts < 0, "expense", "sale"))
+    amounts = amounts.abs().round(2)
+    items = frame.get("item", empty).str.strip()
+    quantities = pd.to_numeric(frame.get("quantity", empty).str.replace(",", "", regex=False), errors="coerce")
+    raw_units = frame.get("unit", empty).str.strip().str.lower()
+    units = raw_units.map(_UNIT_ALIASES).fillna(raw_units).replace("", "pcs")
+
+    reasons = pd.Series(np.select(
+        [dates.isna(), dates.dt.date > today, amounts.isna(), amounts == 0, types.isna()],
+        ["invalid date", "date in the future", "invalid amount", "zero amount", "unknown type"],
+        default="",
+    ), index=frame.index)
+    valid = reasons == ""
+
+    rejected = [
+        {"row": int(row_numbers[index]), "reason": reasons[index], **{column: frame.at[index, column] for column in frame.columns}}
+        for index in frame.index[~valid]
+    ]
+
+    has_quantity = valid & quantities.notna() & (quantities > 0) & (items != "")
+    quantity_text = quantities.map(lambda quantity: f"{quantity:g}", na_action="ignore")
+    # Sales read like live ones ("rice (2 kg)"), so summaries and exports look the same for imported history
+    item_text = items.mask(has_quantity & (types == "sale"), items + " (" + quantity_text + " " + units + ")")
+
+    transactions = []
+    for index in frame.index[valid]:
+        client_txn_id = f"import:{import_id}:{row_numbers[index]}"
+        transaction = {
+            "id": str(uuid.uuid5(_IMPORT_NAMESPACE, client_txn_id)),
+            "client_txn_id": client_txn_id,
+            "date": dates[index].strftime('%Y-%m-%d'),
+            "type": types[index],
+            "amount": float(amounts[index]),
+            "item": item_text[index] or None,
+        }
+        if has_quantity[index]:
+            quantity = float(quantities[index])
+            transaction["lines"] = [{
+                "item_name": items[index], "quantity": quantity, "unit": units[index],
+                "unit_price": round(transaction["amount"] / quantity, 4), "amount": transaction["amount"], "cost": None,
+            }]
+        transactions.append(transaction)
+    return transactions, rejected
+
+
+def _load_progress(progress_path: str, digest: str, user_id: str) -> dict:
+    if os.path.exists(progress_path):
+        with open(progress_path) as progress_file:
+            progress = json.load(progress_file)
+        if progress.get("sha256") == digest and progress.get("user_id") == user_id:
+            return progress
+    return {"sha256": digest, "user_id": user_id, "rows_done": 0, "imported": 0, "rejected": 0}
+
+
+def _save_progress(progress_path: str, progress: dict):
+    temporary_path = f"{progress_path}.tmp"
+    with open(temporary_path, "w") as progress_file:
+        json.dump(progress, progress_file)
+    os.replace(temporary_path, progress_path)
+
+
+def _append_rejected(rejected_path: str, rejected: list[dict]):
+    import csv
+
+    write_header = not os.path.exists(rejected_path)
+    columns = ["row", "reason", *_COLUMN_ALIASES]
+    with open(rejected_path, "a", newline="", encoding="utf-8-sig") as rejected_file:
+        writer = csv.DictWriter(rejected_file, fieldnames=columns, extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rejected)
+
+
+async def import_khata_file(user_id: str, path: str, chunk_rows: int = IMPORT_CHUNK_ROWS, on_progress=None) -> dict:
+    """
+    Imports a CSV/XLSX file of historical transactions for a shop.
+
+    Rows are parsed and validated a chunk at a time and each chunk is inserted as one multi-row
+    upsert. Progress is checkpointed to `<path>.progress.json` after every chunk, so running the
+    same file again resumes where it stopped; every row also gets a stable client_txn_id, so a
+    chunk that was in flight during a crash is not inserted twice. Invalid rows are written to
+    `<path>.rejected.csv` with the reason. Stock levels are not changed by imported history.
+
+    on_progress(progress) is called after each chunk. Returns the final progress
+    ({"rows_done", "imported", "rejected", "seconds", ...}).
+    """
+    if not path.lower().endswith(IMPORT_FORMATS):
+        raise ValueError(f"Unsupported file type for import: {os.path.basename(path)} (expected {', '.join(IMPORT_FORMATS)})")
+    digest = _file_digest(path)
+    progress_path, rejected_path = f"{path}.progress.json", f"{path}.rejected.csv"
+    progress = _load_progress(progress_path, digest, user_id)
+    if progress["rows_done"] == 0 and os.path.exists(rejected_path):
+        os.remove(rejected_path)
+    if progress["rows_done"]:
+        print(f"DEBUG_IMPORT: Resuming {path} for {user_id} after {progress['rows_done']} rows.")
+
+    started = time.perf_counter()
+    today = date.today()
+    partitions_from = None
+    for frame in _read_chunks(path, progress["rows_done"], chunk_rows):
+        # Row numbers count data rows from 1, so they stay the same when a file is re-run. The ids are
+        # per shop too: client_txn_id is unique across shops, and an owner may import one file for each outlet.
+        transactions, rejected = normalize_chunk(frame, progress["rows_done"] + 1, f"{_shop_key(user_id)}:{digest[:16]}", today)
+        if transactions:
+            oldest = min(date.fromisoformat(transaction["date"]) for transaction in transactions)
+            if partitions_from is None or oldest < partitions_from:
+                # Older months get their own partitions instead of piling into the default one
+                await ensure_transaction_partitions(from_date=oldest)
+                partitions_from = oldest
+            await import_transactions(user_id, transactions)
+        if rejected:
+            _append_rejected(rejected_path, rejected)
+        progress["rows_done"] += len(frame)
+        progress["imported"] += len(transactions)
+        progress["rejected"] += len(rejected)
+        _save_progress(progress_path, progress)
+        elapsed = time.perf_counter() - started
+        print(f"DEBUG_IMPORT: {path}: {progress['rows_done']} rows read, {progress['imported']} imported, {progress['rejected']} rejected ({elapsed:.1f}s).")
+        if on_progress is not None:
+            await on_progress(progress)
+
+    progress["seconds"] = round(time.perf_counter() - started, 2)
+    progress["rejected_path"] = rejected_path if progress["rejected"] else None
+    return progress
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(description="Import a CSV/XLSX file of historical transactions for a shop. Re-run the same command to resume.")
+    parser.add_argument("user_id", help="The shop's WhatsApp sender id, e.g. whatsapp:+919876543210")
+    parser.add_argument("path")
+    parser.add_argument("--chunk-rows", type=int, default=IMPORT_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    result = asyncio.run(import_khata_file(args.user_id, args.path, args.chunk_rows))
+    print(f"Imported {result['imported']} of {result['rows_done']} rows in {result['seconds']}s; {result['rejected']} rejected"
+          + (f" (see {result['rejected_path']})" if result["rejected_path"] else "") + ".")
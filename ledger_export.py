@@ -0,0 +1,185 @@
+import csv
+import os
+import secrets
+import time
+from datetime import date, datetime
+
+from storage import get_stock_levels, iter_stock_movement_pages, iter_transaction_pages
+
+# Finished exports are written here and served by the app at /exports/<filename>
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+# Exports are deleted after this many hours (the links sent on WhatsApp stop working)
+EXPORT_TTL_HOURS = float(os.getenv("EXPORT_TTL_HOURS", "24"))
+EXPORT_FORMATS = ("csv", "parquet")
+# Parquet row groups are flushed at this many rows; with the backend's page size this bounds memory
+PARQUET_ROW_GROUP_ROWS = 50_000
+
+# (column, type) for each export; the type picks the Parquet column type
+TRANSACTION_COLUMNS = [
+    ("transaction_date", "date"), ("transaction_type", "string"), ("amount", "float"),
+    ("item", "string"), ("created_at", "timestamp"), ("id", "string"),
+]
+STOCK_MOVEMENT_COLUMNS = [
+    ("created_at", "timestamp"), ("item_name", "string"), ("unit", "string"), ("movement_type", "string"),
+    ("quantity_delta", "float"), ("unit_cost", "float"), ("average_cost_after", "float"), ("id", "int"),
+]
+
+
+class _CsvSink:
+    """Writes rows to a CSV file as they arrive."""
+
+    def __init__(self, path: str, columns: list[tuple[str, str]]):
+        self._columns = [name for name, _ in columns]
+        # utf-8-sig so spreadsheet apps read Hindi/Marathi item names correctly
+        self._file = open(path, "w", newline="", encoding="utf-8-sig")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self._columns)
+
+    def write_page(self, rows: list[dict]):
+        self._writer.writerows([row.get(name) for name in self._columns] for row in rows)
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetSink:
+    """Writes rows to a Parquet file, one row group per PARQUET_ROW_GROUP_ROWS rows."""
+
+    def __init__(self, path: str, columns: list[tuple[str, str]]):
+        import pyarrow as pa  # Only needed for Parquet exports
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._columns = columns
+        types = {"date": pa.date32(), "timestamp": pa.timestamp("us", tz="UTC"), "float": pa.float64(), "int": pa.int64(), "string": pa.string()}
+        self._schema = pa.schema([(name, types[kind]) for name, kind in columns])
+        self._writer = pq.ParquetWriter(path, self._schema, compression="zstd")
+        self._pending = []
+
+    @staticmethod
+    def _convert(value, kind: str):
+        if value is None or kind == "string":
+            return value
+        if kind == "date":
+            return value if isinstance(value, date) else date.fromisoformat(value)
+        if kind == "timestamp":
+            return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+        return float(value) if kind == "float" else int(value)
+
+    def write_page(self, rows: list[dict]):
+        self._pending.extend(rows)
+        if len(self._pending) >= PARQUET_ROW_GROUP_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        table = self._pa.Table.from_pydict(
+            {name: [self._convert(row.get(name), kind) for row in self._pending] for name, kind in self._columns},
+            schema=self._schema,
+        )
+        self._writer.write_table(table)
+        self._pending = []
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self._writer.close()
+
+
+_SINKS = {"csv": _CsvSink, "parquet": _ParquetSink}
+
+
+def remove_expired_exports(ttl_hours: float = EXPORT_TTL_HOURS) -> int:
+    """Deletes exports (and abandoned partial files) older than ttl_hours. Returns how many were deleted."""
+    if not os.path.isdir(EXPORT_DIR):
+        return 0
+    cutoff = time.time() - ttl_hours * 3600
+    removed = 0
+    for file_name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, file_name)
+        try:
+            if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError as e:
+            print(f"ERROR_EXPORT: Could not remove expired export {path}: {e}")
+    return removed
+
+
+async def _write_export(pages, columns: list[tuple[str, str]], path: str, export_format: str, prepare_page=None) -> int:
+    """Streams pages from an async iterator into a file. Returns the number of rows written.
+
+    The rows go to `<path>.part` and are renamed once complete, so a link never serves a half-written file.
+    """
+    partial_path = f"{path}.part"
+    sink = _SINKS[export_format](partial_path, columns)
+    rows_written = 0
+    try:
+        async for page in pages:
+            if prepare_page is not None:
+                prepare_page(page)
+            sink.write_page(page)
+            rows_written += len(page)
+    except BaseException:
+        sink.close()
+        os.remove(partial_path)
+        raise
+    sink.close()
+    os.replace(partial_path, path)
+    return rows_written
+
+
+async def export_shop_ledger(user_id: str, start_date: date, end_date: date, export_format: str = "csv", include_archive: bool = False) -> list[dict]:
+    """
+    Exports a shop's transactions and stock movements between start_date and end_date inclusive
+    to two files in EXPORT_DIR. Both are streamed page by page (keyset paging in the storage
+    backend), so memory stays flat however many rows the shop has. include_archive adds the archived
+    transactions (months older than the archive horizon).
+    Returns [{"kind", "filename", "rows"}] for the transactions and the stock movements files.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{export_format}', expected one of {EXPORT_FORMATS}")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    remove_expired_exports()
+
+    # Movements carry the stock item id; the unit comes from the (small, cached) stock list
+    units = {row["id"]: row.get("unit") for row in await get_stock_levels(user_id)}
+
+    def _add_units(page: list[dict]):
+        for row in page:
+            row["unit"] = units.get(row.get("stock_item_id"))
+
+    exports = []
+    period = f"{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}"
+    for kind, pages, columns, prepare_page in (
+        ("transactions", iter_transaction_pages(user_id, start_date, end_date, include_archive=include_archive), TRANSACTION_COLUMNS, None),
+        ("stock_movements", iter_stock_movement_pages(user_id, start_date, end_date), STOCK_MOVEMENT_COLUMNS, _add_units),
+    ):
+        # The random token is what keeps the link private: the files are served without authentication
+        filename = f"{kind}_{period}_{secrets.token_urlsafe(16)}.{export_format}"
+        started = time.perf_counter()
+        rows = await _write_export(pages, columns, os.path.join(EXPORT_DIR, filename), export_format, prepare_page)
+        print(f"DEBUG_EXPORT: Wrote {rows} {kind} rows for {user_id} to {filename} in {time.perf_counter() - started:.2f}s.")
+        exports.append({"kind": kind, "filename": filename, "rows": rows})
+    return exports
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import tracemalloc
+
+    parser = argparse.ArgumentParser(description="Export a shop's transactions and stock movements for a date range.")
+    parser.add_argument("user_id")
+    parser.add_argument("start_date", type=date.fromisoformat)
+    parser.add_argument("end_date", type=date.fromisoformat)
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--include-archive", action="store_true", help="Also export archived transactions")
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    for export in asyncio.run(export_shop_ledger(args.user_id, args.start_date, args.end_date, args.format, args.include_archive)):
+        print(f"{export['kind']}: {export['rows']} rows -> {os.path.join(EXPORT_DIR, export['filename'])}")
+    print(f"Peak traced memory: {tracemalloc.get_traced_memory()[1] / 1024 / 1024:.1f} MiB")
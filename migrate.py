@@ -0,0 +1,83 @@
+import argparse
+import os
+import re
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Direct Postgres connection string (Supabase: Project Settings -> Database -> Connection string).
+# PostgREST cannot run DDL, so migrations and plan checks connect to Postgres directly.
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+_MIGRATION_FILE = re.compile(r"^(\d+)_[\w-]+\.sql$")
+
+
+def connect():
+    """Opens a psycopg connection to the database behind Supabase."""
+    import psycopg  # Only needed by the migration tooling, not by the app itself
+
+    if not SUPABASE_DB_URL:
+        raise ValueError("SUPABASE_DB_URL must be set in the .env file to run migrations")
+    # Autocommit, so each `conn.transaction()` block is a real transaction rather than a savepoint
+    return psycopg.connect(SUPABASE_DB_URL, autocommit=True)
+
+
+def list_migrations() -> list[tuple[int, str]]:
+    """Returns (version, path) for every migration file, in version order."""
+    migrations = []
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        match = _MIGRATION_FILE.match(file_name)
+        if match:
+            migrations.append((int(match.group(1)), os.path.join(MIGRATIONS_DIR, file_name)))
+    migrations.sort()
+    versions = [version for version, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Duplicate migration versions in {MIGRATIONS_DIR}")
+    return migrations
+
+
+def applied_versions(conn) -> set[int]:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    """)
+    return {row[0] for row in conn.execute("SELECT version FROM schema_migrations").fetchall()}
+
+
+def apply_migrations(dry_run: bool = False) -> list[int]:
+    """Applies pending migrations in order, each in its own transaction. Returns the versions applied."""
+    applied = []
+    with connect() as conn:
+        done = applied_versions(conn)
+        for version, path in list_migrations():
+            if version in done:
+                continue
+            name = os.path.basename(path)
+            if dry_run:
+                print(f"DEBUG_MIGRATE: Would apply {name}")
+                applied.append(version)
+                continue
+            with open(path, encoding="utf-8") as migration_file:
+                sql = migration_file.read()
+            print(f"DEBUG_MIGRATE: Applying {name}...")
+            with conn.transaction():
+                conn.execute(sql)
+                conn.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            applied.append(version)
+    print(f"DEBUG_MIGRATE: {len(applied)} migration(s) {'pending' if dry_run else 'applied'}.")
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply the versioned SQL migrations in migrations/ (run after supabase_schema.sql).")
+    parser.add_argument("--dry-run", action="store_true", help="List pending migrations without applying them.")
+    parser.add_argument("--check", action="store_true", help="Run the EXPLAIN-based index check afterwards.")
+    args = parser.parse_args()
+    apply_migrations(dry_run=args.dry_run)
+    if args.check:
+        from check_query_plans import main as check_query_plans
+        raise SystemExit(check_query_plans())
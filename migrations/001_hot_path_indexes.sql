@@ -0,0 +1,27 @@
+-- Composite/covering indexes for the queries issued by supabase_client.py.
+-- Each index names the query it serves; check_query_plans.py verifies they are used.
+
+-- get_user_transactions_summary: WHERE user_id = ? ORDER BY created_at DESC LIMIT n
+-- Covering, so the recent-transactions list is answered from the index alone.
+CREATE INDEX IF NOT EXISTS idx_transactions_user_created
+    ON transactions (user_id, created_at DESC)
+    INCLUDE (transaction_date, transaction_type, amount, item);
+
+-- get_daily_sales_summary: WHERE user_id = ? AND transaction_type = 'sale' AND transaction_date = ?
+-- ORDER BY created_at DESC LIMIT n. Also serves the per-shop, per-day lookups in recompute_daily_rollups.
+CREATE INDEX IF NOT EXISTS idx_transactions_user_date_type_created
+    ON transactions (user_id, transaction_date, transaction_type, created_at DESC)
+    INCLUDE (item, amount);
+
+-- recompute_daily_rollups: WHERE transaction_date = ? GROUP BY user_id, answered from the index alone.
+-- Replaces the narrower index added with daily_rollups.
+CREATE INDEX IF NOT EXISTS idx_transactions_date_user_covering
+    ON transactions (transaction_date, user_id)
+    INCLUDE (transaction_type, amount);
+DROP INDEX IF EXISTS idx_transactions_date_user;
+
+-- get_stock_levels (WHERE user_id = ? ORDER BY item_name) and apply_stock_delta
+-- (WHERE user_id = ? AND item_name = ?) use the unique_user_item constraint's index.
+-- get_bill_image_hashes (WHERE user_id = ?) uses unique_user_bill_hash.
+-- shop_balances, daily_rollups and shops are read by primary key; low stock and active shops
+-- use the partial indexes created with them.
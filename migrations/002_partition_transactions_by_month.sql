@@ -0,0 +1,100 @@
+-- Range-partitions transactions by month of transaction_date.
+-- Queries bounded by date touch a single partition, and old months can later be detached
+-- or archived as a whole. Rows outside the created months land in transactions_default.
+
+ALTER TABLE transactions RENAME TO transactions_unpartitioned;
+DROP TRIGGER IF EXISTS transactions_update_balances ON transactions_unpartitioned;
+DROP TRIGGER IF EXISTS transactions_update_daily_rollups ON transactions_unpartitioned;
+DROP TRIGGER IF EXISTS transactions_register_shops ON transactions_unpartitioned;
+
+CREATE TABLE transactions (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    transaction_date DATE NOT NULL,
+    transaction_type VARCHAR(50) NOT NULL, -- 'sale', 'expense' or 'purchase'
+    amount NUMERIC(10, 2) NOT NULL,
+    item TEXT,
+    user_id TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (id, transaction_date) -- The partition key must be part of every unique constraint
+) PARTITION BY RANGE (transaction_date);
+
+CREATE TABLE transactions_default PARTITION OF transactions DEFAULT;
+
+-- Creates the monthly partitions from p_from's month through p_months_ahead months after today.
+-- Rows already sitting in transactions_default for a new month are moved into it. Rows are
+-- moved by inserting into the partition directly, so the statement-level triggers on
+-- transactions (balances, rollups, shop registry) do not count them twice.
+CREATE OR REPLACE FUNCTION ensure_transaction_partitions(p_from DATE DEFAULT CURRENT_DATE, p_months_ahead INTEGER DEFAULT 3)
+RETURNS INTEGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_month DATE := date_trunc('month', p_from)::DATE;
+    v_last DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead))::DATE;
+    v_partition TEXT;
+    v_created INTEGER := 0;
+BEGIN
+    WHILE v_month <= v_last LOOP
+        v_partition := format('transactions_%s', to_char(v_month, 'YYYY_MM'));
+        IF to_regclass(v_partition) IS NULL THEN
+            CREATE TEMP TABLE moved_transactions (LIKE transactions) ON COMMIT DROP;
+            WITH moved AS (
+                DELETE FROM transactions_default
+                WHERE transaction_date >= v_month AND transaction_date < (v_month + INTERVAL '1 month')::DATE
+                RETURNING *
+            )
+            INSERT INTO moved_transactions SELECT * FROM moved;
+
+            EXECUTE format('CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                           v_partition, v_month, (v_month + INTERVAL '1 month')::DATE);
+            EXECUTE format('INSERT INTO %I SELECT * FROM moved_transactions', v_partition);
+            DROP TABLE moved_transactions;
+            v_created := v_created + 1;
+        END IF;
+        v_month := (v_month + INTERVAL '1 month')::DATE;
+    END LOOP;
+    RETURN v_created;
+END;
+$$;
+
+SELECT ensure_transaction_partitions(COALESCE((SELECT MIN(transaction_date) FROM transactions_unpartitioned), CURRENT_DATE));
+
+-- Copy before the triggers exist, so balances and rollups (already maintained) are not re-added.
+INSERT INTO transactions (id, transaction_date, transaction_type, amount, item, user_id, created_at)
+SELECT id, transaction_date, transaction_type, amount, item, user_id, created_at
+FROM transactions_unpartitioned;
+
+DROP TABLE transactions_unpartitioned;
+
+-- Indexes created on the parent are created on every partition, present and future.
+CREATE INDEX idx_transactions_user_created
+    ON transactions (user_id, created_at DESC)
+    INCLUDE (transaction_date, transaction_type, amount, item);
+CREATE INDEX idx_transactions_user_date_type_created
+    ON transactions (user_id, transaction_date, transaction_type, created_at DESC)
+    INCLUDE (item, amount);
+CREATE INDEX idx_transactions_date_user_covering
+    ON transactions (transaction_date, user_id)
+    INCLUDE (transaction_type, amount);
+
+CREATE TRIGGER transactions_update_balances
+    AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_transactions
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_transactions_to_balances();
+
+CREATE TRIGGER transactions_update_daily_rollups
+    AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_transactions
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_transactions_to_daily_rollups();
+
+CREATE TRIGGER transactions_register_shops
+    AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION register_shops_from_new_rows();
+
+ALTER TABLE transactions ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Users can view their own transactions." ON transactions
+  FOR SELECT USING (auth.uid()::TEXT = user_id);
+
+CREATE POLICY "Users can insert their own transactions." ON transactions
+  FOR INSERT WITH CHECK (auth.uid()::TEXT = user_id);
@@ -0,0 +1,39 @@
+-- Idempotent replay for the write-behind ledger (write_ahead_ledger.py). Ledger entries are
+-- re-sent until their apply is checkpointed, so a retry after a lost response must not
+-- record a sale or move stock twice.
+
+-- Transactions carry the id the ledger gave them; a replayed insert hits ON CONFLICT DO NOTHING.
+-- A unique index on a partitioned table must include the partition key.
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS client_txn_id TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_client_txn_id
+    ON transactions (client_txn_id, transaction_date);
+
+-- Ledger entries whose stock deltas have been applied.
+CREATE TABLE IF NOT EXISTS applied_ledger_entries (
+    entry_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Applies the stock deltas of several ledger entries in one request and one transaction.
+-- p_entries is a JSON array of {"entry_id", "user_id", "deltas"} (deltas as for apply_stock_deltas);
+-- entries already applied are skipped. Returns how many entries were applied now.
+CREATE OR REPLACE FUNCTION apply_ledger_stock_entries(p_entries JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_entry JSONB;
+    v_applied INTEGER := 0;
+BEGIN
+    FOR v_entry IN SELECT value FROM jsonb_array_elements(p_entries) LOOP
+        INSERT INTO applied_ledger_entries (entry_id, user_id)
+        VALUES (v_entry->>'entry_id', v_entry->>'user_id')
+        ON CONFLICT (entry_id) DO NOTHING;
+        IF FOUND THEN
+            PERFORM apply_stock_deltas(v_entry->>'user_id', v_entry->'deltas');
+            v_applied := v_applied + 1;
+        END IF;
+    END LOOP;
+    RETURN v_applied;
+END;
+$$;
@@ -0,0 +1,213 @@
+-- Append-only stock movement ledger, periodic per-item snapshots and weighted-average cost.
+-- stock_items keeps the current quantity (the hot path); every change to it is also written
+-- to stock_movements in the same transaction, so stock as of any past moment is the latest
+-- snapshot before it plus the few movements since.
+
+-- Moving-average cost per item unit, updated in O(1) by each purchase:
+--   new_avg = (quantity * avg + purchased * unit_cost) / (quantity + purchased)
+-- Sales leave it unchanged. cost_price_per_unit stays the latest purchase price.
+ALTER TABLE stock_items ADD COLUMN IF NOT EXISTS average_cost NUMERIC(12, 4);
+UPDATE stock_items SET average_cost = cost_price_per_unit WHERE average_cost IS NULL;
+
+CREATE TABLE stock_movements (
+    id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    stock_item_id UUID NOT NULL,
+    user_id TEXT NOT NULL,
+    item_name TEXT NOT NULL,
+    movement_type TEXT NOT NULL CHECK (movement_type IN ('opening', 'purchase', 'sale', 'adjustment')),
+    quantity_delta NUMERIC(12, 2) NOT NULL, -- Effective change in the item's unit (after clamping at zero)
+    unit_cost NUMERIC(12, 4), -- Purchase price, or the average cost the goods left at
+    average_cost_after NUMERIC(12, 4),
+    version BIGINT NOT NULL, -- stock_items.version after the movement
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+-- Movements of one item are inserted while its stock_items row is locked, so per item the
+-- id order is the commit order and "id > snapshot.last_movement_id" finds exactly the newer ones.
+CREATE INDEX idx_stock_movements_item_id ON stock_movements (stock_item_id, id);
+CREATE INDEX idx_stock_movements_user_created ON stock_movements (user_id, created_at);
+
+CREATE TABLE stock_snapshots (
+    stock_item_id UUID NOT NULL,
+    snapshot_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    user_id TEXT NOT NULL,
+    item_name TEXT NOT NULL,
+    quantity NUMERIC(12, 2) NOT NULL,
+    average_cost NUMERIC(12, 4),
+    last_movement_id BIGINT NOT NULL,
+    PRIMARY KEY (stock_item_id, snapshot_at)
+);
+
+-- Existing stock opens the ledger, with a first snapshot.
+INSERT INTO stock_movements (stock_item_id, user_id, item_name, movement_type, quantity_delta, unit_cost, average_cost_after, version)
+SELECT id, user_id, item_name, 'opening', quantity, average_cost, average_cost, version
+FROM stock_items;
+
+INSERT INTO stock_snapshots (stock_item_id, user_id, item_name, quantity, average_cost, last_movement_id)
+SELECT i.id, i.user_id, i.item_name, i.quantity, i.average_cost, m.id
+FROM stock_items i
+JOIN stock_movements m ON m.stock_item_id = i.id AND m.movement_type = 'opening';
+
+-- apply_stock_delta gains p_movement_type (defaults to 'purchase' for priced additions,
+-- 'sale' for removals, 'adjustment' otherwise) and now records a movement and the average cost.
+DROP FUNCTION IF EXISTS apply_stock_delta(TEXT, TEXT, NUMERIC, TEXT, NUMERIC, BIGINT);
+
+CREATE OR REPLACE FUNCTION apply_stock_delta(
+    p_user_id TEXT,
+    p_item_name TEXT,
+    p_quantity_delta NUMERIC,
+    p_unit TEXT DEFAULT 'pcs',
+    p_cost_price_per_unit NUMERIC DEFAULT NULL,
+    p_expected_version BIGINT DEFAULT NULL,
+    p_movement_type TEXT DEFAULT NULL
+) RETURNS stock_items
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_item stock_items;
+    v_previous_quantity NUMERIC := 0;
+    v_delta NUMERIC;
+    v_unit_cost NUMERIC;
+    v_average_cost NUMERIC;
+BEGIN
+    SELECT * INTO v_item
+    FROM stock_items
+    WHERE user_id = p_user_id AND item_name = p_item_name
+    ORDER BY (lower(unit) = lower(p_unit)) DESC, id
+    LIMIT 1
+    FOR UPDATE;
+
+    IF FOUND THEN
+        IF p_expected_version IS NOT NULL AND v_item.version <> p_expected_version THEN
+            RAISE EXCEPTION 'stock_version_conflict: % is at version %, expected %', p_item_name, v_item.version, p_expected_version
+                USING ERRCODE = '40001';
+        END IF;
+        v_previous_quantity := v_item.quantity;
+        -- The delta in the row's unit, and what one row unit cost at the given price
+        v_delta := stock_from_base_unit(stock_to_base_unit(p_quantity_delta, p_unit), v_item.unit);
+        v_average_cost := v_item.average_cost;
+        v_unit_cost := v_item.average_cost;
+        IF p_cost_price_per_unit IS NOT NULL AND v_delta > 0 THEN
+            v_unit_cost := p_cost_price_per_unit * p_quantity_delta / v_delta;
+            v_average_cost := CASE
+                WHEN v_item.quantity <= 0 OR v_item.average_cost IS NULL THEN v_unit_cost
+                ELSE (v_item.quantity * v_item.average_cost + v_delta * v_unit_cost) / (v_item.quantity + v_delta)
+            END;
+        END IF;
+
+        UPDATE stock_items
+        SET quantity = ROUND(GREATEST(0, quantity + v_delta), 2),
+            cost_price_per_unit = COALESCE(p_cost_price_per_unit, cost_price_per_unit),
+            average_cost = v_average_cost,
+            version = version + 1,
+            last_updated = NOW()
+        WHERE id = v_item.id
+        RETURNING * INTO v_item;
+    ELSE
+        IF p_expected_version IS NOT NULL AND p_expected_version <> 0 THEN
+            RAISE EXCEPTION 'stock_version_conflict: % no longer exists, expected version %', p_item_name, p_expected_version
+                USING ERRCODE = '40001';
+        END IF;
+
+        -- New items start at the delta, or at zero for a sale of something never stocked
+        v_unit_cost := CASE WHEN p_quantity_delta > 0 THEN p_cost_price_per_unit END;
+        INSERT INTO stock_items (user_id, item_name, quantity, unit, cost_price_per_unit, average_cost, last_updated)
+        VALUES (p_user_id, p_item_name, ROUND(GREATEST(0, p_quantity_delta), 2), p_unit, p_cost_price_per_unit, v_unit_cost, NOW())
+        ON CONFLICT ON CONSTRAINT unique_user_item DO NOTHING
+        RETURNING * INTO v_item;
+        IF NOT FOUND THEN
+            -- A concurrent request created the item first; apply the delta to its row instead
+            RETURN apply_stock_delta(p_user_id, p_item_name, p_quantity_delta, p_unit, p_cost_price_per_unit, p_expected_version, p_movement_type);
+        END IF;
+    END IF;
+
+    IF v_item.quantity <> v_previous_quantity THEN
+        INSERT INTO stock_movements (stock_item_id, user_id, item_name, movement_type, quantity_delta, unit_cost, average_cost_after, version)
+        VALUES (
+            v_item.id, p_user_id, v_item.item_name,
+            COALESCE(p_movement_type, CASE
+                WHEN v_item.quantity > v_previous_quantity AND p_cost_price_per_unit IS NOT NULL THEN 'purchase'
+                WHEN v_item.quantity < v_previous_quantity THEN 'sale'
+                ELSE 'adjustment'
+            END),
+            v_item.quantity - v_previous_quantity, v_unit_cost, v_item.average_cost, v_item.version
+        );
+    END IF;
+    RETURN v_item;
+END;
+$$;
+
+-- apply_stock_deltas passes each delta's optional "movement_type" through.
+CREATE OR REPLACE FUNCTION apply_stock_deltas(p_user_id TEXT, p_deltas JSONB)
+RETURNS TABLE (delta_index INT, stock_item JSONB)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_delta RECORD;
+BEGIN
+    FOR v_delta IN
+        SELECT d.value, d.ordinality
+        FROM jsonb_array_elements(p_deltas) WITH ORDINALITY AS d(value, ordinality)
+        ORDER BY d.value->>'item_name', d.ordinality
+    LOOP
+        delta_index := v_delta.ordinality - 1;
+        stock_item := to_jsonb(apply_stock_delta(
+            p_user_id,
+            v_delta.value->>'item_name',
+            (v_delta.value->>'quantity_delta')::NUMERIC,
+            COALESCE(v_delta.value->>'unit', 'pcs'),
+            (v_delta.value->>'cost_price_per_unit')::NUMERIC,
+            (v_delta.value->>'expected_version')::BIGINT,
+            v_delta.value->>'movement_type'
+        ));
+        RETURN NEXT;
+    END LOOP;
+END;
+$$;
+
+-- Snapshots every item that moved since its last snapshot. Run nightly; the delta scan behind
+-- get_stock_as_of is then at most one day of movements per item. Returns the snapshots taken.
+CREATE OR REPLACE FUNCTION take_stock_snapshots()
+RETURNS INTEGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_count INTEGER;
+BEGIN
+    INSERT INTO stock_snapshots (stock_item_id, user_id, item_name, quantity, average_cost, last_movement_id)
+    SELECT i.id, i.user_id, i.item_name, i.quantity, i.average_cost, latest.id
+    FROM stock_items i
+    JOIN LATERAL (
+        SELECT m.id FROM stock_movements m WHERE m.stock_item_id = i.id ORDER BY m.id DESC LIMIT 1
+    ) latest ON TRUE
+    WHERE latest.id > COALESCE((
+        SELECT s.last_movement_id FROM stock_snapshots s
+        WHERE s.stock_item_id = i.id ORDER BY s.snapshot_at DESC LIMIT 1
+    ), 0);
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$;
+
+-- A shop's stock as of a moment: each item's latest snapshot at or before p_as_of, plus the
+-- movements after that snapshot up to p_as_of.
+CREATE OR REPLACE FUNCTION get_stock_as_of(p_user_id TEXT, p_as_of TIMESTAMP WITH TIME ZONE)
+RETURNS TABLE (stock_item_id UUID, item_name TEXT, unit TEXT, quantity NUMERIC, average_cost NUMERIC)
+LANGUAGE sql STABLE AS $$
+    SELECT i.id, i.item_name, i.unit,
+           COALESCE(s.quantity, 0) + COALESCE(d.quantity_delta, 0),
+           CASE WHEN d.movements > 0 THEN d.average_cost ELSE s.average_cost END
+    FROM stock_items i
+    LEFT JOIN LATERAL (
+        SELECT ss.quantity, ss.average_cost, ss.last_movement_id
+        FROM stock_snapshots ss
+        WHERE ss.stock_item_id = i.id AND ss.snapshot_at <= p_as_of
+        ORDER BY ss.snapshot_at DESC
+        LIMIT 1
+    ) s ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT SUM(m.quantity_delta) AS quantity_delta,
+               (array_agg(m.average_cost_after ORDER BY m.id DESC))[1] AS average_cost,
+               COUNT(*) AS movements
+        FROM stock_movements m
+        WHERE m.stock_item_id = i.id AND m.id > COALESCE(s.last_movement_id, 0) AND m.created_at <= p_as_of
+    ) d ON TRUE
+    WHERE i.user_id = p_user_id AND (s.quantity IS NOT NULL OR d.movements > 0)
+    ORDER BY i.item_name;
+$$;
@@ -0,0 +1,53 @@
+-- Structured line items for transactions. A sale is one transaction with one line per item sold
+-- and a bill purchase is one expense with one line per item bought, so item-level sales and
+-- margin come from an index range scan instead of parsing transactions.item text.
+
+-- There is no foreign key to transactions: it would have to cover the partition key and would
+-- block detaching old transaction partitions. Lines are written in the same flush as their
+-- transaction, under the transaction id the application assigns.
+CREATE TABLE transaction_lines (
+    transaction_id UUID NOT NULL,
+    line_no SMALLINT NOT NULL,
+    user_id TEXT NOT NULL,
+    transaction_date DATE NOT NULL,
+    transaction_type VARCHAR(50) NOT NULL,
+    item_name TEXT NOT NULL,
+    quantity NUMERIC(12, 2),
+    unit TEXT,
+    unit_price NUMERIC(12, 4), -- Selling price for sales, purchase price for purchases
+    amount NUMERIC(12, 2), -- quantity * unit_price
+    cost NUMERIC(12, 2), -- Cost of the goods: average cost for sales (NULL if unknown), the price paid for purchases
+    PRIMARY KEY (transaction_id, line_no) -- Ledger replays of the same transaction hit ON CONFLICT DO NOTHING
+);
+
+CREATE INDEX idx_transaction_lines_user_item_date
+    ON transaction_lines (user_id, item_name, transaction_date)
+    INCLUDE (transaction_type, quantity, amount, cost);
+
+-- Sales recorded before this migration kept the item in text as "<item> (<quantity> <unit>)";
+-- parse them once so older periods also have lines.
+INSERT INTO transaction_lines (transaction_id, line_no, user_id, transaction_date, transaction_type, item_name, quantity, unit, unit_price, amount)
+SELECT t.id, 1, t.user_id, t.transaction_date, t.transaction_type, m[1], m[2]::NUMERIC, m[3],
+       t.amount / NULLIF(m[2]::NUMERIC, 0), t.amount
+FROM transactions t
+CROSS JOIN LATERAL regexp_match(t.item, '^(.+) \(([0-9]+(?:\.[0-9]+)?) (\S+)\)$') AS m
+WHERE lower(t.transaction_type) = 'sale'
+ON CONFLICT DO NOTHING;
+
+-- Per-item sales of a shop between two dates (inclusive): quantity, sales, cost and margin.
+-- Margin only counts lines whose cost is known. p_item_name restricts it to one item.
+CREATE OR REPLACE FUNCTION get_item_sales(p_user_id TEXT, p_start_date DATE, p_end_date DATE, p_item_name TEXT DEFAULT NULL)
+RETURNS TABLE (item_name TEXT, unit TEXT, quantity NUMERIC, sales NUMERIC, cost NUMERIC, margin NUMERIC, line_count BIGINT)
+LANGUAGE sql STABLE AS $$
+    SELECT l.item_name, MIN(l.unit),
+           SUM(l.quantity), SUM(l.amount), SUM(l.cost),
+           SUM(l.amount - l.cost) FILTER (WHERE l.cost IS NOT NULL),
+           COUNT(*)
+    FROM transaction_lines l
+    WHERE l.user_id = p_user_id
+      AND (p_item_name IS NULL OR l.item_name = p_item_name)
+      AND l.transaction_date BETWEEN p_start_date AND p_end_date
+      AND l.transaction_type = 'sale'
+    GROUP BY l.item_name
+    ORDER BY SUM(l.amount) DESC;
+$$;
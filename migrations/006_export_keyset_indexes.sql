@@ -0,0 +1,13 @@
+-- Keyset indexes for the ledger export (ledger_export.py). Each export page is
+-- WHERE user_id = ? AND <range> AND (key) > (last key) ORDER BY key LIMIT n, so it is an index
+-- range scan that costs the same on page 1 and page 200.
+
+-- iter_transactions: keyset on (transaction_date, id) within a date range.
+CREATE INDEX IF NOT EXISTS idx_transactions_user_date_id
+    ON transactions (user_id, transaction_date, id);
+
+-- iter_stock_movements: keyset on (created_at, id) within a time range.
+-- Replaces the (user_id, created_at) index added with stock_movements.
+CREATE INDEX IF NOT EXISTS idx_stock_movements_user_created_id
+    ON stock_movements (user_id, created_at, id);
+DROP INDEX IF EXISTS idx_stock_movements_user_created;
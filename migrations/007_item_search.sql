@@ -0,0 +1,69 @@
+-- Trigram search over what shops sold, bought and spent on ("how much Parle-G did I sell last
+-- month", "when did I last buy ghee"). pg_trgm works on characters, so Devanagari and Latin item
+-- names are both indexed; the app searches with the shopkeeper's words and their translation.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+-- Lets user_id (a plain text equality) share the GIN index with the trigram column
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+-- Sale and purchase lines by item name
+CREATE INDEX IF NOT EXISTS idx_transaction_lines_item_trgm
+    ON transaction_lines USING gin (user_id, lower(item_name) gin_trgm_ops);
+
+-- Expenses recorded as free text ("rent", "electricity bill")
+CREATE INDEX IF NOT EXISTS idx_transactions_expense_item_trgm
+    ON transactions USING gin (user_id, lower(item) gin_trgm_ops)
+    WHERE transaction_type = 'expense';
+
+-- Matches for any of p_terms between two dates, one row per (item, kind) where kind is 'sale'
+-- or 'purchase' (transaction lines) or 'expense' (expense descriptions), best match first.
+-- A term matches when it is similar to a word or phrase in the name (pg_trgm's <% operator,
+-- word_similarity >= pg_trgm.word_similarity_threshold, 0.6 by default). Each term is its own
+-- index scan, so the cost follows the number of matches, not the length of the history.
+CREATE OR REPLACE FUNCTION search_item_history(
+    p_user_id TEXT,
+    p_terms TEXT[],
+    p_start_date DATE,
+    p_end_date DATE,
+    p_kind TEXT DEFAULT NULL,
+    p_limit INTEGER DEFAULT 5
+) RETURNS TABLE (
+    item_name TEXT, kind TEXT, unit TEXT, quantity NUMERIC, amount NUMERIC, entry_count BIGINT,
+    first_date DATE, last_date DATE, last_quantity NUMERIC, last_amount NUMERIC, score REAL
+)
+LANGUAGE sql STABLE AS $$
+    WITH line_matches AS (
+        SELECT l.item_name, CASE WHEN l.transaction_type = 'sale' THEN 'sale' ELSE 'purchase' END AS kind,
+               l.unit, l.quantity, l.amount, l.transaction_date,
+               MAX(word_similarity(lower(q.term), lower(l.item_name))) AS score
+        FROM unnest(p_terms) AS q(term)
+        JOIN transaction_lines l ON l.user_id = p_user_id AND lower(q.term) <% lower(l.item_name)
+        WHERE l.transaction_date BETWEEN p_start_date AND p_end_date
+          AND (p_kind IS NULL OR p_kind = CASE WHEN l.transaction_type = 'sale' THEN 'sale' ELSE 'purchase' END)
+        GROUP BY l.transaction_id, l.line_no -- A line matched by several terms counts once
+    ),
+    expense_matches AS (
+        SELECT t.item AS item_name, 'expense' AS kind, NULL::TEXT AS unit, NULL::NUMERIC AS quantity, t.amount, t.transaction_date,
+               MAX(word_similarity(lower(q.term), lower(t.item))) AS score
+        FROM unnest(p_terms) AS q(term)
+        JOIN transactions t ON t.user_id = p_user_id AND t.transaction_type = 'expense' AND lower(q.term) <% lower(t.item)
+        WHERE t.transaction_date BETWEEN p_start_date AND p_end_date
+          AND (p_kind IS NULL OR p_kind = 'expense')
+          -- Bill purchases are expenses whose items are already matched as purchase lines
+          AND NOT EXISTS (SELECT 1 FROM transaction_lines l WHERE l.transaction_id = t.id)
+        GROUP BY t.id, t.transaction_date
+    ),
+    matches AS (
+        SELECT * FROM line_matches
+        UNION ALL
+        SELECT * FROM expense_matches
+    )
+    SELECT m.item_name, m.kind, MIN(m.unit), SUM(m.quantity), SUM(m.amount), COUNT(*),
+           MIN(m.transaction_date), MAX(m.transaction_date),
+           (array_agg(m.quantity ORDER BY m.transaction_date DESC))[1],
+           (array_agg(m.amount ORDER BY m.transaction_date DESC))[1],
+           MAX(m.score)
+    FROM matches m
+    GROUP BY m.item_name, m.kind
+    ORDER BY MAX(m.score) DESC, SUM(m.amount) DESC
+    LIMIT p_limit;
+$$;
@@ -0,0 +1,330 @@
+-- Hot/cold split of the ledger. Months older than the archive horizon (TRANSACTION_ARCHIVE_MONTHS)
+-- are detached from `transactions` and attached to `transactions_archive`: the partition only
+-- changes parent, no rows are copied, and every per-shop query on `transactions` is left with
+-- recent months. Their lines move to `transaction_lines_archive`. Before a month leaves, its totals
+-- are folded into `archived_balances` and its daily rollups recomputed, so balances, reconciliation
+-- and period summaries keep covering the whole history. Exports and item search read the archive
+-- only when asked to (include_archive / p_include_archive).
+--
+-- A month is archived by archive_transaction_month, one call (and one transaction) per month. Its
+-- partition becomes transactions_archive_YYYY_MM, so ensure_transaction_partitions can create a new
+-- hot transactions_YYYY_MM when history for that month is imported later; the next archive run
+-- moves those rows into the archived month. Re-imported rows that are already archived are skipped
+-- on insert (transactions_skip_archived below).
+
+CREATE TABLE transactions_archive (LIKE transactions INCLUDING DEFAULTS) PARTITION BY RANGE (transaction_date);
+ALTER TABLE transactions_archive ADD PRIMARY KEY (id, transaction_date);
+-- Created on the parent, so attaching a month reuses the index the partition already has
+CREATE INDEX idx_transactions_archive_user_date_id ON transactions_archive (user_id, transaction_date, id);
+CREATE UNIQUE INDEX idx_transactions_archive_client_txn_id ON transactions_archive (client_txn_id, transaction_date);
+CREATE INDEX idx_transactions_archive_expense_item_trgm
+    ON transactions_archive USING gin (user_id, lower(item) gin_trgm_ops)
+    WHERE transaction_type = 'expense';
+
+CREATE TABLE transaction_lines_archive (LIKE transaction_lines INCLUDING ALL);
+
+ALTER TABLE transactions_archive ENABLE ROW LEVEL SECURITY;
+CREATE POLICY "Users can view their own archived transactions." ON transactions_archive
+  FOR SELECT USING (auth.uid()::TEXT = user_id);
+
+-- Totals of each shop's archived transactions, as in shop_balances
+CREATE TABLE archived_balances (
+    user_id TEXT PRIMARY KEY,
+    balance NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    total_sales NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    total_expenses NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    transaction_count BIGINT NOT NULL DEFAULT 0,
+    archived_through DATE NOT NULL, -- Transactions before this date are archived
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Each shop's totals over the whole history: the hot ledger plus what was archived.
+-- A filter on user_id is pushed into both halves.
+CREATE OR REPLACE VIEW ledger_balances AS
+SELECT l.user_id, SUM(l.balance) AS balance, SUM(l.total_sales) AS total_sales,
+       SUM(l.total_expenses) AS total_expenses, SUM(l.transaction_count)::BIGINT AS transaction_count
+FROM (
+    SELECT t.user_id,
+           SUM(CASE lower(t.transaction_type) WHEN 'sale' THEN t.amount WHEN 'expense' THEN -t.amount ELSE 0 END) AS balance,
+           SUM(CASE WHEN lower(t.transaction_type) = 'sale' THEN t.amount ELSE 0 END) AS total_sales,
+           SUM(CASE WHEN lower(t.transaction_type) = 'expense' THEN t.amount ELSE 0 END) AS total_expenses,
+           COUNT(*) AS transaction_count
+    FROM transactions t
+    GROUP BY t.user_id
+    UNION ALL
+    SELECT a.user_id, a.balance, a.total_sales, a.total_expenses, a.transaction_count
+    FROM archived_balances a
+) l
+GROUP BY l.user_id;
+
+-- As in supabase_schema.sql, with the ledger totals taken from ledger_balances so archived
+-- transactions still count.
+CREATE OR REPLACE FUNCTION reconcile_shop_balances(p_fix BOOLEAN DEFAULT TRUE)
+RETURNS TABLE (shop_user_id TEXT, stored_balance NUMERIC, ledger_balance NUMERIC, stored_transaction_count BIGINT, ledger_transaction_count BIGINT)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_candidate TEXT;
+    v_ledger RECORD;
+BEGIN
+    FOR v_candidate IN
+        SELECT COALESCE(l.user_id, b.user_id)
+        FROM ledger_balances l
+        FULL OUTER JOIN shop_balances b ON b.user_id = l.user_id
+        WHERE l.balance IS DISTINCT FROM b.balance OR l.transaction_count IS DISTINCT FROM b.transaction_count
+    LOOP
+        INSERT INTO shop_balances (user_id) VALUES (v_candidate) ON CONFLICT (user_id) DO NOTHING;
+        PERFORM 1 FROM shop_balances b WHERE b.user_id = v_candidate FOR UPDATE;
+
+        SELECT COALESCE(MAX(l.balance), 0) AS balance,
+               COALESCE(MAX(l.total_sales), 0) AS total_sales,
+               COALESCE(MAX(l.total_expenses), 0) AS total_expenses,
+               COALESCE(MAX(l.transaction_count), 0) AS transaction_count
+        INTO v_ledger
+        FROM ledger_balances l
+        WHERE l.user_id = v_candidate;
+
+        SELECT b.user_id, b.balance, v_ledger.balance, b.transaction_count, v_ledger.transaction_count
+        INTO shop_user_id, stored_balance, ledger_balance, stored_transaction_count, ledger_transaction_count
+        FROM shop_balances b
+        WHERE b.user_id = v_candidate;
+
+        IF stored_balance IS DISTINCT FROM ledger_balance OR stored_transaction_count IS DISTINCT FROM ledger_transaction_count THEN
+            IF p_fix THEN
+                UPDATE shop_balances
+                SET balance = v_ledger.balance,
+                    total_sales = v_ledger.total_sales,
+                    total_expenses = v_ledger.total_expenses,
+                    transaction_count = v_ledger.transaction_count,
+                    updated_at = NOW()
+                WHERE user_id = v_candidate;
+            END IF;
+            RETURN NEXT;
+        END IF;
+    END LOOP;
+END;
+$$;
+
+-- Months with transactions in the hot tier that end on or before p_before: monthly partitions
+-- (including months recreated for imported history) and rows that landed in transactions_default.
+CREATE OR REPLACE FUNCTION transaction_months_to_archive(p_before DATE)
+RETURNS SETOF DATE
+LANGUAGE sql STABLE AS $$
+    SELECT m.month
+    FROM (
+        SELECT to_date(substring(c.relname FROM 'transactions_(\d{4}_\d{2})$'), 'YYYY_MM') AS month
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'transactions'::regclass AND c.relname ~ '^transactions_\d{4}_\d{2}$'
+        UNION
+        SELECT date_trunc('month', d.transaction_date)::DATE
+        FROM transactions_default d
+        WHERE d.transaction_date < p_before
+    ) m
+    WHERE (m.month + INTERVAL '1 month')::DATE <= p_before
+    ORDER BY m.month;
+$$;
+
+-- Moves one month of `transactions` (p_month is its first day) and its lines to the archive, in one
+-- transaction: block writes to it, fold its totals into archived_balances, recompute its daily
+-- rollups over both tiers, move its lines, then move the partition. The first time, the partition
+-- is detached, renamed transactions_archive_YYYY_MM and attached to the archive; rows that reach the
+-- month later are copied into that partition and the hot one dropped. Rows of the month sitting in
+-- transactions_default are first moved into a partition of their own, as ensure_transaction_partitions
+-- does. Returns one row, or none if the month has nothing left in the hot tier.
+-- DETACH and DROP briefly lock `transactions`; run it off-peak.
+CREATE OR REPLACE FUNCTION archive_transaction_month(p_month DATE)
+RETURNS TABLE (archived_month DATE, transaction_count BIGINT, line_count BIGINT)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_month DATE := date_trunc('month', p_month)::DATE;
+    v_next DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::DATE;
+    v_partition TEXT := format('transactions_%s', to_char(p_month, 'YYYY_MM'));
+    v_archive TEXT := format('transactions_archive_%s', to_char(p_month, 'YYYY_MM'));
+    v_archived BOOLEAN;
+    v_rows TEXT;
+BEGIN
+    v_archived := to_regclass(v_archive) IS NOT NULL;
+    IF to_regclass(v_partition) IS NULL THEN
+        PERFORM 1 FROM transactions_default WHERE transaction_date >= v_month AND transaction_date < v_next LIMIT 1;
+        IF NOT FOUND THEN
+            RETURN;
+        END IF;
+        CREATE TEMP TABLE moved_transactions (LIKE transactions) ON COMMIT DROP;
+        WITH moved AS (
+            DELETE FROM transactions_default
+            WHERE transaction_date >= v_month AND transaction_date < v_next
+            RETURNING *
+        )
+        INSERT INTO moved_transactions SELECT * FROM moved;
+        EXECUTE format('CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)', v_partition, v_month, v_next);
+        EXECUTE format('INSERT INTO %I SELECT * FROM moved_transactions', v_partition);
+        DROP TABLE moved_transactions;
+    END IF;
+    EXECUTE format('LOCK TABLE %I IN SHARE MODE', v_partition);
+
+    EXECUTE format($sql$
+        INSERT INTO archived_balances AS a (user_id, balance, total_sales, total_expenses, transaction_count, archived_through, updated_at)
+        SELECT t.user_id,
+               SUM(CASE lower(t.transaction_type) WHEN 'sale' THEN t.amount WHEN 'expense' THEN -t.amount ELSE 0 END),
+               SUM(CASE WHEN lower(t.transaction_type) = 'sale' THEN t.amount ELSE 0 END),
+               SUM(CASE WHEN lower(t.transaction_type) = 'expense' THEN t.amount ELSE 0 END),
+               COUNT(*), %L, NOW()
+        FROM %I t
+        GROUP BY t.user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET balance = a.balance + EXCLUDED.balance,
+            total_sales = a.total_sales + EXCLUDED.total_sales,
+            total_expenses = a.total_expenses + EXCLUDED.total_expenses,
+            transaction_count = a.transaction_count + EXCLUDED.transaction_count,
+            archived_through = GREATEST(a.archived_through, EXCLUDED.archived_through),
+            updated_at = NOW()
+    $sql$, v_next, v_partition);
+
+    -- A month archived before already has rows in the archive; its days are recomputed over both
+    v_rows := format('SELECT user_id, transaction_date, transaction_type, amount FROM %I', v_partition);
+    IF v_archived THEN
+        v_rows := v_rows || format(' UNION ALL SELECT user_id, transaction_date, transaction_type, amount FROM %I', v_archive);
+    END IF;
+    EXECUTE format($sql$
+        INSERT INTO daily_rollups AS r (user_id, rollup_date, sales, expenses, purchases, profit, txn_count, updated_at)
+        SELECT d.user_id, d.transaction_date, d.sales, d.expenses, d.purchases, d.sales - d.expenses - d.purchases, d.txn_count, NOW()
+        FROM (
+            SELECT t.user_id, t.transaction_date,
+                   SUM(CASE WHEN lower(t.transaction_type) = 'sale' THEN t.amount ELSE 0 END) AS sales,
+                   SUM(CASE WHEN lower(t.transaction_type) = 'expense' THEN t.amount ELSE 0 END) AS expenses,
+                   SUM(CASE WHEN lower(t.transaction_type) = 'purchase' THEN t.amount ELSE 0 END) AS purchases,
+                   COUNT(*) AS txn_count
+            FROM (%s) t
+            GROUP BY t.user_id, t.transaction_date
+        ) d
+        ON CONFLICT (user_id, rollup_date) DO UPDATE
+        SET sales = EXCLUDED.sales, expenses = EXCLUDED.expenses, purchases = EXCLUDED.purchases,
+            profit = EXCLUDED.profit, txn_count = EXCLUDED.txn_count, updated_at = NOW()
+    $sql$, v_rows);
+
+    -- Lines are found by their transaction's id (the primary key), not by scanning for the month
+    EXECUTE format($sql$
+        WITH moved AS (
+            DELETE FROM transaction_lines l
+            WHERE l.transaction_id IN (SELECT t.id FROM %I t)
+            RETURNING l.*
+        )
+        INSERT INTO transaction_lines_archive SELECT * FROM moved
+    $sql$, v_partition);
+    GET DIAGNOSTICS line_count = ROW_COUNT;
+
+    EXECUTE format('SELECT COUNT(*) FROM %I', v_partition) INTO transaction_count;
+    IF v_archived THEN
+        EXECUTE format('INSERT INTO %I (id, transaction_date, transaction_type, amount, item, user_id, created_at, client_txn_id) '
+                       'SELECT id, transaction_date, transaction_type, amount, item, user_id, created_at, client_txn_id FROM %I',
+                       v_archive, v_partition);
+        EXECUTE format('DROP TABLE %I', v_partition);
+    ELSE
+        EXECUTE format('ALTER TABLE transactions DETACH PARTITION %I', v_partition);
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', v_partition, v_archive);
+        EXECUTE format('ALTER TABLE transactions_archive ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', v_archive, v_month, v_next);
+    END IF;
+    archived_month := v_month;
+    RETURN NEXT;
+END;
+$$;
+
+-- History re-imported for archived months must not be stored (and counted) twice: rows whose
+-- client_txn_id is already archived, and lines already archived, are skipped before the insert,
+-- so the statement triggers never see them. Only months before the current one can be archived.
+CREATE OR REPLACE FUNCTION skip_archived_transaction()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM 1 FROM transactions_archive a
+    WHERE a.client_txn_id = NEW.client_txn_id AND a.transaction_date = NEW.transaction_date;
+    RETURN CASE WHEN FOUND THEN NULL ELSE NEW END;
+END;
+$$;
+
+CREATE TRIGGER transactions_skip_archived
+    BEFORE INSERT ON transactions
+    FOR EACH ROW
+    WHEN (NEW.client_txn_id IS NOT NULL AND NEW.transaction_date < date_trunc('month', CURRENT_DATE))
+    EXECUTE FUNCTION skip_archived_transaction();
+
+CREATE OR REPLACE FUNCTION skip_archived_transaction_line()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM 1 FROM transaction_lines_archive a
+    WHERE a.transaction_id = NEW.transaction_id AND a.line_no = NEW.line_no;
+    RETURN CASE WHEN FOUND THEN NULL ELSE NEW END;
+END;
+$$;
+
+CREATE TRIGGER transaction_lines_skip_archived
+    BEFORE INSERT ON transaction_lines
+    FOR EACH ROW
+    WHEN (NEW.transaction_date < date_trunc('month', CURRENT_DATE))
+    EXECUTE FUNCTION skip_archived_transaction_line();
+
+-- Item search with the archive: the same as 007, each source optionally followed by its archive.
+-- An expense is matched on its description only if it has no lines in the same tier.
+DROP FUNCTION IF EXISTS search_item_history(TEXT, TEXT[], DATE, DATE, TEXT, INTEGER);
+CREATE OR REPLACE FUNCTION search_item_history(
+    p_user_id TEXT,
+    p_terms TEXT[],
+    p_start_date DATE,
+    p_end_date DATE,
+    p_kind TEXT DEFAULT NULL,
+    p_limit INTEGER DEFAULT 5,
+    p_include_archive BOOLEAN DEFAULT FALSE
+) RETURNS TABLE (
+    item_name TEXT, kind TEXT, unit TEXT, quantity NUMERIC, amount NUMERIC, entry_count BIGINT,
+    first_date DATE, last_date DATE, last_quantity NUMERIC, last_amount NUMERIC, score REAL
+)
+LANGUAGE sql STABLE AS $$
+    WITH lines AS (
+        SELECT transaction_id, line_no, user_id, transaction_date, transaction_type, item_name, quantity, unit, amount FROM transaction_lines
+        UNION ALL
+        SELECT transaction_id, line_no, user_id, transaction_date, transaction_type, item_name, quantity, unit, amount FROM transaction_lines_archive
+        WHERE p_include_archive
+    ),
+    expenses AS (
+        SELECT t.id, t.user_id, t.transaction_date, t.item, t.amount FROM transactions t
+        WHERE t.transaction_type = 'expense' AND NOT EXISTS (SELECT 1 FROM transaction_lines l WHERE l.transaction_id = t.id)
+        UNION ALL
+        SELECT t.id, t.user_id, t.transaction_date, t.item, t.amount FROM transactions_archive t
+        WHERE p_include_archive AND t.transaction_type = 'expense'
+          AND NOT EXISTS (SELECT 1 FROM transaction_lines_archive l WHERE l.transaction_id = t.id)
+    ),
+    line_matches AS (
+        SELECT l.item_name, CASE WHEN l.transaction_type = 'sale' THEN 'sale' ELSE 'purchase' END AS kind,
+               MIN(l.unit) AS unit, MIN(l.quantity) AS quantity, MIN(l.amount) AS amount, l.transaction_date,
+               MAX(word_similarity(lower(q.term), lower(l.item_name))) AS score
+        FROM unnest(p_terms) AS q(term)
+        JOIN lines l ON l.user_id = p_user_id AND lower(q.term) <% lower(l.item_name)
+        WHERE l.transaction_date BETWEEN p_start_date AND p_end_date
+          AND (p_kind IS NULL OR p_kind = CASE WHEN l.transaction_type = 'sale' THEN 'sale' ELSE 'purchase' END)
+        GROUP BY l.transaction_id, l.line_no, l.item_name, l.transaction_type, l.transaction_date -- A line matched by several terms counts once
+    ),
+    expense_matches AS (
+        SELECT t.item AS item_name, 'expense' AS kind, NULL::TEXT AS unit, NULL::NUMERIC AS quantity, MIN(t.amount) AS amount, t.transaction_date,
+               MAX(word_similarity(lower(q.term), lower(t.item))) AS score
+        FROM unnest(p_terms) AS q(term)
+        JOIN expenses t ON t.user_id = p_user_id AND lower(q.term) <% lower(t.item)
+        WHERE t.transaction_date BETWEEN p_start_date AND p_end_date
+          AND (p_kind IS NULL OR p_kind = 'expense')
+        GROUP BY t.id, t.transaction_date, t.item
+    ),
+    matches AS (
+        SELECT * FROM line_matches
+        UNION ALL
+        SELECT * FROM expense_matches
+    )
+    SELECT m.item_name, m.kind, MIN(m.unit), SUM(m.quantity), SUM(m.amount), COUNT(*),
+           MIN(m.transaction_date), MAX(m.transaction_date),
+           (array_agg(m.quantity ORDER BY m.transaction_date DESC))[1],
+           (array_agg(m.amount ORDER BY m.transaction_date DESC))[1],
+           MAX(m.score)
+    FROM matches m
+    GROUP BY m.item_name, m.kind
+    ORDER BY MAX(m.score) DESC, SUM(m.amount) DESC
+    LIMIT p_limit;
+$$;
@@ -0,0 +1,56 @@
+-- Owners running several kiranas, each registered as its own WhatsApp sender. An outlet joins
+-- its owner by naming the owner's number (so a shop's figures are only shared with its consent);
+-- the owner's own number is mapped too, so the roll-ups cover every outlet including theirs.
+-- A shop belongs to at most one owner.
+CREATE TABLE owner_shops (
+    user_id TEXT PRIMARY KEY,
+    owner_id TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Every roll-up starts from WHERE owner_id = $1
+CREATE INDEX IF NOT EXISTS idx_owner_shops_owner ON owner_shops (owner_id, user_id);
+
+ALTER TABLE owner_shops ENABLE ROW LEVEL SECURITY;
+CREATE POLICY "Owners can view their outlets." ON owner_shops
+    FOR SELECT USING (auth.uid()::text = owner_id OR auth.uid()::text = user_id);
+
+-- Links p_user_id to p_owner_id (moving it if it had another owner) and maps the owner's own shop.
+CREATE OR REPLACE FUNCTION link_owner_shop(p_owner_id TEXT, p_user_id TEXT)
+RETURNS VOID
+LANGUAGE sql AS $$
+    INSERT INTO owner_shops (user_id, owner_id) VALUES (p_user_id, p_owner_id)
+    ON CONFLICT (user_id) DO UPDATE SET owner_id = EXCLUDED.owner_id, created_at = NOW();
+    INSERT INTO owner_shops (user_id, owner_id) VALUES (p_owner_id, p_owner_id)
+    ON CONFLICT (user_id) DO NOTHING;
+$$;
+
+-- One row per outlet of p_owner_id: its running balance (shop_balances) and its totals between
+-- two dates (daily_rollups). A single grouped query whatever the number of outlets, each outlet
+-- being a primary-key lookup plus a range of its rollups.
+CREATE OR REPLACE FUNCTION get_owner_rollup(p_owner_id TEXT, p_start_date DATE, p_end_date DATE)
+RETURNS TABLE (
+    user_id TEXT, balance NUMERIC, sales NUMERIC, expenses NUMERIC, purchases NUMERIC, profit NUMERIC, txn_count BIGINT
+)
+LANGUAGE sql STABLE AS $$
+    SELECT o.user_id, COALESCE(b.balance, 0),
+           COALESCE(SUM(r.sales), 0), COALESCE(SUM(r.expenses), 0), COALESCE(SUM(r.purchases), 0),
+           COALESCE(SUM(r.profit), 0), COALESCE(SUM(r.txn_count), 0)::BIGINT
+    FROM owner_shops o
+    LEFT JOIN shop_balances b ON b.user_id = o.user_id
+    LEFT JOIN daily_rollups r ON r.user_id = o.user_id AND r.rollup_date BETWEEN p_start_date AND p_end_date
+    WHERE o.owner_id = p_owner_id
+    GROUP BY o.user_id, b.balance
+    ORDER BY o.user_id;
+$$;
+
+-- Low-stock items of every outlet of p_owner_id, served per outlet by the partial low-stock index.
+CREATE OR REPLACE FUNCTION get_owner_low_stock_items(p_owner_id TEXT)
+RETURNS SETOF stock_items
+LANGUAGE sql STABLE AS $$
+    SELECT s.*
+    FROM owner_shops o
+    JOIN stock_items s ON s.user_id = o.user_id AND s.quantity <= s.min_quantity_threshold
+    WHERE o.owner_id = p_owner_id
+    ORDER BY s.user_id, s.item_name;
+$$;
@@ -0,0 +1,12 @@
+-- A second, 256-bit dHash of each bill photo (17x16 thumbnail, stored as 64 hex digits). The 64-bit
+-- image_hash finds candidates through the multi-index table in bill_hash_index.py; the detail hash
+-- confirms them, so bills printed on the same supplier template are not taken for one another.
+-- Rows stored before this migration have no detail hash and are matched on image_hash alone, at a
+-- tighter distance.
+ALTER TABLE bill_image_hashes ADD COLUMN IF NOT EXISTS detail_hash TEXT;
+
+-- Bills on one template often share the 64-bit image_hash, so each of their detail hashes gets its
+-- own row. NULLS NOT DISTINCT keeps rows without a detail hash to one per image_hash. The index
+-- starts with user_id, so get_bill_image_hashes (WHERE user_id = ?) still uses it.
+ALTER TABLE bill_image_hashes DROP CONSTRAINT IF EXISTS unique_user_bill_hash;
+ALTER TABLE bill_image_hashes ADD CONSTRAINT unique_user_bill_detail_hash UNIQUE NULLS NOT DISTINCT (user_id, image_hash, detail_hash);
@@ -0,0 +1,42 @@
+-- Applies write-behind ledger entries (write_ahead_ledger.py) in one request and one transaction:
+-- the stock deltas and the transactions of an entry are committed together, so a rejected
+-- transaction insert also rolls back the stock movement. Replaces apply_ledger_stock_entries
+-- (migrations/003_write_behind_ledger.sql), which only covered the stock half.
+
+-- p_entries is a JSON array of {"entry_id", "user_id", "deltas", "transactions", "lines"}: deltas as
+-- for apply_stock_deltas, transactions and lines as rows of those tables. Replays are skipped:
+-- stock deltas by entry_id, transactions by client_txn_id and lines by (transaction_id, line_no).
+-- Returns how many entries had stock deltas applied now.
+CREATE OR REPLACE FUNCTION apply_ledger_entries(p_entries JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_entry JSONB;
+    v_applied INTEGER := 0;
+BEGIN
+    FOR v_entry IN SELECT value FROM jsonb_array_elements(p_entries) LOOP
+        IF jsonb_array_length(COALESCE(v_entry->'deltas', '[]'::JSONB)) > 0 THEN
+            INSERT INTO applied_ledger_entries (entry_id, user_id)
+            VALUES (v_entry->>'entry_id', v_entry->>'user_id')
+            ON CONFLICT (entry_id) DO NOTHING;
+            IF FOUND THEN
+                PERFORM apply_stock_deltas(v_entry->>'user_id', v_entry->'deltas');
+                v_applied := v_applied + 1;
+            END IF;
+        END IF;
+
+        INSERT INTO transactions (id, transaction_date, transaction_type, amount, item, user_id, client_txn_id)
+        SELECT id, transaction_date, transaction_type, amount, item, user_id, client_txn_id
+        FROM jsonb_populate_recordset(NULL::transactions, COALESCE(v_entry->'transactions', '[]'::JSONB))
+        ON CONFLICT (client_txn_id, transaction_date) DO NOTHING;
+
+        INSERT INTO transaction_lines (transaction_id, line_no, user_id, transaction_date, transaction_type, item_name, quantity, unit, unit_price, amount, cost)
+        SELECT transaction_id, line_no, user_id, transaction_date, transaction_type, item_name, quantity, unit, unit_price, amount, cost
+        FROM jsonb_populate_recordset(NULL::transaction_lines, COALESCE(v_entry->'lines', '[]'::JSONB))
+        ON CONFLICT (transaction_id, line_no) DO NOTHING;
+    END LOOP;
+    RETURN v_applied;
+END;
+$$;
+
+DROP FUNCTION IF EXISTS apply_ledger_stock_entries(JSONB);
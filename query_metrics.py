@@ -0,0 +1,70 @@
+import threading
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (milliseconds), safe to update from any thread."""
+
+    def __init__(self, buckets_ms: tuple = LATENCY_BUCKETS_MS):
+        self._buckets_ms = buckets_ms
+        self._counts = [0] * (len(buckets_ms) + 1)  # Last slot counts everything above the largest bucket
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, latency_ms: float, failed: bool = False):
+        slot = next((index for index, bound in enumerate(self._buckets_ms) if latency_ms <= bound), len(self._buckets_ms))
+        with self._lock:
+            self._counts[slot] += 1
+            self.count += 1
+            self.errors += 1 if failed else 0
+            self.total_ms += latency_ms
+            self.max_ms = max(self.max_ms, latency_ms)
+
+    def _percentile(self, counts: list[int], count: int, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of samples."""
+        threshold = fraction * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= threshold:
+                return min(float(self._buckets_ms[index]), self.max_ms) if index < len(self._buckets_ms) else self.max_ms
+        return self.max_ms
+
+    def summary(self) -> dict:
+        with self._lock:
+            counts = list(self._counts)
+            count, errors, total_ms, max_ms = self.count, self.errors, self.total_ms, self.max_ms
+        if not count:
+            return {"count": 0}
+        labels = [f"<={bound}ms" for bound in self._buckets_ms] + [f">{self._buckets_ms[-1]}ms"]
+        return {
+            "count": count,
+            "errors": errors,
+            "avg_ms": round(total_ms / count, 2),
+            "p50_ms": round(self._percentile(counts, count, 0.5), 2),
+            "p99_ms": round(self._percentile(counts, count, 0.99), 2),
+            "max_ms": round(max_ms, 2),
+            "buckets": {label: bucket_count for label, bucket_count in zip(labels, counts) if bucket_count},
+        }
+
+
+class QueryMetrics:
+    """Latency histograms keyed by query name."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, latency_ms: float, failed: bool = False):
+        with self._lock:
+            histogram = self._histograms.setdefault(name, LatencyHistogram())
+        histogram.record(latency_ms, failed=failed)
+
+    def summary(self) -> dict:
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {name: histogram.summary() for name, histogram in sorted(histograms.items())}
@@ -0,0 +1,121 @@
+import asyncio
+import contextvars
+import time
+
+from storage import get_shop, get_stock_levels
+
+# The prefetch started by the webhook for the request currently being handled.
+_current_prefetch: contextvars.ContextVar = contextvars.ContextVar("sender_prefetch", default=None)
+
+
+def _price_memory(stock_levels: list[dict]) -> dict:
+    return {
+        (item["item_name"].lower(), (item["unit"] or "").lower()): float(item["cost_price_per_unit"])
+        for item in stock_levels
+        if item.get("cost_price_per_unit") is not None
+    }
+
+
+class SenderPrefetch:
+    """Speculatively loads a sender's shop state while their media is downloaded and transcribed.
+
+    The stock list (which also carries the shop's price memory in `cost_price_per_unit`)
+    and the shop's registry row are fetched in background tasks as soon as the webhook
+    arrives. Later pipeline stages await them through `stock_levels()` and `shop()`
+    instead of querying Supabase again.
+    """
+
+    def __init__(self, sender_id: str):
+        self.sender_id = sender_id
+        self.started_at = time.perf_counter()
+        self.fetch_seconds = None  # How long the prefetch itself took
+        self.wait_seconds = 0.0    # How long consumers were blocked waiting for it
+        self.consumed = False
+        self._stock_task = asyncio.create_task(self._load_stock_levels())
+        self._shop_task = asyncio.create_task(get_shop(sender_id))
+
+    async def _load_stock_levels(self) -> list[dict]:
+        try:
+            return await get_stock_levels(self.sender_id)
+        finally:
+            self.fetch_seconds = time.perf_counter() - self.started_at
+
+    async def stock_levels(self) -> list[dict]:
+        """Returns the prefetched stock rows, waiting for the fetch only if it is still running."""
+        wait_started_at = time.perf_counter()
+        stock_levels = await asyncio.shield(self._stock_task)
+        self.wait_seconds += time.perf_counter() - wait_started_at
+        self.consumed = True
+        # Hand out copies so callers can annotate rows without corrupting the shared snapshot
+        return [dict(item) for item in stock_levels]
+
+    async def shop(self) -> dict | None:
+        """Returns the shop's registry row (language, location, status), or None for a new shop."""
+        return await asyncio.shield(self._shop_task)
+
+    async def price_memory(self) -> dict:
+        """Returns the last known cost price per unit keyed by lowercased (item_name, unit)."""
+        return _price_memory(await self.stock_levels())
+
+    def overlap_report(self) -> dict:
+        """Summarises how much of the prefetch latency was hidden behind media processing."""
+        fetch_seconds = self.fetch_seconds or 0.0
+        overlap_seconds = max(0.0, fetch_seconds - self.wait_seconds) if self.consumed else 0.0
+        return {
+            "sender_id": self.sender_id,
+            "consumed": self.consumed,
+            "fetch_ms": round(fetch_seconds * 1000, 1),
+            "wait_ms": round(self.wait_seconds * 1000, 1),
+            "overlap_ms": round(overlap_seconds * 1000, 1),
+            "overlap_ratio": round(overlap_seconds / fetch_seconds, 3) if fetch_seconds else 0.0,
+        }
+
+    async def close(self):
+        """Cancels unconsumed fetches and logs the latency overlap achieved for this request."""
+        for task in (self._stock_task, self._shop_task):
+            if not task.done():
+                task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        print(f"DEBUG_PREFETCH: {self.overlap_report()}")
+
+
+def start_sender_prefetch(sender_id: str) -> SenderPrefetch:
+    """Starts prefetching a sender's shop state and binds it to the current request context."""
+    prefetch = SenderPrefetch(sender_id)
+    _current_prefetch.set(prefetch)
+    return prefetch
+
+
+def current_prefetch(sender_id: str) -> SenderPrefetch | None:
+    """Returns the request-scoped prefetch for `sender_id`, if one was started."""
+    prefetch = _current_prefetch.get()
+    if prefetch is not None and prefetch.sender_id == sender_id:
+        return prefetch
+    return None
+
+
+async def get_prefetched_stock_levels(sender_id: str) -> list[dict]:
+    """Reads stock levels from the request-scoped prefetch, falling back to a direct query."""
+    prefetch = current_prefetch(sender_id)
+    if prefetch is not None:
+        return await prefetch.stock_levels()
+    return await get_stock_levels(sender_id)
+
+
+async def get_prefetched_shop(sender_id: str) -> dict | None:
+    """Reads the shop's registry row from the request-scoped prefetch, falling back to a direct query."""
+    prefetch = current_prefetch(sender_id)
+    if prefetch is not None:
+        return await prefetch.shop()
+    return await get_shop(sender_id)
+
+
+async def get_prefetched_price_memory(sender_id: str) -> dict:
+    """Reads the shop's last known cost prices from the request-scoped prefetch, falling back to a direct query."""
+    prefetch = current_prefetch(sender_id)
+    if prefetch is not None:
+        return await prefetch.price_memory()
+    return _price_memory(await get_stock_levels(sender_id))
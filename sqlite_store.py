@@ -0,0 +1,1353 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, date, timedelta
+
+from query_metrics import QueryMetrics
+from storage_errors import QueryTimeout, StockVersionConflict
+from transaction_writer import create_writer
+
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "vyapaar_saathi.db")
+SQLITE_READER_THREADS = int(os.getenv("SQLITE_READER_THREADS", "4"))  # WAL lets readers run alongside the writer
+SQLITE_QUERY_TIMEOUT_SECONDS = float(os.getenv("SQLITE_QUERY_TIMEOUT_SECONDS", "10"))
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_STATEMENT_CACHE_SIZE = 256  # Prepared statements kept per connection
+ITEM_SEARCH_THRESHOLD = 0.6  # Same as pg_trgm.word_similarity_threshold, which the Postgres search uses
+
+__all__ = ['save_transaction', 'get_user_transactions_summary', 'get_total_balance', 'reconcile_shop_balances', 'update_stock_item', 'get_stock_levels', 'invalidate_stock_cache', 'get_stock_cache_stats', 'get_daily_sales_summary', 'get_daily_rollups', 'get_period_summary', 'recompute_daily_rollups', 'ensure_transaction_partitions', 'archive_transactions', 'get_low_stock_items', 'get_low_stock_items_by_user', 'get_owner_shops', 'link_owner_shop', 'unlink_owner_shop', 'get_owner_rollup', 'get_owner_low_stock_items', 'save_order_confirmation', 'StockVersionConflict', 'apply_stock_deltas', 'save_transactions_bulk', 'get_transaction_writer_metrics', 'get_bill_image_hashes', 'save_bill_image_hash', 'get_all_unique_user_ids_with_stock', 'iter_active_shops', 'get_shop', 'update_shop', 'get_query_metrics', 'QueryTimeout', 'apply_ledger_entries', 'get_stock_as_of', 'take_stock_snapshots', 'get_item_sales', 'search_item_history', 'iter_transaction_pages', 'iter_stock_movement_pages', 'import_transactions']
+
+# The same tables as supabase_schema.sql (plus migrations/), in SQLite types. Aggregates are kept
+# by row-level triggers because SQLite has no statement-level triggers or transition tables.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id TEXT PRIMARY KEY,
+    transaction_date TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    amount REAL NOT NULL,
+    item TEXT,
+    user_id TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    client_txn_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_date_type_created ON transactions (user_id, transaction_date, transaction_type, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_transactions_date_user ON transactions (transaction_date, user_id);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_date_id ON transactions (user_id, transaction_date, id);
+-- search_item_history: expense descriptions of a shop (the trigram index in Postgres)
+CREATE INDEX IF NOT EXISTS idx_transactions_expense_item ON transactions (user_id, item, transaction_date) WHERE transaction_type = 'expense';
+
+CREATE TABLE IF NOT EXISTS stock_items (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    item_name TEXT NOT NULL,
+    quantity REAL NOT NULL DEFAULT 0,
+    unit TEXT,
+    num_packets INTEGER NOT NULL DEFAULT 1,
+    cost_price_per_unit REAL,
+    last_updated TEXT,
+    version INTEGER NOT NULL DEFAULT 1,
+    min_quantity_threshold REAL NOT NULL DEFAULT 0,
+    average_cost REAL,
+    CONSTRAINT unique_user_item UNIQUE (user_id, item_name, unit)
+);
+CREATE INDEX IF NOT EXISTS idx_stock_items_low_stock ON stock_items (user_id, item_name) WHERE quantity <= min_quantity_threshold;
+
+CREATE TABLE IF NOT EXISTS stock_movements (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stock_item_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    item_name TEXT NOT NULL,
+    movement_type TEXT NOT NULL CHECK (movement_type IN ('opening', 'purchase', 'sale', 'adjustment')),
+    quantity_delta REAL NOT NULL,
+    unit_cost REAL,
+    average_cost_after REAL,
+    version INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_stock_movements_item_id ON stock_movements (stock_item_id, id);
+CREATE INDEX IF NOT EXISTS idx_stock_movements_user_created_id ON stock_movements (user_id, created_at, id);
+
+CREATE TABLE IF NOT EXISTS stock_snapshots (
+    stock_item_id TEXT NOT NULL,
+    snapshot_at TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    item_name TEXT NOT NULL,
+    quantity REAL NOT NULL,
+    average_cost REAL,
+    last_movement_id INTEGER NOT NULL,
+    PRIMARY KEY (stock_item_id, snapshot_at)
+);
+
+CREATE TABLE IF NOT EXISTS transaction_lines (
+    transaction_id TEXT NOT NULL,
+    line_no INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    transaction_date TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    item_name TEXT NOT NULL,
+    quantity REAL,
+    unit TEXT,
+    unit_price REAL,
+    amount REAL,
+    cost REAL,
+    PRIMARY KEY (transaction_id, line_no)
+);
+CREATE INDEX IF NOT EXISTS idx_transaction_lines_user_item_date ON transaction_lines (user_id, item_name, transaction_date);
+
+-- Cold tier (migrations/008): transactions before the archive horizon and their lines, moved out
+-- of the hot tables by archive_transactions, with their totals kept in archived_balances
+CREATE TABLE IF NOT EXISTS transactions_archive (
+    id TEXT PRIMARY KEY,
+    transaction_date TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    amount REAL NOT NULL,
+    item TEXT,
+    user_id TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    client_txn_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_archive_user_date_id ON transactions_archive (user_id, transaction_date, id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_archive_client_txn_id ON transactions_archive (client_txn_id);
+CREATE INDEX IF NOT EXISTS idx_transactions_archive_expense_item ON transactions_archive (user_id, item, transaction_date) WHERE transaction_type = 'expense';
+
+CREATE TABLE IF NOT EXISTS transaction_lines_archive (
+    transaction_id TEXT NOT NULL,
+    line_no INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    transaction_date TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    item_name TEXT NOT NULL,
+    quantity REAL,
+    unit TEXT,
+    unit_price REAL,
+    amount REAL,
+    cost REAL,
+    PRIMARY KEY (transaction_id, line_no)
+);
+CREATE INDEX IF NOT EXISTS idx_transaction_lines_archive_user_item_date ON transaction_lines_archive (user_id, item_name, transaction_date);
+
+CREATE TABLE IF NOT EXISTS archived_balances (
+    user_id TEXT PRIMARY KEY,
+    balance REAL NOT NULL DEFAULT 0,
+    total_sales REAL NOT NULL DEFAULT 0,
+    total_expenses REAL NOT NULL DEFAULT 0,
+    transaction_count INTEGER NOT NULL DEFAULT 0,
+    archived_through TEXT NOT NULL,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS bill_image_hashes (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    image_hash INTEGER NOT NULL,
+    detail_hash TEXT,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS shop_balances (
+    user_id TEXT PRIMARY KEY,
+    balance REAL NOT NULL DEFAULT 0,
+    total_sales REAL NOT NULL DEFAULT 0,
+    total_expenses REAL NOT NULL DEFAULT 0,
+    transaction_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    user_id TEXT NOT NULL,
+    rollup_date TEXT NOT NULL,
+    sales REAL NOT NULL DEFAULT 0,
+    expenses REAL NOT NULL DEFAULT 0,
+    purchases REAL NOT NULL DEFAULT 0,
+    profit REAL NOT NULL DEFAULT 0,
+    txn_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    PRIMARY KEY (user_id, rollup_date)
+);
+
+CREATE TABLE IF NOT EXISTS shops (
+    user_id TEXT PRIMARY KEY,
+    language TEXT,
+    latitude REAL,
+    longitude REAL,
+    status TEXT NOT NULL DEFAULT 'active' CHECK (status IN ('active', 'paused', 'closed')),
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_shops_active ON shops (user_id) WHERE status = 'active';
+
+-- Outlets of owners with several shops, keyed by the outlet (a shop has at most one owner)
+CREATE TABLE IF NOT EXISTS owner_shops (
+    user_id TEXT PRIMARY KEY,
+    owner_id TEXT NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_owner_shops_owner ON owner_shops (owner_id, user_id);
+
+CREATE TABLE IF NOT EXISTS applied_ledger_entries (
+    entry_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    applied_at TEXT
+);
+
+CREATE TRIGGER IF NOT EXISTS transactions_after_insert AFTER INSERT ON transactions
+BEGIN
+    INSERT INTO shop_balances (user_id, balance, total_sales, total_expenses, transaction_count, updated_at)
+    VALUES (
+        NEW.user_id,
+        CASE lower(NEW.transaction_type) WHEN 'sale' THEN NEW.amount WHEN 'expense' THEN -NEW.amount ELSE 0 END,
+        CASE WHEN lower(NEW.transaction_type) = 'sale' THEN NEW.amount ELSE 0 END,
+        CASE WHEN lower(NEW.transaction_type) = 'expense' THEN NEW.amount ELSE 0 END,
+        1,
+        NEW.created_at
+    )
+    ON CONFLICT (user_id) DO UPDATE
+    SET balance = round(balance + excluded.balance, 2),
+        total_sales = round(total_sales + excluded.total_sales, 2),
+        total_expenses = round(total_expenses + excluded.total_expenses, 2),
+        transaction_count = transaction_count + 1,
+        updated_at = excluded.updated_at;
+
+    INSERT INTO daily_rollups (user_id, rollup_date, sales, expenses, purchases, profit, txn_count, updated_at)
+    VALUES (
+        NEW.user_id,
+        NEW.transaction_date,
+        CASE WHEN lower(NEW.transaction_type) = 'sale' THEN NEW.amount ELSE 0 END,
+        CASE WHEN lower(NEW.transaction_type) = 'expense' THEN NEW.amount ELSE 0 END,
+        CASE WHEN lower(NEW.transaction_type) = 'purchase' THEN NEW.amount ELSE 0 END,
+        CASE lower(NEW.transaction_type) WHEN 'sale' THEN NEW.amount WHEN 'expense' THEN -NEW.amount WHEN 'purchase' THEN -NEW.amount ELSE 0 END,
+        1,
+        NEW.created_at
+    )
+    ON CONFLICT (user_id, rollup_date) DO UPDATE
+    SET sales = round(sales + excluded.sales, 2),
+        expenses = round(expenses + excluded.expenses, 2),
+        purchases = round(purchases + excluded.purchases, 2),
+        profit = round(profit + excluded.profit, 2),
+        txn_count = txn_count + 1,
+        updated_at = excluded.updated_at;
+
+    INSERT INTO shops (user_id, created_at, updated_at) VALUES (NEW.user_id, NEW.created_at, NEW.created_at)
+    ON CONFLICT (user_id) DO NOTHING;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stock_items_after_insert AFTER INSERT ON stock_items
+BEGIN
+    INSERT INTO shops (user_id, created_at, updated_at) VALUES (NEW.user_id, NEW.last_updated, NEW.last_updated)
+    ON CONFLICT (user_id) DO NOTHING;
+END;
+"""
+
+# Columns added after a table was first created: (table, column, type, backfill SQL or None).
+# Databases created before them get the column (and backfill) on open; _SCHEMA_AFTER_UPGRADES may then rely on it.
+_SCHEMA_UPGRADES = [
+    ("transactions", "client_txn_id", "TEXT", None),
+    ("bill_image_hashes", "detail_hash", "TEXT", None),
+    ("stock_items", "average_cost", "REAL", """
+        UPDATE stock_items SET average_cost = cost_price_per_unit;
+        INSERT INTO stock_movements (stock_item_id, user_id, item_name, movement_type, quantity_delta, unit_cost, average_cost_after, version, created_at)
+        SELECT id, user_id, item_name, 'opening', quantity, average_cost, average_cost, version, strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')
+        FROM stock_items;
+        INSERT INTO stock_snapshots (stock_item_id, snapshot_at, user_id, item_name, quantity, average_cost, last_movement_id)
+        SELECT i.id, m.created_at, i.user_id, i.item_name, i.quantity, i.average_cost, m.id
+        FROM stock_items i JOIN stock_movements m ON m.stock_item_id = i.id AND m.movement_type = 'opening';
+    """),
+]
+# Tables whose constraints changed: (table, text of the old definition, rebuild script). SQLite cannot drop a
+# constraint, so a database whose table still has the old definition gets it rebuilt on open.
+_SCHEMA_REBUILDS = [
+    # One row per (image_hash, detail_hash) instead of per image_hash: bills on one template share the image hash
+    ("bill_image_hashes", "unique_user_bill_hash", """
+        BEGIN;
+        CREATE TABLE bill_image_hashes_rebuilt (id TEXT PRIMARY KEY, user_id TEXT NOT NULL, image_hash INTEGER NOT NULL, detail_hash TEXT, created_at TEXT NOT NULL);
+        INSERT INTO bill_image_hashes_rebuilt (id, user_id, image_hash, detail_hash, created_at)
+        SELECT id, user_id, image_hash, detail_hash, created_at FROM bill_image_hashes;
+        DROP TABLE bill_image_hashes;
+        ALTER TABLE bill_image_hashes_rebuilt RENAME TO bill_image_hashes;
+        COMMIT;
+    """),
+]
+_SCHEMA_AFTER_UPGRADES = """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_client_txn_id ON transactions (client_txn_id);
+-- Rows stored before detail hashes have none; COALESCE keeps them to one per image hash (NULLs are distinct in a unique index)
+CREATE UNIQUE INDEX IF NOT EXISTS unique_user_bill_detail_hash ON bill_image_hashes (user_id, image_hash, COALESCE(detail_hash, ''));
+"""
+
+# Sums the ledger the same way the balance/rollup triggers do
+_LEDGER_BALANCE_SQL = "round(SUM(CASE lower(transaction_type) WHEN 'sale' THEN amount WHEN 'expense' THEN -amount ELSE 0 END), 2)"
+_LEDGER_SALES_SQL = "round(SUM(CASE WHEN lower(transaction_type) = 'sale' THEN amount ELSE 0 END), 2)"
+_LEDGER_EXPENSES_SQL = "round(SUM(CASE WHEN lower(transaction_type) = 'expense' THEN amount ELSE 0 END), 2)"
+_LEDGER_PURCHASES_SQL = "round(SUM(CASE WHEN lower(transaction_type) = 'purchase' THEN amount ELSE 0 END), 2)"
+
+
+class SQLiteEngine:
+    """Embedded storage engine: one SQLite database file in WAL mode, used without network round trips.
+
+    Writes go through a single writer thread (SQLite allows one writer at a time) in
+    `BEGIN IMMEDIATE` transactions; reads run on a small pool of reader threads, which WAL
+    lets proceed while a write is in progress. Each thread keeps its own connection, and
+    every statement is a constant SQL string with `?` parameters, so it is prepared once
+    per connection and reused from sqlite3's statement cache.
+    """
+
+    def __init__(self, path: str, reader_threads: int = SQLITE_READER_THREADS, query_timeout: float = SQLITE_QUERY_TIMEOUT_SECONDS):
+        self.path = path
+        self.reader_threads = reader_threads
+        self.query_timeout = query_timeout
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix="sqlite-reader")
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self.metrics = QueryMetrics()
+
+    def _open(self) -> sqlite3.Connection:
+        # Transactions are managed explicitly (BEGIN IMMEDIATE / COMMIT), hence isolation_level=None
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous = NORMAL")  # With WAL, commits survive an application crash
+        return conn
+
+    def _ensure_schema(self):
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            conn = self._open()
+            try:
+                conn.execute("PRAGMA journal_mode = WAL")  # Persisted in the database file
+                conn.executescript(_SCHEMA)
+                for table, column, column_type, backfill in _SCHEMA_UPGRADES:
+                    if column not in {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                        if backfill:
+                            conn.executescript(backfill)
+                for table, old_definition, rebuild in _SCHEMA_REBUILDS:
+                    if old_definition in conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()["sql"]:
+                        conn.executescript(rebuild)
+                conn.executescript(_SCHEMA_AFTER_UPGRADES)
+            finally:
+                conn.close()
+            self._schema_ready = True
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self._ensure_schema()
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    def run_read(self, name: str, read):
+        """Runs `read(conn)` on the calling thread."""
+        started_at = time.perf_counter()
+        failed = True
+        try:
+            result = read(self._connection())
+            failed = False
+            return result
+        finally:
+            self.metrics.record(name, (time.perf_counter() - started_at) * 1000, failed=failed)
+
+    def run_write(self, name: str, write):
+        """Runs `write(conn)` in one write transaction on the calling thread."""
+        started_at = time.perf_counter()
+        failed = True
+        conn = self._connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = write(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            failed = False
+            return result
+        finally:
+            self.metrics.record(name, (time.perf_counter() - started_at) * 1000, failed=failed)
+
+    async def _dispatch(self, executor, run, name: str, operation, timeout: float | None):
+        timeout = timeout or self.query_timeout
+        try:
+            return await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(executor, run, name, operation), timeout)
+        except asyncio.TimeoutError:
+            raise QueryTimeout(f"Query '{name}' timed out after {timeout:.1f} s")
+
+    async def read(self, name: str, read, timeout: float | None = None):
+        return await self._dispatch(self._readers, self.run_read, name, read, timeout)
+
+    async def write(self, name: str, write, timeout: float | None = None):
+        return await self._dispatch(self._writer, self.run_write, name, write, timeout)
+
+
+engine = SQLiteEngine(SQLITE_DB_PATH)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def _rows(cursor) -> list[dict]:
+    return [dict(row) for row in cursor.fetchall()]
+
+# --- Unit Conversion Helpers ---
+def _convert_to_base_unit(value: float, unit: str) -> float:
+    """Converts a quantity to a common base unit (grams for weight, milliliters for volume) for internal consistency."""
+    unit_lower = (unit or "").lower()
+    if unit_lower == 'kg':
+        return value * 1000.0
+    elif unit_lower == 'g':
+        return value
+    # Add more unit conversions as needed (e.g., litres to ml)
+    return value # For pcs, packets, etc., no conversion, treat as base
+
+def _convert_from_base_unit(value_in_base: float, target_unit: str) -> float:
+    """Converts a quantity from the base unit back to the target unit."""
+    target_unit_lower = (target_unit or "").lower()
+    if target_unit_lower == 'kg':
+        return value_in_base / 1000.0
+    elif target_unit_lower == 'g':
+        return value_in_base
+    # Add more unit conversions as needed
+    return value_in_base # For pcs, packets, etc., no conversion
+
+# --- End Unit Conversion Helpers ---
+
+def _transaction_row(transaction_data: dict, user_id: str) -> dict:
+    """Maps extracted transaction data onto a `transactions` row."""
+    transaction_date = transaction_data.get("date")
+    if transaction_date is not None and not isinstance(transaction_date, str):
+        transaction_date = transaction_date.strftime('%Y-%m-%d')
+    return {
+        "id": transaction_data.get("id") or str(uuid.uuid4()),
+        "transaction_date": transaction_date,
+        "transaction_type": transaction_data.get("type"),
+        "amount": transaction_data.get("amount"),
+        "item": transaction_data.get("item"),
+        "user_id": user_id,
+        "lines": transaction_data.get("lines") or [],
+    }
+
+def _insert_transaction_lines(conn, rows: list[dict]):
+    """Inserts the `lines` of transaction rows; lines already stored (a ledger replay) are skipped."""
+    conn.executemany(
+        "INSERT INTO transaction_lines (transaction_id, line_no, user_id, transaction_date, transaction_type, item_name, quantity, unit, unit_price, amount, cost) "
+        "VALUES (:transaction_id, :line_no, :user_id, :transaction_date, :transaction_type, :item_name, :quantity, :unit, :unit_price, :amount, :cost) "
+        "ON CONFLICT (transaction_id, line_no) DO NOTHING",
+        [
+            {"quantity": None, "unit": None, "unit_price": None, "amount": None, "cost": None, **line,
+             "transaction_id": row["id"], "line_no": line_no, "user_id": row["user_id"],
+             "transaction_date": row["transaction_date"], "transaction_type": row["transaction_type"]}
+            for row in rows for line_no, line in enumerate(row["lines"], start=1)
+        ],
+    )
+
+def _insert_transaction_rows(rows: list[dict]) -> list[dict]:
+    """Inserts transaction rows and their lines in one write transaction. Runs on the transaction writer thread."""
+    created_at = _now()
+    inserted = [{key: value for key, value in row.items() if key != "lines"} | {"created_at": created_at} for row in rows]
+
+    def _insert(conn):
+        conn.executemany(
+            "INSERT INTO transactions (id, transaction_date, transaction_type, amount, item, user_id, created_at) "
+            "VALUES (:id, :transaction_date, :transaction_type, :amount, :item, :user_id, :created_at)",
+            inserted,
+        )
+        _insert_transaction_lines(conn, rows)
+        return inserted
+    return engine.run_write("insert_transactions", _insert)
+
+# Transaction inserts from concurrent requests are coalesced, so many rows share one commit (and fsync)
+transaction_writer = create_writer(_insert_transaction_rows, "transactions")
+
+async def save_transactions_bulk(transactions: list[dict], user_id: str, durable: bool = True) -> list[dict]:
+    """Saves several transactions for a user as a single multi-row insert (see supabase_client)."""
+    if not transactions:
+        return []
+    try:
+        saved_rows = await transaction_writer.write([_transaction_row(transaction_data, user_id) for transaction_data in transactions], durable=durable)
+        print(f"{len(transactions)} transactions saved successfully:", saved_rows)
+        return saved_rows
+    except Exception as e:
+        print(f"Error saving transactions to SQLite: {e}")
+        return []
+
+async def save_transaction(transaction_data: dict, user_id: str, durable: bool = True) -> dict:
+    """Saves one transaction for a user through the coalescing writer."""
+    return await save_transactions_bulk([transaction_data], user_id, durable=durable)
+
+def get_transaction_writer_metrics() -> dict:
+    """Batch size and flush latency metrics of the coalescing transaction writer."""
+    return transaction_writer.metrics()
+
+def get_query_metrics() -> dict:
+    """Per-query latency histograms of the SQLite engine."""
+    return {"pool_size": engine.reader_threads, "queries": engine.metrics.summary()}
+
+def _read_shop_balance(conn, user_id: str) -> float:
+    row = conn.execute("SELECT balance FROM shop_balances WHERE user_id = ?", (user_id,)).fetchone()
+    return float(row["balance"]) if row else 0.0
+
+async def get_total_balance(user_id: str) -> float:
+    """Returns the total balance for a specific user (sales minus expenses) from `shop_balances`."""
+    try:
+        total_balance = await engine.read("shop_balance", lambda conn: _read_shop_balance(conn, user_id))
+        print(f"Total balance for user {user_id}: {total_balance}")
+        return total_balance
+    except Exception as e:
+        print(f"Error fetching total balance from SQLite: {e}")
+        return 0.0
+
+async def get_user_transactions_summary(user_id: str, limit: int = 5) -> tuple[float, list[dict]]:
+    """Fetches the total balance and the `limit` most recent transactions for a specific user."""
+    def _summary(conn):
+        recent_transactions = _rows(conn.execute(
+            "SELECT transaction_date, transaction_type, amount, item FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit),
+        ))
+        return _read_shop_balance(conn, user_id), recent_transactions
+
+    try:
+        total_balance, recent_transactions = await engine.read("transactions_summary", _summary)
+        print(f"Summary for user {user_id}: Total balance {total_balance}, {len(recent_transactions)} recent transactions.")
+        return total_balance, recent_transactions
+    except Exception as e:
+        print(f"Error fetching transaction summary from SQLite: {e}")
+        return 0.0, []
+
+async def reconcile_shop_balances(fix: bool = True) -> list[dict]:
+    """Verifies every shop's running balance against the ledger; returns (and with fix=True corrects) drifted shops."""
+    def _reconcile(conn):
+        # Archived transactions count through their folded totals
+        ledger = {row["user_id"]: row for row in conn.execute(
+            f"SELECT user_id, round(SUM(balance), 2) AS balance, round(SUM(total_sales), 2) AS total_sales, "
+            f"round(SUM(total_expenses), 2) AS total_expenses, SUM(transaction_count) AS transaction_count FROM ("
+            f"SELECT user_id, {_LEDGER_BALANCE_SQL} AS balance, {_LEDGER_SALES_SQL} AS total_sales, "
+            f"{_LEDGER_EXPENSES_SQL} AS total_expenses, COUNT(*) AS transaction_count FROM transactions GROUP BY user_id "
+            f"UNION ALL SELECT user_id, balance, total_sales, total_expenses, transaction_count FROM archived_balances"
+            f") GROUP BY user_id"
+        )}
+        stored = {row["user_id"]: row for row in conn.execute("SELECT user_id, balance, transaction_count FROM shop_balances")}
+        mismatches = []
+        for user_id in sorted(set(ledger) | set(stored)):
+            ledger_row, stored_row = ledger.get(user_id), stored.get(user_id)
+            ledger_balance = ledger_row["balance"] if ledger_row else 0.0
+            ledger_count = ledger_row["transaction_count"] if ledger_row else 0
+            stored_balance = stored_row["balance"] if stored_row else None
+            stored_count = stored_row["transaction_count"] if stored_row else None
+            if stored_balance is not None and abs(stored_balance - ledger_balance) < 0.005 and stored_count == ledger_count:
+                continue
+            mismatches.append({
+                "shop_user_id": user_id,
+                "stored_balance": stored_balance,
+                "ledger_balance": ledger_balance,
+                "stored_transaction_count": stored_count,
+                "ledger_transaction_count": ledger_count,
+            })
+            if fix:
+                conn.execute(
+                    "INSERT INTO shop_balances (user_id, balance, total_sales, total_expenses, transaction_count, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET balance = excluded.balance, total_sales = excluded.total_sales, "
+                    "total_expenses = excluded.total_expenses, transaction_count = excluded.transaction_count, updated_at = excluded.updated_at",
+                    (user_id, ledger_balance, ledger_row["total_sales"] if ledger_row else 0.0, ledger_row["total_expenses"] if ledger_row else 0.0, ledger_count, _now()),
+                )
+        return mismatches
+
+    try:
+        mismatches = await engine.write("reconcile_shop_balances", _reconcile, timeout=300)
+        for mismatch in mismatches:
+            print(f"ERROR_BALANCE: Shop {mismatch['shop_user_id']} balance {mismatch['stored_balance']} "
+                  f"({mismatch['stored_transaction_count']} txns) != ledger {mismatch['ledger_balance']} "
+                  f"({mismatch['ledger_transaction_count']} txns){', corrected' if fix else ''}.")
+        print(f"DEBUG_BALANCE: Reconciliation finished, {len(mismatches)} shop(s) out of sync.")
+        return mismatches
+    except Exception as e:
+        print(f"Error reconciling shop balances in SQLite: {e}")
+        return []
+
+# Stock management
+
+def _apply_stock_delta(conn, user_id: str, item_name: str, quantity_delta: float, unit: str, cost_price_per_unit: float | None, expected_version: int | None, movement_type: str | None = None) -> dict:
+    """Same semantics as the `apply_stock_delta` Postgres function (migrations/004_stock_movements.sql),
+    inside the caller's write transaction: updates the row and its weighted-average cost and records the movement."""
+    row = conn.execute(
+        "SELECT * FROM stock_items WHERE user_id = ? AND item_name = ? ORDER BY (lower(unit) = lower(?)) DESC, id LIMIT 1",
+        (user_id, item_name, unit),
+    ).fetchone()
+    if row is not None:
+        if expected_version is not None and row["version"] != expected_version:
+            raise StockVersionConflict(f"stock_version_conflict: {item_name} is at version {row['version']}, expected {expected_version}")
+        previous_quantity = row["quantity"]
+        # The delta in the row's unit, and what one row unit cost at the given price
+        delta = _convert_from_base_unit(_convert_to_base_unit(quantity_delta, unit), row["unit"])
+        average_cost = unit_cost = row["average_cost"]
+        if cost_price_per_unit is not None and delta > 0:
+            unit_cost = round(cost_price_per_unit * quantity_delta / delta, 4)
+            if previous_quantity <= 0 or row["average_cost"] is None:
+                average_cost = unit_cost
+            else:
+                average_cost = round((previous_quantity * row["average_cost"] + delta * unit_cost) / (previous_quantity + delta), 4)
+        stock_item = _rows(conn.execute(
+            "UPDATE stock_items SET quantity = ?, cost_price_per_unit = COALESCE(?, cost_price_per_unit), average_cost = ?, version = version + 1, last_updated = ? "
+            "WHERE id = ? RETURNING *",
+            (round(max(0.0, previous_quantity + delta), 2), cost_price_per_unit, average_cost, _now(), row["id"]),
+        ))[0]
+    else:
+        if expected_version is not None and expected_version != 0:
+            raise StockVersionConflict(f"stock_version_conflict: {item_name} no longer exists, expected version {expected_version}")
+        # New items start at the delta, or at zero for a sale of something never stocked
+        previous_quantity = 0.0
+        unit_cost = cost_price_per_unit if quantity_delta > 0 else None
+        stock_item = _rows(conn.execute(
+            "INSERT INTO stock_items (id, user_id, item_name, quantity, unit, cost_price_per_unit, average_cost, last_updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING *",
+            (str(uuid.uuid4()), user_id, item_name, round(max(0.0, quantity_delta), 2), unit, cost_price_per_unit, unit_cost, _now()),
+        ))[0]
+
+    if stock_item["quantity"] != previous_quantity:
+        if movement_type is None:
+            if stock_item["quantity"] > previous_quantity and cost_price_per_unit is not None:
+                movement_type = "purchase"
+            elif stock_item["quantity"] < previous_quantity:
+                movement_type = "sale"
+            else:
+                movement_type = "adjustment"
+        conn.execute(
+            "INSERT INTO stock_movements (stock_item_id, user_id, item_name, movement_type, quantity_delta, unit_cost, average_cost_after, version, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (stock_item["id"], user_id, stock_item["item_name"], movement_type, round(stock_item["quantity"] - previous_quantity, 2),
+             unit_cost, stock_item["average_cost"], stock_item["version"], stock_item["last_updated"]),
+        )
+    return stock_item
+
+async def update_stock_item(user_id: str, item_name: str, quantity_delta: float, unit: str = "pcs", cost_price_per_unit: float | None = None, expected_version: int | None = None) -> dict:
+    """Updates or inserts a stock item for a user (see supabase_client.update_stock_item)."""
+    print(f"Applying stock delta: {item_name} {quantity_delta} {unit} for {user_id}")
+    try:
+        return await engine.write("apply_stock_delta", lambda conn: _apply_stock_delta(conn, user_id, item_name, float(quantity_delta), unit, cost_price_per_unit, expected_version))
+    except StockVersionConflict:
+        raise
+    except Exception as e:
+        print(f"Error: Failed to update/insert stock item. Error: {e}")
+        raise Exception(f"Failed to update/insert stock item: {e}")
+
+def _apply_stock_deltas(conn, user_id: str, deltas: list[dict]) -> list[dict]:
+    """Applies several deltas inside the caller's write transaction; returns the rows in input order."""
+    results = [None] * len(deltas)
+    # Same order as the Postgres function, so repeated items resolve identically on both backends
+    for delta_index in sorted(range(len(deltas)), key=lambda index: (deltas[index]['item_name'], index)):
+        delta = deltas[delta_index]
+        results[delta_index] = _apply_stock_delta(
+            conn, user_id, delta['item_name'], float(delta['quantity_delta']), delta.get('unit', 'pcs'),
+            delta.get('cost_price_per_unit'), delta.get('expected_version'), delta.get('movement_type'),
+        )
+    return results
+
+async def apply_stock_deltas(user_id: str, deltas: list[dict]) -> list[dict]:
+    """Applies several stock deltas for a user in one transaction; returns the rows in input order."""
+    if not deltas:
+        return []
+    print(f"Applying {len(deltas)} stock deltas for user {user_id}")
+    try:
+        return await engine.write("apply_stock_deltas", lambda conn: _apply_stock_deltas(conn, user_id, deltas))
+    except StockVersionConflict:
+        raise
+    except Exception as e:
+        print(f"Error: Failed to apply stock deltas. Error: {e}")
+        raise Exception(f"Failed to apply stock deltas: {e}")
+
+def apply_ledger_entries(entries: list[dict]):
+    """Applies write-behind ledger entries in one write transaction (blocking; runs on the ledger's flusher thread).
+    Replays are skipped: stock deltas by entry_id, transactions by client_txn_id."""
+    def _apply(conn):
+        for entry in entries:
+            if entry.get("stock_deltas") and conn.execute(
+                "INSERT INTO applied_ledger_entries (entry_id, user_id, applied_at) VALUES (?, ?, ?) ON CONFLICT (entry_id) DO NOTHING",
+                (entry["entry_id"], entry["user_id"], _now()),
+            ).rowcount:
+                _apply_stock_deltas(conn, entry["user_id"], entry["stock_deltas"])
+        _upsert_transaction_rows(conn, [
+            {**_transaction_row(transaction_data, entry["user_id"]), "created_at": _now(), "client_txn_id": transaction_data["client_txn_id"]}
+            for entry in entries for transaction_data in entry.get("transactions") or []
+        ])
+    engine.run_write("apply_ledger_entries", _apply)
+
+def _drop_archived_rows(conn, rows: list[dict]) -> list[dict]:
+    """Drops rows whose client_txn_id was already archived (re-imported history). Only months before this one can be archived."""
+    month_start = date.today().replace(day=1).isoformat()
+    old_ids = [row["client_txn_id"] for row in rows if row["transaction_date"] and row["transaction_date"] < month_start]
+    archived_ids = set()
+    for offset in range(0, len(old_ids), 500):
+        chunk = old_ids[offset:offset + 500]
+        archived_ids.update(client_txn_id for (client_txn_id,) in conn.execute(
+            f"SELECT client_txn_id FROM transactions_archive WHERE client_txn_id IN ({', '.join('?' * len(chunk))})", chunk,
+        ))
+    return [row for row in rows if row["client_txn_id"] not in archived_ids] if archived_ids else rows
+
+def _upsert_transaction_rows(conn, rows: list[dict]):
+    """Inserts transaction rows that carry a client_txn_id, and their lines; rows already stored, in either tier, are skipped."""
+    rows = _drop_archived_rows(conn, rows)
+    conn.executemany(
+        "INSERT INTO transactions (id, transaction_date, transaction_type, amount, item, user_id, created_at, client_txn_id) "
+        "VALUES (:id, :transaction_date, :transaction_type, :amount, :item, :user_id, :created_at, :client_txn_id) "
+        "ON CONFLICT (client_txn_id) DO NOTHING",
+        [{key: value for key, value in row.items() if key != "lines"} for row in rows],
+    )
+    _insert_transaction_lines(conn, rows)
+
+async def import_transactions(user_id: str, transactions: list[dict]) -> int:
+    """Bulk-inserts historical transactions in one write transaction; rows whose client_txn_id is stored are skipped (see supabase_client)."""
+    created_at = _now()
+    rows = [{**_transaction_row(transaction_data, user_id), "created_at": created_at, "client_txn_id": transaction_data["client_txn_id"]} for transaction_data in transactions]
+    if rows:
+        await engine.write("import_transactions", lambda conn: _upsert_transaction_rows(conn, rows), timeout=120)
+    return len(rows)
+
+async def get_stock_levels(user_id: str, populate_cache: bool = True) -> list[dict]:
+    """Retrieves all stock items of a user. Local reads are cheap, so there is no stock cache in front of them."""
+    try:
+        return await engine.read("stock_levels", lambda conn: _rows(conn.execute("SELECT * FROM stock_items WHERE user_id = ? ORDER BY item_name", (user_id,))))
+    except Exception as e:
+        print(f"Error: Failed to retrieve stock levels. Error: {e}")
+        return []
+
+def invalidate_stock_cache(user_id: str | None = None):
+    """No-op: the SQLite backend reads stock directly."""
+    pass
+
+def get_stock_cache_stats() -> dict:
+    return {"enabled": False}
+
+async def get_stock_as_of(user_id: str, as_of: datetime) -> list[dict]:
+    """Reconstructs a user's stock as of a past moment from the latest snapshot before it plus the movements since."""
+    as_of_text = as_of.astimezone(timezone.utc).isoformat()
+    try:
+        rows = await engine.read("stock_as_of", lambda conn: _rows(conn.execute(
+            """
+            SELECT i.id AS stock_item_id, i.item_name, i.unit,
+                   round(COALESCE(s.quantity, 0) + COALESCE((
+                       SELECT SUM(m.quantity_delta) FROM stock_movements m
+                       WHERE m.stock_item_id = i.id AND m.id > COALESCE(s.last_movement_id, 0) AND m.created_at <= :as_of
+                   ), 0), 2) AS quantity,
+                   COALESCE((
+                       SELECT m.average_cost_after FROM stock_movements m
+                       WHERE m.stock_item_id = i.id AND m.id > COALESCE(s.last_movement_id, 0) AND m.created_at <= :as_of
+                       ORDER BY m.id DESC LIMIT 1
+                   ), s.average_cost) AS average_cost,
+                   s.quantity IS NOT NULL OR EXISTS (
+                       SELECT 1 FROM stock_movements m
+                       WHERE m.stock_item_id = i.id AND m.id > COALESCE(s.last_movement_id, 0) AND m.created_at <= :as_of
+                   ) AS existed
+            FROM stock_items i
+            LEFT JOIN stock_snapshots s ON s.stock_item_id = i.id AND s.snapshot_at = (
+                SELECT MAX(snapshot_at) FROM stock_snapshots WHERE stock_item_id = i.id AND snapshot_at <= :as_of
+            )
+            WHERE i.user_id = :user_id
+            ORDER BY i.item_name
+            """,
+            {"user_id": user_id, "as_of": as_of_text},
+        )))
+        return [{key: value for key, value in row.items() if key != "existed"} for row in rows if row["existed"]]
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error reconstructing stock of {user_id} as of {as_of}: {e}")
+        return []
+
+async def take_stock_snapshots() -> int:
+    """Snapshots every stock item that moved since its last snapshot; returns how many were taken."""
+    def _snapshot(conn):
+        return conn.execute(
+            """
+            INSERT INTO stock_snapshots (stock_item_id, snapshot_at, user_id, item_name, quantity, average_cost, last_movement_id)
+            SELECT i.id, ?, i.user_id, i.item_name, i.quantity, i.average_cost, latest.last_movement_id
+            FROM stock_items i
+            JOIN (SELECT stock_item_id, MAX(id) AS last_movement_id FROM stock_movements GROUP BY stock_item_id) latest ON latest.stock_item_id = i.id
+            WHERE latest.last_movement_id > COALESCE((
+                SELECT s.last_movement_id FROM stock_snapshots s WHERE s.stock_item_id = i.id ORDER BY s.snapshot_at DESC LIMIT 1
+            ), 0)
+            """,
+            (_now(),),
+        ).rowcount
+
+    try:
+        snapshot_count = await engine.write("take_stock_snapshots", _snapshot, timeout=300)
+        print(f"DEBUG_STOCK: Took {snapshot_count} stock snapshots.")
+        return snapshot_count
+    except Exception as e:
+        print(f"Error taking stock snapshots in SQLite: {e}")
+        return 0
+
+async def get_daily_rollups(user_id: str, start_date: date, end_date: date) -> list[dict]:
+    """Retrieves the per-day totals for a user between start_date and end_date inclusive, oldest first."""
+    try:
+        return await engine.read("daily_rollups", lambda conn: _rows(conn.execute(
+            "SELECT rollup_date, sales, expenses, purchases, profit, txn_count FROM daily_rollups "
+            "WHERE user_id = ? AND rollup_date >= ? AND rollup_date <= ? ORDER BY rollup_date",
+            (user_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')),
+        )))
+    except Exception as e:
+        print(f"Error fetching daily rollups from SQLite: {e}")
+        return []
+
+async def get_period_summary(user_id: str, start_date: date, end_date: date) -> dict:
+    """Sums the daily rollups of a user over a date range (e.g. a week or a month)."""
+    rollups = await get_daily_rollups(user_id, start_date, end_date)
+    summary = {"start_date": start_date, "end_date": end_date, "sales": 0.0, "expenses": 0.0, "purchases": 0.0, "profit": 0.0, "txn_count": 0, "days": rollups}
+    for rollup in rollups:
+        for key in ("sales", "expenses", "purchases", "profit", "txn_count"):
+            summary[key] += rollup[key]
+    print(f"Period summary for user {user_id} {start_date}..{end_date}: Sales {summary['sales']}, profit {summary['profit']}, {summary['txn_count']} transactions.")
+    return summary
+
+async def get_item_sales(user_id: str, start_date: date, end_date: date, item_name: str | None = None) -> list[dict]:
+    """Per-item sales of a user between start_date and end_date inclusive, from `transaction_lines`, best-selling first."""
+    def _item_sales(conn):
+        rows = _rows(conn.execute(
+            "SELECT item_name, MIN(unit) AS unit, round(SUM(quantity), 2) AS quantity, round(SUM(amount), 2) AS sales, "
+            "round(SUM(cost), 2) AS cost, round(SUM(CASE WHEN cost IS NOT NULL THEN amount - cost END), 2) AS margin, COUNT(*) AS line_count "
+            "FROM transaction_lines WHERE user_id = ? AND (? IS NULL OR item_name = ?) AND transaction_date BETWEEN ? AND ? AND transaction_type = 'sale' "
+            "GROUP BY item_name ORDER BY SUM(amount) DESC",
+            (user_id, item_name, item_name, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')),
+        ))
+        for row in rows:
+            row["quantity"], row["sales"] = row["quantity"] or 0.0, row["sales"] or 0.0
+        return rows
+    try:
+        return await engine.read("item_sales", _item_sales)
+    except Exception as e:
+        print(f"Error fetching item sales from SQLite: {e}")
+        return []
+
+def _trigram_words(text: str) -> list[str]:
+    """Splits text into lowercase words of letters, combining marks (Devanagari matras) and digits, like pg_trgm."""
+    words, current = [], []
+    for char in (text or "").lower():
+        if unicodedata.category(char)[0] in "LMN":
+            current.append(char)
+        elif current:
+            words.append("".join(current))
+            current = []
+    if current:
+        words.append("".join(current))
+    return words
+
+def _trigrams(text: str) -> list[str]:
+    """The trigrams of each word in order, each word padded with two spaces before and one after."""
+    trigrams = []
+    for word in _trigram_words(text):
+        padded = f"  {word} "
+        trigrams.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+def _word_similarity(needle: set[str], text: str) -> float:
+    """
+    pg_trgm's word_similarity: the best trigram similarity between the needle (a term's trigrams)
+    and any contiguous extent of text. The best extent starts and ends on a shared trigram.
+    """
+    haystack = _trigrams(text)
+    if not needle or len(needle.intersection(haystack)) < ITEM_SEARCH_THRESHOLD * len(needle):
+        return 0.0
+    best = 0.0
+    for start in range(len(haystack)):
+        if haystack[start] not in needle:
+            continue
+        extent, common = set(), 0
+        for trigram in haystack[start:]:
+            if trigram not in extent:
+                extent.add(trigram)
+                common += trigram in needle
+            best = max(best, common / (len(needle) + len(extent) - common))
+    return best
+
+async def search_item_history(user_id: str, terms: list[str], start_date: date, end_date: date, kind: str | None = None, limit: int = 5, include_archive: bool = False) -> list[dict]:
+    """
+    Searches a user's sales and purchase lines and expenses between start_date and end_date inclusive
+    for items similar to any of `terms`. There is no trigram index in SQLite: the shop's distinct item
+    names are scored here, then only the matching items are summed from the (user_id, item_name, date) index.
+    include_archive also searches the archived months; their totals are merged with the hot ones.
+    """
+    needles = [set(_trigrams(term)) for term in terms]
+    params = (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+    tiers = [("transactions", "transaction_lines")] + ([("transactions_archive", "transaction_lines_archive")] if include_archive else [])
+
+    def _scores(names) -> dict:
+        scores = {}
+        for (name,) in names:
+            score = max((_word_similarity(needle, name) for needle in needles), default=0.0)
+            if score >= ITEM_SEARCH_THRESHOLD:
+                scores[name] = score
+        return scores
+
+    def _search_tier(conn, transactions_table: str, lines_table: str) -> list[dict]:
+        groups = []
+        if kind != "expense":
+            line_scores = _scores(conn.execute(f"SELECT DISTINCT item_name FROM {lines_table} WHERE user_id = ?", (user_id,)))
+            if line_scores:
+                groups.extend(dict(row, score=line_scores[row["item_name"]]) for row in conn.execute(
+                    f"SELECT * FROM (SELECT item_name, CASE WHEN transaction_type = 'sale' THEN 'sale' ELSE 'purchase' END AS kind, MIN(unit) AS unit, "
+                    f"round(SUM(quantity), 2) AS quantity, round(SUM(amount), 2) AS amount, COUNT(*) AS entry_count, "
+                    f"MIN(transaction_date) AS first_date, MAX(transaction_date) AS last_date FROM {lines_table} "
+                    f"WHERE user_id = ? AND item_name IN ({', '.join('?' * len(line_scores))}) AND transaction_date BETWEEN ? AND ? "
+                    f"GROUP BY item_name, kind) WHERE ? IS NULL OR kind = ?",
+                    (user_id, *line_scores, *params, kind, kind),
+                ))
+        if kind in (None, "expense"):
+            expense_scores = _scores(conn.execute(
+                f"SELECT DISTINCT item FROM {transactions_table} WHERE user_id = ? AND transaction_type = 'expense' AND item IS NOT NULL", (user_id,),
+            ))
+            if expense_scores:
+                # Bill purchases are expenses whose items are already matched as purchase lines
+                groups.extend(dict(row, score=expense_scores[row["item_name"]]) for row in conn.execute(
+                    f"SELECT item AS item_name, 'expense' AS kind, NULL AS unit, NULL AS quantity, round(SUM(amount), 2) AS amount, COUNT(*) AS entry_count, "
+                    f"MIN(transaction_date) AS first_date, MAX(transaction_date) AS last_date FROM {transactions_table} t "
+                    f"WHERE user_id = ? AND transaction_type = 'expense' AND item IN ({', '.join('?' * len(expense_scores))}) AND transaction_date BETWEEN ? AND ? "
+                    f"AND NOT EXISTS (SELECT 1 FROM {lines_table} l WHERE l.transaction_id = t.id) GROUP BY item",
+                    (user_id, *expense_scores, *params),
+                ))
+        for group in groups:
+            group["tier"] = (transactions_table, lines_table)
+        return groups
+
+    def _search(conn):
+        merged = {}
+        for tier in tiers:
+            for group in _search_tier(conn, *tier):
+                key = (group["item_name"], group["kind"])
+                if key not in merged:
+                    merged[key] = group
+                    continue
+                # The item has entries in both tiers: add them up, the last entry is in the later tier
+                total = merged[key]
+                if group["quantity"] is not None:
+                    total["quantity"] = round((total["quantity"] or 0) + group["quantity"], 2)
+                total["amount"] = round((total["amount"] or 0) + (group["amount"] or 0), 2)
+                total["entry_count"] += group["entry_count"]
+                total["unit"] = total["unit"] or group["unit"]
+                total["first_date"] = min(total["first_date"], group["first_date"])
+                if group["last_date"] > total["last_date"]:
+                    total["last_date"], total["tier"] = group["last_date"], group["tier"]
+        groups = sorted(merged.values(), key=lambda group: (-group["score"], -(group["amount"] or 0)))[:limit]
+        for group in groups:
+            # The most recent entry of the item: "when did I last buy ghee" wants its quantity and amount
+            transactions_table, lines_table = group.pop("tier")
+            if group["kind"] == "expense":
+                last = conn.execute(
+                    f"SELECT NULL, amount FROM {transactions_table} WHERE user_id = ? AND transaction_type = 'expense' AND item = ? AND transaction_date = ? "
+                    f"ORDER BY created_at DESC LIMIT 1",
+                    (user_id, group["item_name"], group["last_date"]),
+                ).fetchone()
+            else:
+                last = conn.execute(
+                    f"SELECT quantity, amount FROM {lines_table} WHERE user_id = ? AND item_name = ? AND transaction_date = ? "
+                    f"AND (transaction_type = 'sale') = ? LIMIT 1",
+                    (user_id, group["item_name"], group["last_date"], group["kind"] == "sale"),
+                ).fetchone()
+            group["last_quantity"], group["last_amount"] = last[0], last[1]
+        return groups
+    try:
+        return await engine.read("search_item_history", _search)
+    except Exception as e:
+        print(f"Error searching item history in SQLite: {e}")
+        return []
+
+async def recompute_daily_rollups(target_date: date | None = None) -> int:
+    """Recomputes one day's rollups for all shops from the ledger (defaults to yesterday)."""
+    target_date = target_date or (datetime.now().date() - timedelta(days=1))
+    formatted_date = target_date.strftime('%Y-%m-%d')
+
+    def _recompute(conn):
+        # `WHERE true` disambiguates INSERT ... SELECT ... ON CONFLICT for SQLite's parser
+        conn.execute(
+            f"INSERT INTO daily_rollups (user_id, rollup_date, sales, expenses, purchases, profit, txn_count, updated_at) "
+            f"SELECT user_id, transaction_date, {_LEDGER_SALES_SQL}, {_LEDGER_EXPENSES_SQL}, {_LEDGER_PURCHASES_SQL}, "
+            f"round({_LEDGER_SALES_SQL} - {_LEDGER_EXPENSES_SQL} - {_LEDGER_PURCHASES_SQL}, 2), COUNT(*), ? "
+            f"FROM transactions WHERE transaction_date = ? AND true GROUP BY user_id, transaction_date "
+            f"ON CONFLICT (user_id, rollup_date) DO UPDATE SET sales = excluded.sales, expenses = excluded.expenses, "
+            f"purchases = excluded.purchases, profit = excluded.profit, txn_count = excluded.txn_count, updated_at = excluded.updated_at",
+            (_now(), formatted_date),
+        )
+        conn.execute(
+            "DELETE FROM daily_rollups WHERE rollup_date = ? AND NOT EXISTS "
+            "(SELECT 1 FROM transactions t WHERE t.user_id = daily_rollups.user_id AND t.transaction_date = daily_rollups.rollup_date)",
+            (formatted_date,),
+        )
+        return conn.execute("SELECT COUNT(*) FROM daily_rollups WHERE rollup_date = ?", (formatted_date,)).fetchone()[0]
+
+    try:
+        shop_count = await engine.write("recompute_daily_rollups", _recompute, timeout=300)
+        print(f"DEBUG_ROLLUPS: Recomputed rollups for {target_date} across {shop_count} shops.")
+        return shop_count
+    except Exception as e:
+        print(f"Error recomputing daily rollups in SQLite: {e}")
+        return 0
+
+async def ensure_transaction_partitions(months_ahead: int = 3, from_date: date | None = None) -> int:
+    """No-op: the SQLite backend keeps transactions in a single table."""
+    return 0
+
+_TRANSACTION_COLUMNS = "id, transaction_date, transaction_type, amount, item, user_id, created_at, client_txn_id"
+_LINE_COLUMNS = "transaction_id, line_no, user_id, transaction_date, transaction_type, item_name, quantity, unit, unit_price, amount, cost"
+
+def _archive_transaction_month(conn, month_start: str) -> dict:
+    """Moves one month of transactions (month_start is its first day) and their lines to the archive tables.
+    Its totals are folded into `archived_balances` and its daily rollups recomputed over both tiers,
+    since rows imported after the month was first archived join the ones already there."""
+    next_month = (date.fromisoformat(month_start).replace(day=28) + timedelta(days=4)).replace(day=1).isoformat()
+    month_range = "transaction_date >= ? AND transaction_date < ?"
+    transaction_count = conn.execute(f"SELECT COUNT(*) FROM transactions WHERE {month_range}", (month_start, next_month)).fetchone()[0]
+    conn.execute(
+        f"INSERT INTO archived_balances (user_id, balance, total_sales, total_expenses, transaction_count, archived_through, updated_at) "
+        f"SELECT user_id, {_LEDGER_BALANCE_SQL}, {_LEDGER_SALES_SQL}, {_LEDGER_EXPENSES_SQL}, COUNT(*), ?, ? "
+        f"FROM transactions WHERE {month_range} GROUP BY user_id "
+        f"ON CONFLICT (user_id) DO UPDATE SET balance = round(archived_balances.balance + excluded.balance, 2), "
+        f"total_sales = round(archived_balances.total_sales + excluded.total_sales, 2), "
+        f"total_expenses = round(archived_balances.total_expenses + excluded.total_expenses, 2), "
+        f"transaction_count = archived_balances.transaction_count + excluded.transaction_count, "
+        f"archived_through = max(archived_balances.archived_through, excluded.archived_through), updated_at = excluded.updated_at",
+        (next_month, _now(), month_start, next_month),
+    )
+    conn.execute(
+        f"INSERT INTO daily_rollups (user_id, rollup_date, sales, expenses, purchases, profit, txn_count, updated_at) "
+        f"SELECT user_id, transaction_date, {_LEDGER_SALES_SQL}, {_LEDGER_EXPENSES_SQL}, {_LEDGER_PURCHASES_SQL}, "
+        f"round({_LEDGER_SALES_SQL} - {_LEDGER_EXPENSES_SQL} - {_LEDGER_PURCHASES_SQL}, 2), COUNT(*), ? "
+        f"FROM (SELECT user_id, transaction_date, transaction_type, amount FROM transactions WHERE {month_range} "
+        f"UNION ALL SELECT user_id, transaction_date, transaction_type, amount FROM transactions_archive WHERE {month_range}) "
+        f"GROUP BY user_id, transaction_date "
+        f"ON CONFLICT (user_id, rollup_date) DO UPDATE SET sales = excluded.sales, expenses = excluded.expenses, "
+        f"purchases = excluded.purchases, profit = excluded.profit, txn_count = excluded.txn_count, updated_at = excluded.updated_at",
+        (_now(), month_start, next_month, month_start, next_month),
+    )
+    month_ids = f"SELECT id FROM transactions WHERE {month_range}"
+    line_count = conn.execute(
+        f"INSERT INTO transaction_lines_archive ({_LINE_COLUMNS}) SELECT {_LINE_COLUMNS} FROM transaction_lines WHERE transaction_id IN ({month_ids})",
+        (month_start, next_month),
+    ).rowcount
+    conn.execute(f"DELETE FROM transaction_lines WHERE transaction_id IN ({month_ids})", (month_start, next_month))
+    conn.execute(
+        f"INSERT INTO transactions_archive ({_TRANSACTION_COLUMNS}) SELECT {_TRANSACTION_COLUMNS} FROM transactions WHERE {month_range}",
+        (month_start, next_month),
+    )
+    conn.execute(f"DELETE FROM transactions WHERE {month_range}", (month_start, next_month))
+    return {"archived_month": month_start, "transaction_count": transaction_count, "line_count": line_count}
+
+async def archive_transactions(before_date: date) -> list[dict]:
+    """
+    Moves the transactions of whole months ending on or before before_date (and their lines) to the
+    archive tables, after folding their totals into `archived_balances` and the daily rollups.
+    Each month is its own write transaction, as in supabase_client.
+    Returns [{"archived_month", "transaction_count", "line_count"}], one per archived month.
+    """
+    cutoff = before_date.replace(day=1).strftime('%Y-%m-%d')
+    archived = []
+    try:
+        months = await engine.read("transaction_months_to_archive", lambda conn: [row[0] for row in conn.execute(
+            "SELECT DISTINCT substr(transaction_date, 1, 7) || '-01' FROM transactions WHERE transaction_date < ? ORDER BY 1", (cutoff,),
+        )])
+        for month_start in months:
+            month = await engine.write("archive_transaction_month", lambda conn, month_start=month_start: _archive_transaction_month(conn, month_start), timeout=600)
+            print(f"DEBUG_ARCHIVE: Archived {month['transaction_count']} transactions and {month['line_count']} lines of {month['archived_month']}.")
+            archived.append(month)
+        print(f"DEBUG_ARCHIVE: Archived {len(archived)} month(s) before {cutoff}.")
+    except Exception as e:
+        print(f"Error archiving transactions in SQLite after {len(archived)} month(s): {e}")
+    return archived
+
+async def get_daily_sales_summary(user_id: str, target_date: date, detail_limit: int = 10) -> tuple[float, list[dict]]:
+    """Retrieves the total sales (from `daily_rollups`) and the latest sales transactions for a user and date."""
+    formatted_date = target_date.strftime('%Y-%m-%d')
+
+    def _summary(conn):
+        rollup = conn.execute("SELECT sales FROM daily_rollups WHERE user_id = ? AND rollup_date = ?", (user_id, formatted_date)).fetchone()
+        sales_transactions = _rows(conn.execute(
+            "SELECT item, amount FROM transactions WHERE user_id = ? AND transaction_type = 'sale' AND transaction_date = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, formatted_date, detail_limit),
+        ))
+        return (float(rollup["sales"]) if rollup else 0.0), sales_transactions
+
+    try:
+        total_sales, sales_transactions = await engine.read("daily_sales", _summary)
+        print(f"Daily sales summary for user {user_id} on {formatted_date}: Total sales {total_sales}, {len(sales_transactions)} transactions listed.")
+        return total_sales, sales_transactions
+    except Exception as e:
+        print(f"Error fetching daily sales summary from SQLite: {e}")
+        return 0.0, []
+
+async def get_low_stock_items(user_id: str) -> list[dict]:
+    """Retrieves items for a user whose quantity is at or below their min_quantity_threshold."""
+    try:
+        low_stock_items = await engine.read("low_stock_items", lambda conn: _rows(conn.execute(
+            "SELECT * FROM stock_items WHERE user_id = ? AND quantity <= min_quantity_threshold ORDER BY item_name", (user_id,)
+        )))
+        print(f"DEBUG_STOCK: Found {len(low_stock_items)} low stock items for user {user_id}.")
+        return low_stock_items
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error retrieving low stock items for {user_id}: {e}")
+        return []
+
+async def get_low_stock_items_by_user() -> dict[str, list[dict]]:
+    """Retrieves the low-stock items of every shop in one query, keyed by user_id."""
+    try:
+        items = await engine.read("all_low_stock_items", lambda conn: _rows(conn.execute(
+            "SELECT * FROM stock_items WHERE quantity <= min_quantity_threshold ORDER BY user_id, item_name"
+        )), timeout=60)
+        low_stock_by_user = {}
+        for item in items:
+            low_stock_by_user.setdefault(item['user_id'], []).append(item)
+        return low_stock_by_user
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error retrieving low stock items for all shops: {e}")
+        return {}
+
+async def get_owner_shops(owner_id: str) -> list[str]:
+    """Retrieves the user_ids of an owner's outlets (their own shop included), or [] if they are not an owner."""
+    try:
+        rows = await engine.read("owner_shops", lambda conn: _rows(conn.execute(
+            "SELECT user_id FROM owner_shops WHERE owner_id = ? ORDER BY user_id", (owner_id,)
+        )))
+        return [row["user_id"] for row in rows]
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error retrieving the shops of owner {owner_id}: {e}")
+        return []
+
+async def link_owner_shop(owner_id: str, user_id: str) -> bool:
+    """Links a shop to its owner (replacing any previous owner); the owner's own shop is mapped as well."""
+    def _link(conn):
+        now = _now()
+        conn.execute(
+            "INSERT INTO owner_shops (user_id, owner_id, created_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET owner_id = excluded.owner_id, created_at = excluded.created_at",
+            (user_id, owner_id, now),
+        )
+        conn.execute("INSERT INTO owner_shops (user_id, owner_id, created_at) VALUES (?, ?, ?) ON CONFLICT (user_id) DO NOTHING", (owner_id, owner_id, now))
+
+    try:
+        await engine.write("link_owner_shop", _link)
+        print(f"DEBUG_OWNER: Linked shop {user_id} to owner {owner_id}.")
+        return True
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error linking shop {user_id} to owner {owner_id}: {e}")
+        return False
+
+async def unlink_owner_shop(user_id: str) -> str | None:
+    """Removes a shop from its owner's outlets. Returns the owner it was linked to, or None."""
+    try:
+        rows = await engine.write("unlink_owner_shop", lambda conn: _rows(conn.execute(
+            "DELETE FROM owner_shops WHERE user_id = ? RETURNING owner_id", (user_id,)
+        )))
+        return rows[0]["owner_id"] if rows else None
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error unlinking shop {user_id} from its owner: {e}")
+        return None
+
+def _owner_rollup(rows: list[dict]) -> dict:
+    shops = [{
+        "user_id": row["user_id"],
+        **{field: float(row[field]) for field in ("balance", "sales", "expenses", "purchases", "profit")},
+        "txn_count": int(row["txn_count"]),
+    } for row in rows]
+    totals = {field: round(sum(shop[field] for shop in shops), 2) for field in ("balance", "sales", "expenses", "purchases", "profit")}
+    return {"shops": shops, **totals, "txn_count": sum(shop["txn_count"] for shop in shops)}
+
+async def get_owner_rollup(owner_id: str, start_date: date, end_date: date) -> dict:
+    """
+    Combined figures of an owner's outlets: {"shops": [{user_id, balance, sales, expenses, purchases,
+    profit, txn_count}], "balance", "sales", ...} with the period totals from `daily_rollups` and the
+    current balances from `shop_balances`, in one grouped query. "shops" is empty for a non-owner.
+    """
+    try:
+        rows = await engine.read("owner_rollup", lambda conn: _rows(conn.execute(
+            "SELECT o.user_id, COALESCE(b.balance, 0) AS balance, "
+            "COALESCE(SUM(r.sales), 0) AS sales, COALESCE(SUM(r.expenses), 0) AS expenses, COALESCE(SUM(r.purchases), 0) AS purchases, "
+            "COALESCE(SUM(r.profit), 0) AS profit, COALESCE(SUM(r.txn_count), 0) AS txn_count "
+            "FROM owner_shops o "
+            "LEFT JOIN shop_balances b ON b.user_id = o.user_id "
+            "LEFT JOIN daily_rollups r ON r.user_id = o.user_id AND r.rollup_date BETWEEN ? AND ? "
+            "WHERE o.owner_id = ? GROUP BY o.user_id, b.balance ORDER BY o.user_id",
+            (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), owner_id),
+        )))
+        rollup = _owner_rollup(rows)
+        print(f"DEBUG_OWNER: Roll-up of {len(rollup['shops'])} shops for owner {owner_id}: balance {rollup['balance']}, sales {rollup['sales']}.")
+        return rollup
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error retrieving the roll-up of owner {owner_id}: {e}")
+        return _owner_rollup([])
+
+async def get_owner_low_stock_items(owner_id: str) -> dict[str, list[dict]]:
+    """Retrieves the low-stock items of every outlet of an owner in one query, keyed by user_id."""
+    try:
+        items = await engine.read("owner_low_stock_items", lambda conn: _rows(conn.execute(
+            "SELECT s.* FROM owner_shops o "
+            "JOIN stock_items s ON s.user_id = o.user_id AND s.quantity <= s.min_quantity_threshold "
+            "WHERE o.owner_id = ? ORDER BY s.user_id, s.item_name", (owner_id,)
+        )))
+        low_stock_by_user = {}
+        for item in items:
+            low_stock_by_user.setdefault(item['user_id'], []).append(item)
+        return low_stock_by_user
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error retrieving low stock items of owner {owner_id}: {e}")
+        return {}
+
+async def save_order_confirmation(
+    user_id: str,
+    item_name: str,
+    quantity: float,
+    unit: str,
+    cost_price_per_unit: float,
+    supplier_name: str,
+) -> dict:
+    """Saves an order confirmation, updating stock and recording a purchase transaction."""
+    try:
+        updated_stock = await update_stock_item(user_id, item_name, quantity, unit, cost_price_per_unit)
+        transaction_data = {
+            "date": datetime.now(timezone.utc).strftime('%Y-%m-%d'),
+            "type": "purchase",
+            "amount": quantity * cost_price_per_unit,
+            "item": f"{item_name} ({quantity} {unit}) from {supplier_name}"
+        }
+        saved_transaction = await save_transaction(transaction_data, user_id)
+        return {"status": "success", "stock": updated_stock, "transaction": saved_transaction}
+    except Exception as e:
+        print(f"ERROR_SQLITE_ORDER: Failed to save order confirmation: {e}")
+        raise Exception(f"Failed to save order confirmation: {e}")
+
+SHOP_PAGE_SIZE = 500
+
+async def iter_active_shops(page_size: int = SHOP_PAGE_SIZE):
+    """Yields every active shop from the `shops` registry, paging with a keyset on user_id."""
+    last_user_id = ""
+    while True:
+        page = await engine.read("active_shops_page", lambda conn: _rows(conn.execute(
+            "SELECT user_id, language, latitude, longitude FROM shops WHERE status = 'active' AND user_id > ? ORDER BY user_id LIMIT ?",
+            (last_user_id, page_size),
+        )))
+        for shop in page:
+            yield shop
+        if len(page) < page_size:
+            return
+        last_user_id = page[-1]["user_id"]
+
+EXPORT_PAGE_SIZE = 5000
+
+async def iter_transaction_pages(user_id: str, start_date: date, end_date: date, page_size: int = EXPORT_PAGE_SIZE, include_archive: bool = False):
+    """
+    Yields a user's transactions between start_date and end_date inclusive, a page at a time, keyset on (transaction_date, id).
+    With include_archive the archived months come first; they all precede the hot ones.
+    """
+    for table in (["transactions_archive"] if include_archive else []) + ["transactions"]:
+        after = ("", "")
+        while True:
+            page = await engine.read("export_transactions_page", lambda conn: _rows(conn.execute(
+                f"SELECT id, transaction_date, transaction_type, amount, item, created_at FROM {table} "
+                f"WHERE user_id = ? AND transaction_date >= ? AND transaction_date <= ? AND (transaction_date, id) > (?, ?) "
+                f"ORDER BY transaction_date, id LIMIT ?",
+                (user_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), *after, page_size),
+            )))
+            if page:
+                yield page
+            if len(page) < page_size:
+                break
+            after = (page[-1]["transaction_date"], page[-1]["id"])
+
+async def iter_stock_movement_pages(user_id: str, start_date: date, end_date: date, page_size: int = EXPORT_PAGE_SIZE):
+    """Yields a user's stock movements made between start_date and end_date inclusive (UTC days), a page at a time, keyset on (created_at, id)."""
+    after = ("", 0)
+    while True:
+        page = await engine.read("export_stock_movements_page", lambda conn: _rows(conn.execute(
+            "SELECT id, stock_item_id, item_name, movement_type, quantity_delta, unit_cost, average_cost_after, created_at FROM stock_movements "
+            "WHERE user_id = ? AND created_at >= ? AND created_at < ? AND (created_at, id) > (?, ?) "
+            "ORDER BY created_at, id LIMIT ?",
+            (user_id, start_date.strftime('%Y-%m-%d'), (end_date + timedelta(days=1)).strftime('%Y-%m-%d'), *after, page_size),
+        )))
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after = (page[-1]["created_at"], page[-1]["id"])
+
+async def get_shop(user_id: str) -> dict | None:
+    """Retrieves a shop's registry row, or None if it has never written anything."""
+    try:
+        rows = await engine.read("shop", lambda conn: _rows(conn.execute(
+            "SELECT user_id, language, latitude, longitude, status FROM shops WHERE user_id = ?", (user_id,)
+        )))
+        return rows[0] if rows else None
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error retrieving shop {user_id}: {e}")
+        return None
+
+_SHOP_FIELDS = ("language", "latitude", "longitude", "status")
+
+async def update_shop(user_id: str, **fields) -> dict:
+    """Creates or updates a shop's registry row, e.g. update_shop(user_id, language="hi")."""
+    unknown_fields = set(fields) - set(_SHOP_FIELDS)
+    if unknown_fields:
+        raise ValueError(f"Unknown shop fields: {sorted(unknown_fields)}")
+    columns = [field for field in _SHOP_FIELDS if field in fields]
+    now = _now()
+    assignments = "".join(f"{column} = excluded.{column}, " for column in columns)
+    sql = (
+        f"INSERT INTO shops (user_id, {''.join(column + ', ' for column in columns)}created_at, updated_at) "
+        f"VALUES (?, {'?, ' * len(columns)}?, ?) "
+        f"ON CONFLICT (user_id) DO UPDATE SET {assignments}updated_at = excluded.updated_at RETURNING *"
+    )
+    try:
+        rows = await engine.write("update_shop", lambda conn: _rows(conn.execute(sql, (user_id, *(fields[column] for column in columns), now, now))))
+        return rows[0] if rows else {}
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error updating shop {user_id}: {e}")
+        return {}
+
+async def get_all_unique_user_ids_with_stock() -> list[str]:
+    """Retrieves the user_ids of all active shops as a list. Prefer `iter_active_shops` for large registries."""
+    try:
+        return [shop["user_id"] async for shop in iter_active_shops()]
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error retrieving active shop user IDs: {e}")
+        return []
+
+# Bill image hashes are unsigned 64-bit integers; SQLite INTEGER is signed, so they are stored shifted.
+def _hash_to_bigint(image_hash: int) -> int:
+    return image_hash - (1 << 64) if image_hash >= (1 << 63) else image_hash
+
+def _bigint_to_hash(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+async def get_bill_image_hashes(user_id: str) -> list[dict]:
+    """Retrieves the perceptual hashes of every bill image already processed for a user (see supabase_client)."""
+    try:
+        rows = await engine.read("bill_image_hashes", lambda conn: _rows(conn.execute(
+            "SELECT image_hash, detail_hash, created_at FROM bill_image_hashes WHERE user_id = ?", (user_id,)
+        )))
+        return [
+            {"image_hash": _bigint_to_hash(int(row["image_hash"])), "detail_hash": int(row["detail_hash"], 16) if row["detail_hash"] else None, "created_at": row["created_at"]}
+            for row in rows
+        ]
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error retrieving bill image hashes for {user_id}: {e}")
+        return []
+
+async def save_bill_image_hash(user_id: str, image_hash: int, detail_hash: int | None = None) -> dict:
+    """Stores the perceptual hashes of a processed bill image for a user (the 256-bit detail hash as hex)."""
+    detail_hash_text = f"{detail_hash:064x}" if detail_hash is not None else None
+
+    def _save(conn):
+        # Every detail hash is kept per image hash; saving the same pair again returns the stored row
+        conn.execute(
+            "INSERT INTO bill_image_hashes (id, user_id, image_hash, detail_hash, created_at) VALUES (?, ?, ?, ?, ?) ON CONFLICT DO NOTHING",
+            (str(uuid.uuid4()), user_id, _hash_to_bigint(image_hash), detail_hash_text, _now()),
+        )
+        return _rows(conn.execute(
+            "SELECT * FROM bill_image_hashes WHERE user_id = ? AND image_hash = ? AND COALESCE(detail_hash, '') = ?",
+            (user_id, _hash_to_bigint(image_hash), detail_hash_text or ""),
+        ))
+
+    try:
+        rows = await engine.write("save_bill_image_hash", _save)
+        return rows[0] if rows else {}
+    except Exception as e:
+        print(f"ERROR_SQLITE: Error saving bill image hash for {user_id}: {e}")
+        return {}
@@ -0,0 +1,221 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+STOCK_CACHE_MAX_SHOPS = int(os.getenv("STOCK_CACHE_MAX_SHOPS", "1000"))  # LRU bound across shops
+STOCK_CACHE_TTL_SECONDS = float(os.getenv("STOCK_CACHE_TTL_SECONDS", "300"))  # Bounds staleness from writes made elsewhere
+
+
+class _CachedShop:
+    def __init__(self, rows: list[dict]):
+        self.rows = {row["id"]: dict(row) for row in rows}
+        self.loaded_at = time.monotonic()  # When the rows were last read from the database
+
+
+class StockCache:
+    """In-process, per-shop cache of stock rows with read-through loading and write-through updates.
+
+    Rows returned by the stock mutation functions are written into the cache, so a shop's
+    list stays current without re-reading it after every sale or purchase. Shops are kept
+    in an LRU bounded by `max_shops`; entries older than `ttl_seconds` are reloaded to pick
+    up writes made by other processes, which can also call `invalidate` directly.
+    Webhook requests run on different event loops, so the cache is guarded by a thread lock.
+    """
+
+    def __init__(self, load_rows, max_shops: int = STOCK_CACHE_MAX_SHOPS, ttl_seconds: float = STOCK_CACHE_TTL_SECONDS):
+        self._load_rows = load_rows
+        self.max_shops = max_shops
+        self.ttl_seconds = ttl_seconds
+        self._shops = OrderedDict()
+        self._loading = {}  # user_id -> Future shared by concurrent misses for the same shop
+        # Logical clock of writes/invalidations, so a load that raced a write is not cached
+        self._clock = 0
+        self._last_write = {}  # user_id -> clock of its last write, kept while the shop is cached or loading
+        self._invalidated_all_at = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+        self._served_age_total = 0.0
+        self._served_age_max = 0.0
+
+    @staticmethod
+    def _sorted_copies(rows) -> list[dict]:
+        return sorted((dict(row) for row in rows), key=lambda row: (row.get("item_name") or "", row.get("unit") or ""))
+
+    def _record_write(self, user_id: str):
+        if user_id in self._shops or user_id in self._loading:
+            self._clock += 1
+            self._last_write[user_id] = self._clock
+
+    def _written_since(self, user_id: str, clock: int) -> bool:
+        return max(self._last_write.get(user_id, 0), self._invalidated_all_at) > clock
+
+    def _forget(self, user_id: str):
+        if user_id not in self._shops and user_id not in self._loading:
+            self._last_write.pop(user_id, None)
+
+    def _store(self, user_id: str, shop: _CachedShop):
+        self._shops[user_id] = shop
+        self._shops.move_to_end(user_id)
+        while len(self._shops) > self.max_shops:
+            evicted_user_id, _ = self._shops.popitem(last=False)
+            self._forget(evicted_user_id)
+            self._evictions += 1
+
+    async def get(self, user_id: str, populate: bool = True) -> list[dict]:
+        """Returns copies of a shop's stock rows, loading them on a miss.
+
+        With populate=False a miss is loaded without being cached, so batch jobs that walk
+        every shop do not evict the shops that are actively messaging.
+        """
+        with self._lock:
+            shop = self._shops.get(user_id)
+            if shop is not None and time.monotonic() - shop.loaded_at <= self.ttl_seconds:
+                age = time.monotonic() - shop.loaded_at
+                self._hits += 1
+                self._served_age_total += age
+                self._served_age_max = max(self._served_age_max, age)
+                self._shops.move_to_end(user_id)
+                return self._sorted_copies(shop.rows.values())
+            self._misses += 1
+            if not populate:
+                pending = None
+            else:
+                pending = self._loading.get(user_id)
+                if pending is None:
+                    pending = Future()
+                    self._loading[user_id] = pending
+                    load_started_at = self._clock
+                else:
+                    load_started_at = None  # Someone else is loading this shop; wait for them
+
+        if not populate:
+            return self._sorted_copies(await self._load_rows(user_id))
+        if load_started_at is None:
+            return self._sorted_copies(await asyncio.wrap_future(pending))
+
+        try:
+            rows = await self._load_rows(user_id)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(user_id, None)
+                self._forget(user_id)
+            # Waiters on other loops were not cancelled themselves; give them a plain error instead
+            pending.set_exception(RuntimeError(f"Stock load for {user_id} was cancelled") if isinstance(e, asyncio.CancelledError) else e)
+            raise
+        with self._lock:
+            self._loading.pop(user_id, None)
+            # A write that landed while loading may not be in `rows`; don't cache a possibly older list
+            if self._written_since(user_id, load_started_at):
+                self._shops.pop(user_id, None)  # Drop an expired entry too, it is older still
+                self._forget(user_id)
+            else:
+                self._store(user_id, _CachedShop(rows))
+        pending.set_result(rows)
+        return self._sorted_copies(rows)
+
+    def apply_rows(self, user_id: str, rows: list[dict]):
+        """Write-through: merges rows returned by a stock mutation into the cached shop, if cached."""
+        with self._lock:
+            self._record_write(user_id)
+            shop = self._shops.get(user_id)
+            if shop is None:
+                return
+            for row in rows:
+                cached_row = shop.rows.get(row["id"])
+                # Mutations from concurrent requests can return out of order; never go back a version
+                if cached_row is None or int(row.get("version") or 0) >= int(cached_row.get("version") or 0):
+                    shop.rows[row["id"]] = dict(row)
+
+    def invalidate(self, user_id: str | None = None):
+        """Drops one shop (or every shop) so the next read goes to the database."""
+        with self._lock:
+            if user_id is None:
+                self._clock += 1
+                self._invalidated_all_at = self._clock
+                self._invalidations += len(self._shops)
+                self._shops.clear()
+                self._last_write = {loading_user_id: self._last_write[loading_user_id] for loading_user_id in self._loading if loading_user_id in self._last_write}
+                return
+            self._record_write(user_id)
+            if self._shops.pop(user_id, None) is not None:
+                self._invalidations += 1
+                self._forget(user_id)
+
+    def stats(self) -> dict:
+        """Hit ratio, evictions and how old (seconds since loaded from the database) served entries were."""
+        with self._lock:
+            lookups = self._hits + self._misses
+            now = time.monotonic()
+            return {
+                "shops_cached": len(self._shops),
+                "max_shops": self.max_shops,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 3) if lookups else 0.0,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+                "avg_served_age_s": round(self._served_age_total / self._hits, 2) if self._hits else 0.0,
+                "max_served_age_s": round(self._served_age_max, 2),
+                "oldest_entry_age_s": round(max((now - shop.loaded_at for shop in self._shops.values()), default=0.0), 2),
+            }
+
+
+if __name__ == "__main__":
+    import random
+
+    database = {}  # user_id -> {row_id: row}, stands in for stock_items
+    loads = []
+
+    async def _load_rows(user_id: str) -> list[dict]:
+        loads.append(user_id)
+        await asyncio.sleep(0.01)
+        return [dict(row) for row in database.get(user_id, {}).values()]
+
+    def _write(user_id: str, item_name: str, delta: float) -> dict:
+        rows = database.setdefault(user_id, {})
+        row_id = f"{user_id}:{item_name}"
+        row = rows.get(row_id) or {"id": row_id, "item_name": item_name, "unit": "pcs", "quantity": 0.0, "version": 0}
+        row = {**row, "quantity": row["quantity"] + delta, "version": row["version"] + 1}
+        rows[row_id] = row
+        return row
+
+    async def _demo():
+        cache = StockCache(_load_rows, max_shops=50, ttl_seconds=60)
+        for shop_number in range(200):
+            for item_number in range(5):
+                _write(f"shop-{shop_number}", f"item-{item_number}", 10)
+
+        # Concurrent misses for one shop share a single load
+        await asyncio.gather(*(cache.get("shop-0") for _ in range(20)))
+        assert loads.count("shop-0") == 1, loads
+
+        # Skewed traffic: most messages come from a few busy shops
+        random.seed(3)
+        for _ in range(5000):
+            user_id = f"shop-{int(random.paretovariate(1.2)) % 200}"
+            rows = await cache.get(user_id)
+            row = _write(user_id, rows[0]["item_name"], -1)
+            cache.apply_rows(user_id, [row])  # Write-through, as the stock mutation functions do
+            cached = {cached_row["id"]: cached_row for cached_row in await cache.get(user_id)}
+            assert cached[row["id"]]["quantity"] == row["quantity"], "Write-through lost an update"
+
+        # A write made elsewhere is only seen after invalidation
+        _write("shop-0", "item-0", 100)
+        cache.invalidate("shop-0")
+        assert (await cache.get("shop-0"))[0]["quantity"] == database["shop-0"]["shop-0:item-0"]["quantity"]
+
+        # Batch jobs read without evicting busy shops
+        before = cache.stats()["shops_cached"]
+        for shop_number in range(200):
+            await cache.get(f"shop-{shop_number}", populate=False)
+        assert cache.stats()["shops_cached"] == before
+        print(f"Stock cache stats: {cache.stats()}")
+        print(f"Database loads: {len(loads)} for {cache.stats()['hits'] + cache.stats()['misses']} reads")
+
+    asyncio.run(_demo())
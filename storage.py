@@ -0,0 +1,225 @@
+import asyncio
+import importlib
+import os
+import time
+import uuid
+from datetime import date
+
+from dotenv import load_dotenv
+
+from storage_errors import QueryTimeout
+from write_ahead_ledger import create_ledger
+
+load_dotenv()
+
+# "supabase" (hosted Postgres, the default) or "sqlite" (embedded, single-host deployments and local development)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+# Sales, purchases and expenses (stock and transactions) are acknowledged once they are in the local ledger (write_ahead_ledger.py)
+WRITE_BEHIND_LEDGER = os.getenv("WRITE_BEHIND_LEDGER", "true").lower() in ("1", "true", "yes")
+# How long a stock read waits for an apply of the shop's ledger entries to finish before merging them anyway
+LEDGER_READ_WAIT_SECONDS = float(os.getenv("LEDGER_READ_WAIT_SECONDS", "2"))
+# Whole months of transactions older than this many months are moved to the archive tables (cold tier)
+TRANSACTION_ARCHIVE_MONTHS = int(os.getenv("TRANSACTION_ARCHIVE_MONTHS", "24"))
+
+_BACKEND_MODULES = {
+    "supabase": "supabase_client",
+    "sqlite": "sqlite_store",
+}
+
+# The storage interface: every backend module exports exactly these names, with the same
+# signatures and return shapes (checked by storage_conformance.py).
+STORAGE_INTERFACE = [
+    'save_transaction', 'save_transactions_bulk', 'get_transaction_writer_metrics',
+    'get_user_transactions_summary', 'get_total_balance', 'reconcile_shop_balances',
+    'update_stock_item', 'apply_stock_deltas', 'get_stock_levels', 'invalidate_stock_cache', 'get_stock_cache_stats',
+    'get_stock_as_of', 'take_stock_snapshots',
+    'get_daily_sales_summary', 'get_daily_rollups', 'get_period_summary', 'get_item_sales', 'search_item_history', 'recompute_daily_rollups',
+    'ensure_transaction_partitions', 'archive_transactions',
+    'get_low_stock_items', 'get_low_stock_items_by_user', 'save_order_confirmation',
+    'get_owner_shops', 'link_owner_shop', 'unlink_owner_shop', 'get_owner_rollup', 'get_owner_low_stock_items',
+    'get_bill_image_hashes', 'save_bill_image_hash',
+    'get_all_unique_user_ids_with_stock', 'iter_active_shops', 'get_shop', 'update_shop',
+    'iter_transaction_pages', 'iter_stock_movement_pages', 'import_transactions',
+    'get_query_metrics', 'StockVersionConflict', 'QueryTimeout', 'apply_ledger_entries',
+]
+
+
+def load_backend(name: str):
+    """Imports a storage backend module by name and checks that it implements the whole interface."""
+    if name not in _BACKEND_MODULES:
+        raise ValueError(f"Unknown STORAGE_BACKEND '{name}', expected one of {sorted(_BACKEND_MODULES)}")
+    backend = importlib.import_module(_BACKEND_MODULES[name])
+    missing = [attribute for attribute in STORAGE_INTERFACE if not hasattr(backend, attribute)]
+    if missing:
+        raise ImportError(f"Storage backend '{name}' does not implement {missing}")
+    return backend
+
+
+backend = load_backend(STORAGE_BACKEND)
+print(f"DEBUG_STORAGE: Using the {STORAGE_BACKEND} storage backend.")
+
+globals().update({attribute: getattr(backend, attribute) for attribute in STORAGE_INTERFACE})
+
+
+# Postgres error classes worth waiting out: connection, serialization/deadlock, resources, operator intervention, system
+_TRANSIENT_SQLSTATE_CLASSES = {"08", "40", "53", "57", "58"}
+
+def _is_transient(error: Exception) -> bool:
+    """Whether a failed ledger apply is an outage or slowdown (retry) rather than a rejection of the entry."""
+    if isinstance(error, (QueryTimeout, OSError)):
+        return True
+    if type(error).__module__.split(".")[0] in ("httpx", "httpcore"):
+        return True
+    return str(getattr(error, "code", "") or "")[:2] in _TRANSIENT_SQLSTATE_CLASSES
+
+
+ledger = create_ledger(backend.apply_ledger_entries, _is_transient)
+
+def start_write_behind_ledger():
+    """Replays entries left by the previous run. Also happens on the first write; call it at startup to not wait for one."""
+    if WRITE_BEHIND_LEDGER:
+        ledger.start()
+
+# Units a delta is converted through before it lands on a row of another unit (as the backends convert)
+_UNIT_SCALES = {"kg": 1000.0, "g": 1.0}
+
+def _unit_scale(unit: str | None) -> float:
+    return _UNIT_SCALES.get((unit or "").lower(), 1.0)
+
+def _apply_entry_locally(stock_levels: list[dict], entry: dict) -> tuple[list[dict], list[dict]]:
+    """Applies a ledger entry's stock deltas to a copy of `stock_levels` the way the database will
+    (`apply_stock_deltas`): same row choice and order, quantity, weighted-average cost and version.
+    Returns (new stock levels, the touched rows in delta order); raises StockVersionConflict like the database."""
+    stock_levels = list(stock_levels)
+    deltas = entry.get("stock_deltas") or []
+    results = [None] * len(deltas)
+    for delta_index in sorted(range(len(deltas)), key=lambda index: (deltas[index]["item_name"], index)):
+        delta = deltas[delta_index]
+        item_name, unit = delta["item_name"], delta.get("unit", "pcs")
+        quantity_delta, cost_price_per_unit, expected_version = float(delta["quantity_delta"]), delta.get("cost_price_per_unit"), delta.get("expected_version")
+        candidates = [position for position, row in enumerate(stock_levels) if row.get("item_name") == item_name]
+        candidates.sort(key=lambda position: ((stock_levels[position].get("unit") or "").lower() != (unit or "").lower(),
+                                              str(stock_levels[position].get("id")).startswith("ledger:"), str(stock_levels[position].get("id"))))
+        if candidates:
+            position = candidates[0]
+            row = dict(stock_levels[position])
+            if expected_version is not None and row.get("version") != expected_version:
+                raise backend.StockVersionConflict(f"stock_version_conflict: {item_name} is at version {row.get('version')}, expected {expected_version}")
+            previous_quantity = row.get("quantity") or 0.0
+            quantity = quantity_delta * _unit_scale(unit) / _unit_scale(row.get("unit"))
+            if cost_price_per_unit is not None and quantity > 0:
+                unit_cost = round(cost_price_per_unit * quantity_delta / quantity, 4)
+                if previous_quantity <= 0 or row.get("average_cost") is None:
+                    row["average_cost"] = unit_cost
+                else:
+                    row["average_cost"] = round((previous_quantity * row["average_cost"] + quantity * unit_cost) / (previous_quantity + quantity), 4)
+                row["cost_price_per_unit"] = cost_price_per_unit
+            row["quantity"] = round(max(0.0, previous_quantity + quantity), 2)
+            row["version"] = (row.get("version") or 0) + 1
+            stock_levels[position] = row
+        else:
+            if expected_version is not None and expected_version != 0:
+                raise backend.StockVersionConflict(f"stock_version_conflict: {item_name} no longer exists, expected version {expected_version}")
+            # Keyed by entry and delta until the database assigns the row its id
+            row = {"id": f"ledger:{entry['entry_id']}:{delta_index}", "user_id": entry["user_id"], "item_name": item_name,
+                   "quantity": round(max(0.0, quantity_delta), 2), "unit": unit, "cost_price_per_unit": cost_price_per_unit,
+                   "average_cost": cost_price_per_unit if quantity_delta > 0 else None, "version": 1, "min_quantity_threshold": 0}
+            stock_levels.append(row)
+        results[delta_index] = row
+    return stock_levels, results
+
+async def get_stock_levels(user_id: str, populate_cache: bool = True) -> list[dict]:
+    """The backend's stock rows with the shop's ledger entries that are not applied yet merged on top (read-your-writes).
+
+    The database read is repeated if an apply of the shop's entries started or finished
+    meanwhile, so an entry is never counted both in the read and in the merge. An entry the
+    database will reject (a stale expected_version) is left out.
+    """
+    if not WRITE_BEHIND_LEDGER:
+        return await backend.get_stock_levels(user_id, populate_cache)
+    deadline = time.monotonic() + LEDGER_READ_WAIT_SECONDS
+    while True:
+        generation = ledger.apply_generation(user_id)
+        if generation is None and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+            continue
+        stock_levels = await backend.get_stock_levels(user_id, populate_cache)
+        current_generation, entries = ledger.pending_entries(user_id)
+        if generation is not None and current_generation == generation:
+            break
+        if time.monotonic() >= deadline:
+            print(f"DEBUG_LEDGER: Entries of {user_id} still being applied after {LEDGER_READ_WAIT_SECONDS} s, merging {len(entries)} pending entries anyway.")
+            break
+    for entry in entries:
+        if not entry.get("stock_deltas"):
+            continue
+        try:
+            stock_levels, _ = _apply_entry_locally(stock_levels, entry)
+        except backend.StockVersionConflict as e:
+            print(f"DEBUG_LEDGER: Leaving ledger entry {entry.get('seq')} of {user_id} out of its stock: {e}")
+    return stock_levels
+
+def _find_stock_row(stock_levels: list[dict], delta: dict) -> dict | None:
+    """The row a delta was applied to: same item name, preferring the same unit (as the backends choose)."""
+    candidates = [row for row in stock_levels if row.get("item_name") == delta["item_name"]]
+    candidates.sort(key=lambda row: ((row.get("unit") or "").lower() != (delta.get("unit", "pcs") or "").lower(), str(row.get("id"))))
+    return candidates[0] if candidates else None
+
+async def record_writes(user_id: str, stock_deltas: list[dict] | None = None, transactions: list[dict] | None = None) -> dict:
+    """Records a shop's stock movements and transactions (e.g. one sale or one purchase bill) together.
+
+    Both go into one ledger entry, acknowledged once it is fsynced locally and applied to the
+    database in the background, stock and transactions in one database transaction. Stock
+    read through `get_stock_levels` includes the entry from now on, so the next message
+    already sees what was just bought or sold. A delta's `expected_version` is checked here
+    against that view (StockVersionConflict) and again when the entry is applied. Without
+    the write-behind ledger the entry is applied directly, in the same single transaction.
+    If the local append fails nothing is written and the error is raised. Returns
+    {"stock": [...], "transactions": [...]} with the updated stock rows in the order of `stock_deltas`.
+
+    A transaction may carry its item lines as `lines`: [{"item_name", "quantity", "unit",
+    "unit_price", "amount", "cost"}], stored in `transaction_lines` with it.
+    """
+    stock_deltas = list(stock_deltas or [])
+    transactions = [
+        {**transaction_data, "date": transaction_data["date"].strftime('%Y-%m-%d') if isinstance(transaction_data.get("date"), date) else transaction_data.get("date"),
+         "id": str(uuid.uuid4()), "client_txn_id": str(uuid.uuid4())}
+        for transaction_data in transactions or []
+    ]
+    if not stock_deltas and not transactions:
+        return {"stock": [], "transactions": []}
+    entry = {"entry_id": str(uuid.uuid4()), "user_id": user_id, "stock_deltas": stock_deltas, "transactions": transactions, "recorded_at": time.time()}
+
+    if not WRITE_BEHIND_LEDGER:
+        await asyncio.to_thread(backend.apply_ledger_entries, [entry])
+        stock_levels = await backend.get_stock_levels(user_id) if stock_deltas else []
+        return {"stock": [_find_stock_row(stock_levels, delta) for delta in stock_deltas], "transactions": transactions}
+
+    updated_stock = []
+    if stock_deltas:
+        _, updated_stock = _apply_entry_locally(await get_stock_levels(user_id), entry)
+    try:
+        seq = await ledger.record(entry)
+    except Exception as e:
+        print(f"ERROR_LEDGER: Local append failed for {user_id}, nothing was recorded: {e}")
+        raise
+    print(f"DEBUG_LEDGER: Recorded entry {seq} for {user_id}: {len(stock_deltas)} stock deltas, {len(transactions)} transactions.")
+    return {"stock": updated_stock, "transactions": transactions}
+
+def archive_horizon(today: date | None = None) -> date:
+    """First day of the oldest month kept in the hot tables; earlier transactions are archived."""
+    today = today or date.today()
+    months = today.year * 12 + today.month - 1 - TRANSACTION_ARCHIVE_MONTHS
+    return date(months // 12, months % 12 + 1, 1)
+
+async def archive_old_transactions() -> list[dict]:
+    """Archives the months older than TRANSACTION_ARCHIVE_MONTHS (the monthly job)."""
+    return await backend.archive_transactions(archive_horizon())
+
+def get_ledger_metrics() -> dict:
+    """Backlog and throughput of the write-behind ledger."""
+    return {"enabled": WRITE_BEHIND_LEDGER, **ledger.metrics()}
+
+
+__all__ = ['STORAGE_BACKEND', 'TRANSACTION_ARCHIVE_MONTHS', *STORAGE_INTERFACE, 'record_writes', 'start_write_behind_ledger', 'get_ledger_metrics',
+           'archive_horizon', 'archive_old_transactions']
@@ -0,0 +1,534 @@
+"""Conformance checks for the storage backends (see storage.py).
+
+Runs the same scenarios against a backend and fails on the first difference from the
+expected behaviour:
+
+    python storage_conformance.py sqlite
+    python storage_conformance.py supabase   # needs SUPABASE_URL/KEY and the schema + migrations applied
+    python storage_conformance.py sqlite --benchmark   # also times bill ingestion, per-item vs apply_stock_deltas
+
+Every run uses fresh random shop ids, so it can be pointed at a shared database.
+"""
+import asyncio
+import inspect
+import os
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+if __name__ == "__main__":
+    os.environ["STORAGE_BACKEND"] = sys.argv[1] if len(sys.argv) > 1 else "sqlite"
+
+from storage import STORAGE_BACKEND, STORAGE_INTERFACE, archive_horizon, load_backend
+
+
+def _close(actual: float, expected: float) -> bool:
+    return abs(float(actual) - float(expected)) < 0.005
+
+
+async def check_interface(store):
+    """Signatures must match the other backend's, when its dependencies are installed."""
+    other_backend_name = "sqlite" if store.__name__ == "supabase_client" else "supabase"
+    try:
+        other_store = load_backend(other_backend_name)
+    except ImportError as e:
+        print(f"DEBUG_STORAGE: Not comparing signatures with the {other_backend_name} backend: {e}")
+        return
+    for attribute in STORAGE_INTERFACE:
+        expected, actual = getattr(other_store, attribute), getattr(store, attribute)
+        if inspect.isclass(expected):
+            continue
+        assert inspect.signature(actual) == inspect.signature(expected), f"{attribute}: {inspect.signature(actual)} != {inspect.signature(expected)}"
+        assert inspect.iscoroutinefunction(actual) == inspect.iscoroutinefunction(expected), f"{attribute}: sync/async differs"
+        assert inspect.isasyncgenfunction(actual) == inspect.isasyncgenfunction(expected), f"{attribute}: generator kind differs"
+
+
+async def check_transactions_and_balance(store, user_id: str):
+    today = date.today()
+    saved = await store.save_transactions_bulk([
+        {"date": today, "type": "sale", "amount": 120.50, "item": "rice"},
+        {"date": today, "type": "expense", "amount": 20.25, "item": "tea"},
+        {"date": today - timedelta(days=1), "type": "sale", "amount": 80, "item": "sugar"},
+        {"date": today, "type": "purchase", "amount": 40, "item": "dal"},
+    ], user_id)
+    assert len(saved) == 4 and all(row.get("id") for row in saved), saved
+    assert await store.save_transaction({"date": today.isoformat(), "type": "sale", "amount": 9.75, "item": "soap"}, user_id)
+
+    assert _close(await store.get_total_balance(user_id), 120.50 - 20.25 + 80 + 9.75)
+    balance, recent = await store.get_user_transactions_summary(user_id, limit=2)
+    assert _close(balance, 190.0) and len(recent) == 2, (balance, recent)
+    assert recent[0]["item"] == "soap", recent
+    assert set(recent[0]) == {"transaction_date", "transaction_type", "amount", "item"}, recent[0]
+    assert await store.get_total_balance(f"{user_id}-nobody") == 0.0
+
+
+async def check_rollups(store, user_id: str):
+    today = date.today()
+    rollups = await store.get_daily_rollups(user_id, today - timedelta(days=6), today)
+    assert [str(rollup["rollup_date"]) for rollup in rollups] == [(today - timedelta(days=1)).isoformat(), today.isoformat()], rollups
+    todays = rollups[-1]
+    assert _close(todays["sales"], 130.25) and _close(todays["expenses"], 20.25) and _close(todays["purchases"], 40), todays
+    assert _close(todays["profit"], 130.25 - 20.25 - 40) and todays["txn_count"] == 4, todays
+
+    summary = await store.get_period_summary(user_id, today - timedelta(days=6), today)
+    assert _close(summary["sales"], 210.25) and summary["txn_count"] == 5, summary
+
+    total_sales, details = await store.get_daily_sales_summary(user_id, today, detail_limit=1)
+    assert _close(total_sales, 130.25) and len(details) == 1 and set(details[0]) == {"item", "amount"}, (total_sales, details)
+
+    # Recomputing from the ledger leaves trigger-maintained rollups unchanged
+    assert await store.recompute_daily_rollups(today) >= 1
+    assert await store.get_daily_rollups(user_id, today, today) == [todays]
+    assert isinstance(await store.ensure_transaction_partitions(), int)
+    assert [mismatch for mismatch in await store.reconcile_shop_balances(fix=False) if mismatch["shop_user_id"] == user_id] == []
+
+
+async def check_stock(store, user_id: str):
+    row = await store.update_stock_item(user_id, "rice", 2, "kg", 40.0)
+    assert _close(row["quantity"], 2) and row["unit"] == "kg" and row["version"] == 1, row
+
+    # A delta in grams is applied to the kg row
+    row = await store.update_stock_item(user_id, "rice", -500, "g")
+    assert _close(row["quantity"], 1.5) and row["version"] == 2 and _close(row["cost_price_per_unit"], 40.0), row
+
+    # Quantities never go below zero; a sale of an unknown item creates it at zero
+    row = await store.update_stock_item(user_id, "rice", -5, "kg")
+    assert _close(row["quantity"], 0), row
+    row = await store.update_stock_item(user_id, "salt", -3, "pcs")
+    assert _close(row["quantity"], 0) and row["version"] == 1, row
+
+    try:
+        await store.update_stock_item(user_id, "rice", 1, "kg", expected_version=1)
+        raise AssertionError("A stale expected_version was accepted")
+    except store.StockVersionConflict:
+        pass
+
+    rows = await store.apply_stock_deltas(user_id, [
+        {"item_name": "sugar", "quantity_delta": 5, "unit": "kg"},
+        {"item_name": "rice", "quantity_delta": 3, "unit": "kg", "expected_version": 3},
+        {"item_name": "sugar", "quantity_delta": -1, "unit": "kg"},
+    ])
+    assert [row["item_name"] for row in rows] == ["sugar", "rice", "sugar"], rows
+    assert _close(rows[1]["quantity"], 3) and _close(rows[2]["quantity"], 4), rows
+
+    # One conflicting delta rolls back the whole batch
+    try:
+        await store.apply_stock_deltas(user_id, [
+            {"item_name": "dal", "quantity_delta": 1, "unit": "kg"},
+            {"item_name": "rice", "quantity_delta": 1, "unit": "kg", "expected_version": 1},
+        ])
+        raise AssertionError("A stale expected_version was accepted in a batch")
+    except store.StockVersionConflict:
+        pass
+    levels = await store.get_stock_levels(user_id)
+    assert [row["item_name"] for row in levels] == ["rice", "salt", "sugar"], levels
+
+    # Concurrent deltas on one item are all applied
+    await asyncio.gather(*(store.update_stock_item(user_id, "sugar", 1, "kg") for _ in range(10)))
+    sugar = next(row for row in await store.get_stock_levels(user_id) if row["item_name"] == "sugar")
+    assert _close(sugar["quantity"], 14) and sugar["version"] == 12, sugar
+    store.invalidate_stock_cache(user_id)
+    assert isinstance(store.get_stock_cache_stats(), dict)
+
+    # Items at or below zero (the default threshold) are low stock
+    low_stock = await store.get_low_stock_items(user_id)
+    assert [row["item_name"] for row in low_stock] == ["salt"], low_stock
+    assert [row["item_name"] for row in (await store.get_low_stock_items_by_user()).get(user_id, [])] == ["salt"]
+
+    order = await store.save_order_confirmation(user_id, "salt", 10, "pcs", 2.0, "Sharma Traders")
+    assert order["status"] == "success" and _close(order["stock"]["quantity"], 10) and order["transaction"], order
+
+
+async def check_concurrent_stock(store, user_id: str, writers: int = 40, optimistic_writers: int = 8):
+    """No lost updates on one item: concurrent single and batched deltas, half of them from a second
+    event loop (webhook requests run on several), and read-modify-write writers that retry on a version conflict."""
+    start = await store.update_stock_item(user_id, "atta", 100, "kg", 30.0)
+    deltas = [(index % 7) - 3 + 0.5 for index in range(writers)]
+
+    async def _write(index: int):
+        if index % 2:
+            await store.update_stock_item(user_id, "atta", deltas[index], "kg")
+        else:
+            await store.apply_stock_deltas(user_id, [
+                {"item_name": "maida", "quantity_delta": 1, "unit": "kg"},
+                {"item_name": "atta", "quantity_delta": deltas[index], "unit": "kg"},
+            ])
+
+    async def _burst(indexes):
+        await asyncio.gather(*(_write(index) for index in indexes))
+
+    async def _optimistic_write():
+        for _ in range(50 * optimistic_writers):
+            row = next(row for row in await store.get_stock_levels(user_id) if row["item_name"] == "atta")
+            try:
+                return await store.update_stock_item(user_id, "atta", 1, "kg", expected_version=row["version"])
+            except store.StockVersionConflict:
+                store.invalidate_stock_cache(user_id)
+        raise AssertionError("An optimistic writer never got its update in")
+
+    await asyncio.gather(
+        _burst(range(0, writers, 2)),
+        asyncio.to_thread(asyncio.run, _burst(range(1, writers, 2))),
+        *(_optimistic_write() for _ in range(optimistic_writers)),
+    )
+    store.invalidate_stock_cache(user_id)
+    levels = {row["item_name"]: row for row in await store.get_stock_levels(user_id)}
+    atta = levels["atta"]
+    assert _close(atta["quantity"], 100 + sum(deltas) + optimistic_writers), (atta, 100 + sum(deltas) + optimistic_writers)
+    assert atta["version"] == start["version"] + writers + optimistic_writers, atta
+    assert _close(levels["maida"]["quantity"], (writers + 1) // 2), levels["maida"]
+
+    # A stale expected_version is rejected, alone or in a batch, and changes nothing
+    for stale_write in (
+        store.update_stock_item(user_id, "atta", 1, "kg", expected_version=start["version"]),
+        store.apply_stock_deltas(user_id, [{"item_name": "atta", "quantity_delta": 1, "unit": "kg", "expected_version": start["version"]}]),
+    ):
+        try:
+            await stale_write
+            raise AssertionError("A stale expected_version was accepted")
+        except store.StockVersionConflict:
+            pass
+    store.invalidate_stock_cache(user_id)
+    after = next(row for row in await store.get_stock_levels(user_id) if row["item_name"] == "atta")
+    assert _close(after["quantity"], atta["quantity"]) and after["version"] == atta["version"], after
+
+
+async def check_export_paging(store, user_id: str):
+    today = date.today()
+    # Several transactions share a date, so pages must break ties on id to not skip or repeat rows
+    transactions = [{"date": today - timedelta(days=offset % 3), "type": "sale", "amount": offset + 1, "item": f"item {offset}"} for offset in range(8)]
+    transactions.append({"date": today - timedelta(days=30), "type": "sale", "amount": 99, "item": "outside the range"})
+    await store.save_transactions_bulk(transactions, user_id)
+    for item_name in ("soap", "tea"):
+        for quantity in (5, -1, -1):
+            await store.update_stock_item(user_id, item_name, quantity, "pcs", 10.0 if quantity > 0 else None)
+
+    pages = [page async for page in store.iter_transaction_pages(user_id, today - timedelta(days=2), today, page_size=3)]
+    assert [len(page) for page in pages] == [3, 3, 2], pages
+    rows = [row for page in pages for row in page]
+    keys = [(str(row["transaction_date"]), row["id"]) for row in rows]
+    assert keys == sorted(keys) and len(set(keys)) == 8, keys
+
+    pages = [page async for page in store.iter_stock_movement_pages(user_id, today - timedelta(days=1), today, page_size=4)]
+    assert [len(page) for page in pages] == [4, 2], pages
+    movements = [row for page in pages for row in page]
+    assert [row["movement_type"] for row in movements if row["item_name"] == "tea"] == ["purchase", "sale", "sale"], movements
+    assert [page async for page in store.iter_stock_movement_pages(user_id, today - timedelta(days=5), today - timedelta(days=3))] == []
+
+
+async def check_stock_movements(store, user_id: str):
+    started_at = datetime.now(timezone.utc)
+    await store.update_stock_item(user_id, "ghee", 2, "kg", 500.0)
+    # 500 g at 0.6/g is 600/kg, so the average of 2 kg at 500 and 0.5 kg at 600 is 520
+    row = await store.update_stock_item(user_id, "ghee", 500, "g", 0.6)
+    assert _close(row["average_cost"], 520) and _close(row["cost_price_per_unit"], 0.6), row
+    row = await store.update_stock_item(user_id, "ghee", -1.5, "kg")
+    assert _close(row["quantity"], 1) and _close(row["average_cost"], 520), row
+    assert await store.take_stock_snapshots() >= 1
+    after_snapshot = datetime.now(timezone.utc)
+
+    await asyncio.sleep(0.01)
+    row = await store.update_stock_item(user_id, "ghee", 1, "kg", 640.0)
+    assert _close(row["quantity"], 2) and _close(row["average_cost"], 580), row
+    await store.apply_stock_deltas(user_id, [{"item_name": "ghee", "quantity_delta": -5, "unit": "kg", "movement_type": "adjustment"}])
+
+    # Snapshot plus the movements since reproduce the stock at each moment
+    before = await store.get_stock_as_of(user_id, started_at - timedelta(seconds=1))
+    assert before == [], before
+    at_snapshot = await store.get_stock_as_of(user_id, after_snapshot)
+    assert [(row["item_name"], round(float(row["quantity"]), 2)) for row in at_snapshot] == [("ghee", 1.0)], at_snapshot
+    now = await store.get_stock_as_of(user_id, datetime.now(timezone.utc) + timedelta(seconds=1))
+    assert _close(now[0]["quantity"], 0) and _close(now[0]["average_cost"], 580), now
+
+
+async def check_shops(store, user_ids: list[str]):
+    for user_id in user_ids:
+        await store.save_transaction({"date": date.today(), "type": "sale", "amount": 1, "item": "pen"}, user_id)
+    shop = await store.get_shop(user_ids[0])
+    assert shop["status"] == "active" and shop["language"] is None, shop
+    assert (await store.update_shop(user_ids[0], language="hi", latitude=28.6, longitude=77.2))["language"] == "hi"
+    assert (await store.get_shop(user_ids[0]))["language"] == "hi"
+    await store.update_shop(user_ids[1], status="paused")
+    assert await store.get_shop(f"{user_ids[0]}-nobody") is None
+    try:
+        await store.update_shop(user_ids[0], owner="someone")
+        raise AssertionError("An unknown shop field was accepted")
+    except ValueError:
+        pass
+
+    # Paging with a small page size sees every active shop exactly once
+    paged = [shop["user_id"] async for shop in store.iter_active_shops(page_size=2)]
+    assert len(paged) == len(set(paged)), paged
+    assert set(user_ids) - set(paged) == {user_ids[1]}, paged
+    assert set(user_ids) - set(await store.get_all_unique_user_ids_with_stock()) == {user_ids[1]}
+
+
+async def check_owner_rollup(store, owner_id: str, outlet_ids: list[str]):
+    today = date.today()
+    for number, user_id in enumerate([owner_id, *outlet_ids], start=1):
+        await store.save_transactions_bulk([
+            {"date": today, "type": "sale", "amount": 100 * number, "item": "rice"},
+            {"date": today - timedelta(days=1), "type": "expense", "amount": 10, "item": "tea"},
+        ], user_id)
+    await store.update_stock_item(outlet_ids[0], "salt", -1, "pcs")
+    assert await store.get_owner_shops(owner_id) == [] and (await store.get_owner_rollup(owner_id, today, today))["shops"] == []
+
+    for user_id in outlet_ids:
+        assert await store.link_owner_shop(owner_id, user_id)
+    assert await store.get_owner_shops(owner_id) == sorted([owner_id, *outlet_ids])
+    rollup = await store.get_owner_rollup(owner_id, today, today)
+    assert [shop["user_id"] for shop in rollup["shops"]] == sorted([owner_id, *outlet_ids]), rollup
+    assert _close(rollup["sales"], 600) and _close(rollup["balance"], 570) and rollup["txn_count"] == 3, rollup
+    week = await store.get_owner_rollup(owner_id, today - timedelta(days=6), today)
+    assert _close(week["expenses"], 30) and week["txn_count"] == 6, week
+    low_stock = await store.get_owner_low_stock_items(owner_id)
+    assert {user_id: [item["item_name"] for item in items] for user_id, items in low_stock.items()} == {outlet_ids[0]: ["salt"]}, low_stock
+
+    # An outlet is not an owner itself, and leaves the roll-up when unlinked
+    assert (await store.get_owner_rollup(outlet_ids[0], today, today))["shops"] == []
+    assert await store.unlink_owner_shop(outlet_ids[1]) == owner_id
+    assert await store.unlink_owner_shop(outlet_ids[1]) is None
+    assert _close((await store.get_owner_rollup(owner_id, today, today))["sales"], 300)
+
+
+async def check_bill_hashes(store, user_id: str):
+    hashes = [1, (1 << 63) + 5, (1 << 64) - 1]
+    for image_hash in hashes:
+        assert await store.save_bill_image_hash(user_id, image_hash)
+    assert await store.save_bill_image_hash(user_id, hashes[1])  # Saving twice is not an error
+    assert sorted(row["image_hash"] for row in await store.get_bill_image_hashes(user_id)) == hashes
+    # The 256-bit detail hash round-trips, and two bills sharing an image hash keep both detail hashes
+    detail_hash = (1 << 256) - 3
+    assert await store.save_bill_image_hash(user_id, hashes[0], 7)
+    assert await store.save_bill_image_hash(user_id, hashes[0], detail_hash)
+    assert await store.save_bill_image_hash(user_id, hashes[0], 7)
+    stored = sorted((row["image_hash"], row["detail_hash"] or 0) for row in await store.get_bill_image_hashes(user_id))
+    assert stored == [(hashes[0], 0), (hashes[0], 7), (hashes[0], detail_hash), (hashes[1], 0), (hashes[2], 0)], stored
+
+
+async def check_ledger_replay(store, user_id: str):
+    entry = {
+        "entry_id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "stock_deltas": [{"item_name": "oil", "quantity_delta": 4, "unit": "l"}],
+        "transactions": [{
+            "id": str(uuid.uuid4()), "date": date.today().isoformat(), "type": "sale", "amount": 55.5, "item": "oil (1 l)", "client_txn_id": str(uuid.uuid4()),
+            "lines": [{"item_name": "oil", "quantity": 1, "unit": "l", "unit_price": 55.5, "amount": 55.5, "cost": 50}],
+        }],
+    }
+    # A replay after a lost acknowledgement, and a batch holding the same entry twice, apply it once
+    await asyncio.to_thread(store.apply_ledger_entries, [entry])
+    await asyncio.to_thread(store.apply_ledger_entries, [entry, entry])
+    assert _close(await store.get_total_balance(user_id), 55.5)
+    _, recent = await store.get_user_transactions_summary(user_id)
+    assert len(recent) == 1, recent
+    store.invalidate_stock_cache(user_id)
+    assert [(row["item_name"], row["quantity"]) for row in await store.get_stock_levels(user_id)] == [("oil", 4)]
+    item_sales = await store.get_item_sales(user_id, date.today(), date.today())
+    assert [(row["item_name"], row["line_count"]) for row in item_sales] == [("oil", 1)], item_sales
+
+
+async def check_import(store, user_id: str):
+    day = date.today() - timedelta(days=400)
+    await store.ensure_transaction_partitions(from_date=day)
+    rows = [
+        {"id": str(uuid.uuid4()), "client_txn_id": f"import:{user_id}:1", "date": day.isoformat(), "type": "sale", "amount": 80, "item": "dal (1 kg)",
+         "lines": [{"item_name": "dal", "quantity": 1, "unit": "kg", "unit_price": 80, "amount": 80, "cost": None}]},
+        {"id": str(uuid.uuid4()), "client_txn_id": f"import:{user_id}:2", "date": day.isoformat(), "type": "expense", "amount": 30, "item": "tea"},
+    ]
+    # A resumed import re-sends the chunk that was in flight; it is stored once
+    assert await store.import_transactions(user_id, rows) == 2
+    assert await store.import_transactions(user_id, rows) == 2
+    assert _close(await store.get_total_balance(user_id), 50)
+    rollups = await store.get_daily_rollups(user_id, day, day)
+    assert len(rollups) == 1 and _close(rollups[0]["sales"], 80) and rollups[0]["txn_count"] == 2, rollups
+    item_sales = await store.get_item_sales(user_id, day, day)
+    assert [(row["item_name"], row["line_count"]) for row in item_sales] == [("dal", 1)], item_sales
+
+
+async def check_transaction_lines(store, user_id: str):
+    today = date.today()
+    sales = [
+        {"date": today, "type": "sale", "amount": 120, "item": "rice (2 kg)",
+         "lines": [{"item_name": "rice", "quantity": 2, "unit": "kg", "unit_price": 60, "amount": 120, "cost": 90}]},
+        {"date": today, "type": "sale", "amount": 65, "item": "rice (1 kg)",
+         "lines": [{"item_name": "rice", "quantity": 1, "unit": "kg", "unit_price": 65, "amount": 65, "cost": 45}]},
+        {"date": today, "type": "sale", "amount": 30, "item": "salt (1 kg)",
+         "lines": [{"item_name": "salt", "quantity": 1, "unit": "kg", "unit_price": 30, "amount": 30, "cost": None}]},
+        {"date": today - timedelta(days=40), "type": "sale", "amount": 500, "item": "rice (10 kg)",
+         "lines": [{"item_name": "rice", "quantity": 10, "unit": "kg", "unit_price": 50, "amount": 500, "cost": 400}]},
+        {"date": today, "type": "expense", "amount": 300, "item": "Stock purchase (2 items)",
+         "lines": [{"item_name": "rice", "quantity": 5, "unit": "kg", "unit_price": 40, "amount": 200, "cost": 200},
+                   {"item_name": "salt", "quantity": 5, "unit": "kg", "unit_price": 20, "amount": 100, "cost": 100}]},
+        {"date": today, "type": "expense", "amount": 40, "item": "tea"},
+    ]
+    saved = await store.save_transactions_bulk(sales, user_id)
+    assert len(saved) == len(sales) and all("lines" not in row for row in saved), saved
+
+    # Purchase lines and sales outside the range are not counted; salt has no known cost, so no margin
+    item_sales = await store.get_item_sales(user_id, today - timedelta(days=6), today)
+    assert [row["item_name"] for row in item_sales] == ["rice", "salt"], item_sales
+    rice, salt = item_sales
+    assert _close(rice["quantity"], 3) and _close(rice["sales"], 185) and _close(rice["cost"], 135) and _close(rice["margin"], 50), rice
+    assert rice["line_count"] == 2 and rice["unit"] == "kg", rice
+    assert _close(salt["sales"], 30) and salt["cost"] is None and salt["margin"] is None, salt
+    only_salt = await store.get_item_sales(user_id, today - timedelta(days=6), today, item_name="salt")
+    assert [row["item_name"] for row in only_salt] == ["salt"], only_salt
+
+
+async def check_item_search(store, user_id: str):
+    today = date.today()
+    rows = [
+        {"date": today - timedelta(days=3), "type": "sale", "amount": 50, "item": "Parle-G (10 pcs)",
+         "lines": [{"item_name": "Parle-G", "quantity": 10, "unit": "pcs", "unit_price": 5, "amount": 50, "cost": 40}]},
+        {"date": today - timedelta(days=1), "type": "sale", "amount": 25, "item": "Parle-G (5 pcs)",
+         "lines": [{"item_name": "Parle-G", "quantity": 5, "unit": "pcs", "unit_price": 5, "amount": 25, "cost": 20}]},
+        {"date": today - timedelta(days=2), "type": "expense", "amount": 1040, "item": "Stock purchase (1 items)",
+         "lines": [{"item_name": "देसी घी", "quantity": 2, "unit": "kg", "unit_price": 520, "amount": 1040, "cost": 1040}]},
+        {"date": today - timedelta(days=200), "type": "expense", "amount": 500, "item": "देसी घी",
+         "lines": [{"item_name": "देसी घी", "quantity": 1, "unit": "kg", "unit_price": 500, "amount": 500, "cost": 500}]},
+        {"date": today, "type": "expense", "amount": 1500, "item": "electricity bill"},
+        {"date": today, "type": "sale", "amount": 30, "item": "salt (1 kg)",
+         "lines": [{"item_name": "salt", "quantity": 1, "unit": "kg", "unit_price": 30, "amount": 30, "cost": None}]},
+    ]
+    await store.save_transactions_bulk(rows, user_id)
+    week_ago = today - timedelta(days=6)
+
+    # A typo still finds the item; totals and the last entry cover the period
+    found = await store.search_item_history(user_id, ["parleg"], week_ago, today)
+    assert [(row["item_name"], row["kind"]) for row in found] == [("Parle-G", "sale")], found
+    parle = found[0]
+    assert _close(parle["quantity"], 15) and _close(parle["amount"], 75) and parle["entry_count"] == 2, parle
+    assert str(parle["last_date"]) == (today - timedelta(days=1)).isoformat() and _close(parle["last_quantity"], 5), parle
+
+    # Devanagari terms match a word of the name; the purchase 200 days ago is outside the week
+    ghee = await store.search_item_history(user_id, ["घी"], week_ago, today, kind="purchase")
+    assert [(row["item_name"], row["entry_count"]) for row in ghee] == [("देसी घी", 1)], ghee
+    assert _close(ghee[0]["amount"], 1040) and ghee[0]["unit"] == "kg", ghee
+    assert await store.search_item_history(user_id, ["घी"], week_ago, today, kind="sale") == []
+    year = await store.search_item_history(user_id, ["ghee", "घी"], today - timedelta(days=365), today)
+    assert [(row["item_name"], row["entry_count"]) for row in year] == [("देसी घी", 2)], year
+
+    # Expenses without lines are matched on their description
+    electricity = await store.search_item_history(user_id, ["electricity"], week_ago, today)
+    assert [(row["item_name"], row["kind"]) for row in electricity] == [("electricity bill", "expense")], electricity
+    assert electricity[0]["quantity"] is None and _close(electricity[0]["last_amount"], 1500), electricity
+    assert await store.search_item_history(user_id, ["sugar"], week_ago, today) == []
+
+
+async def check_archive(store, user_id: str):
+    # Archives at the production horizon, so on a shared database it does what the monthly job would
+    horizon = archive_horizon()
+    old_day, today = horizon - timedelta(days=40), date.today()
+    await store.ensure_transaction_partitions(from_date=old_day)
+    rows = [
+        {"id": str(uuid.uuid4()), "client_txn_id": f"archive:{user_id}:1", "date": old_day.isoformat(), "type": "sale", "amount": 90, "item": "kesar (2 g)",
+         "lines": [{"item_name": "kesar", "quantity": 2, "unit": "g", "unit_price": 45, "amount": 90, "cost": None}]},
+        {"id": str(uuid.uuid4()), "client_txn_id": f"archive:{user_id}:2", "date": old_day.isoformat(), "type": "expense", "amount": 25, "item": "diesel"},
+        {"id": str(uuid.uuid4()), "client_txn_id": f"archive:{user_id}:3", "date": today.isoformat(), "type": "sale", "amount": 50, "item": "kesar (1 g)",
+         "lines": [{"item_name": "kesar", "quantity": 1, "unit": "g", "unit_price": 50, "amount": 50, "cost": None}]},
+    ]
+    assert await store.import_transactions(user_id, rows) == 3
+
+    archived = await store.archive_transactions(horizon)
+    assert any(str(month["archived_month"])[:7] == old_day.isoformat()[:7] for month in archived), archived
+    assert await store.archive_transactions(horizon) == []
+
+    # Balances and rollups still cover the archived month; reconciliation counts it through archived_balances
+    assert _close(await store.get_total_balance(user_id), 115)
+    rollups = await store.get_daily_rollups(user_id, old_day, old_day)
+    assert len(rollups) == 1 and _close(rollups[0]["sales"], 90) and rollups[0]["txn_count"] == 2, rollups
+    assert all(mismatch["shop_user_id"] != user_id for mismatch in await store.reconcile_shop_balances(fix=False))
+
+    # Hot reads no longer see it; exports and search include it when asked
+    hot = [row async for page in store.iter_transaction_pages(user_id, old_day, today) for row in page]
+    assert [row["amount"] for row in hot] == [50], hot
+    everything = [row async for page in store.iter_transaction_pages(user_id, old_day, today, include_archive=True) for row in page]
+    assert [str(row["transaction_date"]) for row in everything] == [old_day.isoformat()] * 2 + [today.isoformat()], everything
+    assert [row["item_name"] for row in await store.search_item_history(user_id, ["diesel"], old_day, today)] == []
+    kesar = await store.search_item_history(user_id, ["kesar"], old_day, today, include_archive=True)
+    assert [(row["item_name"], row["kind"], row["entry_count"]) for row in kesar] == [("kesar", "sale", 2)], kesar
+    assert _close(kesar[0]["quantity"], 3) and _close(kesar[0]["amount"], 140) and str(kesar[0]["last_date"]) == today.isoformat(), kesar
+    diesel = await store.search_item_history(user_id, ["diesel"], old_day, today, include_archive=True)
+    assert [(row["item_name"], row["kind"], row["amount"]) for row in diesel] == [("diesel", "expense", 25)], diesel
+
+    # History imported later for the archived month joins it on the next run; rows already archived are skipped
+    await store.ensure_transaction_partitions(from_date=old_day)
+    late_rows = [
+        rows[0],
+        {"id": str(uuid.uuid4()), "client_txn_id": f"archive:{user_id}:4", "date": old_day.isoformat(), "type": "sale", "amount": 10, "item": "kesar (1 g)",
+         "lines": [{"item_name": "kesar", "quantity": 1, "unit": "g", "unit_price": 10, "amount": 10, "cost": None}]},
+    ]
+    await store.import_transactions(user_id, late_rows)
+    assert _close(await store.get_total_balance(user_id), 125)
+    archived = await store.archive_transactions(horizon)
+    assert [month["transaction_count"] for month in archived if str(month["archived_month"])[:7] == old_day.isoformat()[:7]] == [1], archived
+    hot = [row async for page in store.iter_transaction_pages(user_id, old_day, today) for row in page]
+    assert [row["amount"] for row in hot] == [50], hot
+    everything = [row async for page in store.iter_transaction_pages(user_id, old_day, today, include_archive=True) for row in page]
+    assert sorted(float(row["amount"]) for row in everything) == [10, 25, 50, 90], everything
+    assert _close(await store.get_total_balance(user_id), 125)
+    rollups = await store.get_daily_rollups(user_id, old_day, old_day)
+    assert len(rollups) == 1 and _close(rollups[0]["sales"], 100) and rollups[0]["txn_count"] == 3, rollups
+    assert all(mismatch["shop_user_id"] != user_id for mismatch in await store.reconcile_shop_balances(fix=False))
+    kesar = await store.search_item_history(user_id, ["kesar"], old_day, today, include_archive=True)
+    assert [row["entry_count"] for row in kesar] == [3], kesar
+
+
+async def benchmark_bill_ingestion(store, user_id: str, item_counts=(5, 25, 100), rounds: int = 5) -> list[dict]:
+    """Times recording a bill of N items as N update_stock_item calls vs one apply_stock_deltas call (median of `rounds`)."""
+    results = []
+    for item_count in item_counts:
+        per_item_timings, bulk_timings = [], []
+        for round_number in range(rounds):
+            deltas = [{"item_name": f"bench-{item_count}-{round_number}-{index}", "quantity_delta": 1, "unit": "pcs", "cost_price_per_unit": 10.0}
+                      for index in range(item_count)]
+            # Both modes add the same items to stock that already holds them, as a repeat supplier's bill does
+            await store.apply_stock_deltas(user_id, deltas)
+            started_at = time.perf_counter()
+            for delta in deltas:
+                await store.update_stock_item(user_id, delta["item_name"], delta["quantity_delta"], delta["unit"], delta["cost_price_per_unit"])
+            per_item_timings.append(time.perf_counter() - started_at)
+            started_at = time.perf_counter()
+            await store.apply_stock_deltas(user_id, deltas)
+            bulk_timings.append(time.perf_counter() - started_at)
+        per_item_ms = sorted(per_item_timings)[rounds // 2] * 1000
+        bulk_ms = sorted(bulk_timings)[rounds // 2] * 1000
+        results.append({"items": item_count, "per_item_ms": round(per_item_ms, 2), "bulk_ms": round(bulk_ms, 2), "speedup": round(per_item_ms / bulk_ms, 1)})
+    return results
+
+
+async def run(store):
+    run_id = uuid.uuid4().hex[:8]
+    checks = [
+        ("interface", check_interface(store)),
+        ("transactions and balance", check_transactions_and_balance(store, f"conformance:{run_id}:ledger")),
+        ("daily rollups", check_rollups(store, f"conformance:{run_id}:ledger")),
+        ("stock", check_stock(store, f"conformance:{run_id}:stock")),
+        ("concurrent stock", check_concurrent_stock(store, f"conformance:{run_id}:concurrency")),
+        ("import", check_import(store, f"conformance:{run_id}:import")),
+        ("transaction lines", check_transaction_lines(store, f"conformance:{run_id}:lines")),
+        ("item search", check_item_search(store, f"conformance:{run_id}:search")),
+        ("archive", check_archive(store, f"conformance:{run_id}:archive")),
+        ("export paging", check_export_paging(store, f"conformance:{run_id}:export")),
+        ("stock movements", check_stock_movements(store, f"conformance:{run_id}:movements")),
+        ("shops", check_shops(store, [f"conformance:{run_id}:shop-{number}" for number in range(5)])),
+        ("owner roll-up", check_owner_rollup(store, f"conformance:{run_id}:owner", [f"conformance:{run_id}:outlet-{number}" for number in range(2)])),
+        ("bill hashes", check_bill_hashes(store, f"conformance:{run_id}:bills")),
+        ("ledger replay", check_ledger_replay(store, f"conformance:{run_id}:replay")),
+    ]
+    for name, check in checks:
+        started_at = time.perf_counter()
+        await check
+        print(f"ok    {name} ({(time.perf_counter() - started_at) * 1000:.0f} ms)")
+
+
+if __name__ == "__main__":
+    store = load_backend(STORAGE_BACKEND)
+    asyncio.run(run(store))
+    print(f"All checks passed on the {STORAGE_BACKEND} backend.")
+    if "--benchmark" in sys.argv:
+        for result in asyncio.run(benchmark_bill_ingestion(store, f"conformance:{uuid.uuid4().hex[:8]}:benchmark")):
+            print(f"{result['items']:>3} items: per-item {result['per_item_ms']:.1f} ms, bulk {result['bulk_ms']:.1f} ms ({result['speedup']}x)")
+    print(f"Query metrics: {store.get_query_metrics()['queries']}")
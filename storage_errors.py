@@ -0,0 +1,11 @@
+# Exceptions shared by every storage backend, so callers can catch them whichever backend is configured.
+
+
+class StockVersionConflict(Exception):
+    """Raised when a stock row changed since the caller read it (optimistic concurrency check failed)."""
+    pass
+
+
+class QueryTimeout(Exception):
+    """Raised when a query does not finish within its timeout."""
+    pass
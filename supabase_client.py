@@ -1,126 +1,148 @@
 import os
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from datetime import datetime, timezone, date
+from datetime import datetime, timezone, date, timedelta
 import asyncio # Import asyncio
+import uuid
+
+from db_pool import create_pool
+from stock_cache import StockCache
+from storage_errors import QueryTimeout, StockVersionConflict
+from transaction_writer import create_writer
 
 load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Supabase URL and Key must be set in the .env file")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-__all__ = ['save_transaction', 'get_user_transactions_summary', 'update_stock_item', 'get_stock_levels', 'get_daily_sales_summary', 'get_low_stock_items', 'save_order_confirmation']
-
-# --- Unit Conversion Helpers (Centralized in Supabase Client) ---
-def _convert_to_base_unit(value: float, unit: str) -> float:
-    """Converts a quantity to a common base unit (grams for weight, milliliters for volume) for internal consistency."""
-    unit_lower = unit.lower()
-    if unit_lower == 'kg':
-        return value * 1000.0
-    elif unit_lower == 'g':
-        return value
-    # Add more unit conversions as needed (e.g., litres to ml)
-    return value # For pcs, packets, etc., no conversion, treat as base
+# Every query runs on a native async client with a bounded number of queries in flight (see db_pool.py).
+# The client connects on first use, so a missing SUPABASE_URL/KEY only fails when a query is made.
+db = create_pool(SUPABASE_URL, SUPABASE_KEY)
+
+__all__ = ['save_transaction', 'get_user_transactions_summary', 'get_total_balance', 'reconcile_shop_balances', 'update_stock_item', 'get_stock_levels', 'invalidate_stock_cache', 'get_stock_cache_stats', 'get_daily_sales_summary', 'get_daily_rollups', 'get_period_summary', 'recompute_daily_rollups', 'ensure_transaction_partitions', 'archive_transactions', 'get_low_stock_items', 'get_low_stock_items_by_user', 'get_owner_shops', 'link_owner_shop', 'unlink_owner_shop', 'get_owner_rollup', 'get_owner_low_stock_items', 'save_order_confirmation', 'StockVersionConflict', 'apply_stock_deltas', 'save_transactions_bulk', 'get_transaction_writer_metrics', 'get_bill_image_hashes', 'save_bill_image_hash', 'get_all_unique_user_ids_with_stock', 'iter_active_shops', 'get_shop', 'update_shop', 'get_query_metrics', 'QueryTimeout', 'apply_ledger_entries', 'get_stock_as_of', 'take_stock_snapshots', 'get_item_sales', 'search_item_history', 'iter_transaction_pages', 'iter_stock_movement_pages', 'import_transactions']
+
+def _transaction_row(transaction_data: dict, user_id: str) -> dict:
+    """Maps extracted transaction data onto a `transactions` row."""
+    # Ensure the date is in 'YYYY-MM-DD' format if not already
+    transaction_date = transaction_data.get("date")
+    if transaction_date is not None and not isinstance(transaction_date, str):
+        transaction_date = transaction_date.strftime('%Y-%m-%d')
+    return {
+        # Assigned here rather than by the database so the transaction's lines can reference it
+        "id": transaction_data.get("id") or str(uuid.uuid4()),
+        "transaction_date": transaction_date,
+        "transaction_type": transaction_data.get("type"),
+        "amount": transaction_data.get("amount"),
+        "item": transaction_data.get("item"),
+        "user_id": user_id, # New: Save user_id
+        "lines": transaction_data.get("lines") or [],
+    }
 
-def _convert_from_base_unit(value_in_base: float, target_unit: str) -> float:
-    """Converts a quantity from the base unit back to the target unit."""
-    target_unit_lower = target_unit.lower()
-    if target_unit_lower == 'kg':
-        return value_in_base / 1000.0
-    elif target_unit_lower == 'g':
-        return value_in_base
-    # Add more unit conversions as needed
-    return value_in_base # For pcs, packets, etc., no conversion
+def _split_transaction_lines(rows: list[dict]) -> tuple[list[dict], list[dict]]:
+    """Separates `transactions` rows from their `transaction_lines` rows."""
+    transaction_rows, line_rows = [], []
+    for row in rows:
+        transaction_row = {key: value for key, value in row.items() if key != "lines"}
+        transaction_rows.append(transaction_row)
+        for line_no, line in enumerate(row.get("lines") or [], start=1):
+            line_rows.append({
+                "transaction_id": transaction_row["id"],
+                "line_no": line_no,
+                "user_id": transaction_row["user_id"],
+                "transaction_date": transaction_row["transaction_date"],
+                "transaction_type": transaction_row["transaction_type"],
+                "item_name": line["item_name"],
+                "quantity": line.get("quantity"),
+                "unit": line.get("unit"),
+                "unit_price": line.get("unit_price"),
+                "amount": line.get("amount"),
+                "cost": line.get("cost"),
+            })
+    return transaction_rows, line_rows
+
+def _insert_transaction_rows(rows: list[dict]) -> list[dict]:
+    """Inserts transaction rows, then all their lines, as two multi-row inserts. Runs on the transaction writer thread."""
+    transaction_rows, line_rows = _split_transaction_lines(rows)
+    response = db.execute_sync("insert_transactions", lambda client: client.table("transactions").insert(transaction_rows))
+    if line_rows:
+        db.execute_sync("insert_transaction_lines", lambda client: client.table("transaction_lines").insert(line_rows))
+    return response.data
+
+# Transaction inserts from concurrent requests are coalesced into multi-row inserts
+transaction_writer = create_writer(_insert_transaction_rows, "transactions")
+
+async def save_transactions_bulk(transactions: list[dict], user_id: str, durable: bool = True) -> list[dict]:
+    """
+    Saves several transactions for a user as a single multi-row insert.
 
-# --- End Unit Conversion Helpers ---
+    With durable=True (the default) this waits until the rows are committed and returns them;
+    with durable=False it returns as soon as they are queued on the coalescing writer.
+    """
+    if not transactions:
+        return []
+    try:
+        saved_rows = await transaction_writer.write([_transaction_row(transaction_data, user_id) for transaction_data in transactions], durable=durable)
+        print(f"{len(transactions)} transactions saved successfully:", saved_rows)
+        return saved_rows
+    except Exception as e:
+        print(f"Error saving transactions to Supabase: {e}")
+        return []
 
-async def save_transaction(transaction_data: dict, user_id: str) -> dict:
+async def save_transaction(transaction_data: dict, user_id: str, durable: bool = True) -> dict:
     """
     Saves the extracted transaction data to the Supabase database for a specific user.
+    The insert is coalesced with concurrent writes from other requests (see `save_transactions_bulk`).
     """
-    try:
-        # Ensure the date is in 'YYYY-MM-DD' format if not already
-        if 'date' in transaction_data and not isinstance(transaction_data['date'], str):
-            transaction_data['date'] = transaction_data['date'].strftime('%Y-%m-%d')
-
-        response = await asyncio.to_thread(supabase.table("transactions").insert({
-            "transaction_date": transaction_data.get("date"),
-            "transaction_type": transaction_data.get("type"),
-            "amount": transaction_data.get("amount"),
-            "item": transaction_data.get("item"),
-            "user_id": user_id # New: Save user_id
-        }).execute)
-        print("Transaction saved successfully:", response.data)
-        return response.data
-    except Exception as e:
-        print(f"Error saving transaction to Supabase: {e}")
-        return {}
+    return await save_transactions_bulk([transaction_data], user_id, durable=durable)
+
+def get_transaction_writer_metrics() -> dict:
+    """Batch size and flush latency metrics of the coalescing transaction writer."""
+    return transaction_writer.metrics()
+
+def get_query_metrics() -> dict:
+    """Per-query latency histograms and occupancy of the query pool."""
+    return db.metrics()
 
-def get_total_balance(user_id: str) -> float:
+async def _read_shop_balance(user_id: str) -> float:
+    """Reads the running balance kept in `shop_balances` by the transactions insert trigger."""
+    response = await db.execute("shop_balance", lambda client: client.table("shop_balances").select("balance").eq("user_id", user_id).limit(1))
+    if response.data:
+        return float(response.data[0]["balance"])
+    return 0.0  # No transactions recorded yet
+
+async def get_total_balance(user_id: str) -> float:
     """
-    Calculates the total balance from the 'transactions' table for a specific user.
-    Sales are added, expenses are subtracted.
+    Returns the total balance for a specific user (sales minus expenses).
+    This is a single-row read of the `shop_balances` aggregate, not a scan of the ledger.
     """
     try:
-        response = supabase.table("transactions").select("transaction_type, amount").eq("user_id", user_id).execute()
-        
-        total_balance = 0.0
-        if response.data:
-            for record in response.data:
-                amount = float(record["amount"])
-                if record["transaction_type"].lower() == "sale":
-                    total_balance += amount
-                elif record["transaction_type"].lower() == "expense":
-                    total_balance -= amount
-        
-        print(f"Total balance calculated for user {user_id}: {total_balance}")
+        total_balance = await _read_shop_balance(user_id)
+        print(f"Total balance for user {user_id}: {total_balance}")
         return total_balance
     except Exception as e:
         print(f"Error fetching total balance from Supabase: {e}")
         return 0.0
 
-def get_user_transactions_summary(user_id: str, limit: int = 5) -> tuple[float, list[dict]]:
+async def get_user_transactions_summary(user_id: str, limit: int = 5) -> tuple[float, list[dict]]:
     """
-    Calculates the total balance and fetches a summary of recent transactions for a specific user.
+    Fetches the total balance and a summary of recent transactions for a specific user.
     Sales are added, expenses are subtracted.
     Returns a tuple: (total_balance, recent_transactions_list)
     """
     try:
-        response = supabase.table("transactions") \
-                           .select("transaction_date, transaction_type, amount, item") \
-                           .eq("user_id", user_id) \
-                           .order("created_at", desc=True) \
-                           .limit(limit) \
-                           .execute()
-        
-        total_balance = 0.0
-        recent_transactions = []
+        total_balance, response = await asyncio.gather(
+            _read_shop_balance(user_id),
+            db.execute("recent_transactions", lambda client: client.table("transactions") \
+                                                            .select("transaction_date, transaction_type, amount, item") \
+                                                            .eq("user_id", user_id) \
+                                                            .order("created_at", desc=True) \
+                                                            .limit(limit)),
+        )
 
-        # Fetch all transactions to calculate total balance
-        all_transactions_response = supabase.table("transactions") \
-                                        .select("transaction_type, amount") \
-                                        .eq("user_id", user_id) \
-                                        .execute()
-
-        if all_transactions_response.data:
-            for record in all_transactions_response.data:
-                amount = float(record["amount"])
-                if record["transaction_type"].lower() == "sale":
-                    total_balance += amount
-                elif record["transaction_type"].lower() == "expense":
-                    total_balance -= amount
-
-        # Process recent transactions for summary
-        if response.data:
-            for record in response.data:
-                # Format date to YYYY-MM-DD for consistency
-                record["transaction_date"] = record["transaction_date"].split('T')[0] # Assuming date comes with time
-                recent_transactions.append(record)
+        recent_transactions = []
+        for record in response.data or []:
+            # Format date to YYYY-MM-DD for consistency
+            record["transaction_date"] = record["transaction_date"].split('T')[0] # Assuming date comes with time
+            recent_transactions.append(record)
         
         print(f"Summary for user {user_id}: Total balance {total_balance}, {len(recent_transactions)} recent transactions.")
         return total_balance, recent_transactions
@@ -128,11 +150,34 @@ def get_user_transactions_summary(user_id: str, limit: int = 5) -> tuple[float,
         print(f"Error fetching transaction summary from Supabase: {e}")
         return 0.0, []
 
+async def reconcile_shop_balances(fix: bool = True) -> list[dict]:
+    """
+    Verifies every shop's running balance against the transactions ledger.
+    Returns the shops whose aggregate had drifted; with fix=True they are also corrected.
+    """
+    try:
+        # Scans the whole ledger, so it gets a far longer timeout than interactive queries
+        response = await db.execute("reconcile_shop_balances", lambda client: client.rpc('reconcile_shop_balances', {'p_fix': fix}), timeout=300)
+        mismatches = response.data or []
+        for mismatch in mismatches:
+            print(f"ERROR_BALANCE: Shop {mismatch['shop_user_id']} balance {mismatch['stored_balance']} "
+                  f"({mismatch['stored_transaction_count']} txns) != ledger {mismatch['ledger_balance']} "
+                  f"({mismatch['ledger_transaction_count']} txns){', corrected' if fix else ''}.")
+        print(f"DEBUG_BALANCE: Reconciliation finished, {len(mismatches)} shop(s) out of sync.")
+        return mismatches
+    except Exception as e:
+        print(f"Error reconciling shop balances in Supabase: {e}")
+        return []
+
 
 # New functions for stock management
 
-async def update_stock_item(user_id: str, item_name: str, quantity_delta: float, unit: str = "pcs", cost_price_per_unit: float | None = None) -> dict:
+async def update_stock_item(user_id: str, item_name: str, quantity_delta: float, unit: str = "pcs", cost_price_per_unit: float | None = None, expected_version: int | None = None) -> dict:
     """Updates or inserts a stock item for a user, handling fractional quantities and units.
+
+    The whole read-modify-write happens server-side in the `apply_stock_delta` Postgres
+    function (see supabase_schema.sql), so this is a single round trip and concurrent
+    updates to the same item cannot overwrite each other.
     
     Args:
         user_id: The WhatsApp sender ID.
@@ -140,129 +185,459 @@ async def update_stock_item(user_id: str, item_name: str, quantity_delta: float,
         quantity_delta: The amount to add or subtract from the stock quantity. Positive for purchase, negative for sale.
         unit: The unit of the quantity (e.g., kg, g, dozen, pcs). This is the unit of `quantity_delta`.
         cost_price_per_unit: The cost price per unit of the item (optional).
+        expected_version: The `version` the caller last saw for this row (optional). If the row
+            has changed since, StockVersionConflict is raised and nothing is written.
 
     Returns:
         The updated or newly created stock item record.
     """
-    quantity_delta = float(quantity_delta)
-
-    # Try to find an existing item with the same user_id, item_name, and unit
-    # It's crucial to search by item_name and the *stored* unit to ensure consistency.
-    print(f"Searching for existing item: user_id={user_id}, item_name={item_name}")
-    response = await asyncio.to_thread(supabase.from_('stock_items').select('*').eq('user_id', user_id).eq('item_name', item_name).execute)
-    print(f"Supabase search response: {response.data}")
-    existing_item = None
-    # Find the best matching item, prioritizing exact unit match
-    for item in response.data:
-        if item['unit'].lower() == unit.lower(): # Exact unit match
-            existing_item = item
-            break
-    if existing_item is None and response.data: # Fallback to first item if unit doesn't match (should be rare with good data extraction)
-        existing_item = response.data[0]
-        print(f"DEBUG_STOCK: No exact unit match for '{unit}' for item '{item_name}'. Using existing item with unit '{existing_item['unit']}'.")
-
-    if existing_item:
-        # Convert existing quantity to base unit
-        existing_quantity_in_base = _convert_to_base_unit(existing_item['quantity'], existing_item['unit'])
-        # Convert incoming delta to base unit
-        delt_in_base = _convert_to_base_unit(quantity_delta, unit)
-
-        # Calculate new quantity in base unit
-        new_quantity_in_base = existing_quantity_in_base + delt_in_base
-
-        # Convert new quantity back to the *original stock item's unit* for storage
-        new_quantity_for_storage = _convert_from_base_unit(max(0.0, new_quantity_in_base), existing_item['unit'])
-
-        update_data = {
-            'quantity': new_quantity_for_storage,
-            'last_updated': datetime.now(timezone.utc).isoformat()
-        }
-        # Only update cost_price_per_unit if it's explicitly provided (for purchases)
-        if cost_price_per_unit is not None:
-            update_data['cost_price_per_unit'] = cost_price_per_unit
-        
-        print(f"Updating existing item {existing_item['id']} with {update_data}")
-        response = await asyncio.to_thread(supabase.from_('stock_items').update(update_data).eq('id', existing_item['id']).execute)
-        print(f"Supabase update response: {response.data}")
-    else:
-        # Insert new item. For sales, quantity_delta will be negative, so new item should start at 0 quantity.
-        # This ensures we don't add negative stock if a sale of a non-existent item is processed.
-        initial_quantity_for_storage = _convert_from_base_unit(max(0.0, _convert_to_base_unit(quantity_delta, unit)), unit) # Convert to base and back to ensure consistency
-        if quantity_delta < 0: # If it was a sale and item not found, set quantity to 0.
-            initial_quantity_for_storage = 0.0
-
-        insert_data = {
-            'user_id': user_id,
-            'item_name': item_name,
-            'quantity': initial_quantity_for_storage,
-            'unit': unit,
-            'last_updated': datetime.now(timezone.utc).isoformat()
-        }
-        if cost_price_per_unit is not None:
-            insert_data['cost_price_per_unit'] = cost_price_per_unit
-            
-        print(f"Inserting new item: {insert_data}")
-        response = await asyncio.to_thread(supabase.from_('stock_items').insert(insert_data).execute)
-        print(f"Supabase insert response: {response.data}")
-    
-    if response.data:
-        return response.data[0]
+    params = {
+        'p_user_id': user_id,
+        'p_item_name': item_name,
+        'p_quantity_delta': float(quantity_delta),
+        'p_unit': unit,
+        'p_cost_price_per_unit': cost_price_per_unit,
+        'p_expected_version': expected_version,
+    }
+    print(f"Applying stock delta: {params}")
+    try:
+        response = await db.execute("apply_stock_delta", lambda client: client.rpc('apply_stock_delta', params))
+    except Exception as e:
+        if 'stock_version_conflict' in str(e):
+            raise StockVersionConflict(str(e)) from e
+        print(f"Error: Failed to update/insert stock item. Error: {e}")
+        raise Exception(f"Failed to update/insert stock item: {e}")
+    print(f"Supabase stock delta response: {response.data}")
+
+    stock_item = response.data[0] if isinstance(response.data, list) and response.data else response.data
+    if stock_item:
+        stock_cache.apply_rows(user_id, [stock_item])
+        return stock_item
     else:
-        print(f"Error: Failed to update/insert stock item. Error: {response.error}")
-        raise Exception(f"Failed to update/insert stock item: {response.error}")
+        print(f"Error: Failed to update/insert stock item. No row returned for {item_name}.")
+        raise Exception(f"Failed to update/insert stock item: no row returned for {item_name}")
+
+def _stock_delta_payload(delta: dict) -> dict:
+    """Maps a stock delta onto the JSON shape the `apply_stock_deltas` Postgres function reads."""
+    return {
+        'item_name': delta['item_name'],
+        'quantity_delta': float(delta['quantity_delta']),
+        'unit': delta.get('unit', 'pcs'),
+        'cost_price_per_unit': delta.get('cost_price_per_unit'),
+        'expected_version': delta.get('expected_version'),
+        'movement_type': delta.get('movement_type'),
+    }
 
-async def get_stock_levels(user_id: str) -> list[dict]:
-    """Retrieves all stock items, their quantities, and units for a given user."""
-    response = await asyncio.to_thread(supabase.from_("stock_items").select("item_name, quantity, unit, cost_price_per_unit, min_quantity_threshold").eq("user_id", user_id).order("item_name").execute)
-    if response.data:
-        return response.data
-    else:
-        print(f"Error: Failed to retrieve stock levels. Error: {response.error}")
+async def apply_stock_deltas(user_id: str, deltas: list[dict]) -> list[dict]:
+    """Applies several stock deltas for a user in a single request and a single transaction.
+
+    Args:
+        user_id: The WhatsApp sender ID.
+        deltas: A list of {"item_name", "quantity_delta", "unit", "cost_price_per_unit",
+            "expected_version"} dicts; only item_name and quantity_delta are required.
+            Semantics per delta are the same as `update_stock_item`.
+
+    Returns:
+        The updated or newly created stock item record for each delta, in input order.
+        If any delta fails, none of them are applied.
+    """
+    if not deltas:
+        return []
+    payload = [_stock_delta_payload(delta) for delta in deltas]
+    print(f"Applying {len(payload)} stock deltas for user {user_id}: {payload}")
+    try:
+        response = await db.execute("apply_stock_deltas", lambda client: client.rpc('apply_stock_deltas', {'p_user_id': user_id, 'p_deltas': payload}))
+    except Exception as e:
+        if 'stock_version_conflict' in str(e):
+            raise StockVersionConflict(str(e)) from e
+        print(f"Error: Failed to apply stock deltas. Error: {e}")
+        raise Exception(f"Failed to apply stock deltas: {e}")
+
+    results = [None] * len(payload)
+    for row in response.data or []:
+        results[row['delta_index']] = row['stock_item']
+    if any(result is None for result in results):
+        stock_cache.invalidate(user_id)
+        raise Exception(f"Failed to apply stock deltas: expected {len(payload)} rows, got {len(response.data or [])}")
+    stock_cache.apply_rows(user_id, results)
+    return results
+
+def apply_ledger_entries(entries: list[dict]):
+    """Applies write-behind ledger entries ({"entry_id", "user_id", "stock_deltas", "transactions"}).
+
+    Blocking; runs on the ledger's flusher thread. One call of the `apply_ledger_entries`
+    function applies the stock deltas and inserts the transactions and their lines in a single
+    transaction, so a failed insert also rolls back the stock. Replays are harmless: stock
+    deltas already applied are skipped by entry_id, and transactions whose client_txn_id is
+    already stored are ignored (see migrations/011_atomic_ledger_apply.sql).
+    """
+    payload = []
+    for entry in entries:
+        transaction_rows, line_rows = _split_transaction_lines([
+            {**_transaction_row(transaction_data, entry["user_id"]), "client_txn_id": transaction_data["client_txn_id"]}
+            for transaction_data in entry.get("transactions") or []
+        ])
+        payload.append({
+            "entry_id": entry["entry_id"],
+            "user_id": entry["user_id"],
+            "deltas": [_stock_delta_payload(delta) for delta in entry.get("stock_deltas") or []],
+            "transactions": transaction_rows,
+            "lines": line_rows,
+        })
+    stock_user_ids = {entry["user_id"] for entry in entries if entry.get("stock_deltas")}
+    try:
+        db.execute_sync("apply_ledger_entries", lambda client: client.rpc('apply_ledger_entries', {'p_entries': payload}), timeout=60)
+    except Exception as e:
+        if 'stock_version_conflict' in str(e):
+            raise StockVersionConflict(str(e)) from e
+        raise
+    finally:
+        # The function does not return rows to write through, so these shops are re-read
+        for user_id in stock_user_ids:
+            stock_cache.invalidate(user_id)
+
+def _upsert_transaction_rows(rows: list[dict], source: str, timeout: float = 60):
+    """Inserts transaction rows that carry a client_txn_id, and their lines; rows already stored are skipped. Blocking."""
+    rows, line_rows = _split_transaction_lines(rows)
+    if rows:
+        db.execute_sync(f"insert_{source}_transactions", lambda client: client.table("transactions").upsert(
+            rows, on_conflict="client_txn_id,transaction_date", ignore_duplicates=True,
+        ), timeout=timeout)
+    # Transaction ids are fixed by the caller, so replayed lines are ignored the same way
+    if line_rows:
+        db.execute_sync(f"insert_{source}_transaction_lines", lambda client: client.table("transaction_lines").upsert(
+            line_rows, on_conflict="transaction_id,line_no", ignore_duplicates=True,
+        ), timeout=timeout)
+
+async def import_transactions(user_id: str, transactions: list[dict]) -> int:
+    """
+    Bulk-inserts historical transactions (see khata_import.py) as one multi-row upsert.
+    Each must carry a stable `id` and `client_txn_id`, so re-importing a chunk skips the rows
+    already stored. Balances and rollups are updated by the same triggers as live writes.
+    Raises on failure; returns the number of rows sent.
+    """
+    rows = [{**_transaction_row(transaction_data, user_id), "client_txn_id": transaction_data["client_txn_id"]} for transaction_data in transactions]
+    if rows:
+        await asyncio.to_thread(_upsert_transaction_rows, rows, "import", 120)
+    return len(rows)
+
+async def _load_stock_levels(user_id: str) -> list[dict]:
+    """Reads a user's stock rows from the database (the stock cache's loader)."""
+    response = await db.execute("stock_levels", lambda client: client.from_("stock_items").select("*").eq("user_id", user_id).order("item_name"))
+    return response.data or []
+
+# Shops' stock lists are cached in-process; the mutation functions above write their rows through
+stock_cache = StockCache(_load_stock_levels)
+
+async def get_stock_levels(user_id: str, populate_cache: bool = True) -> list[dict]:
+    """Retrieves all stock items, their quantities, and units for a given user.
+    Served from the stock cache; pass populate_cache=False from batch jobs that visit every shop."""
+    try:
+        return await stock_cache.get(user_id, populate=populate_cache)
+    except Exception as e:
+        print(f"Error: Failed to retrieve stock levels. Error: {e}")
+        return []
+
+def invalidate_stock_cache(user_id: str | None = None):
+    """Invalidation hook for stock changed outside this process (one shop, or all shops if user_id is None)."""
+    stock_cache.invalidate(user_id)
+
+def get_stock_cache_stats() -> dict:
+    """Hit ratio, evictions and staleness of the in-process stock cache."""
+    return stock_cache.stats()
+
+async def get_stock_as_of(user_id: str, as_of: datetime) -> list[dict]:
+    """
+    Reconstructs a user's stock ({stock_item_id, item_name, unit, quantity, average_cost}) as of a past moment
+    from the latest stock snapshot before it plus the movements since (see migrations/004_stock_movements.sql).
+    """
+    try:
+        response = await db.execute("stock_as_of", lambda client: client.rpc('get_stock_as_of', {'p_user_id': user_id, 'p_as_of': as_of.isoformat()}))
+        return response.data or []
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error reconstructing stock of {user_id} as of {as_of}: {e}")
         return []
 
-async def get_daily_sales_summary(user_id: str, target_date: date) -> tuple[float, list[dict]]:
+async def take_stock_snapshots() -> int:
+    """Snapshots every stock item that moved since its last snapshot; returns how many were taken."""
+    try:
+        response = await db.execute("take_stock_snapshots", lambda client: client.rpc('take_stock_snapshots', {}), timeout=300)
+        snapshot_count = response.data if isinstance(response.data, int) else 0
+        print(f"DEBUG_STOCK: Took {snapshot_count} stock snapshots.")
+        return snapshot_count
+    except Exception as e:
+        print(f"Error taking stock snapshots in Supabase: {e}")
+        return 0
+
+async def get_daily_rollups(user_id: str, start_date: date, end_date: date) -> list[dict]:
     """
-    Retrieves the total sales amount and a list of sales transactions for a specific user and date.
+    Retrieves the precomputed per-day totals (sales, expenses, purchases, profit, txn_count)
+    for a user between start_date and end_date inclusive, oldest first.
+    Days without any transaction have no row.
+    """
+    try:
+        response = await db.execute("daily_rollups", lambda client: client.table("daily_rollups") \
+                                                                  .select("rollup_date, sales, expenses, purchases, profit, txn_count") \
+                                                                  .eq("user_id", user_id) \
+                                                                  .gte("rollup_date", start_date.strftime('%Y-%m-%d')) \
+                                                                  .lte("rollup_date", end_date.strftime('%Y-%m-%d')) \
+                                                                  .order("rollup_date"))
+        rollups = []
+        for record in response.data or []:
+            rollups.append({
+                "rollup_date": record["rollup_date"],
+                "sales": float(record["sales"]),
+                "expenses": float(record["expenses"]),
+                "purchases": float(record["purchases"]),
+                "profit": float(record["profit"]),
+                "txn_count": int(record["txn_count"]),
+            })
+        return rollups
+    except Exception as e:
+        print(f"Error fetching daily rollups from Supabase: {e}")
+        return []
+
+async def get_period_summary(user_id: str, start_date: date, end_date: date) -> dict:
+    """Sums the daily rollups of a user over a date range (e.g. a week or a month)."""
+    rollups = await get_daily_rollups(user_id, start_date, end_date)
+    summary = {"start_date": start_date, "end_date": end_date, "sales": 0.0, "expenses": 0.0, "purchases": 0.0, "profit": 0.0, "txn_count": 0, "days": rollups}
+    for rollup in rollups:
+        for key in ("sales", "expenses", "purchases", "profit", "txn_count"):
+            summary[key] += rollup[key]
+    print(f"Period summary for user {user_id} {start_date}..{end_date}: Sales {summary['sales']}, profit {summary['profit']}, {summary['txn_count']} transactions.")
+    return summary
+
+def _item_sales_row(record: dict) -> dict:
+    return {
+        "item_name": record["item_name"],
+        "unit": record["unit"],
+        "quantity": float(record["quantity"] or 0),
+        "sales": float(record["sales"] or 0),
+        "cost": float(record["cost"]) if record["cost"] is not None else None,
+        "margin": float(record["margin"]) if record["margin"] is not None else None,
+        "line_count": int(record["line_count"]),
+    }
+
+async def get_item_sales(user_id: str, start_date: date, end_date: date, item_name: str | None = None) -> list[dict]:
+    """
+    Per-item sales of a user between start_date and end_date inclusive, from `transaction_lines`:
+    quantity, sales, cost and margin (None when no cost is known), best-selling first.
+    """
+    params = {'p_user_id': user_id, 'p_start_date': start_date.strftime('%Y-%m-%d'), 'p_end_date': end_date.strftime('%Y-%m-%d'), 'p_item_name': item_name}
+    try:
+        response = await db.execute("item_sales", lambda client: client.rpc('get_item_sales', params))
+        return [_item_sales_row(record) for record in response.data or []]
+    except Exception as e:
+        print(f"Error fetching item sales from Supabase: {e}")
+        return []
+
+def _item_search_row(record: dict) -> dict:
+    def _number(key):
+        return float(record[key]) if record[key] is not None else None
+    return {
+        "item_name": record["item_name"],
+        "kind": record["kind"],
+        "unit": record["unit"],
+        "quantity": _number("quantity"),
+        "amount": float(record["amount"] or 0),
+        "entry_count": int(record["entry_count"]),
+        "first_date": record["first_date"],
+        "last_date": record["last_date"],
+        "last_quantity": _number("last_quantity"),
+        "last_amount": _number("last_amount"),
+        "score": float(record["score"]),
+    }
+
+async def search_item_history(user_id: str, terms: list[str], start_date: date, end_date: date, kind: str | None = None, limit: int = 5, include_archive: bool = False) -> list[dict]:
+    """
+    Searches a user's sales and purchase lines and expenses between start_date and end_date inclusive
+    for items similar to any of `terms` (trigram match, any script). kind restricts it to 'sale',
+    'purchase' or 'expense'. One row per (item, kind) with totals and the last entry, best match first.
+    include_archive also searches the archived months.
+    """
+    params = {'p_user_id': user_id, 'p_terms': terms, 'p_start_date': start_date.strftime('%Y-%m-%d'), 'p_end_date': end_date.strftime('%Y-%m-%d'),
+              'p_kind': kind, 'p_limit': limit, 'p_include_archive': include_archive}
+    try:
+        response = await db.execute("search_item_history", lambda client: client.rpc('search_item_history', params))
+        return [_item_search_row(record) for record in response.data or []]
+    except Exception as e:
+        print(f"Error searching item history in Supabase: {e}")
+        return []
+
+async def recompute_daily_rollups(target_date: date | None = None) -> int:
+    """
+    Recomputes one day's rollups for all shops from the ledger in a single pass.
+    Defaults to yesterday, which is what the nightly job runs.
+    """
+    target_date = target_date or (datetime.now().date() - timedelta(days=1))
+    try:
+        response = await db.execute("recompute_daily_rollups", lambda client: client.rpc('recompute_daily_rollups', {'p_date': target_date.strftime('%Y-%m-%d')}), timeout=300)
+        shop_count = response.data if isinstance(response.data, int) else 0
+        print(f"DEBUG_ROLLUPS: Recomputed rollups for {target_date} across {shop_count} shops.")
+        return shop_count
+    except Exception as e:
+        print(f"Error recomputing daily rollups in Supabase: {e}")
+        return 0
+
+async def ensure_transaction_partitions(months_ahead: int = 3, from_date: date | None = None) -> int:
+    """
+    Creates the monthly `transactions` partitions up to `months_ahead` months from now (see migrations/).
+    from_date (default: this month) reaches back for imports of older history.
+    """
+    params = {'p_months_ahead': months_ahead}
+    if from_date is not None:
+        params['p_from'] = from_date.strftime('%Y-%m-%d')
+    try:
+        response = await db.execute("ensure_transaction_partitions", lambda client: client.rpc('ensure_transaction_partitions', params), timeout=120)
+        created = response.data if isinstance(response.data, int) else 0
+        print(f"DEBUG_PARTITIONS: Created {created} new transaction partition(s).")
+        return created
+    except Exception as e:
+        print(f"Error creating transaction partitions in Supabase: {e}")
+        return 0
+
+async def archive_transactions(before_date: date) -> list[dict]:
+    """
+    Moves the months of `transactions` that end on or before before_date (and their lines) to the
+    archive tables, after folding their totals into `archived_balances` and the daily rollups.
+    Each month is its own call to `archive_transaction_month`, so a failure only rolls back that month.
+    Returns [{"archived_month", "transaction_count", "line_count"}], one per archived month.
+    """
+    archived = []
+    try:
+        response = await db.execute("transaction_months_to_archive", lambda client: client.rpc('transaction_months_to_archive', {'p_before': before_date.strftime('%Y-%m-%d')}))
+        months = response.data or []
+        for month in months:
+            response = await db.execute("archive_transaction_month", lambda client, month=month: client.rpc('archive_transaction_month', {'p_month': month}), timeout=600)
+            for archived_month in response.data or []:
+                print(f"DEBUG_ARCHIVE: Archived {archived_month['transaction_count']} transactions and {archived_month['line_count']} lines of {archived_month['archived_month']}.")
+                archived.append(archived_month)
+        print(f"DEBUG_ARCHIVE: Archived {len(archived)} month(s) before {before_date}.")
+    except Exception as e:
+        print(f"Error archiving transactions in Supabase after {len(archived)} month(s): {e}")
+    return archived
+
+async def get_daily_sales_summary(user_id: str, target_date: date, detail_limit: int = 10) -> tuple[float, list[dict]]:
+    """
+    Retrieves the total sales amount and the latest sales transactions for a specific user and date.
+    The total comes from `daily_rollups`; only the `detail_limit` most recent sales are read for the itemised reply.
     """
     try:
         # Convert target_date to string for Supabase query
         formatted_date = target_date.strftime('%Y-%m-%d')
-        
-        response = await asyncio.to_thread(supabase.table("transactions") \
-                                        .select("item, amount") \
-                                        .eq("user_id", user_id) \
-                                        .eq("transaction_type", "sale") \
-                                        .eq("transaction_date", formatted_date) \
-                                        .order("created_at", desc=True) \
-                                        .execute)
-        
-        total_sales = 0.0
-        sales_transactions = []
 
-        if response.data:
-            for record in response.data:
-                amount = float(record["amount"])
-                total_sales += amount
-                sales_transactions.append(record)
+        rollups_task = get_daily_rollups(user_id, target_date, target_date)
+        details_task = db.execute("daily_sales", lambda client: client.table("transactions") \
+                                                               .select("item, amount") \
+                                                               .eq("user_id", user_id) \
+                                                               .eq("transaction_type", "sale") \
+                                                               .eq("transaction_date", formatted_date) \
+                                                               .order("created_at", desc=True) \
+                                                               .limit(detail_limit))
+        rollups, response = await asyncio.gather(rollups_task, details_task)
+
+        total_sales = rollups[0]["sales"] if rollups else 0.0
+        sales_transactions = response.data or []
 
-        print(f"Daily sales summary for user {user_id} on {formatted_date}: Total sales {total_sales}, {len(sales_transactions)} transactions.")
+        print(f"Daily sales summary for user {user_id} on {formatted_date}: Total sales {total_sales}, {len(sales_transactions)} transactions listed.")
         return total_sales, sales_transactions
     except Exception as e:
         print(f"Error fetching daily sales summary from Supabase: {e}")
         return 0.0, []
 
 async def get_low_stock_items(user_id: str) -> list[dict]:
-    """Retrieves items for a user that are below their specified min_quantity_alert."""
-    all_stock_items = await get_stock_levels(user_id)
-    low_stock_items = []
-    for item in all_stock_items:
-        # Ensure both quantity and min_quantity_alert are numeric for comparison
-        current_quantity = float(item.get('quantity', 0))
-        min_alert = float(item.get('min_quantity_threshold', 0))
-        if current_quantity <= min_alert:
-            low_stock_items.append(item)
-    print(f"DEBUG_STOCK: Found {len(low_stock_items)} low stock items for user {user_id}.")
-    return low_stock_items
+    """Retrieves items for a user whose quantity is at or below their min_quantity_threshold.
+    The filter runs server-side on the partial low-stock index."""
+    try:
+        response = await db.execute("low_stock_items", lambda client: client.rpc('get_low_stock_items', {'p_user_id': user_id}))
+        low_stock_items = response.data or []
+        print(f"DEBUG_STOCK: Found {len(low_stock_items)} low stock items for user {user_id}.")
+        return low_stock_items
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error retrieving low stock items for {user_id}: {e}")
+        return []
+
+async def get_low_stock_items_by_user() -> dict[str, list[dict]]:
+    """Retrieves the low-stock items of every shop in one query, keyed by user_id."""
+    try:
+        response = await db.execute("all_low_stock_items", lambda client: client.rpc('get_all_low_stock_items', {}), timeout=60)
+        low_stock_by_user = {}
+        for item in response.data or []:
+            low_stock_by_user.setdefault(item['user_id'], []).append(item)
+        print(f"DEBUG_STOCK: Found {len(response.data or [])} low stock items across {len(low_stock_by_user)} shops.")
+        return low_stock_by_user
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error retrieving low stock items for all shops: {e}")
+        return {}
+
+async def get_owner_shops(owner_id: str) -> list[str]:
+    """Retrieves the user_ids of an owner's outlets (their own shop included), or [] if they are not an owner."""
+    try:
+        response = await db.execute("owner_shops", lambda client: client.table("owner_shops").select("user_id").eq("owner_id", owner_id).order("user_id"))
+        return [row["user_id"] for row in response.data or []]
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error retrieving the shops of owner {owner_id}: {e}")
+        return []
+
+async def link_owner_shop(owner_id: str, user_id: str) -> bool:
+    """Links a shop to its owner (replacing any previous owner); the owner's own shop is mapped as well."""
+    try:
+        await db.execute("link_owner_shop", lambda client: client.rpc('link_owner_shop', {'p_owner_id': owner_id, 'p_user_id': user_id}))
+        print(f"DEBUG_OWNER: Linked shop {user_id} to owner {owner_id}.")
+        return True
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error linking shop {user_id} to owner {owner_id}: {e}")
+        return False
+
+async def unlink_owner_shop(user_id: str) -> str | None:
+    """Removes a shop from its owner's outlets. Returns the owner it was linked to, or None."""
+    try:
+        response = await db.execute("unlink_owner_shop", lambda client: client.table("owner_shops").delete().eq("user_id", user_id))
+        return response.data[0]["owner_id"] if response.data else None
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error unlinking shop {user_id} from its owner: {e}")
+        return None
+
+def _owner_rollup(rows: list[dict]) -> dict:
+    shops = [{
+        "user_id": row["user_id"],
+        **{field: float(row[field]) for field in ("balance", "sales", "expenses", "purchases", "profit")},
+        "txn_count": int(row["txn_count"]),
+    } for row in rows]
+    totals = {field: round(sum(shop[field] for shop in shops), 2) for field in ("balance", "sales", "expenses", "purchases", "profit")}
+    return {"shops": shops, **totals, "txn_count": sum(shop["txn_count"] for shop in shops)}
+
+async def get_owner_rollup(owner_id: str, start_date: date, end_date: date) -> dict:
+    """
+    Combined figures of an owner's outlets: {"shops": [{user_id, balance, sales, expenses, purchases,
+    profit, txn_count}], "balance", "sales", ...} with the period totals between start_date and
+    end_date inclusive and the current balances. One grouped query however many outlets there are;
+    "shops" is empty for a sender who is not an owner.
+    """
+    try:
+        response = await db.execute("owner_rollup", lambda client: client.rpc('get_owner_rollup', {
+            'p_owner_id': owner_id,
+            'p_start_date': start_date.strftime('%Y-%m-%d'),
+            'p_end_date': end_date.strftime('%Y-%m-%d'),
+        }))
+        rollup = _owner_rollup(response.data or [])
+        print(f"DEBUG_OWNER: Roll-up of {len(rollup['shops'])} shops for owner {owner_id}: balance {rollup['balance']}, sales {rollup['sales']}.")
+        return rollup
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error retrieving the roll-up of owner {owner_id}: {e}")
+        return _owner_rollup([])
+
+async def get_owner_low_stock_items(owner_id: str) -> dict[str, list[dict]]:
+    """Retrieves the low-stock items of every outlet of an owner in one query, keyed by user_id."""
+    try:
+        response = await db.execute("owner_low_stock_items", lambda client: client.rpc('get_owner_low_stock_items', {'p_owner_id': owner_id}))
+        low_stock_by_user = {}
+        for item in response.data or []:
+            low_stock_by_user.setdefault(item['user_id'], []).append(item)
+        return low_stock_by_user
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error retrieving low stock items of owner {owner_id}: {e}")
+        return {}
 
 async def save_order_confirmation(
     user_id: str,
@@ -293,22 +668,150 @@ async def save_order_confirmation(
         print(f"ERROR_SUPABASE_ORDER: Failed to save order confirmation: {e}")
         raise Exception(f"Failed to save order confirmation: {e}")
 
+SHOP_PAGE_SIZE = 500
+
+async def iter_active_shops(page_size: int = SHOP_PAGE_SIZE):
+    """
+    Yields every active shop ({user_id, language, latitude, longitude}) from the `shops` registry.
+    Pages with a keyset on user_id, so memory stays constant however many shops there are.
+    """
+    last_user_id = ""
+    while True:
+        response = await db.execute("active_shops_page", lambda client: client.table("shops") \
+                                                                  .select("user_id, language, latitude, longitude") \
+                                                                  .eq("status", "active") \
+                                                                  .gt("user_id", last_user_id) \
+                                                                  .order("user_id") \
+                                                                  .limit(page_size))
+        page = response.data or []
+        for shop in page:
+            yield shop
+        if len(page) < page_size:
+            return
+        last_user_id = page[-1]["user_id"]
+
+EXPORT_PAGE_SIZE = 5000
+
+async def iter_transaction_pages(user_id: str, start_date: date, end_date: date, page_size: int = EXPORT_PAGE_SIZE, include_archive: bool = False):
+    """
+    Yields a user's transactions between start_date and end_date inclusive, a page (list) at a time,
+    ordered by (transaction_date, id). Keyset paging on that pair keeps every page an index range scan.
+    With include_archive the archived months come first; they all precede the hot ones.
+    """
+    for table in (["transactions_archive"] if include_archive else []) + ["transactions"]:
+        after = None
+        while True:
+            def _page(client, after=after, table=table):
+                query = client.table(table) \
+                              .select("id, transaction_date, transaction_type, amount, item, created_at") \
+                              .eq("user_id", user_id) \
+                              .gte("transaction_date", start_date.strftime('%Y-%m-%d')) \
+                              .lte("transaction_date", end_date.strftime('%Y-%m-%d'))
+                if after is not None:
+                    query = query.or_(f'transaction_date.gt.{after[0]},and(transaction_date.eq.{after[0]},id.gt.{after[1]})')
+                return query.order("transaction_date").order("id").limit(page_size)
+            response = await db.execute("export_transactions_page", _page, timeout=60)
+            page = response.data or []
+            if page:
+                yield page
+            if len(page) < page_size:
+                break
+            after = (page[-1]["transaction_date"], page[-1]["id"])
+
+async def iter_stock_movement_pages(user_id: str, start_date: date, end_date: date, page_size: int = EXPORT_PAGE_SIZE):
+    """
+    Yields a user's stock movements made between start_date and end_date inclusive (UTC days),
+    a page at a time, ordered by (created_at, id) with keyset paging.
+    """
+    after = None
+    while True:
+        def _page(client, after=after):
+            query = client.table("stock_movements") \
+                          .select("id, stock_item_id, item_name, movement_type, quantity_delta, unit_cost, average_cost_after, created_at") \
+                          .eq("user_id", user_id) \
+                          .gte("created_at", start_date.strftime('%Y-%m-%d')) \
+                          .lt("created_at", (end_date + timedelta(days=1)).strftime('%Y-%m-%d'))
+            if after is not None:
+                # Timestamps contain ':' and '.', so they are quoted inside the or() filter
+                query = query.or_(f'created_at.gt."{after[0]}",and(created_at.eq."{after[0]}",id.gt.{after[1]})')
+            return query.order("created_at").order("id").limit(page_size)
+        response = await db.execute("export_stock_movements_page", _page, timeout=60)
+        page = response.data or []
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after = (page[-1]["created_at"], page[-1]["id"])
+
+async def get_shop(user_id: str) -> dict | None:
+    """Retrieves a shop's registry row (language, location, status), or None if it has never written anything."""
+    try:
+        response = await db.execute("shop", lambda client: client.table("shops").select("user_id, language, latitude, longitude, status").eq("user_id", user_id).limit(1))
+        return response.data[0] if response.data else None
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error retrieving shop {user_id}: {e}")
+        return None
+
+async def update_shop(user_id: str, **fields) -> dict:
+    """Creates or updates a shop's registry row, e.g. update_shop(user_id, language="hi")."""
+    allowed_fields = {"language", "latitude", "longitude", "status"}
+    unknown_fields = set(fields) - allowed_fields
+    if unknown_fields:
+        raise ValueError(f"Unknown shop fields: {sorted(unknown_fields)}")
+    row = {"user_id": user_id, **fields, "updated_at": datetime.now(timezone.utc).isoformat()}
+    try:
+        response = await db.execute("update_shop", lambda client: client.table("shops").upsert(row, on_conflict="user_id"))
+        return response.data[0] if response.data else {}
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error updating shop {user_id}: {e}")
+        return {}
+
 async def get_all_unique_user_ids_with_stock() -> list[str]:
-    """Retrieves all unique user_ids that have stock items."""
+    """Retrieves the user_ids of all active shops as a list. Prefer `iter_active_shops` for large registries."""
+    try:
+        unique_user_ids = [shop["user_id"] async for shop in iter_active_shops()]
+        print(f"DEBUG_SUPABASE: Retrieved {len(unique_user_ids)} active shop user IDs.")
+        return unique_user_ids
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error retrieving active shop user IDs: {e}")
+        return []
+
+# Bill image hashes are unsigned 64-bit integers; Postgres BIGINT is signed, so they are stored shifted.
+def _hash_to_bigint(image_hash: int) -> int:
+    return image_hash - (1 << 64) if image_hash >= (1 << 63) else image_hash
+
+def _bigint_to_hash(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+def _detail_hash_from_text(value: str | None) -> int | None:
+    return int(value, 16) if value else None
+
+async def get_bill_image_hashes(user_id: str) -> list[dict]:
+    """Retrieves the perceptual hashes ({"image_hash", "detail_hash", "created_at"}) of every bill image already processed for a user.
+    detail_hash is None for bills stored before migrations/010."""
     try:
-        response = await asyncio.to_thread(supabase.from_("stock_items").select("user_id").execute)
-        if response.data:
-            # Extract unique user_ids from the response
-            unique_user_ids = list(set([item['user_id'] for item in response.data]))
-            print(f"DEBUG_SUPABASE: Retrieved unique user IDs with stock: {unique_user_ids}")
-            return unique_user_ids
-        else:
-            print("DEBUG_SUPABASE: No user IDs found in stock_items table.")
-            return []
+        response = await db.execute("bill_image_hashes", lambda client: client.from_("bill_image_hashes").select("image_hash, detail_hash, created_at").eq("user_id", user_id))
+        return [
+            {"image_hash": _bigint_to_hash(int(row["image_hash"])), "detail_hash": _detail_hash_from_text(row.get("detail_hash")), "created_at": row.get("created_at")}
+            for row in response.data or []
+        ]
     except Exception as e:
-        print(f"ERROR_SUPABASE: Error retrieving unique user IDs with stock: {e}")
+        print(f"ERROR_SUPABASE: Error retrieving bill image hashes for {user_id}: {e}")
         return []
 
+async def save_bill_image_hash(user_id: str, image_hash: int, detail_hash: int | None = None) -> dict:
+    """Stores the perceptual hashes of a processed bill image for a user (the 256-bit detail hash as hex).
+    Every detail hash is kept per image hash (migrations/010); saving the same pair again returns the stored row."""
+    try:
+        response = await db.execute("save_bill_image_hash", lambda client: client.from_("bill_image_hashes").upsert(
+            {"user_id": user_id, "image_hash": _hash_to_bigint(image_hash), "detail_hash": f"{detail_hash:064x}" if detail_hash is not None else None},
+            on_conflict="user_id,image_hash,detail_hash",
+        ))
+        return response.data[0] if response.data else {}
+    except Exception as e:
+        print(f"ERROR_SUPABASE: Error saving bill image hash for {user_id}: {e}")
+        return {}
+
 if __name__ == "__main__":
     print("--- Simulating Supabase Save and Balance for a User ---")
     # Use a dummy user ID for testing
@@ -332,9 +835,13 @@ if __name__ == "__main__":
     asyncio.run(save_transaction(example_data2, test_user_id))
 
     print("\n--- Testing Total Balance ---")
-    balance = get_total_balance(test_user_id)
+    balance = asyncio.run(get_total_balance(test_user_id))
     print(f"Current account balance for {test_user_id}: ₹{balance:.2f}")
 
+    print("\n--- Testing Balance Reconciliation ---")
+    mismatches = asyncio.run(reconcile_shop_balances(fix=False))
+    print(f"Shops with a drifted balance: {len(mismatches)}")
+
     print("\n--- Testing User Transactions Summary ---")
     total_bal, recent_txns = asyncio.run(get_user_transactions_summary(test_user_id))
     print(f"Total Balance: ₹{total_bal:.2f}")
@@ -363,6 +870,13 @@ if __name__ == "__main__":
     for txn in sales_txns:
         print(f"  Item: {txn['item']}, Amount: {txn['amount']}")
 
+    print("\n--- Testing Daily Rollups ---")
+    asyncio.run(recompute_daily_rollups(today))
+    week = asyncio.run(get_period_summary(test_user_id, today - timedelta(days=6), today))
+    print(f"Last 7 days: sales ₹{week['sales']:.2f}, expenses ₹{week['expenses']:.2f}, profit ₹{week['profit']:.2f} over {week['txn_count']} transactions")
+    today_rollup = next((day for day in week["days"] if day["rollup_date"] == today.isoformat()), None)
+    assert (today_rollup["sales"] if today_rollup else 0.0) == total_sales, "Rollup disagrees with today's total"
+
     print("\n--- Testing Low Stock Items ---")
     # To test low stock, you might need to manually set min_quantity_threshold for some items in your Supabase table
     low_stock = asyncio.run(get_low_stock_items(test_user_id))
@@ -370,6 +884,30 @@ if __name__ == "__main__":
     for item in low_stock:
         print(f"  Item: {item['item_name']}, Qty: {item['quantity']} {item['unit']}, Min Threshold: {item['min_quantity_threshold']}")
 
+    low_stock_by_user = asyncio.run(get_low_stock_items_by_user())
+    assert [item['id'] for item in low_stock_by_user.get(test_user_id, [])] == [item['id'] for item in low_stock], "Bulk low-stock query disagrees"
+
     print("\n--- Testing Get All Unique User IDs With Stock ---")
     unique_users = asyncio.run(get_all_unique_user_ids_with_stock())
     print(f"Unique users with stock: {unique_users}")
+
+    print("\n--- Testing Shop Registry Keyset Paging ---")
+    asyncio.run(update_shop(test_user_id, language="hi"))
+    async def _count_active_shops(page_size: int) -> int:
+        return len([shop async for shop in iter_active_shops(page_size=page_size)])
+    assert asyncio.run(_count_active_shops(2)) == len(unique_users), "Small pages and the full listing disagree"
+    print(f"Registry row for {test_user_id}: {asyncio.run(get_shop(test_user_id))}")
+
+    # Bill ingestion, per-item vs apply_stock_deltas: python storage_conformance.py supabase --benchmark
+
+    print("\n--- Testing Coalesced Transaction Writes ---")
+    async def _concurrent_sales(count: int):
+        await asyncio.gather(*(save_transaction({"date": date.today(), "type": "sale", "amount": 10.0, "item": f"coalesce-check {index}"}, test_user_id) for index in range(count)))
+    asyncio.run(_concurrent_sales(50))
+    print(f"Writer metrics: {get_transaction_writer_metrics()}")
+
+    # Lost updates and stale expected_version are checked by storage_conformance.py (check_concurrent_stock)
+
+    print("\n--- Query Latency Histograms ---")
+    for query_name, histogram in get_query_metrics()["queries"].items():
+        print(f"  {query_name}: {histogram}")
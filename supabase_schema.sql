@@ -38,3 +38,400 @@ CREATE TABLE stock_items (
     last_updated TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     CONSTRAINT unique_user_item UNIQUE (user_id, item_name, unit)
 );
+
+-- Perceptual (dHash) fingerprints of processed bill photos, used to catch re-photographed bills.
+-- The unsigned 64-bit hash is stored shifted into the signed BIGINT range.
+CREATE TABLE bill_image_hashes (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id TEXT NOT NULL,
+    image_hash BIGINT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    CONSTRAINT unique_user_bill_hash UNIQUE (user_id, image_hash)
+);
+
+-- Atomic, server-side stock mutation.
+-- `version` is bumped on every change so callers can detect that a row moved under them.
+ALTER TABLE stock_items ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1;
+
+-- Quantities are compared in a base unit (grams for weight); other units are used as-is.
+CREATE OR REPLACE FUNCTION stock_to_base_unit(p_value NUMERIC, p_unit TEXT) RETURNS NUMERIC
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE lower(coalesce(p_unit, '')) WHEN 'kg' THEN p_value * 1000 ELSE p_value END;
+$$;
+
+CREATE OR REPLACE FUNCTION stock_from_base_unit(p_value NUMERIC, p_unit TEXT) RETURNS NUMERIC
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE lower(coalesce(p_unit, '')) WHEN 'kg' THEN p_value / 1000 ELSE p_value END;
+$$;
+
+-- Applies a quantity delta (in p_unit) to a user's item in one statement-level transaction:
+-- locks the matching row (exact unit match preferred), converts units, clamps at zero and
+-- bumps the version. Unknown items are inserted, racing inserts fold into the same row via
+-- the unique_user_item constraint. Raises SQLSTATE 40001 'stock_version_conflict' if
+-- p_expected_version is given and no longer matches.
+CREATE OR REPLACE FUNCTION apply_stock_delta(
+    p_user_id TEXT,
+    p_item_name TEXT,
+    p_quantity_delta NUMERIC,
+    p_unit TEXT DEFAULT 'pcs',
+    p_cost_price_per_unit NUMERIC DEFAULT NULL,
+    p_expected_version BIGINT DEFAULT NULL
+) RETURNS stock_items
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_item stock_items;
+BEGIN
+    SELECT * INTO v_item
+    FROM stock_items
+    WHERE user_id = p_user_id AND item_name = p_item_name
+    ORDER BY (lower(unit) = lower(p_unit)) DESC, id
+    LIMIT 1
+    FOR UPDATE;
+
+    IF FOUND THEN
+        IF p_expected_version IS NOT NULL AND v_item.version <> p_expected_version THEN
+            RAISE EXCEPTION 'stock_version_conflict: % is at version %, expected %', p_item_name, v_item.version, p_expected_version
+                USING ERRCODE = '40001';
+        END IF;
+
+        UPDATE stock_items
+        SET quantity = stock_from_base_unit(GREATEST(0, stock_to_base_unit(quantity, unit) + stock_to_base_unit(p_quantity_delta, p_unit)), unit),
+            cost_price_per_unit = COALESCE(p_cost_price_per_unit, cost_price_per_unit),
+            version = version + 1,
+            last_updated = NOW()
+        WHERE id = v_item.id
+        RETURNING * INTO v_item;
+        RETURN v_item;
+    END IF;
+
+    IF p_expected_version IS NOT NULL AND p_expected_version <> 0 THEN
+        RAISE EXCEPTION 'stock_version_conflict: % no longer exists, expected version %', p_item_name, p_expected_version
+            USING ERRCODE = '40001';
+    END IF;
+
+    -- New items start at the delta, or at zero for a sale of something never stocked
+    INSERT INTO stock_items (user_id, item_name, quantity, unit, cost_price_per_unit, last_updated)
+    VALUES (p_user_id, p_item_name, GREATEST(0, p_quantity_delta), p_unit, p_cost_price_per_unit, NOW())
+    ON CONFLICT ON CONSTRAINT unique_user_item DO UPDATE
+    SET quantity = GREATEST(0, stock_items.quantity + p_quantity_delta),
+        cost_price_per_unit = COALESCE(p_cost_price_per_unit, stock_items.cost_price_per_unit),
+        version = stock_items.version + 1,
+        last_updated = NOW()
+    RETURNING * INTO v_item;
+    RETURN v_item;
+END;
+$$;
+
+-- Bulk variant of apply_stock_delta: applies every delta of a bill or sale in one request and
+-- one transaction (any failure rolls all of them back). p_deltas is a JSON array of
+-- {"item_name", "quantity_delta", "unit", "cost_price_per_unit", "expected_version"}.
+-- Rows are locked in item-name order so concurrent bulk calls cannot deadlock; results
+-- come back tagged with the delta's position in the input array.
+CREATE OR REPLACE FUNCTION apply_stock_deltas(p_user_id TEXT, p_deltas JSONB)
+RETURNS TABLE (delta_index INT, stock_item JSONB)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_delta RECORD;
+BEGIN
+    FOR v_delta IN
+        SELECT d.value, d.ordinality
+        FROM jsonb_array_elements(p_deltas) WITH ORDINALITY AS d(value, ordinality)
+        ORDER BY d.value->>'item_name', d.ordinality
+    LOOP
+        delta_index := v_delta.ordinality - 1;
+        stock_item := to_jsonb(apply_stock_delta(
+            p_user_id,
+            v_delta.value->>'item_name',
+            (v_delta.value->>'quantity_delta')::NUMERIC,
+            COALESCE(v_delta.value->>'unit', 'pcs'),
+            (v_delta.value->>'cost_price_per_unit')::NUMERIC,
+            (v_delta.value->>'expected_version')::BIGINT
+        ));
+        RETURN NEXT;
+    END LOOP;
+END;
+$$;
+
+-- Running balance per shop, maintained in the same statement as every transaction insert so a
+-- balance inquiry is a single-row read instead of a scan over the whole ledger.
+-- Sales add to the balance and expenses subtract from it; other types (e.g. 'purchase') only count.
+CREATE TABLE shop_balances (
+    user_id TEXT PRIMARY KEY,
+    balance NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    total_sales NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    total_expenses NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    transaction_count BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE OR REPLACE FUNCTION apply_transactions_to_balances() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO shop_balances AS b (user_id, balance, total_sales, total_expenses, transaction_count, updated_at)
+    SELECT n.user_id,
+           SUM(CASE lower(n.transaction_type) WHEN 'sale' THEN n.amount WHEN 'expense' THEN -n.amount ELSE 0 END),
+           SUM(CASE WHEN lower(n.transaction_type) = 'sale' THEN n.amount ELSE 0 END),
+           SUM(CASE WHEN lower(n.transaction_type) = 'expense' THEN n.amount ELSE 0 END),
+           COUNT(*),
+           NOW()
+    FROM new_transactions n
+    GROUP BY n.user_id
+    ON CONFLICT (user_id) DO UPDATE
+    SET balance = b.balance + EXCLUDED.balance,
+        total_sales = b.total_sales + EXCLUDED.total_sales,
+        total_expenses = b.total_expenses + EXCLUDED.total_expenses,
+        transaction_count = b.transaction_count + EXCLUDED.transaction_count,
+        updated_at = NOW();
+    RETURN NULL;
+END;
+$$;
+
+-- Statement-level, so a multi-row insert from the coalescing writer updates each shop once.
+CREATE TRIGGER transactions_update_balances
+    AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_transactions
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_transactions_to_balances();
+
+-- One-time backfill for shops that already have transactions.
+INSERT INTO shop_balances (user_id, balance, total_sales, total_expenses, transaction_count)
+SELECT user_id,
+       SUM(CASE lower(transaction_type) WHEN 'sale' THEN amount WHEN 'expense' THEN -amount ELSE 0 END),
+       SUM(CASE WHEN lower(transaction_type) = 'sale' THEN amount ELSE 0 END),
+       SUM(CASE WHEN lower(transaction_type) = 'expense' THEN amount ELSE 0 END),
+       COUNT(*)
+FROM transactions
+GROUP BY user_id
+ON CONFLICT (user_id) DO NOTHING;
+
+-- Verifies shop_balances against the transactions ledger and returns the shops that drifted.
+-- A first grouped pass finds candidates without locking anything; each candidate is then
+-- re-checked with its balance row locked (which serialises it against concurrent inserts)
+-- and, if p_fix, overwritten with the ledger totals.
+CREATE OR REPLACE FUNCTION reconcile_shop_balances(p_fix BOOLEAN DEFAULT TRUE)
+RETURNS TABLE (shop_user_id TEXT, stored_balance NUMERIC, ledger_balance NUMERIC, stored_transaction_count BIGINT, ledger_transaction_count BIGINT)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_candidate TEXT;
+    v_ledger RECORD;
+BEGIN
+    FOR v_candidate IN
+        SELECT COALESCE(l.user_id, b.user_id)
+        FROM (
+            SELECT t.user_id,
+                   SUM(CASE lower(t.transaction_type) WHEN 'sale' THEN t.amount WHEN 'expense' THEN -t.amount ELSE 0 END) AS balance,
+                   COUNT(*) AS transaction_count
+            FROM transactions t
+            GROUP BY t.user_id
+        ) l
+        FULL OUTER JOIN shop_balances b ON b.user_id = l.user_id
+        WHERE l.balance IS DISTINCT FROM b.balance OR l.transaction_count IS DISTINCT FROM b.transaction_count
+    LOOP
+        INSERT INTO shop_balances (user_id) VALUES (v_candidate) ON CONFLICT (user_id) DO NOTHING;
+        PERFORM 1 FROM shop_balances b WHERE b.user_id = v_candidate FOR UPDATE;
+
+        SELECT COALESCE(SUM(CASE lower(t.transaction_type) WHEN 'sale' THEN t.amount WHEN 'expense' THEN -t.amount ELSE 0 END), 0) AS balance,
+               COALESCE(SUM(CASE WHEN lower(t.transaction_type) = 'sale' THEN t.amount ELSE 0 END), 0) AS total_sales,
+               COALESCE(SUM(CASE WHEN lower(t.transaction_type) = 'expense' THEN t.amount ELSE 0 END), 0) AS total_expenses,
+               COUNT(*) AS transaction_count
+        INTO v_ledger
+        FROM transactions t
+        WHERE t.user_id = v_candidate;
+
+        SELECT b.user_id, b.balance, v_ledger.balance, b.transaction_count, v_ledger.transaction_count
+        INTO shop_user_id, stored_balance, ledger_balance, stored_transaction_count, ledger_transaction_count
+        FROM shop_balances b
+        WHERE b.user_id = v_candidate;
+
+        IF stored_balance IS DISTINCT FROM ledger_balance OR stored_transaction_count IS DISTINCT FROM ledger_transaction_count THEN
+            IF p_fix THEN
+                UPDATE shop_balances
+                SET balance = v_ledger.balance,
+                    total_sales = v_ledger.total_sales,
+                    total_expenses = v_ledger.total_expenses,
+                    transaction_count = v_ledger.transaction_count,
+                    updated_at = NOW()
+                WHERE user_id = v_candidate;
+            END IF;
+            RETURN NEXT;
+        END IF;
+    END LOOP;
+END;
+$$;
+
+-- Per-shop, per-day totals maintained incrementally on every transaction insert, so earnings
+-- replies, weekly/monthly summaries and forecasting inputs never aggregate raw transactions.
+-- profit = sales - expenses - purchases.
+CREATE TABLE daily_rollups (
+    user_id TEXT NOT NULL,
+    rollup_date DATE NOT NULL,
+    sales NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    expenses NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    purchases NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    profit NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    txn_count BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (user_id, rollup_date) -- Also serves date-range reads for one shop
+);
+
+CREATE OR REPLACE FUNCTION apply_transactions_to_daily_rollups() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO daily_rollups AS r (user_id, rollup_date, sales, expenses, purchases, profit, txn_count, updated_at)
+    SELECT d.user_id, d.transaction_date, d.sales, d.expenses, d.purchases, d.sales - d.expenses - d.purchases, d.txn_count, NOW()
+    FROM (
+        SELECT n.user_id,
+               n.transaction_date,
+               SUM(CASE WHEN lower(n.transaction_type) = 'sale' THEN n.amount ELSE 0 END) AS sales,
+               SUM(CASE WHEN lower(n.transaction_type) = 'expense' THEN n.amount ELSE 0 END) AS expenses,
+               SUM(CASE WHEN lower(n.transaction_type) = 'purchase' THEN n.amount ELSE 0 END) AS purchases,
+               COUNT(*) AS txn_count
+        FROM new_transactions n
+        GROUP BY n.user_id, n.transaction_date
+    ) d
+    ON CONFLICT (user_id, rollup_date) DO UPDATE
+    SET sales = r.sales + EXCLUDED.sales,
+        expenses = r.expenses + EXCLUDED.expenses,
+        purchases = r.purchases + EXCLUDED.purchases,
+        profit = r.profit + EXCLUDED.profit,
+        txn_count = r.txn_count + EXCLUDED.txn_count,
+        updated_at = NOW();
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER transactions_update_daily_rollups
+    AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_transactions
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_transactions_to_daily_rollups();
+
+-- Recomputes one day for every shop from the ledger in a single set-based pass (run nightly
+-- for the previous day). Rows for shops with no transactions left on that day are removed.
+-- Returns the number of shops that have a rollup for the day.
+CREATE OR REPLACE FUNCTION recompute_daily_rollups(p_date DATE)
+RETURNS INTEGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_shops INTEGER;
+BEGIN
+    INSERT INTO daily_rollups AS r (user_id, rollup_date, sales, expenses, purchases, profit, txn_count, updated_at)
+    SELECT d.user_id, p_date, d.sales, d.expenses, d.purchases, d.sales - d.expenses - d.purchases, d.txn_count, NOW()
+    FROM (
+        SELECT t.user_id,
+               SUM(CASE WHEN lower(t.transaction_type) = 'sale' THEN t.amount ELSE 0 END) AS sales,
+               SUM(CASE WHEN lower(t.transaction_type) = 'expense' THEN t.amount ELSE 0 END) AS expenses,
+               SUM(CASE WHEN lower(t.transaction_type) = 'purchase' THEN t.amount ELSE 0 END) AS purchases,
+               COUNT(*) AS txn_count
+        FROM transactions t
+        WHERE t.transaction_date = p_date
+        GROUP BY t.user_id
+    ) d
+    ON CONFLICT (user_id, rollup_date) DO UPDATE
+    SET sales = EXCLUDED.sales,
+        expenses = EXCLUDED.expenses,
+        purchases = EXCLUDED.purchases,
+        profit = EXCLUDED.profit,
+        txn_count = EXCLUDED.txn_count,
+        updated_at = NOW();
+    GET DIAGNOSTICS v_shops = ROW_COUNT;
+
+    DELETE FROM daily_rollups r
+    WHERE r.rollup_date = p_date
+      AND NOT EXISTS (SELECT 1 FROM transactions t WHERE t.user_id = r.user_id AND t.transaction_date = p_date);
+
+    RETURN v_shops;
+END;
+$$;
+
+-- Serves the nightly per-day recompute and the per-day earnings queries.
+CREATE INDEX IF NOT EXISTS idx_transactions_date_user ON transactions (transaction_date, user_id);
+
+-- One-time backfill of past days.
+INSERT INTO daily_rollups (user_id, rollup_date, sales, expenses, purchases, profit, txn_count)
+SELECT user_id, transaction_date, sales, expenses, purchases, sales - expenses - purchases, txn_count
+FROM (
+    SELECT user_id,
+           transaction_date,
+           SUM(CASE WHEN lower(transaction_type) = 'sale' THEN amount ELSE 0 END) AS sales,
+           SUM(CASE WHEN lower(transaction_type) = 'expense' THEN amount ELSE 0 END) AS expenses,
+           SUM(CASE WHEN lower(transaction_type) = 'purchase' THEN amount ELSE 0 END) AS purchases,
+           COUNT(*) AS txn_count
+    FROM transactions
+    GROUP BY user_id, transaction_date
+) d
+ON CONFLICT (user_id, rollup_date) DO NOTHING;
+
+-- Low-stock threshold per item. An item is low when quantity <= min_quantity_threshold, so the
+-- default of 0 flags items that have run out.
+ALTER TABLE stock_items ADD COLUMN IF NOT EXISTS min_quantity_threshold NUMERIC(10, 2) NOT NULL DEFAULT 0;
+
+-- Only low rows are indexed, so the index stays tiny and low-stock lookups never touch healthy stock.
+-- Queries must repeat the predicate exactly for the planner to use it.
+CREATE INDEX IF NOT EXISTS idx_stock_items_low_stock
+    ON stock_items (user_id, item_name)
+    WHERE quantity <= min_quantity_threshold;
+
+-- PostgREST filters cannot compare two columns, so the low-stock reads are exposed as functions.
+CREATE OR REPLACE FUNCTION get_low_stock_items(p_user_id TEXT)
+RETURNS SETOF stock_items
+LANGUAGE sql STABLE AS $$
+    SELECT *
+    FROM stock_items
+    WHERE user_id = p_user_id
+      AND quantity <= min_quantity_threshold
+    ORDER BY item_name;
+$$;
+
+-- All shops in one query, for the alert/insight jobs.
+CREATE OR REPLACE FUNCTION get_all_low_stock_items()
+RETURNS SETOF stock_items
+LANGUAGE sql STABLE AS $$
+    SELECT *
+    FROM stock_items
+    WHERE quantity <= min_quantity_threshold
+    ORDER BY user_id, item_name;
+$$;
+
+-- Registry of shops (one row per WhatsApp sender), created on a shop's first write so that
+-- scheduler jobs can page through shops instead of deduplicating stock_items rows.
+CREATE TABLE shops (
+    user_id TEXT PRIMARY KEY,
+    language TEXT, -- Last language the shopkeeper spoke in; NULL until a voice note is seen
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    status TEXT NOT NULL DEFAULT 'active' CHECK (status IN ('active', 'paused', 'closed')),
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Keyset pagination over active shops: WHERE status = 'active' AND user_id > $last ORDER BY user_id
+CREATE INDEX IF NOT EXISTS idx_shops_active ON shops (user_id) WHERE status = 'active';
+
+CREATE OR REPLACE FUNCTION register_shops_from_new_rows() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO shops (user_id)
+    SELECT DISTINCT n.user_id FROM new_rows n
+    ON CONFLICT (user_id) DO NOTHING;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER stock_items_register_shops
+    AFTER INSERT ON stock_items
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION register_shops_from_new_rows();
+
+CREATE TRIGGER transactions_register_shops
+    AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION register_shops_from_new_rows();
+
+-- One-time backfill for shops that already have data.
+INSERT INTO shops (user_id)
+SELECT user_id FROM stock_items
+UNION
+SELECT user_id FROM transactions
+ON CONFLICT (user_id) DO NOTHING;
+
+-- Later schema changes (hot-path indexes, monthly partitioning of transactions) are versioned
+-- in migrations/ and applied in order with `python migrate.py --check`.
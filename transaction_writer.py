@@ -0,0 +1,153 @@
+import asyncio
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# How long the writer waits for more rows after the first one arrives, and the largest batch it sends.
+COALESCE_WINDOW_MS = 5
+MAX_BATCH_ROWS = 500
+
+
+class CoalescingWriter:
+    """Per-process writer that coalesces rows from concurrent requests into multi-row inserts.
+
+    Each webhook request runs on its own event loop, so the writer lives on a dedicated
+    thread: callers enqueue rows and get back a Future. The thread waits up to
+    COALESCE_WINDOW_MS after the first queued row, then flushes everything collected as a
+    single insert through `flush_rows` and hands each caller the rows it submitted.
+    """
+
+    def __init__(self, flush_rows, name: str, coalesce_window_ms: float = COALESCE_WINDOW_MS, max_batch_rows: int = MAX_BATCH_ROWS):
+        self._flush_rows = flush_rows
+        self.name = name
+        self._coalesce_window = coalesce_window_ms / 1000
+        self._max_batch_rows = max_batch_rows
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._batch_sizes = []
+        self._flush_latencies = []
+        self._failed_flushes = 0
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, rows: list[dict]) -> Future:
+        """Queues rows for the next flush. The Future resolves to the inserted rows, in order."""
+        future = Future()
+        if not rows:
+            future.set_result([])
+            return future
+        self._ensure_started()
+        self._queue.put((list(rows), future, time.perf_counter()))
+        return future
+
+    async def write(self, rows: list[dict], durable: bool = True) -> list[dict]:
+        """Writes rows through the coalescing batch.
+
+        With durable=True the caller waits until its rows are committed and gets them back;
+        with durable=False it returns as soon as the rows are queued (failures are only logged).
+        """
+        future = self.submit(rows)
+        if durable:
+            return await asyncio.wrap_future(future)
+        future.add_done_callback(self._log_failure)
+        return []
+
+    def _log_failure(self, future: Future):
+        if future.exception() is not None:
+            print(f"ERROR_WRITER: {self.name} non-durable write failed: {future.exception()}")
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            pending = [first]
+            pending_rows = len(first[0])
+            deadline = time.perf_counter() + self._coalesce_window
+            stop_after_flush = False
+            while pending_rows < self._max_batch_rows:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    submission = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if submission is None:
+                    stop_after_flush = True
+                    break
+                pending.append(submission)
+                pending_rows += len(submission[0])
+            self._flush(pending)
+            if stop_after_flush:
+                return
+
+    def _flush(self, pending: list):
+        batch = [row for rows, _, _ in pending for row in rows]
+        started_at = time.perf_counter()
+        try:
+            inserted = self._flush_rows(batch)
+        except Exception as e:
+            # One bad submission must not fail everyone it was batched with: retry each on its own
+            print(f"ERROR_WRITER: {self.name} batch of {len(batch)} rows failed ({e}), retrying submissions individually.")
+            with self._metrics_lock:
+                self._failed_flushes += 1
+            for rows, future, _ in pending:
+                try:
+                    future.set_result(self._flush_rows(rows))
+                except Exception as individual_error:
+                    future.set_exception(individual_error)
+            return
+        flush_latency = time.perf_counter() - started_at
+
+        offset = 0
+        for rows, future, _ in pending:
+            future.set_result(inserted[offset:offset + len(rows)])
+            offset += len(rows)
+
+        with self._metrics_lock:
+            self._batch_sizes.append(len(batch))
+            self._flush_latencies.append(flush_latency)
+            # Keep the metric windows bounded
+            del self._batch_sizes[:-1000]
+            del self._flush_latencies[:-1000]
+        oldest_wait = started_at - min(queued_at for _, _, queued_at in pending)
+        print(f"DEBUG_WRITER: {self.name} flushed {len(batch)} rows from {len(pending)} submissions in {flush_latency * 1000:.1f} ms (oldest waited {oldest_wait * 1000:.1f} ms).")
+
+    def metrics(self) -> dict:
+        """Batch size and flush latency statistics over the last 1000 flushes."""
+        with self._metrics_lock:
+            batch_sizes = list(self._batch_sizes)
+            flush_latencies = sorted(self._flush_latencies)
+            failed_flushes = self._failed_flushes
+        if not batch_sizes:
+            return {"flushes": 0, "failed_flushes": failed_flushes}
+        return {
+            "flushes": len(batch_sizes),
+            "failed_flushes": failed_flushes,
+            "avg_batch_size": round(sum(batch_sizes) / len(batch_sizes), 2),
+            "max_batch_size": max(batch_sizes),
+            "flush_p50_ms": round(flush_latencies[len(flush_latencies) // 2] * 1000, 2),
+            "flush_p99_ms": round(flush_latencies[int(len(flush_latencies) * 0.99)] * 1000, 2),
+        }
+
+    def close(self, timeout: float = 5.0):
+        """Flushes anything still queued and stops the writer thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+
+def create_writer(flush_rows, name: str) -> CoalescingWriter:
+    """Creates a writer that is drained when the process exits, so queued non-durable rows are not dropped."""
+    writer = CoalescingWriter(flush_rows, name)
+    atexit.register(writer.close)
+    return writer
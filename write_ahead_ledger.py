@@ -0,0 +1,431 @@
+import asyncio
+import atexit
+import collections
+import fcntl
+import itertools
+import json
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+LEDGER_DIR = os.getenv("LEDGER_DIR", "ledger")  # One directory per process
+LEDGER_SEGMENT_BYTES = int(os.getenv("LEDGER_SEGMENT_BYTES", str(8 * 1024 * 1024)))  # Rotate segment files at this size
+# How long the appender waits for more entries before one fsync covers them all, and the largest group.
+LEDGER_FSYNC_WINDOW_MS = 2
+LEDGER_MAX_GROUP_ENTRIES = 500
+LEDGER_FLUSH_BATCH = 200  # Entries applied to the database per round trip
+LEDGER_MAX_ATTEMPTS = 5  # Rejections of one entry (not outages) before it is set aside in rejected.wal
+LEDGER_RETRY_MAX_SECONDS = 60.0
+
+_SEGMENT_FILE = re.compile(r"^segment-(\d{16})\.wal$")
+
+
+class WriteAheadLedger:
+    """Local append-only ledger in front of the database (write-behind).
+
+    `record` appends an entry and returns once it is fsynced, so a request is acknowledged
+    without waiting on the database. Appends from concurrent requests are grouped so one
+    fsync covers them all. A flusher thread then applies entries to the database in order
+    and in batches through `apply_entries`, checkpointing the last applied sequence number.
+    Entries are re-sent until checkpointed, after a crash too, so `apply_entries` must be
+    idempotent. Failures that `is_transient` recognises (outages, timeouts) are retried with
+    backoff indefinitely; an entry the database keeps rejecting is moved to rejected.wal.
+
+    Entries live in segment files named after their first sequence number; segments whose
+    entries have all been applied are deleted. `pending_entries` lets readers merge a user's
+    not yet applied entries over what they read from the database (read-your-writes).
+    """
+
+    def __init__(self, directory: str, apply_entries, is_transient, segment_bytes: int = LEDGER_SEGMENT_BYTES):
+        self.directory = directory
+        self._apply_entries = apply_entries
+        self._is_transient = is_transient
+        self.segment_bytes = segment_bytes
+        self._appends = queue.Queue()
+        self._pending = collections.deque()  # Fsynced entries not yet applied, in sequence order
+        self._pending_by_user = {}  # user_id -> their entries in self._pending, same order
+        self._applying = collections.Counter()  # user_id -> batches with their entries being applied right now
+        self._apply_generations = collections.Counter()  # user_id -> applies of their entries started or finished
+        self._cond = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._stopping = False
+        self._broken = None  # Set if a failed append could not be rolled back; appends then fail
+        self._lock_file = None
+        self._segment = None
+        self._segments = []  # (first_seq, path), oldest first; the last one is being appended to
+        self._next_seq = 1
+        self._applied_seq = 0
+        self._failed_seq = None
+        self._failed_attempts = 0
+        self._appender = None
+        self._flusher = None
+        self._metrics_lock = threading.Lock()
+        self._group_sizes = []
+        self._fsync_latencies = []
+        self._applied_entries = 0
+        self._rejected_entries = 0
+        self._apply_failures = 0
+        self._last_error = None
+
+    # --- Files ---
+
+    @staticmethod
+    def _encode(entry: dict) -> bytes:
+        payload = json.dumps(entry, separators=(",", ":"), default=str).encode("utf-8")
+        return b"%08x " % zlib.crc32(payload) + payload + b"\n"
+
+    @staticmethod
+    def _decode(line: bytes) -> dict | None:
+        """Parses one ledger line; None for a torn or corrupt line."""
+        if not line.endswith(b"\n") or len(line) < 10:
+            return None
+        checksum, payload = line[:8], line[9:-1]
+        try:
+            if int(checksum, 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
+
+    def _fsync_directory(self):
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(self._path("checkpoint.json"), encoding="utf-8") as checkpoint_file:
+                return int(json.load(checkpoint_file)["applied_seq"])
+        except FileNotFoundError:
+            return 0
+
+    def _write_checkpoint(self, applied_seq: int):
+        temporary_path = self._path("checkpoint.json.tmp")
+        with open(temporary_path, "w", encoding="utf-8") as checkpoint_file:
+            json.dump({"applied_seq": applied_seq}, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temporary_path, self._path("checkpoint.json"))
+
+    def _recover(self):
+        """Loads unapplied entries from existing segments, cutting off a torn write at the tail."""
+        self._applied_seq = self._read_checkpoint()
+        segment_files = sorted(file_name for file_name in os.listdir(self.directory) if _SEGMENT_FILE.match(file_name))
+        for file_name in segment_files:
+            path = self._path(file_name)
+            valid_bytes = 0
+            with open(path, "rb") as segment_file:
+                for line in segment_file:
+                    entry = self._decode(line)
+                    if entry is None:
+                        break
+                    valid_bytes += len(line)
+                    self._next_seq = max(self._next_seq, entry["seq"] + 1)
+                    if entry["seq"] > self._applied_seq:
+                        self._add_pending([entry])
+            if valid_bytes < os.path.getsize(path):
+                print(f"ERROR_LEDGER: Truncating {file_name} after {valid_bytes} bytes (torn or corrupt write).")
+                os.truncate(path, valid_bytes)
+            self._segments.append((int(_SEGMENT_FILE.match(file_name).group(1)), path))
+        self._next_seq = max(self._next_seq, self._applied_seq + 1)
+        if self._pending:
+            print(f"DEBUG_LEDGER: Recovered {len(self._pending)} unapplied entries from {self.directory}.")
+
+    def _open_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+        first_seq = self._next_seq
+        path = self._path(f"segment-{first_seq:016d}.wal")
+        self._segment = open(path, "ab")
+        self._fsync_directory()
+        if not self._segments or self._segments[-1][1] != path:
+            self._segments.append((first_seq, path))
+
+    def _delete_applied_segments(self):
+        # A closed segment is fully applied once the next segment starts at or before applied_seq + 1
+        while len(self._segments) > 1 and self._segments[1][0] <= self._applied_seq + 1:
+            _, path = self._segments.pop(0)
+            os.remove(path)
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Takes the directory lock, replays what the last run left behind and starts the threads."""
+        with self._start_lock:
+            if self._started:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._lock_file = open(self._path("LOCK"), "a")
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._lock_file.close()
+                raise RuntimeError(f"Ledger directory {self.directory} is in use by another process; give each process its own LEDGER_DIR")
+            self._recover()
+            self._open_segment()
+            self._appender = threading.Thread(target=self._run_appender, name="ledger-appender", daemon=True)
+            self._flusher = threading.Thread(target=self._run_flusher, name="ledger-flusher", daemon=True)
+            self._appender.start()
+            self._flusher.start()
+            self._started = True
+
+    def close(self, timeout: float = 5.0):
+        """Stops accepting entries and gives the flusher `timeout` seconds to drain; the rest stays on disk."""
+        if not self._started:
+            return
+        self._appends.put(None)
+        self._appender.join(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._flusher.join(timeout)
+        with self._cond:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            pending = len(self._pending)
+        if pending:
+            print(f"DEBUG_LEDGER: {pending} entries left in {self.directory} for the next start.")
+        self._lock_file.close()
+
+    # --- Appending ---
+
+    def append(self, entry: dict) -> Future:
+        """Queues an entry; the Future resolves to its sequence number once it is fsynced."""
+        self.start()
+        future = Future()
+        self._appends.put((dict(entry), future))
+        return future
+
+    async def record(self, entry: dict) -> int:
+        """Appends an entry and waits until it is durable on local disk."""
+        return await asyncio.wrap_future(self.append(entry))
+
+    def _run_appender(self):
+        while True:
+            first = self._appends.get()
+            if first is None:
+                return
+            group = [first]
+            deadline = time.perf_counter() + LEDGER_FSYNC_WINDOW_MS / 1000
+            stop_after_write = False
+            while len(group) < LEDGER_MAX_GROUP_ENTRIES:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    submission = self._appends.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if submission is None:
+                    stop_after_write = True
+                    break
+                group.append(submission)
+            self._write_group(group)
+            if stop_after_write:
+                return
+
+    def _write_group(self, group: list):
+        if self._broken is not None:
+            for _, future in group:
+                future.set_exception(self._broken)
+            return
+        started_at = time.perf_counter()
+        entries = []
+        for seq, (entry, _) in enumerate(group, start=self._next_seq):
+            entry["seq"] = seq
+            entries.append(entry)
+        offset = self._segment.tell()
+        try:
+            self._segment.write(b"".join(self._encode(entry) for entry in entries))
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+        except OSError as e:
+            print(f"ERROR_LEDGER: Append of {len(entries)} entries failed: {e}")
+            try:
+                # Callers are told these entries failed, so they must not be replayed later
+                self._segment.truncate(offset)
+                self._segment.seek(offset)
+                os.fsync(self._segment.fileno())
+            except OSError as truncate_error:
+                self._broken = truncate_error
+            for _, future in group:
+                future.set_exception(e)
+            return
+        self._next_seq += len(entries)
+        fsync_latency = time.perf_counter() - started_at
+
+        with self._cond:
+            self._add_pending(entries)
+            self._cond.notify_all()
+        for entry, (_, future) in zip(entries, group):
+            future.set_result(entry["seq"])
+
+        with self._metrics_lock:
+            self._group_sizes.append(len(entries))
+            self._fsync_latencies.append(fsync_latency)
+            # Keep the metric windows bounded
+            del self._group_sizes[:-1000]
+            del self._fsync_latencies[:-1000]
+        if self._segment.tell() >= self.segment_bytes:
+            self._open_segment()
+
+    # --- Draining ---
+
+    def _run_flusher(self):
+        retry_delay = 0.0
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch = list(itertools.islice(self._pending, LEDGER_FLUSH_BATCH))
+            try:
+                self._apply(batch)
+                retry_delay = 0.0
+            except Exception as e:
+                with self._metrics_lock:
+                    self._apply_failures += 1
+                    self._last_error = str(e)
+                retry_delay = min(max(retry_delay * 2, 0.5), LEDGER_RETRY_MAX_SECONDS)
+                print(f"ERROR_LEDGER: Applying {len(batch)} entries failed ({e}), retrying in {retry_delay:.1f} s.")
+                with self._cond:
+                    if self._stopping:
+                        return
+                    self._cond.wait(retry_delay)
+
+    def _apply(self, batch: list[dict]):
+        try:
+            self._apply_and_mark(batch)
+            return
+        except Exception as e:
+            if self._is_transient(e):
+                raise
+            if len(batch) == 1:
+                if self._apply_one_failed(batch[0], e):
+                    return
+                raise
+            print(f"ERROR_LEDGER: Batch of {len(batch)} entries rejected ({e}), applying them one by one.")
+        for entry in batch:
+            try:
+                self._apply_and_mark([entry])
+            except Exception as e:
+                if self._apply_one_failed(entry, e):
+                    continue
+                raise
+
+    def _apply_and_mark(self, entries: list[dict]):
+        """Applies entries and marks them applied, bumping their users' apply generation before and after (see `pending_entries`)."""
+        user_ids = {entry.get("user_id") for entry in entries}
+        self._track_apply(user_ids, 1)
+        try:
+            self._apply_entries(entries)
+            self._mark_applied(entries)
+        finally:
+            self._track_apply(user_ids, -1)
+
+    def _track_apply(self, user_ids: set, step: int):
+        with self._cond:
+            for user_id in user_ids:
+                self._applying[user_id] += step
+                if not self._applying[user_id]:
+                    del self._applying[user_id]
+                self._apply_generations[user_id] += 1
+
+    def _apply_one_failed(self, entry: dict, error: Exception) -> bool:
+        """Counts a rejection of `entry`; sets it aside (returning True) once it has been rejected too often."""
+        if self._is_transient(error):
+            return False
+        if self._failed_seq != entry["seq"]:
+            self._failed_seq, self._failed_attempts = entry["seq"], 0
+        self._failed_attempts += 1
+        if self._failed_attempts < LEDGER_MAX_ATTEMPTS:
+            return False
+        with open(self._path("rejected.wal"), "ab") as rejected_file:
+            rejected_file.write(self._encode({**entry, "error": str(error)}))
+            rejected_file.flush()
+            os.fsync(rejected_file.fileno())
+        print(f"ERROR_LEDGER: Entry {entry['seq']} for {entry.get('user_id')} rejected {self._failed_attempts} times ({error}); moved to rejected.wal.")
+        with self._metrics_lock:
+            self._rejected_entries += 1
+        self._mark_applied([entry])
+        return True
+
+    def _add_pending(self, entries: list[dict]):
+        for entry in entries:
+            self._pending.append(entry)
+            self._pending_by_user.setdefault(entry.get("user_id"), collections.deque()).append(entry)
+
+    def _mark_applied(self, entries: list[dict]):
+        with self._cond:
+            for _ in entries:
+                entry = self._pending.popleft()
+                user_entries = self._pending_by_user[entry.get("user_id")]
+                user_entries.popleft()
+                if not user_entries:
+                    del self._pending_by_user[entry.get("user_id")]
+            self._applied_seq = entries[-1]["seq"]
+            self._write_checkpoint(self._applied_seq)
+            self._delete_applied_segments()
+        with self._metrics_lock:
+            self._applied_entries += len(entries)
+
+    def apply_generation(self, user_id: str) -> int | None:
+        """Counter bumped whenever an apply of the user's entries starts or finishes; None while one is running."""
+        with self._cond:
+            return None if self._applying[user_id] else self._apply_generations[user_id]
+
+    def pending_entries(self, user_id: str) -> tuple[int | None, list[dict]]:
+        """The user's entries not yet applied, oldest first, with `apply_generation` taken at the same moment.
+
+        A reader merging these over a database read is consistent if the generation was the
+        same (and not None) before the read: no entry of the user was applied in between.
+        """
+        with self._cond:
+            generation = None if self._applying[user_id] else self._apply_generations[user_id]
+            return generation, list(self._pending_by_user.get(user_id, ()))
+
+    def metrics(self) -> dict:
+        """Backlog size and age, fsync grouping and apply statistics."""
+        with self._cond:
+            pending = len(self._pending)
+            oldest_recorded_at = self._pending[0].get("recorded_at") if self._pending else None
+            segments = len(self._segments)
+        with self._metrics_lock:
+            group_sizes = list(self._group_sizes)
+            fsync_latencies = sorted(self._fsync_latencies)
+            metrics = {
+                "pending_entries": pending,
+                "oldest_pending_age_s": round(time.time() - oldest_recorded_at, 2) if oldest_recorded_at else 0.0,
+                "segments": segments,
+                "applied_entries": self._applied_entries,
+                "rejected_entries": self._rejected_entries,
+                "apply_failures": self._apply_failures,
+                "last_error": self._last_error,
+            }
+        if group_sizes:
+            metrics.update({
+                "fsyncs": len(group_sizes),
+                "avg_entries_per_fsync": round(sum(group_sizes) / len(group_sizes), 2),
+                "fsync_p50_ms": round(fsync_latencies[len(fsync_latencies) // 2] * 1000, 2),
+                "fsync_p99_ms": round(fsync_latencies[int(len(fsync_latencies) * 0.99)] * 1000, 2),
+            })
+        return metrics
+
+
+def create_ledger(apply_entries, is_transient, directory: str = LEDGER_DIR) -> WriteAheadLedger:
+    """Creates the process-wide ledger. It starts on first use and is drained when the process exits."""
+    ledger = WriteAheadLedger(directory, apply_entries, is_transient)
+    atexit.register(ledger.close)
+    return ledger